@@ -19,6 +19,7 @@ from scipy.optimize import curve_fit
 
 from legacyhalos.desiutil import brickname as get_brickname
 import legacyhalos.io
+import legacyhalos.telemetry
 
 ZCOLUMN = 'Z'
 RACOLUMN = 'GROUP_RA'
@@ -151,6 +152,7 @@ def mpi_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--nproc', default=1, type=int, help='number of multiprocessing processes per MPI rank.')
     parser.add_argument('--mpi', action='store_true', help='Use MPI parallelism')
+    parser.add_argument('--local-workers', default=1, type=int, help='Without --mpi, number of local worker processes (each using --nproc cores).')
 
     parser.add_argument('--first', type=int, help='Index of first object to process.')
     parser.add_argument('--last', type=int, help='Index of last object to process.')
@@ -183,6 +185,19 @@ def mpi_args():
     parser.add_argument('--no-cleanup', action='store_false', dest='cleanup', help='Do not clean up legacypipe files after coadds.')
     parser.add_argument('--ccdqa', action='store_true', help='Build the CCD-level diagnostics.')
 
+    parser.add_argument('--timeout', default=None, type=float, help='Wall-clock budget per galaxy (minutes) for --coadds and --ellipse.')
+    parser.add_argument('--retries', default=1, type=int, help='Number of degraded-mode retries after a galaxy exceeds --timeout.')
+    parser.add_argument('--mem-budget', default=None, type=float, help='Memory budget per node (GB) shared by all ranks for --ellipse, --htmlplots, and --remake-cogqa.')
+    parser.add_argument('--inprocess', action='store_true', help='Run runbrick in-process (with a survey object reused by all the galaxies on a rank) for --coadds and --pipeline-coadds.')
+    parser.add_argument('--reuse-coadds', default=None, type=str, metavar='REGISTRY_DIR', help='Directory of the registry of built mosaics; cut out mosaics which are contained in an existing one (with the same settings) instead of rerunning runbrick with --coadds and --pipeline-coadds.')
+    parser.add_argument('--compression', default='runbrick', type=str, metavar='PROFILE', help='Output compression profile of the image, model, and invvar mosaics built with --coadds and --pipeline-coadds: runbrick, lossless, rice[:QLEVEL], or float32 (see legacyhalos.compression).')
+    parser.add_argument('--psf-cache-dir', default=None, type=str, help='Directory of the on-disk cache of the unWISE and GALEX PSF stamps (shared by all ranks) for --coadds.')
+    parser.add_argument('--pyramid', default=None, type=int, metavar='WIDTH', help='Use the multi-resolution (2x/4x/8x block-averaged) mode of --ellipse for mosaics at least WIDTH pixels wide.')
+    parser.add_argument('--mge-roi', default=None, type=float, metavar='FACTOR', help='With --ellipse, only measure the geometry of each central within a window of FACTOR times max(D25/2, r_half).')
+    parser.add_argument('--mge-median', default='medfilt', choices=['medfilt', 'separable'], help='Median filter used to measure the geometry of each central with --ellipse.')
+    parser.add_argument('--mge-downsample', default=1, type=int, help='Find the central blob on a block-averaged image downsampled by this factor with --ellipse.')
+    parser.add_argument('--maskcache', action='store_true', help='Write (or reuse) the geometry and masks of the centrals in a sidecar file with --ellipse, so --htmlplots does not measure them again.')
+
     parser.add_argument('--force', action='store_true', help='Use with --coadds; ignore previous pickle files.')
     parser.add_argument('--count', action='store_true', help='Count how many objects are left to analyze and then return.')
     parser.add_argument('--debug', action='store_true', help='Log to STDOUT and build debugging plots.')
@@ -195,172 +210,29 @@ def mpi_args():
 
     return args
 
-def missing_files(args, sample, size=1, clobber_overwrite=None):
-    from glob import glob
-    import multiprocessing
-    from legacyhalos.io import _missing_files_one
-
-    dependson = None
-    if args.htmlplots is False and args.htmlindex is False:
-        if args.verbose:
-            t0 = time.time()
-            print('Getting galaxy names and directories...', end='')
-        galaxy, galaxydir = get_galaxy_galaxydir(sample)
-        if args.verbose:
-            print('...took {:.3f} sec'.format(time.time() - t0))
-
-    use_glob = False
-    if args.coadds:
-        suffix = 'coadds'
-        filesuffix = '-largegalaxy-coadds.isdone'
-    elif args.pipeline_coadds:
-        suffix = 'pipeline-coadds'
-        if args.just_coadds:
-            filesuffix = '-pipeline-image-grz.jpg'
-        else:
-            filesuffix = '-pipeline-coadds.isdone'
-    elif args.ellipse:
-        suffix = 'ellipse'
-        filesuffix = '-largegalaxy-ellipse.isdone'
-        dependson = '-largegalaxy-coadds.isdone'
-    elif args.build_SGA:
-        suffix = 'build-SGA'
-        filesuffix = '-largegalaxy-SGA.isdone'
-        dependson = '-largegalaxy-ellipse.isdone'
-    elif args.htmlplots:
-        suffix = 'html'
-        if args.just_coadds:
-            filesuffix = '-largegalaxy-grz-montage.png'
-        else:
-            filesuffix = '-largegalaxy-grz-montage.png'
-            #filesuffix = '-largegalaxy-coadds.isdone'
-            #filesuffix = '-ccdpos.png'
-            #filesuffix = '-largegalaxy-maskbits.png'
-            #dependson = '-largegalaxy-ellipse.isdone'
-            #dependson = '-largegalaxy-coadds.isdone'
-            dependson = '-largegalaxy-image-grz.jpg'
-            #LeoA-largegalaxy-resid-grz.jpg
-            #dependson = None
-
-            ## ##########
-            ## hack!
-            #use_glob = True
-            #dependson = '-ellipse.fits'
-            #filesuffix = '-ellipse-sbprofile.png'
-            #galaxy_id = [str(galid) for galid in sample['SGA_ID']]
-            ## ##########
-            
-        galaxy, dependsondir, galaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
-        #galaxy, galaxydir, htmlgalaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
-    elif args.htmlindex:
-        suffix = 'htmlindex'
-        filesuffix = '-largegalaxy-grz-montage.png'
-        galaxy, _, galaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
-        #galaxy, galaxydir, htmlgalaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
-    elif args.remake_cogqa:
-        suffix = 'remake_cogqa'
-        use_glob = True
-        dependson = '-ellipse.fits'
-        filesuffix = '-ellipse-cog.png'
-        galaxy, dependsondir, galaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
-        galaxy_id = [str(galid) for galid in sample['SGA_ID']]
-    else:
-        raise ValueError('Need at least one keyword argument.')
-
-    # Make clobber=False for build_SGA and htmlindex because we're not making
-    # the files here, we're just looking for them. The argument args.clobber
-    # gets used downstream.
-    if args.htmlindex:
-        clobber = False
-    elif args.build_SGA:
-        clobber = True
-    else:
-        clobber = args.clobber
-
-    if clobber_overwrite is not None:
-        clobber = clobber_overwrite
-
-    if type(sample) is astropy.table.row.Row:
-        ngal = 1
-    else:
-        ngal = len(sample)
-    indices = np.arange(ngal)
-
-    missargs = []
-    #if args.htmlplots:
-    #    for gal, gdir, ddir in zip(np.atleast_1d(galaxy), np.atleast_1d(galaxydir), np.atleast_1d(dependsondir)):
-    #        checkfile = os.path.join(gdir, '{}{}'.format(gal, filesuffix))
-    #        missargs.append([checkfile, os.path.join(ddir, '{}{}'.format(gal, dependson)), clobber])
-    #else:
-    for igal, (gal, gdir) in enumerate(zip(np.atleast_1d(galaxy), np.atleast_1d(galaxydir))):
-        #missargs.append([gal, gdir, filesuffix, dependson, clobber])
-        if use_glob:
-            checkfile = os.path.join(gdir, '{}-largegalaxy-{}{}'.format(gal, galaxy_id[igal], filesuffix))
-            #checkfile = glob(os.path.join(gdir, '{}-*{}'.format(gal, filesuffix)))
-            #if len(checkfile) > 0:
-            #    checkfile = checkfile[0]
-            #else:
-            #    checkfile = 'null'
-            #print(checkfile)
-        else:
-            checkfile = os.path.join(gdir, '{}{}'.format(gal, filesuffix))
-        if dependson:
-            if use_glob:
-                missargs.append([checkfile, os.path.join(np.atleast_1d(dependsondir)[igal], '{}-largegalaxy-{}{}'.format(
-                    gal, galaxy_id[igal], dependson)), clobber])
-            else:
-                missargs.append([checkfile, os.path.join(np.atleast_1d(dependsondir)[igal], '{}{}'.format(gal, dependson)), clobber])
-        else:
-            missargs.append([checkfile, None, clobber])
-
-    if args.verbose:
-        t0 = time.time()
-        print('Finding missing files...', end='')
-    if args.nproc > 1:
-        with multiprocessing.Pool(args.nproc) as P:
-            todo = np.array(P.map(_missing_files_one, missargs))
-    else:
-        todo = np.array([_missing_files_one(_missargs) for _missargs in missargs])
-        
-    # hack
-    #todo = np.repeat('todo', len(galaxy))
-    if args.verbose:
-        print('...took {:.3f} min'.format((time.time() - t0)/60))
-
-    itodo = np.where(todo == 'todo')[0]
-    idone = np.where(todo == 'done')[0]
-    ifail = np.where(todo == 'fail')[0]
-
-    if len(ifail) > 0:
-        fail_indices = [indices[ifail]]
-    else:
-        fail_indices = [np.array([])]
-
-    if len(idone) > 0:
-        done_indices = [indices[idone]]
-    else:
-        done_indices = [np.array([])]
-
-    if len(itodo) > 0:
-        _todo_indices = indices[itodo]
-
-        # Assign the sample to ranks to make the D25 distribution per rank ~flat.
+# Filename templates of the files which mark each stage as complete (and of the
+# files each stage depends on); see legacyhalos.mpi.missing_files_plan.
+STAGE_TEMPLATES = [
+    ('coadds', {'suffix': 'coadds', 'filesuffix': '{galaxy}-largegalaxy-coadds.isdone'}),
+    ('pipeline_coadds', {'suffix': 'pipeline-coadds', 'filesuffix': '{galaxy}-pipeline-coadds.isdone',
+                         'just_coadds': {'filesuffix': '{galaxy}-pipeline-image-grz.jpg'}}),
+    ('ellipse', {'suffix': 'ellipse', 'filesuffix': '{galaxy}-largegalaxy-ellipse.isdone',
+                 'dependson': '{galaxy}-largegalaxy-coadds.isdone'}),
+    ('build_SGA', {'suffix': 'build-SGA', 'filesuffix': '{galaxy}-largegalaxy-SGA.isdone',
+                   'dependson': '{galaxy}-largegalaxy-ellipse.isdone', 'clobber': True}),
+    ('htmlplots', {'suffix': 'html', 'filesuffix': '{galaxy}-largegalaxy-grz-montage.png',
+                   'dependson': '{galaxy}-largegalaxy-image-grz.jpg', 'html': True,
+                   'just_coadds': {'dependson': None}}),
+    ('htmlindex', {'suffix': 'htmlindex', 'filesuffix': '{galaxy}-largegalaxy-grz-montage.png',
+                   'html': True, 'clobber': False}),
+    ('remake_cogqa', {'suffix': 'remake_cogqa', 'filesuffix': '{galaxy}-largegalaxy-{SGA_ID}-ellipse-cog.png',
+                      'dependson': '{galaxy}-largegalaxy-{SGA_ID}-ellipse.fits', 'html': True}),
+    ]
 
-        # https://stackoverflow.com/questions/33555496/split-array-into-equally-weighted-chunks-based-on-order
-        weight = np.atleast_1d(sample[DIAMCOLUMN])[_todo_indices]
-        cumuweight = weight.cumsum() / weight.sum()
-        idx = np.searchsorted(cumuweight, np.linspace(0, 1, size, endpoint=False)[1:])
-        if len(idx) < size: # can happen in corner cases or with 1 rank
-            todo_indices = np.array_split(_todo_indices, size) # unweighted
-        else:
-            todo_indices = np.array_split(_todo_indices, idx) # weighted
-        for ii in range(size): # sort by weight
-            srt = np.argsort(sample[DIAMCOLUMN][todo_indices[ii]])
-            todo_indices[ii] = todo_indices[ii][srt]
-    else:
-        todo_indices = [np.array([])]
-
-    return suffix, todo_indices, done_indices, fail_indices
+def missing_files(args, sample, size=1, clobber_overwrite=None):
+    from legacyhalos.mpi import missing_files_plan
+    return missing_files_plan(args, sample, STAGE_TEMPLATES, get_galaxy_galaxydir, size=size,
+                              clobber_overwrite=clobber_overwrite, weightcolumn=DIAMCOLUMN)
     
 def get_raslice(ra):
     return '{:06d}'.format(int(ra*1000))[:3]
@@ -1004,7 +876,7 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', seed=1, verbose=False
     from astrometry.util.util import Tan
     from tractor.ellipses import EllipseE # EllipseESoft
     from legacyhalos.io import read_ellipsefit, get_run
-    from legacyhalos.misc import is_in_ellipse
+    from legacyhalos.misc import EllipseProximityIndex
     #from legacyhalos.ellipse import SBTHRESH as sbcuts
 
     onegal = Table(onegal)
@@ -1073,32 +945,21 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', seed=1, verbose=False
             return None, onegal
         assert('G2' not in set(tractor['REF_CAT']))
 
-    def _check_grz(galaxydir, galaxy, radec=None, just_ivar=False):
-        grzmissing, box = False, 2
-        for band in ['g', 'r', 'z']:
-            imfile = os.path.join(galaxydir, '{}-largegalaxy-image-{}.fits.fz'.format(galaxy, band))
-            ivarfile = os.path.join(galaxydir, '{}-largegalaxy-invvar-{}.fits.fz'.format(galaxy, band))
-            wcs = Tan(imfile, 1)
-            img = fitsio.read(imfile)
-            ivar = fitsio.read(ivarfile)
-            H, W = img.shape
-            if radec is not None:
-                _, xcen, ycen = wcs.radec2pixelxy(radec[0], radec[1])
-                ycen, xcen = np.int(ycen-1), np.int(xcen-1)
-            else:
-                ycen, xcen = H//2, W//2
-            #print(band, img[ycen-box:ycen+box, xcen-box:xcen+box],
-            #      ivar[ycen-box:ycen+box, xcen-box:xcen+box])
-            if just_ivar:
-                if np.all(ivar[ycen-box:ycen+box, xcen-box:xcen+box] == 0):
-                    grzmissing = True
-                    break
-            else:
-                if (np.all(img[ycen-box:ycen+box, xcen-box:xcen+box] == 0) and
-                    np.all(ivar[ycen-box:ycen+box, xcen-box:xcen+box] == 0)):
-                    grzmissing = True
-                    break
-        return grzmissing
+    coverage = {}
+    def _check_grz(galaxydir, galaxy, igal=None, just_ivar=False):
+        # The (cached) coverage map is read at most once per group, and the
+        # positions of all the galaxies in the group are checked at once.
+        from legacyhalos.coverage import get_coverage_map
+        if 'map' not in coverage:
+            coverage['map'] = get_coverage_map(galaxy, galaxydir, filesuffix='largegalaxy')
+        if igal is None:
+            return coverage['map'].grz_missing(just_ivar=just_ivar)
+        kind = 'ivar' if just_ivar else 'data'
+        if kind not in coverage:
+            coverage[kind] = coverage['map'].grz_missing(np.atleast_1d(fullsample['RA']),
+                                                         np.atleast_1d(fullsample['DEC']),
+                                                         just_ivar=just_ivar)
+        return coverage[kind][igal]
 
     # Make sure we have at least one SGA in this field; if not, it means the
     # galaxy is spurious (or *all* the galaxies, in the case of a galaxy group
@@ -1222,6 +1083,9 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', seed=1, verbose=False
     isdonefile = os.path.join(isdonedir, '{}-largegalaxy-ellipse.isdone'.format(galaxy))
     isfailfile = os.path.join(isdonedir, '{}-largegalaxy-ellipse.isfail'.format(galaxy))
 
+    # Spatial index of the Tractor sources for the ellipse-of-influence tests.
+    srcindex = EllipseProximityIndex(tractor['RA'], tractor['DEC'])
+
     dropcat = []
     for igal, sga_id in enumerate(np.atleast_1d(fullsample['SGA_ID'])):
         ellipsefile = os.path.join(galaxydir, '{}-largegalaxy-{}-ellipse.fits'.format(galaxy, sga_id))
@@ -1255,7 +1119,7 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', seed=1, verbose=False
                     print('M33 hack---need coadds!')
                     grzmissing = False
                 else:
-                    grzmissing = _check_grz(galaxydir, galaxy, radec=(thisgal['RA'], thisgal['DEC']))
+                    grzmissing = _check_grz(galaxydir, galaxy, igal=igal)
                 if grzmissing:
                     print('Missing grz coverage for galaxy {} in the field of {} (SGA_ID={})'.format(
                         fullsample['GALAXY'][igal], galaxy, onegal['SGA_ID'][0]), flush=True)
@@ -1300,14 +1164,14 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', seed=1, verbose=False
                     # In some corner cases we can end up as PSF or with negative
                     # r-band flux because of missing grz coverage right at the
                     # center of the galaxy, e.g., PGC046314.
-                    grzmissing = _check_grz(galaxydir, galaxy, radec=(thisgal['RA'], thisgal['DEC']))
+                    grzmissing = _check_grz(galaxydir, galaxy, igal=igal)
                     if grzmissing:
                         print('Missing grz coverage in the field of {} (SGA_ID={})'.format(galaxy, onegal['SGA_ID'][0]), flush=True)
                         thisgal['DROPBIT'] |= DROPBITS['nogrz']
                         dropcat.append(thisgal)
                     else:
                         # check for fully mask (e.g. bleed trail)--
-                        if _check_grz(galaxydir, galaxy, radec=(thisgal['RA'], thisgal['DEC']), just_ivar=True):
+                        if _check_grz(galaxydir, galaxy, igal=igal, just_ivar=True):
                             print('Masked galaxy in the field of {} (SGA_ID={})'.format(galaxy, onegal['SGA_ID'][0]), flush=True)
                             thisgal['DROPBIT'] |= DROPBITS['masked']
                             dropcat.append(thisgal)
@@ -1434,7 +1298,7 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', seed=1, verbose=False
             # axis (i.e., radius) in arcsec.
             reff, e1, e2 = EllipseE.fromRAbPhi(diam*60/2, ba, 180-pa) # note the 180 rotation
             #try:
-            inellipse = np.where(is_in_ellipse(tractor['RA'], tractor['DEC'], ragal, decgal, reff, e1, e2))[0]
+            inellipse = srcindex.in_ellipse(ragal, decgal, reff, e1, e2)
             #except:
             #    print('!!!!!!!!!!!!!!!!!!!!!', onegal['GROUP_NAME'])
 
@@ -1765,23 +1629,116 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', seed=1, verbose=False
 
     return tractor, dropcat
 
+def _pack_central_image(data, filt, model_nocentral, mask, filt2pixscale,
+                        filt2var, fill_value=0.0):
+    """Append the model-subtracted, masked image (in surface brightness) and the
+    variance image of one central in one band to data.
+
+    """
+    import numpy.ma as ma
+
+    thispixscale = filt2pixscale[filt]
+    imagekey, varkey = '{}_masked'.format(filt), '{}_var'.format(filt)
+    if imagekey not in data.keys():
+        data[imagekey], data[varkey] = [], []
+
+    # Convert to surface brightness and 32-bit precision.
+    img = (ma.getdata(data[filt]) - model_nocentral) / thispixscale**2 # [nanomaggies/arcsec**2]
+    img = ma.masked_array(img.astype('f4'), mask)
+    # The variance image is the same for every central, so share it.
+    if filt not in filt2var:
+        filt2var[filt] = data['{}_var_'.format(filt)] / thispixscale**4 # [nanomaggies**2/arcsec**4]
+    var = filt2var[filt]
+
+    # Fill with zeros, for fun--
+    ma.set_fill_value(img, fill_value)
+    #img.filled(fill_value)
+    data[imagekey].append(img)
+    data[varkey].append(var)
+
+def _central_model_renderer(data, tractor, render_once=True, maskcache=None):
+    """Return a function model_nocentral(band, central) which renders the model
+    image of every Tractor source except the central, on the refband WCS and
+    PSF (see _build_multiband_mask).
+
+    maskcache - if a dictionary (and render_once=True), add the full model image
+      of each band and the (clipped) model patch of each central to it, so
+      _cached_model_renderer can rebuild the same images without rendering.
+
+    """
+    from legacyhalos.misc import srcs2image, SourceModelCache
+
+    refband = data['refband']
+    if render_once:
+        modelcache = SourceModelCache(tractor, data['{}_wcs'.format(refband)],
+                                      pixelized_psf=data['{}_psf'.format(refband)])
+
+    def _model_nocentral(band, central):
+        if render_once:
+            band = band.lower()
+            if maskcache is not None:
+                maskcache['model_{}'.format(band)] = modelcache.model(band)
+                y0, x0, cutout = modelcache.patch(band, central)
+                maskcache['patch_{}_{}'.format(central, band)] = cutout
+                maskcache['patchyx_{}_{}'.format(central, band)] = np.array([y0, x0])
+            return modelcache.model_without(band, central)
+        nocentral = np.delete(np.arange(len(tractor)), central)
+        srcs = tractor.copy()
+        srcs.cut(nocentral)
+        return srcs2image(srcs, data['{}_wcs'.format(refband)], band=band.lower(),
+                          pixelized_psf=data['{}_psf'.format(refband)])
+
+    return _model_nocentral
+
+def _cached_model_renderer(maskcache):
+    """Same as _central_model_renderer, but from the model images and patches it
+    stored in maskcache (i.e., without rendering any source).
+
+    """
+    def _model_nocentral(band, central):
+        band = band.lower()
+        model = maskcache['model_{}'.format(band)].copy()
+        y0, x0 = maskcache['patchyx_{}_{}'.format(central, band)]
+        cutout = maskcache['patch_{}_{}'.format(central, band)]
+        model[y0:y0+cutout.shape[0], x0:x0+cutout.shape[1]] -= cutout
+        return model
+
+    return _model_nocentral
+
 def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
-                          verbose=False):
+                          render_once=True, mge_roi=None, mge_median='medfilt',
+                          mge_downsample=1, maskcache=None, verbose=False):
     """Wrapper to prepare the data for the SGA / large-galaxy project.
 
+    render_once - render each Tractor source only once per band (see
+      legacyhalos.misc.SourceModelCache) rather than re-rendering the whole
+      catalog for every central.
+    mge_roi - if not None, only run find_galaxy within a window of half-width
+      mge_roi times the larger of the D(25)/2 and Tractor half-light radius of
+      each central (see the roi keyword of legacyhalos.mge.find_galaxy).
+    mge_median, mge_downsample - median filter and downsampling factor of the
+      blob finding in find_galaxy (see the median and downsample keywords of
+      legacyhalos.mge.find_galaxy).
+    maskcache - if a dictionary (and render_once=True), fill it with what
+      _apply_maskcache needs to rebuild the masked images without re-measuring
+      the geometry or re-rendering the models: the geometry and the bit-packed
+      mask of each central in each band, plus one model image per band and the
+      model patch of each central (see _central_model_renderer).
+
     """
     import numpy.ma as ma
     from legacyhalos.mge import find_galaxy
-    from legacyhalos.misc import srcs2image, ellipse_mask
+    from legacyhalos.misc import ellipse_mask_bbox, ellipse_masks, ellipse_max_shrink
 
     bands, refband = data['bands'], data['refband']
-    residual_mask = data['residual_mask']
 
     nbox = 5
     box = np.arange(nbox)-nbox // 2
     #box = np.meshgrid(np.arange(nbox), np.arange(nbox))[0]-nbox//2
 
-    xobj, yobj = np.ogrid[0:data['refband_height'], 0:data['refband_width']]
+    # Only the bounding box of each ellipse is rasterized (see
+    # legacyhalos.misc.ellipse_mask_bbox).
+    shape = (data['refband_height'], data['refband_width'])
 
     # If the row-index of the central galaxy is not provided, use the source
     # nearest to the center of the field.
@@ -1792,9 +1749,13 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
 
     #print('Import hack!')
     #import matplotlib.pyplot as plt ; from astropy.visualization import simple_norm
+
+    # Note that all the models are rendered on the refband WCS and PSF.
+    _model_nocentral = _central_model_renderer(data, tractor, render_once=render_once,
+                                               maskcache=maskcache)
     
     # Now, loop through each 'galaxy_indx' from bright to faint.
-    data['mge'] = []
+    data['mge'], filt2var = [], {}
     for ii, central in enumerate(galaxy_indx):
         if verbose:
             print('Building masked image for central {}/{}.'.format(ii+1, len(galaxy_indx)))
@@ -1802,35 +1763,39 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         # Build the model image (of every object except the central)
         # on-the-fly. Need to be smarter about Tractor sources of resolved
         # structure (i.e., sources that "belong" to the central).
-        nocentral = np.delete(np.arange(len(tractor)), central)
-        srcs = tractor.copy()
-        srcs.cut(nocentral)
-        model_nocentral = srcs2image(srcs, data['{}_wcs'.format(refband)], band=refband.lower(),
-                                     pixelized_psf=data['{}_psf'.format(refband)])
+        with legacyhalos.telemetry.timer('render'):
+            model_nocentral = _model_nocentral(refband, central)
 
         # Mask all previous (brighter) central galaxies, if any.
-        img, newmask = ma.getdata(data[refband]) - model_nocentral, ma.getmask(data[refband])
+        img, newmask = ma.getdata(data[refband]) - model_nocentral, legacyhalos.io.band_mask(data, refband)
+        prevgeo = []
+
+        # Pixels of the 5x5 box around the center of the current galaxy (with
+        # Python's wrap-around for negative indices, as when indexing a mask).
+        boxrows, boxcols = np.meshgrid((box + tractor.by[central]).astype(int),
+                                       (box + tractor.bx[central]).astype(int))
+        boxrows, boxcols = boxrows.ravel(), boxcols.ravel()
+        boxrows[boxrows < 0] += shape[0]
+        boxcols[boxcols < 0] += shape[1]
+        
         for jj in np.arange(ii):
             geo = data['mge'][jj] # the previous galaxy
 
-            # Do this step iteratively to capture the possibility where the
-            # previous galaxy has masked the central pixels of the *current*
-            # galaxy, in each iteration reducing the size of the mask.
-            for shrink in np.arange(0.1, 1.05, 0.05)[::-1]:
-                maxis = shrink * geo['majoraxis']
-                _mask = ellipse_mask(geo['xmed'], geo['ymed'], maxis, maxis * (1-geo['eps']),
-                                     np.radians(geo['theta']-90), xobj, yobj)
-                notok = False
-                for xb in box:
-                    for yb in box:
-                        if _mask[int(yb+tractor.by[central]), int(xb+tractor.bx[central])]:
-                            notok = True
-                            break
-                if notok:
-                #if _mask[int(tractor.by[central]), int(tractor.bx[central])]:
-                    print('The previous central has masked the current central with shrink factor {:.2f}'.format(shrink))
-                else:
-                    break
+            # Shrink the mask of the previous galaxy until it no longer covers
+            # the central pixels of the *current* galaxy. Rather than
+            # rasterizing the ellipse at each shrink factor, test the 5x5 box of
+            # central pixels directly for all the factors at once.
+            shrink, rejected = ellipse_max_shrink(geo['xmed'], geo['ymed'], geo['majoraxis'], geo['eps'],
+                                                  np.radians(geo['theta']-90), boxrows, boxcols)
+            for _shrink in rejected:
+                print('The previous central has masked the current central with shrink factor {:.2f}'.format(_shrink))
+            maxis = shrink * geo['majoraxis']
+            prevgeo.append((geo['xmed'], geo['ymed'], maxis, maxis * (1-geo['eps']),
+                            np.radians(geo['theta']-90)))
+
+        # Paint all the (shrunken) previous centrals in a single pass.
+        if len(prevgeo) > 0:
+            _mask = ellipse_masks(*[np.array(par) for par in zip(*prevgeo)], shape)
             newmask = ma.mask_or(_mask, newmask)
 
         # Next, get the basic galaxy geometry and pack it into a dictionary. If
@@ -1871,12 +1836,19 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             maxis = 1.5 * tractor.shape_r[central] / filt2pixscale[refband] # [pixels]
             theta = (270 - pa) % 180
                 
-            fixmask = ellipse_mask(xmed, ymed, maxis, maxis*ba, np.radians(theta-90), xobj, yobj)
+            fixmask = ellipse_mask_bbox(xmed, ymed, maxis, maxis*ba, np.radians(theta-90), shape)
             newmask[fixmask] = ma.nomask
         
+        if mge_roi is None:
+            roi = None
+        else:
+            radius = mge_roi * np.max((tractor.d25_leda[central] * 60 / 2, tractor.shape_r[central]))
+            roi = (tractor.by[central], tractor.bx[central], radius / filt2pixscale[refband])
+
         #import matplotlib.pyplot as plt ; plt.clf()
         mgegalaxy = find_galaxy(ma.masked_array(img/filt2pixscale[refband]**2, newmask), 
-                                nblob=1, binning=3, level=minsb)#, plot=True)#, quiet=not verbose
+                                nblob=1, binning=3, level=minsb, roi=roi, median=mge_median,
+                                downsample=mge_downsample)#, plot=True)#, quiet=not verbose
         #plt.savefig('junk.png') ; pdb.set_trace()
 
         # Above, we used the Tractor positions, so check one more time here with
@@ -1900,12 +1872,13 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             while (maxis > prevmaxis) and (iiter < maxiter):
                 #print(prevmaxis, maxis, iiter, maxiter)
                 print('  r={:.2f} pixels'.format(maxis))
-                fixmask = ellipse_mask(mgegalaxy.xmed, mgegalaxy.ymed,
-                                       maxis, maxis * (1-mgegalaxy.eps), 
-                                       np.radians(mgegalaxy.theta-90), xobj, yobj)
+                fixmask = ellipse_mask_bbox(mgegalaxy.xmed, mgegalaxy.ymed,
+                                            maxis, maxis * (1-mgegalaxy.eps), 
+                                            np.radians(mgegalaxy.theta-90), shape)
                 newmask[fixmask] = ma.nomask
                 mgegalaxy = find_galaxy(ma.masked_array(img/filt2pixscale[refband]**2, newmask), 
-                                        nblob=1, binning=3, quiet=True, plot=False, level=minsb)
+                                        nblob=1, binning=3, quiet=True, plot=False, level=minsb,
+                                        roi=roi, median=mge_median, downsample=mge_downsample)
                 prevmaxis = maxis.copy()
                 maxis = 1.2 * mgegalaxy.majoraxis # [pixels]
                 iiter += 1
@@ -1934,9 +1907,9 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             mgegalaxy.theta = (270 - pa) % 180
             mgegalaxy.majoraxis = 2 * tractor.shape_r[central] / filt2pixscale[refband] # [pixels]
             print('  r={:.2f} pixels'.format(mgegalaxy.majoraxis))
-            fixmask = ellipse_mask(mgegalaxy.xmed, mgegalaxy.ymed,
-                                   mgegalaxy.majoraxis, mgegalaxy.majoraxis * (1-mgegalaxy.eps), 
-                                   np.radians(mgegalaxy.theta-90), xobj, yobj)
+            fixmask = ellipse_mask_bbox(mgegalaxy.xmed, mgegalaxy.ymed,
+                                        mgegalaxy.majoraxis, mgegalaxy.majoraxis * (1-mgegalaxy.eps), 
+                                        np.radians(mgegalaxy.theta-90), shape)
             newmask[fixmask] = ma.nomask
         else:
             largeshift = False
@@ -1972,19 +1945,13 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         
         #for filt in [refband]:
         for filt in bands:
-            thispixscale = filt2pixscale[filt]
-            
-            imagekey, varkey = '{}_masked'.format(filt), '{}_var'.format(filt)
-            if imagekey not in data.keys():
-                data[imagekey], data[varkey] = [], []
-
             factor = filt2pixscale[refband] / filt2pixscale[filt]
             majoraxis = 1.5 * factor * mgegalaxy.majoraxis # [pixels]
 
             # Grab the pixels belonging to this galaxy so we can unmask them below.
-            central_mask = ellipse_mask(mge['xmed'] * factor, mge['ymed'] * factor, 
-                                        majoraxis, majoraxis * (1-mgegalaxy.eps), 
-                                        np.radians(mgegalaxy.theta-90), xobj, yobj)
+            central_mask = ellipse_mask_bbox(mge['xmed'] * factor, mge['ymed'] * factor, 
+                                             majoraxis, majoraxis * (1-mgegalaxy.eps), 
+                                             np.radians(mgegalaxy.theta-90), shape)
             if np.sum(central_mask) == 0:
                 print('No pixels belong to the central galaxy---this is bad!')
                 data['failed'] = True
@@ -1993,7 +1960,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             # Build the mask from the (cumulative) residual-image mask and the
             # inverse variance mask for this galaxy, but then "unmask" the
             # pixels belonging to the central.
-            _residual_mask = residual_mask.copy()
+            _residual_mask = data['maskplanes'][shape]['residual']
             _residual_mask[central_mask] = ma.nomask
             mask = ma.mask_or(_residual_mask, newmask, shrink=False)
 
@@ -2002,40 +1969,160 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             #pdb.set_trace()
 
             # Need to be smarter about the srcs list...
-            srcs = tractor.copy()
-            srcs.cut(nocentral)
-            model_nocentral = srcs2image(srcs, data['{}_wcs'.format(refband)], band=filt.lower(),
-                                         pixelized_psf=data['{}_psf'.format(refband)])
-
-            # Convert to surface brightness and 32-bit precision.
-            img = (ma.getdata(data[filt]) - model_nocentral) / thispixscale**2 # [nanomaggies/arcsec**2]
-            img = ma.masked_array(img.astype('f4'), mask)
-            var = data['{}_var_'.format(filt)] / thispixscale**4 # [nanomaggies**2/arcsec**4]
-
-            # Fill with zeros, for fun--
-            ma.set_fill_value(img, fill_value)
-            #img.filled(fill_value)
-            data[imagekey].append(img)
-            data[varkey].append(var)
+            with legacyhalos.telemetry.timer('render'):
+                model_nocentral = _model_nocentral(filt, central)
+
+            _pack_central_image(data, filt, model_nocentral, mask, filt2pixscale,
+                                filt2var, fill_value=fill_value)
+
+            if maskcache is not None:
+                maskcache['mask_{}_{}'.format(ii, filt)] = np.packbits(mask)
 
             #if tractor.ref_id[central] == 474614:
             #    import matplotlib.pyplot as plt ; from astropy.visualization import simple_norm ; plt.clf()
             #    thisimg = np.log10(data[imagekey][ii]) ; norm = simple_norm(thisimg, 'log') ; plt.imshow(thisimg, origin='lower', norm=norm) ; plt.savefig('junk{}.png'.format(ii+1))
             #    pdb.set_trace()
 
+    if maskcache is not None and render_once and not data['failed']:
+        mgekeys = list(data['mge'][0].keys())
+        maskcache['mge_keys'] = np.array(mgekeys)
+        maskcache['mge_pykeys'] = np.array([key for key in mgekeys if not isinstance(data['mge'][0][key], np.generic)], str)
+        for key in mgekeys:
+            maskcache['mge_{}'.format(key)] = np.array([mge[key] for mge in data['mge']])
+    elif maskcache is not None:
+        maskcache.clear()
+
     # Cleanup?
     for filt in bands:
         del data[filt]
         del data['{}_var_'.format(filt)]
+    del data['maskplanes']
 
     return data            
 
+def _apply_maskcache(data, maskcache, filt2pixscale, fill_value=0.0):
+    """Rebuild the masked images built by _build_multiband_mask from the contents of
+    its maskcache dictionary (see legacyhalos.io.read_maskcache), without
+    re-measuring the geometry of the centrals or rendering any Tractor models.
+    The cached models are subtracted exactly as before, so the result is
+    identical.
+
+    """
+    bands = data['bands']
+    shape = (data['refband_height'], data['refband_width'])
+    ncentral = len(data['galaxy_indx'])
+
+    pykeys = set(maskcache['mge_pykeys'])
+    data['mge'] = []
+    for ii in range(ncentral):
+        mge = {}
+        for key in maskcache['mge_keys']:
+            val = maskcache['mge_{}'.format(key)][ii]
+            mge[str(key)] = val.item() if key in pykeys else val
+        data['mge'].append(mge)
+
+    _model_nocentral = _cached_model_renderer(maskcache)
+
+    filt2var = {}
+    for filt in bands:
+        for ii, central in enumerate(data['galaxy_indx']):
+            with legacyhalos.telemetry.timer('render'):
+                model_nocentral = _model_nocentral(filt, central)
+            mask = np.unpackbits(maskcache['mask_{}_{}'.format(ii, filt)],
+                                 count=shape[0]*shape[1]).reshape(shape).view(bool)
+            _pack_central_image(data, filt, model_nocentral, mask, filt2pixscale,
+                                filt2var, fill_value=fill_value)
+
+    for filt in bands:
+        del data[filt]
+        del data['{}_var_'.format(filt)]
+    del data['maskplanes']
+
+    return data
+
+def _classify_sga_sources(sga_id, tractor, refband='r', minsize=2.0, minsize_rex=5.0):
+    """Match the SGA galaxies to the Tractor catalog and decide which ones to keep
+    (for ellipse-fitting) or reject (and why), using array operations rather than
+    a search of the full Tractor catalog for each galaxy.
+
+    Returns the Tractor row index of each kept galaxy, the kept and rejected
+    indices into sga_id, a dictionary of the rejection flags (keyed by SGA_ID),
+    and a message for each rejected galaxy.
+
+    minsize - minimum half-light radius of any type [arcsec]
+    minsize_rex - minimum half-light radius of type REX [arcsec]
+
+    """
+    sga_id = np.atleast_1d(sga_id)
+    nsga = len(sga_id)
+
+    # Match on the first LSLGA/SGA (e.g., ref_cat=L6) source with this ref_id.
+    islslga = np.char.find(np.asarray(tractor.ref_cat).astype(str), 'L') != -1
+    candidx = np.where(islslga)[0]
+    candid = tractor.ref_id[candidx]
+    if len(candidx) == 0: # all dropped by Tractor
+        flags = {str(sid): 'dropped' for sid in sga_id}
+        return (np.zeros(0, int), np.zeros(0, int), np.arange(nsga), flags,
+                ['Dropped by Tractor (spurious?)'] * nsga)
+
+    srt = np.argsort(candid, kind='stable')
+    pos = np.minimum(np.searchsorted(candid[srt], sga_id), len(candidx)-1)
+    found = candid[srt][pos] == sga_id
+    I = np.where(found, candidx[srt][pos], candidx[0])
+
+    r50 = tractor.shape_r[I]
+    refflux = tractor.get('flux_{}'.format(refband))[I]
+    typ = tractor.type[I]
+
+    # Bug in fit_on_coadds: nobs_[g,r,z] is 1 even when missing the band, so
+    # use flux_ivar_[g,r,z].
+    nogrz = np.zeros(nsga, bool)
+    for filt in ('g', 'r', 'z'):
+        nogrz |= tractor.get('flux_{}'.format(filt))[I] * np.sqrt(tractor.get('flux_ivar_{}'.format(filt))[I]) == 0
+
+    # The order of the tests sets the reason for the rejection.
+    conditions = [~found, nogrz, typ == 'PSF', refflux < 0, r50 < minsize,
+                  (typ == 'REX') * (r50 < minsize_rex)]
+    reasons = ['dropped', 'nogrz', 'psf', 'negflux', 'anytype_toosmall', 'rex_toosmall']
+    reason = np.select(conditions, np.arange(len(reasons)), default=-1)
+
+    keep_galaxy = np.where(reason == -1)[0]
+    reject_galaxy = np.where(reason != -1)[0]
+    galaxy_indx = I[keep_galaxy]
+
+    flags, msg = {}, []
+    for ii in reject_galaxy:
+        flag = reasons[reason[ii]]
+        flags[str(sga_id[ii])] = flag
+        if flag == 'dropped':
+            msg.append('Dropped by Tractor (spurious?)')
+        elif flag == 'nogrz':
+            msg.append('Missing 3-band coverage')
+        elif flag == 'psf':
+            msg.append('Tractor type=PSF')
+        elif flag == 'negflux':
+            msg.append('{}-band flux={:.3g} (<=0)'.format(refband, refflux[ii]))
+        elif flag == 'anytype_toosmall':
+            msg.append('type={}, r50={:.3f} (<{:.1f}) arcsec'.format(typ[ii:ii+1], r50[ii], minsize))
+        else:
+            msg.append('Tractor type=REX & r50={:.3f} (<{:.1f}) arcsec'.format(r50[ii], minsize_rex))
+
+    return galaxy_indx, keep_galaxy, reject_galaxy, flags, msg
+
 def read_multiband(galaxy, galaxydir, filesuffix='largegalaxy', refband='r', 
                    bands=['g', 'r', 'z'], pixscale=0.262, fill_value=0.0,
-                   galaxy_id=None, verbose=False):
+                   galaxy_id=None, mge_roi=None, mge_median='medfilt', mge_downsample=1,
+                   maskcache=False, verbose=False):
     """Read the multi-band images (converted to surface brightness) and create a
     masked array suitable for ellipse-fitting.
 
+    mge_roi, mge_median, mge_downsample - see _build_multiband_mask.
+    maskcache - read the geometry and the bit-packed masks of the centrals from
+      (or, if it is missing or stale, write them to) the
+      {galaxy}-{filesuffix}-maskcache.npz sidecar file, so that only the first
+      call (e.g., in the ellipse stage) measures the geometry and the later ones
+      (e.g., htmlplots) do not.
+
     """
     import fitsio
     import astropy.units as u
@@ -2043,6 +2130,8 @@ def read_multiband(galaxy, galaxydir, filesuffix='largegalaxy', refband='r',
     from astrometry.util.fits import fits_table
     from legacypipe.bits import MASKBITS
     from legacyhalos.io import _get_psfsize_and_depth, _read_image_data
+    from legacyhalos.io import get_maskcache_filename, read_maskcache, write_maskcache
+    from legacyhalos.misc import data_nbytes
 
     # Dictionary mapping between optical filter and filename coded up in
     # coadds.py, galex.py, and unwise.py, which depends on the project.
@@ -2142,65 +2231,16 @@ def read_multiband(galaxy, galaxydir, filesuffix='largegalaxy', refband='r',
         print('Read {} sources from {}'.format(len(sample), samplefile))
     
     # Be pedantic to be sure we get it right (np.isin doens't preserve order)-- 
-    msg = []
-    islslga = ['L' in refcat for refcat in tractor.ref_cat] # e.g., L6
-    minsize = 2.0     # [arcsec]
-    minsize_rex = 5.0 # minimum size for REX [arcsec]
-    galaxy_indx, reject_galaxy, keep_galaxy = [], [], []
-    data['tractor_flags'] = {}
-    for ii, sid in enumerate(sample['SGA_ID']):
-        I = np.where((sid == tractor.ref_id) * islslga)[0]
-        if len(I) == 0: # dropped by Tractor
-            reject_galaxy.append(ii)
-            data['tractor_flags'].update({str(sid): 'dropped'})
-            msg.append('Dropped by Tractor (spurious?)')
-        else:
-            r50 = tractor.shape_r[I][0]
-            refflux = tractor.get('flux_{}'.format(refband))[I][0]
-            # Bug in fit_on_coadds: nobs_[g,r,z] is 1 even when missing the
-            # band, so use flux_ivar_[g,r,z].
-            #ng, nr, nz = tractor.nobs_g[I][0], tractor.nobs_z[I][0], tractor.nobs_z[I][0]
-            #if ng < 1 or nr < 1 or nz < 1:
-            ng = tractor.flux_g[I][0] * np.sqrt(tractor.flux_ivar_g[I][0]) == 0
-            nr = tractor.flux_r[I][0] * np.sqrt(tractor.flux_ivar_r[I][0]) == 0
-            nz = tractor.flux_z[I][0] * np.sqrt(tractor.flux_ivar_z[I][0]) == 0
-            if ng or nr or nz:
-                reject_galaxy.append(ii)
-                data['tractor_flags'].update({str(sid): 'nogrz'})
-                msg.append('Missing 3-band coverage')
-            elif tractor.type[I] == 'PSF': # always reject
-                reject_galaxy.append(ii)
-                data['tractor_flags'].update({str(sid): 'psf'})
-                msg.append('Tractor type=PSF')
-            elif refflux < 0:
-                reject_galaxy.append(ii)
-                data['tractor_flags'].update({str(sid): 'negflux'})
-                msg.append('{}-band flux={:.3g} (<=0)'.format(refband, refflux))
-            elif r50 < minsize:
-                reject_galaxy.append(ii)
-                data['tractor_flags'].update({str(sid): 'anytype_toosmall'})
-                msg.append('type={}, r50={:.3f} (<{:.1f}) arcsec'.format(tractor.type[I], r50, minsize))
-            elif tractor.type[I] == 'REX':
-                if r50 < minsize_rex: # REX must have a minimum size
-                    reject_galaxy.append(ii)
-                    data['tractor_flags'].update({str(sid): 'rex_toosmall'})
-                    msg.append('Tractor type=REX & r50={:.3f} (<{:.1f}) arcsec'.format(r50, minsize_rex))
-                else:
-                    keep_galaxy.append(ii)
-                    galaxy_indx.append(I)
-            else:
-                keep_galaxy.append(ii)
-                galaxy_indx.append(I)
+    galaxy_indx, keep_galaxy, reject_galaxy, flags, msg = _classify_sga_sources(
+        sample['SGA_ID'], tractor, refband=refband)
+    data['tractor_flags'] = flags
 
     if len(reject_galaxy) > 0:
-        reject_galaxy = np.hstack(reject_galaxy)
         for jj, rej in enumerate(reject_galaxy):
             print('  Dropping {} (SGA_ID={}, RA, Dec = {:.7f} {:.7f}): {}'.format(
                 sample[rej]['GALAXY'], sample[rej]['SGA_ID'], sample[rej]['RA'], sample[rej]['DEC'], msg[jj]))
 
     if len(galaxy_indx) > 0:
-        keep_galaxy = np.hstack(keep_galaxy)
-        galaxy_indx = np.hstack(galaxy_indx)
         sample = sample[keep_galaxy]
     else:
         data['failed'] = True
@@ -2226,10 +2266,35 @@ def read_multiband(galaxy, galaxydir, filesuffix='largegalaxy', refband='r',
     data['galaxy_id'] = galaxy_id
     data['galaxy_indx'] = galaxy_indx
 
-    # Now build the multiband mask.
-    data = _build_multiband_mask(data, tractor, filt2pixscale,
-                                 fill_value=fill_value,
-                                 verbose=verbose)
+    # Now build the multiband mask, or read it from the cache if none of the
+    # inputs have changed.
+    if maskcache:
+        cachefile = get_maskcache_filename(galaxy, galaxydir, filesuffix=filesuffix)
+        inputfiles = [tractorfile, samplefile, maskbitsfile]
+        for filt in bands:
+            inputfiles += [filt2imfile[filt][imtype] for imtype in sorted(filt2imfile[filt].keys())]
+        params = {'bands': list(bands), 'refband': refband, 'pixscale': float(pixscale),
+                  'mge_roi': mge_roi, 'mge_median': mge_median, 'mge_downsample': int(mge_downsample),
+                  'galaxy_indx': [int(indx) for indx in galaxy_indx]}
+        cache = read_maskcache(cachefile, inputfiles, params, verbose=verbose)
+    else:
+        cache = None
+
+    with legacyhalos.telemetry.timer('mask'):
+        if cache is not None:
+            data = _apply_maskcache(data, cache, filt2pixscale, fill_value=fill_value)
+            legacyhalos.telemetry.record(maskcache='read')
+        else:
+            newcache = {} if maskcache else None
+            data = _build_multiband_mask(data, tractor, filt2pixscale,
+                                         fill_value=fill_value, mge_roi=mge_roi,
+                                         mge_median=mge_median, mge_downsample=mge_downsample,
+                                         maskcache=newcache, verbose=verbose)
+            if newcache: # empty if the masking failed
+                write_maskcache(cachefile, newcache, inputfiles, params, verbose=verbose)
+                legacyhalos.telemetry.record(maskcache='write')
+    legacyhalos.telemetry.record(ncentral=len(data['galaxy_indx']), nsource=len(tractor),
+                                 data_nbytes=data_nbytes(data))
 
     #import matplotlib.pyplot as plt
     #plt.clf() ; plt.imshow(np.log10(data['g_masked'][0]), origin='lower') ; plt.savefig('junk1.png')
@@ -2253,37 +2318,51 @@ def read_multiband(galaxy, galaxydir, filesuffix='largegalaxy', refband='r',
 
 def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                  filesuffix='largegalaxy', bands=['g', 'r', 'z'], refband='r',
-                 unwise=False, verbose=False, debug=False, logfile=None):
+                 unwise=False, verbose=False, debug=False, logfile=None,
+                 timeout=None, retries=1, pyramid=False, mge_roi=None,
+                 mge_median='medfilt', mge_downsample=1, maskcache=False):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the SGA project.
 
+    pyramid - multi-resolution mode (see legacyhalos.ellipse.ellipsefit_multiband)
+    mge_roi, mge_median, mge_downsample - options of the geometry measurement
+      (see _build_multiband_mask)
+    maskcache - read (or write) the mask cache (see read_multiband)
+
     """
+    import legacyhalos.telemetry
     from legacyhalos.mpi import call_ellipse as mpi_call_ellipse
 
-    data, galaxyinfo = read_multiband(galaxy, galaxydir, bands=bands,
-                                      filesuffix=filesuffix,
-                                      refband=refband, pixscale=pixscale,
-                                      verbose=verbose)
-
-    maxis = data['mge'][igal]['majoraxis'] # [pixels]        
-
-    igal = 0
-    if galaxyinfo[igal]['d25_leda'] > 10 or galaxyinfo[igal]['pgc'] == 31968: # e.g., NGC5457, NGC3344
-        if galaxyinfo[igal]['pgc'] == 31968: # special-case NGC3344
-            print('Special-casing PGC031968==NGC3344!')
-        maxsma = 1.5 * maxis # [pixels]
-        delta_sma = 0.003 * maxsma
-    else:
-        maxsma = 2 * maxis # [pixels]
-        delta_sma = 0.0015 * maxsma
-    if delta_sma < 1:
-        delta_sma = 1.0
-        
-    mpi_call_ellipse(galaxy, galaxydir, data, galaxyinfo=galaxyinfo,
-                     pixscale=pixscale, nproc=nproc,
-                     logsma=False, delta_sma=delta_sma, maxsma=maxsma,
-                     bands=bands, refband=refband, sbthresh=SBTHRESH,
-                     verbose=verbose, debug=debug, logfile=logfile)
+    # Open the telemetry stage here (mpi_call_ellipse joins it) so the read
+    # and mask timers and the image dimensions are recorded.
+    with legacyhalos.telemetry.stage(galaxy, 'ellipse'):
+        data, galaxyinfo = read_multiband(galaxy, galaxydir, bands=bands,
+                                          filesuffix=filesuffix,
+                                          refband=refband, pixscale=pixscale,
+                                          mge_roi=mge_roi, mge_median=mge_median,
+                                          mge_downsample=mge_downsample, maskcache=maskcache,
+                                          verbose=verbose)
+
+        igal = 0
+        maxis = data['mge'][igal]['majoraxis'] # [pixels]
+
+        if galaxyinfo[igal]['d25_leda'] > 10 or galaxyinfo[igal]['pgc'] == 31968: # e.g., NGC5457, NGC3344
+            if galaxyinfo[igal]['pgc'] == 31968: # special-case NGC3344
+                print('Special-casing PGC031968==NGC3344!')
+            maxsma = 1.5 * maxis # [pixels]
+            delta_sma = 0.003 * maxsma
+        else:
+            maxsma = 2 * maxis # [pixels]
+            delta_sma = 0.0015 * maxsma
+        if delta_sma < 1:
+            delta_sma = 1.0
+
+        mpi_call_ellipse(galaxy, galaxydir, data, galaxyinfo=galaxyinfo,
+                         pixscale=pixscale, nproc=nproc,
+                         logsma=False, delta_sma=delta_sma, maxsma=maxsma,
+                         bands=bands, refband=refband, sbthresh=SBTHRESH,
+                         verbose=verbose, debug=debug, logfile=logfile,
+                         timeout=timeout, retries=retries, pyramid=pyramid)
 
 def remake_cogqa(onegal, fullsample, htmldir=None, clobber=False, verbose=False):
     """Remake the curve of growth QA figures just for the SGA-2020 data release. The
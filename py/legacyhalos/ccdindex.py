@@ -0,0 +1,337 @@
+"""
+legacyhalos.ccdindex
+====================
+
+A reusable spatial index over the CCD tables, for finding the CCDs which touch
+many custom bricks (mosaics) in one vectorized batch.
+
+The index is a KD-tree on the unit vectors of the CCD centers plus the four
+corners of each CCD, so a query for thousands of galaxies is one tree search
+followed by one (vectorized) polygon-intersection test. The selection follows
+legacypipe.survey.ccds_touching_wcs (radius cut followed by an intersection
+test between the CCD and the brick footprints), so it returns the same CCDs as
+survey.ccds_touching_wcs(wcs_for_brick(...)). Build the index once with
+CCDIndex.from_survey and it will be written to (and subsequently read from) an
+optional index file, which is rebuilt whenever the CCD tables change.
+
+"""
+import os, time
+import numpy as np
+
+CCDINDEX_VERSION = 1
+
+# LegacySurveyData.ccds_touching_wcs only considers CCDs within one degree of
+# the brick center when it searches the CCD kd-tree files.
+KDTREE_RADIUS = 1.0 # [degrees]
+
+GEOMETRY_COLUMNS = ['ra', 'dec', 'crval1', 'crval2', 'crpix1', 'crpix2',
+                    'cd1_1', 'cd1_2', 'cd2_1', 'cd2_2', 'width', 'height']
+
+def radec2xyz(ra, dec):
+    """Unit vectors [N, 3] for the given coordinates (in degrees)."""
+    ra, dec = np.radians(np.atleast_1d(ra)), np.radians(np.atleast_1d(dec))
+    cosdec = np.cos(dec)
+    return np.stack((cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)), axis=-1)
+
+def _tangent_basis(xyz):
+    """East and north unit vectors at each point on the sphere."""
+    east = np.stack((-xyz[..., 1], xyz[..., 0], np.zeros_like(xyz[..., 0])), axis=-1)
+    east /= np.linalg.norm(east, axis=-1, keepdims=True)
+    north = np.cross(xyz, east)
+    return east, north
+
+def tan_pixelxy2xyz(crval1, crval2, crpix1, crpix2, cd1_1, cd1_2, cd2_1, cd2_2, x, y):
+    """Unit vectors of pixel positions x, y [N, M] in N TAN (gnomonic) WCSs, following
+    astrometry.util.util.Tan.pixelxy2radec.
+
+    """
+    cen = radec2xyz(crval1, crval2)[:, np.newaxis, :]
+    east, north = _tangent_basis(cen)
+    dx, dy = x - np.atleast_1d(crpix1)[:, np.newaxis], y - np.atleast_1d(crpix2)[:, np.newaxis]
+    u = np.radians(np.atleast_1d(cd1_1)[:, np.newaxis] * dx + np.atleast_1d(cd1_2)[:, np.newaxis] * dy)
+    v = np.radians(np.atleast_1d(cd2_1)[:, np.newaxis] * dx + np.atleast_1d(cd2_2)[:, np.newaxis] * dy)
+    xyz = cen + u[..., np.newaxis] * east + v[..., np.newaxis] * north
+    return xyz / np.linalg.norm(xyz, axis=-1, keepdims=True)
+
+def tan_radec2pixelxy(crval1, crval2, crpix1, crpix2, cd1_1, cd1_2, cd2_1, cd2_2, ra, dec):
+    """(One-indexed) pixel positions of ra, dec in a TAN (gnomonic) WCS, following
+    astrometry.util.util.Tan.radec2pixelxy.
+
+    """
+    cen = radec2xyz(crval1, crval2)[0]
+    east, north = _tangent_basis(cen)
+    xyz = radec2xyz(ra, dec)
+    denom = np.dot(xyz, cen)
+    u, v = np.degrees(np.dot(xyz, east) / denom), np.degrees(np.dot(xyz, north) / denom)
+    det = cd1_1 * cd2_2 - cd1_2 * cd2_1
+    x = crpix1 + ( cd2_2 * u - cd1_2 * v) / det
+    y = crpix2 + (-cd2_1 * u + cd1_1 * v) / det
+    if np.isscalar(ra):
+        return x[0], y[0]
+    return x, y
+
+def _convex_polygons_intersect(poly1, poly2):
+    """Whether each pair of convex polygons poly1 [N, K, 2] and poly2 [N, M, 2]
+    intersect (or touch), using the separating-axis theorem.
+
+    """
+    intersect = np.ones(len(poly1), bool)
+    for poly in (poly1, poly2):
+        edge = np.roll(poly, -1, axis=1) - poly
+        for kk in range(poly.shape[1]):
+            nx, ny = -edge[:, kk, 1:2], edge[:, kk, 0:1]
+            proj1 = poly1[:, :, 0] * nx + poly1[:, :, 1] * ny
+            proj2 = poly2[:, :, 0] * nx + poly2[:, :, 1] * ny
+            intersect &= ~((proj1.max(axis=1) < proj2.min(axis=1)) |
+                           (proj2.max(axis=1) < proj1.min(axis=1)))
+    return intersect
+
+def ccd_files(survey):
+    """The CCD tables searched by survey.ccds_touching_wcs: the kd-tree files, if
+    there are any, or else the CCD tables themselves.
+
+    """
+    fns = survey.filter_ccd_kd_files(survey.find_file('ccd-kds'))
+    if len(fns) > 0:
+        return list(fns), True
+    return list(survey.filter_ccds_files(survey.find_file('ccds'))), False
+
+def _index_meta(files):
+    """Modification time and size of each CCD table, used to decide whether an
+    index file is stale.
+
+    """
+    import json
+    inputs = {}
+    for infile in files:
+        st = os.stat(infile)
+        inputs[infile] = [st.st_mtime, st.st_size]
+    return json.loads(json.dumps({'version': CCDINDEX_VERSION, 'inputs': inputs}))
+
+class CCDIndex(object):
+    """Spatial index over a CCD table.
+
+    ra, dec - CCD centers [degrees]
+    corners - unit vectors of the four CCD corners [N, 4, 3]
+    radius - radius of the largest CCD [degrees]
+    maxradius - optional maximum search radius [degrees]
+    files, fileindx, rowindx - CCD table and row of each CCD (used by read_ccds)
+
+    """
+    def __init__(self, ra, dec, corners, radius, maxradius=None,
+                 files=None, fileindx=None, rowindx=None):
+        from scipy.spatial import cKDTree
+
+        self.ra = np.asarray(ra, 'f8')
+        self.dec = np.asarray(dec, 'f8')
+        self.corners = np.asarray(corners, 'f8')
+        self.radius = float(radius)
+        self.maxradius = maxradius
+        self.files = files
+        self.fileindx = fileindx
+        self.rowindx = rowindx
+        self.xyz = radec2xyz(self.ra, self.dec)
+        self.tree = cKDTree(self.xyz)
+
+    def __len__(self):
+        return len(self.ra)
+
+    @classmethod
+    def from_table(cls, ccds, **kwargs):
+        """Build the index from a CCD table (with the GEOMETRY_COLUMNS)."""
+        W, H = np.asarray(ccds.width, 'f8'), np.asarray(ccds.height, 'f8')
+        x = np.stack((0.5+0*W, W+0.5, W+0.5, 0.5+0*W), axis=-1)
+        y = np.stack((0.5+0*H, 0.5+0*H, H+0.5, H+0.5), axis=-1)
+        corners = tan_pixelxy2xyz(ccds.crval1, ccds.crval2, ccds.crpix1, ccds.crpix2,
+                                  ccds.cd1_1, ccds.cd1_2, ccds.cd2_1, ccds.cd2_2, x, y)
+        # Same definition as legacypipe.survey.ccds_touching_wcs.
+        if len(W) > 0:
+            radius = np.max(np.sqrt(np.abs(ccds.cd1_1 * ccds.cd2_2 - ccds.cd1_2 * ccds.cd2_1)) *
+                            np.hypot(W, H) / 2.)
+        else:
+            radius = 0.0
+        return cls(ccds.ra, ccds.dec, corners, radius, **kwargs)
+
+    @classmethod
+    def from_survey(cls, survey, indexfile=None, verbose=False):
+        """Build (or read) the index of all the CCDs searched by
+        survey.ccds_touching_wcs. If indexfile is given the index is read from
+        it, unless it is stale, in which case it is rebuilt and written out.
+
+        """
+        from astrometry.util.fits import fits_table, merge_tables
+
+        files, kdtree = ccd_files(survey)
+        if indexfile is not None:
+            index = cls.read(indexfile, files=files, verbose=verbose)
+            if index is not None:
+                return index
+
+        t0 = time.time()
+        TT, fileindx, rowindx = [], [], []
+        for ifile, fn in enumerate(files):
+            T = fits_table(fn, columns=GEOMETRY_COLUMNS)
+            TT.append(T)
+            fileindx.append(np.repeat(ifile, len(T)).astype('i2'))
+            rowindx.append(np.arange(len(T), dtype='i4'))
+        ccds = merge_tables(TT)
+        index = cls.from_table(ccds, maxradius=KDTREE_RADIUS if kdtree else None, files=files,
+                               fileindx=np.hstack(fileindx), rowindx=np.hstack(rowindx))
+        if verbose:
+            print('Indexed {} CCDs from {} file(s) in {:.2f} sec'.format(
+                len(index), len(files), time.time() - t0))
+
+        if indexfile is not None:
+            index.write(indexfile, verbose=verbose)
+        return index
+
+    def write(self, indexfile, verbose=False):
+        """Write the index (atomically) to a compressed numpy file."""
+        import json
+
+        meta = {'radius': self.radius, 'maxradius': self.maxradius}
+        if self.files is not None:
+            meta.update(_index_meta(self.files))
+            meta['files'] = list(self.files)
+        out = {'ra': self.ra, 'dec': self.dec, 'corners': self.corners}
+        if self.fileindx is not None:
+            out.update({'fileindx': self.fileindx, 'rowindx': self.rowindx})
+
+        tmpfile = indexfile+'.tmp'
+        with open(tmpfile, 'wb') as F:
+            np.savez_compressed(F, meta=np.array(json.dumps(meta)), **out)
+        os.rename(tmpfile, indexfile)
+        if verbose:
+            print('Wrote {} ({:.1f} MB)'.format(indexfile, os.path.getsize(indexfile)/1024**2))
+
+    @classmethod
+    def read(cls, indexfile, files=None, verbose=False):
+        """Read the output of write. Returns None if the file does not exist, cannot
+        be read, or is stale (i.e., files is given and the CCD tables have
+        changed since the index was written).
+
+        """
+        import json, zipfile
+
+        if not os.path.isfile(indexfile):
+            return None
+        try:
+            with np.load(indexfile) as F:
+                meta = json.loads(str(F['meta']))
+                if files is not None:
+                    current = _index_meta(files)
+                    if meta.get('version') != current['version'] or meta.get('inputs') != current['inputs']:
+                        if verbose:
+                            print('Ignoring stale CCD index {}'.format(indexfile))
+                        return None
+                kwargs = {}
+                if 'fileindx' in F.files:
+                    kwargs.update({'files': meta['files'], 'fileindx': F['fileindx'],
+                                   'rowindx': F['rowindx']})
+                index = cls(F['ra'], F['dec'], F['corners'], meta['radius'],
+                            maxradius=meta['maxradius'], **kwargs)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            print('Problem reading CCD index {}'.format(indexfile))
+            return None
+        if verbose:
+            print('Read {} CCDs from {}'.format(len(index), indexfile))
+        return index
+
+    def query(self, ra, dec, width, pixscale=0.262, height=None, chunksize=1000):
+        """Indices of the CCDs touching each of a set of custom bricks, i.e., TAN
+        projections centered on ra, dec with width x height pixels, as built by
+        legacypipe.survey.wcs_for_brick.
+
+        ra, dec - brick centers [degrees]
+        width, height - brick size [pixels] (scalar or array; height defaults to width)
+        pixscale - pixel scale [arcsec/pixel]
+
+        Returns a list (one per brick) of sorted index arrays into this index.
+
+        """
+        ra, dec = np.atleast_1d(ra).astype('f8'), np.atleast_1d(dec).astype('f8')
+        ngal = len(ra)
+        if height is None:
+            height = width
+        # Half-width and -height of the brick in the tangent plane [radians].
+        hw = np.radians(np.broadcast_to(np.asarray(width, 'f8'), (ngal,)) * pixscale / 3600 / 2)
+        hh = np.radians(np.broadcast_to(np.asarray(height, 'f8'), (ngal,)) * pixscale / 3600 / 2)
+
+        # Same search radius as legacypipe.survey.ccds_touching_wcs.
+        rad = np.degrees(np.hypot(hw, hh)) + self.radius
+        if self.maxradius is not None:
+            rad = np.minimum(rad, self.maxradius)
+
+        out = []
+        for i0 in range(0, ngal, chunksize):
+            i1 = min(i0 + chunksize, ngal)
+            out += self._query(ra[i0:i1], dec[i0:i1], hw[i0:i1], hh[i0:i1], rad[i0:i1])
+        return out
+
+    def _query(self, ra, dec, hw, hh, rad):
+        ngal = len(ra)
+        empty = np.zeros(0, int)
+        if len(self) == 0:
+            return [empty] * ngal
+
+        xyz = radec2xyz(ra, dec)
+        chord = 2 * np.sin(np.radians(rad) / 2)
+        cand = self.tree.query_ball_point(xyz, chord)
+        ncand = np.array([len(cc) for cc in cand])
+        if np.sum(ncand) == 0:
+            return [empty] * ngal
+        igal = np.repeat(np.arange(ngal), ncand)
+        iccd = np.hstack([cc for cc in cand if len(cc) > 0]).astype(int)
+
+        # Radius cut.
+        cosdist = np.clip(np.sum(xyz[igal] * self.xyz[iccd], axis=1), -1.0, 1.0)
+        keep = ((np.abs(self.dec[iccd] - dec[igal]) < rad[igal]) &
+                (np.degrees(np.arccos(cosdist)) < rad[igal]))
+        igal, iccd = igal[keep], iccd[keep]
+
+        # Project the CCD corners onto the tangent plane of each brick and check
+        # whether the two footprints intersect.
+        cen = xyz[igal]
+        east, north = _tangent_basis(cen)
+        corners = self.corners[iccd]
+        denom = np.sum(corners * cen[:, np.newaxis, :], axis=-1)
+        ccdpoly = np.stack((np.sum(corners * east[:, np.newaxis, :], axis=-1) / denom,
+                            np.sum(corners * north[:, np.newaxis, :], axis=-1) / denom), axis=-1)
+        sx, sy = hw[igal][:, np.newaxis], hh[igal][:, np.newaxis]
+        brickpoly = np.stack((np.hstack((-sx, sx, sx, -sx)), np.hstack((-sy, -sy, sy, sy))), axis=-1)
+        keep = _convex_polygons_intersect(brickpoly, ccdpoly)
+        igal, iccd = igal[keep], iccd[keep]
+
+        srt = np.lexsort((iccd, igal))
+        igal, iccd = igal[srt], iccd[srt]
+        edges = np.searchsorted(igal, np.arange(ngal+1))
+        return [iccd[edges[ii]:edges[ii+1]] for ii in range(ngal)]
+
+    def read_ccds(self, survey, indx):
+        """Read the CCD table rows for the given (sorted) indices, in the same order
+        as survey.ccds_touching_wcs. Returns None if indx is empty.
+
+        """
+        from astrometry.util.fits import fits_table, merge_tables
+
+        if len(indx) == 0:
+            return None
+        TT = []
+        for ifile in np.unique(self.fileindx[indx]):
+            rows = self.rowindx[indx][self.fileindx[indx] == ifile]
+            T = fits_table(self.files[ifile], rows=rows)
+            TT.append(survey.cleanup_ccds_table(T))
+        if len(TT) > 1:
+            ccds = merge_tables(TT, columns='fillzero')
+        else:
+            ccds = TT[0]
+        return ccds
+
+    def ccds_touching(self, survey, ra, dec, width, pixscale=0.262, height=None):
+        """Batched equivalent of survey.ccds_touching_wcs(wcs_for_brick(...)) for a set
+        of custom bricks. Returns a list of CCD tables (or None if no CCDs touch
+        a given brick).
+
+        """
+        return [self.read_ccds(survey, indx) for indx in
+                self.query(ra, dec, width, pixscale=pixscale, height=height)]
@@ -3,7 +3,7 @@ legacyhalos.coadds
 ==================
 
 """
-import os, pdb
+import os, sys, time, pdb
 import numpy as np
 
 from legacyhalos.misc import custom_brickname
@@ -20,23 +20,67 @@ def _mosaic_width(radius_mosaic, pixscale):
     width = (np.ceil(width) // 2 * 2 + 1).astype('int') # [pixels]
     return width
 
+def _stage_file(infile, outfile, move=False):
+    """Put infile at outfile without copying the data, if possible.
+
+    If both paths are on the same device then the file is renamed (move=True)
+    or hard-linked (move=False, or if the rename fails); otherwise it is copied
+    (to a temporary file which is then renamed, so a partial file never
+    appears at outfile). With move=True the input file is removed.
+
+    Returns the method used ('rename', 'link', or 'copy') and the number of
+    bytes actually written.
+
+    """
+    import shutil
+
+    tmpfile = outfile+'.tmp'
+    if os.stat(infile).st_dev == os.stat(os.path.dirname(os.path.abspath(outfile))).st_dev:
+        if move:
+            try:
+                os.replace(infile, outfile)
+                return 'rename', 0
+            except OSError:
+                pass
+        try:
+            if os.path.lexists(tmpfile):
+                os.remove(tmpfile)
+            os.link(infile, tmpfile)
+            os.replace(tmpfile, outfile)
+            if move:
+                os.remove(infile)
+            return 'link', 0
+        except OSError: # e.g., no hard links on this filesystem
+            pass
+    shutil.copyfile(infile, tmpfile)
+    os.replace(tmpfile, outfile)
+    if move:
+        os.remove(infile)
+    return 'copy', os.path.getsize(outfile)
+
 def _rearrange_files(galaxy, output_dir, brickname, stagesuffix, run,
                      unwise=True, galex=False, cleanup=False, just_coadds=False,
                      clobber=False, require_grz=True, missing_ok=False,
                      write_wise_psf=False):
     """Move (rename) files into the desired output directory and clean up.
 
+    The files are renamed if cleanup=True (since the runbrick outputs are
+    going to be deleted anyway) or hard-linked otherwise, and only copied if
+    output_dir spans more than one filesystem; see _stage_file.
+
     """
     import fitsio
-    import shutil
-        
+    import legacyhalos.telemetry
+
+    staged = {'rename': 0, 'link': 0, 'copy': 0, 'bytes': 0}
+
     def _copyfile(infile, outfile, clobber=False, update_header=False, missing_ok=False):
         if os.path.isfile(outfile) and not clobber:
             return 1
         if os.path.isfile(infile):
-            tmpfile = outfile+'.tmp'
-            shutil.copyfile(infile, tmpfile)
-            os.rename(tmpfile, outfile)
+            method, nbytes = _stage_file(infile, outfile, move=cleanup)
+            staged[method] += 1
+            staged['bytes'] += nbytes
             if update_header:
                 pass
             return 1
@@ -51,6 +95,7 @@ def _rearrange_files(galaxy, output_dir, brickname, stagesuffix, run,
     def _do_cleanup():
         import shutil
         from glob import glob
+        _report()
         shutil.rmtree(os.path.join(output_dir, 'coadd'), ignore_errors=True)
         shutil.rmtree(os.path.join(output_dir, 'metrics'), ignore_errors=True)
         shutil.rmtree(os.path.join(output_dir, 'tractor'), ignore_errors=True)
@@ -60,6 +105,14 @@ def _rearrange_files(galaxy, output_dir, brickname, stagesuffix, run,
             if os.path.isfile(picklefile):
                 os.remove(picklefile)
 
+    def _report():
+        nfile = staged['rename'] + staged['link'] + staged['copy']
+        if nfile > 0:
+            print('Staged {} files ({} renamed, {} linked, {} copied; {:.2f} MB written).'.format(
+                nfile, staged['rename'], staged['link'], staged['copy'], staged['bytes']/1024**2))
+        legacyhalos.telemetry.record(staged_files=nfile, staged_copies=staged['copy'],
+                                     staged_bytes=staged['bytes'])
+
     # Diagnostic plots (OK if they're missing) (put this above the check for the
     # CCDs--if the plots have been made then they are useful for testing and
     # debugging).
@@ -116,6 +169,14 @@ def _rearrange_files(galaxy, output_dir, brickname, stagesuffix, run,
             if not ok:
                 return ok
 
+    # Exposure-count images, for the coverage maps (see legacyhalos.coverage).
+    for band in bands:
+        ok = _copyfile(
+            os.path.join(output_dir, 'coadd', 'cus', brickname,
+                         'legacysurvey-{}-nexp-{}.fits.fz'.format(brickname, band)),
+            os.path.join(output_dir, '{}-{}-nexp-{}.fits.fz'.format(galaxy, stagesuffix, band)),
+            clobber=clobber, missing_ok=True)
+
     # JPG images
     ok = _copyfile(
         os.path.join(output_dir, 'coadd', 'cus', brickname,
@@ -277,28 +338,372 @@ def _rearrange_files(galaxy, output_dir, brickname, stagesuffix, run,
 
     if cleanup:
         _do_cleanup()
+    else:
+        _report()
 
     return 1
 
-def get_ccds(survey, ra, dec, pixscale, width):
+class SurveyCache(object):
+    """Per-process cache of the LegacySurveyData object of each run, for calling
+    runbrick in-process (see run_runbrick).
+
+    A fresh runbrick.py process pays for the interpreter start, the
+    legacypipe/tractor imports, and the construction of the survey object and
+    its CCD tables for every galaxy; here those costs are only paid by the
+    first galaxy on a rank. The state of the survey object right after it is
+    built (including the CCD tables) is snapshotted, and every attribute which
+    runbrick sets or changes for a brick is restored from the snapshot on each
+    call to get.
+
+    The time spent in each call to get is kept in startup. Optionally (with
+    measure=True, or $LEGACYHALOS_STARTUP_BENCHMARK set for the per-process
+    SURVEYS cache), the time saved per galaxy is measured against a real
+    runbrick.py start-up: the first call to get times (once per process) a
+    subprocess which does the same imports and builds the same survey object.
+    This is a one-off benchmark; it roughly doubles the cold start-up time and
+    memory of each rank, so it is off by default.
+
+    """
+    def __init__(self, measure=False):
+        self.surveys = {}
+        self.states = {}
+        self.measure = measure
+        self.subprocess_startup = None
+        self.startup = 0.0
+
+    @staticmethod
+    def _snapshot(survey):
+        """Copy of the attributes of survey; containers are copied (shallowly) so
+        that in-place changes (e.g., to output_file_hashes) can be undone.
+
+        """
+        import copy
+        return {key: copy.copy(val) if isinstance(val, (dict, list, set)) else val
+                for key, val in vars(survey).items()}
+
+    @staticmethod
+    def _restore(survey, state):
+        import copy
+        for key in list(vars(survey).keys()):
+            if key not in state:
+                delattr(survey, key)
+        for key, val in state.items():
+            setattr(survey, key, copy.copy(val) if isinstance(val, (dict, list, set)) else val)
+
+    def _new_survey(self, run, output_dir, survey_dir=None):
+        import legacypipe.runbrick
+        from legacypipe.runs import get_survey
+        survey = get_survey(run, survey_dir=survey_dir, output_dir=output_dir)
+        # Read the CCD tables now, so that they are loaded before any
+        # forked worker (see legacyhalos.mpi.run_with_watchdog) uses them.
+        if hasattr(survey, 'get_ccd_kdtrees'):
+            survey.get_ccd_kdtrees()
+        return survey
+
+    def _startup_command(self, run, output_dir, survey_dir=None):
+        """Command which repeats the start-up of a runbrick.py process."""
+        script = '; '.join([
+            'import sys, legacypipe.runbrick',
+            'from legacypipe.runs import get_survey',
+            'run, survey_dir = [None if arg == "" else arg for arg in sys.argv[1:3]]',
+            'survey = get_survey(run, survey_dir=survey_dir, output_dir=sys.argv[3])',
+            'hasattr(survey, "get_ccd_kdtrees") and survey.get_ccd_kdtrees()'])
+        return [sys.executable, '-c', script, run or '', survey_dir or '', output_dir]
+
+    def measure_subprocess_startup(self, run, output_dir, survey_dir=None):
+        """Time [seconds] to start a runbrick.py process, up to the point where it
+        starts working on the brick. Measured once per process.
+
+        """
+        import subprocess, tempfile
+
+        if self.subprocess_startup is None:
+            tmpdir = output_dir if os.path.isdir(output_dir) else None
+            with tempfile.TemporaryDirectory(dir=tmpdir) as tmpdir:
+                t0 = time.time()
+                err = subprocess.call(self._startup_command(run, tmpdir, survey_dir=survey_dir),
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                startup = time.time() - t0
+            if err != 0:
+                print('Unable to measure the runbrick.py start-up time.')
+                startup = 0.0
+            self.subprocess_startup = startup
+        return self.subprocess_startup
+
+    def get(self, run, output_dir, survey_dir=None):
+        """Return the survey object for this run, reset to its initial state and
+        pointed at output_dir.
+
+        """
+        key = (run, survey_dir)
+        if self.measure and key not in self.surveys:
+            self.measure_subprocess_startup(run, output_dir, survey_dir=survey_dir)
+
+        t0 = time.time()
+        if key not in self.surveys:
+            survey = self._new_survey(run, output_dir, survey_dir=survey_dir)
+            self.surveys[key] = survey
+            self.states[key] = self._snapshot(survey)
+
+        survey = self.surveys[key]
+        self._restore(survey, self.states[key])
+        survey.output_dir = output_dir
+        if hasattr(survey, 'output_file_hashes'):
+            survey.output_file_hashes.clear()
+
+        self.startup = time.time() - t0
+        return survey
+
+    def saved(self):
+        """Startup time [seconds] saved by the last call to get, relative to
+        starting a runbrick.py process (zero unless it was measured).
+
+        """
+        if self.subprocess_startup is None:
+            return 0.0
+        return self.subprocess_startup - self.startup
+
+SURVEYS = SurveyCache(measure=os.getenv('LEGACYHALOS_STARTUP_BENCHMARK') is not None)
+
+def _runbrick_inprocess(args, survey, log=None):
+    """Call the runbrick entry point in this process (see run_runbrick). This is
+    legacypipe.runbrick.main, but with the given survey object and with the
+    logging sent to log.
+
+    """
+    import logging, inspect, traceback
+    from contextlib import redirect_stdout, redirect_stderr
+    from legacypipe.runbrick import (get_parser, get_runbrick_kwargs, run_brick,
+                                     NothingToDoError, RunbrickError)
+
+    if log is None:
+        log = sys.stdout
+
+    parser = get_parser()
+    opt = parser.parse_args(args=args)
+    optdict = vars(opt)
+    verbose = optdict.pop('verbose', 0)
+    for key in ('ps', 'ps_t0'):
+        optdict.pop(key, None)
+
+    if optdict.get('output_dir') is not None:
+        survey.output_dir = optdict['output_dir']
+    if 'survey' in inspect.signature(get_runbrick_kwargs).parameters:
+        _, kwargs = get_runbrick_kwargs(survey=survey, **optdict)
+    else:
+        _, kwargs = get_runbrick_kwargs(**optdict)
+    if kwargs in [-1, 0]:
+        return kwargs
+    kwargs.update(command_line='runbrick.py {}'.format(' '.join(args)))
+
+    # Send the logging (and stdout/stderr) of this galaxy to its own log and
+    # restore the previous handlers afterwards.
+    rootlog = logging.getLogger()
+    handlers, level = rootlog.handlers[:], rootlog.level
+    handler = logging.StreamHandler(log)
+    handler.setFormatter(logging.Formatter('%(name)s %(message)s'))
+    rootlog.handlers = [handler]
+    rootlog.setLevel(logging.DEBUG if verbose else logging.INFO)
+    try:
+        with redirect_stdout(log), redirect_stderr(log):
+            try:
+                run_brick(opt.brick, survey, **kwargs)
+                err = 0
+            except NothingToDoError as e:
+                print(e)
+                err = 0
+            except RunbrickError as e:
+                print(e)
+                err = -1
+            except Exception:
+                traceback.print_exc()
+                err = 1
+    finally:
+        rootlog.handlers = handlers
+        rootlog.setLevel(level)
+        log.flush()
+
+    return err
+
+def run_runbrick(cmd, survey=None, log=None, inprocess=False):
+    """Run a 'python .../runbrick.py [args]' command line and return its exit
+    status.
+
+    inprocess - call the runbrick entry point directly, with the given (warm)
+      survey object (see SurveyCache), rather than in a subprocess.
+
+    """
+    import subprocess
+
+    if not inprocess:
+        return subprocess.call(cmd.split(), stdout=log, stderr=log)
+    return _runbrick_inprocess(cmd.split()[2:], survey, log=log)
+
+def get_ccds(survey, ra, dec, pixscale, width, ccdindex=None):
     """Quickly get the CCDs touching this custom brick.  This code is mostly taken
     from legacypipe.runbrick.stage_tims.
 
+    ccdindex - optional legacyhalos.ccdindex.CCDIndex to search instead of
+      calling survey.ccds_touching_wcs (same CCDs, but much faster when it is
+      reused for many galaxies)
+
     """
-    from legacypipe.survey import wcs_for_brick, BrickDuck
-    brickname = 'custom-{}'.format(custom_brickname(ra, dec))
-    brick = BrickDuck(ra, dec, brickname)
+    if ccdindex is not None:
+        ccds = ccdindex.ccds_touching(survey, ra, dec, width, pixscale=pixscale)[0]
+    else:
+        from legacypipe.survey import wcs_for_brick, BrickDuck
+        brickname = 'custom-{}'.format(custom_brickname(ra, dec))
+        brick = BrickDuck(ra, dec, brickname)
 
-    targetwcs = wcs_for_brick(brick, W=np.float(width), H=np.float(width), pixscale=pixscale)
-    ccds = survey.ccds_touching_wcs(targetwcs)
+        targetwcs = wcs_for_brick(brick, W=float(width), H=float(width), pixscale=pixscale)
+        ccds = survey.ccds_touching_wcs(targetwcs)
 
+    return select_ccds(ccds)
+
+def select_ccds(ccds, band=('g', 'r', 'z')):
+    """Keep the CCDs which pass the ccd_cuts and are in one of the requested
+    bands (as in legacypipe.runbrick.stage_tims). Returns an empty list if no
+    CCDs survive.
+
+    """
     if ccds is None or np.sum(ccds.ccd_cuts == 0) == 0:
         return []
     ccds.cut(ccds.ccd_cuts == 0)
-    ccds.cut(np.array([b in ['g', 'r', 'z'] for b in ccds.filter]))
+    ccds.cut(np.array([b in band for b in ccds.filter]))
+    if len(ccds) == 0:
+        return []
 
     return ccds
 
+# https://github.com/legacysurvey/legacypipe/blob/main/py/legacypipe/unwise.py#L267-L310
+UNWISE_FLUXRESCALES = {1: 1.04, 2: 1.005, 3: 1.0, 4: 1.0}
+
+def unwise_psf_stamp(band, coadd_id):
+    """Normalized (and flux-rescaled) unWISE PSF for one band (1-4) of one
+    unWISE coadd, at the 2.75 arcsec/pixel scale of the coadds.
+
+    """
+    import unwise_psf.unwise_psf as unwise_psf
+
+    if (band == 1) or (band == 2):
+        # we only have updated PSFs for W1 and W2
+        psfimg = unwise_psf.get_unwise_psf(band, coadd_id,
+                                           modelname='neo6_unwisecat')
+    else:
+        psfimg = unwise_psf.get_unwise_psf(band, coadd_id)
+
+    if band == 4:
+        # oversample (the unwise_psf models are at native W4 5.5"/pix,
+        # while the unWISE coadds are made at 2.75"/pix.
+        ph,pw = psfimg.shape
+        subpsf = np.zeros((ph*2-1, pw*2-1), np.float32)
+        from astrometry.util.util import lanczos3_interpolate
+        xx,yy = np.meshgrid(np.arange(0., pw-0.51, 0.5, dtype=np.float32),
+                            np.arange(0., ph-0.51, 0.5, dtype=np.float32))
+        xx = xx.ravel()
+        yy = yy.ravel()
+        ix = xx.astype(np.int32)
+        iy = yy.astype(np.int32)
+        dx = (xx - ix).astype(np.float32)
+        dy = (yy - iy).astype(np.float32)
+        psfimg = psfimg.astype(np.float32)
+        rtn = lanczos3_interpolate(ix, iy, dx, dy, [subpsf.flat], [psfimg])
+
+        psfimg = subpsf
+        del xx, yy, ix, iy, dx, dy
+
+    psfimg /= psfimg.sum()
+    psfimg *= UNWISE_FLUXRESCALES[band]
+    return psfimg
+
+def galex_psf_stamp(band, galex_dir):
+    """Normalized GALEX PSF for band 'f' or 'n'."""
+    from legacypipe.galex import galex_psf
+
+    psfimg = galex_psf(band, galex_dir)
+    psfimg /= psfimg.sum()
+    return psfimg
+
+PSFCACHE_VERSION = 1
+
+class PSFCache(object):
+    """Content-addressed cache of the ready-to-write unWISE and GALEX PSF stamps,
+    which recur for many neighboring galaxies.
+
+    The stamps are kept in memory and (if cache_dir is set) in cache_dir, in a
+    file named by the hash of the key which defines the stamp (band, coadd_id,
+    PSF model, oversampling, and flux rescaling). Each file is written to a
+    private temporary file which is then renamed, so the directory can be
+    shared by any number of MPI ranks and a partially written stamp is never
+    read.
+
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.memory = {}
+        self.hits = 0
+        self.misses = 0
+
+    def unwise(self, band, coadd_id):
+        """See unwise_psf_stamp."""
+        coadd_id = str(coadd_id).strip()
+        key = dict(kind='unwise', band=band, coadd_id=coadd_id,
+                   modelname='neo6_unwisecat' if band in (1, 2) else None,
+                   oversample=2 if band == 4 else 1,
+                   fluxrescale=UNWISE_FLUXRESCALES[band])
+        return self.get(key, unwise_psf_stamp, band, coadd_id)
+
+    def galex(self, band, galex_dir):
+        """See galex_psf_stamp."""
+        key = dict(kind='galex', band=band, galex_dir=galex_dir)
+        return self.get(key, galex_psf_stamp, band, galex_dir)
+
+    def get(self, key, func, *args):
+        """Return the stamp defined by key, calling func(*args) (and caching the
+        result) if necessary. The returned stamp should not be modified in place.
+
+        """
+        import json, hashlib
+
+        key = dict(key, version=PSFCACHE_VERSION)
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        if digest in self.memory:
+            self.hits += 1
+            return self.memory[digest]
+
+        cachefile = None
+        if self.cache_dir is not None:
+            cachefile = os.path.join(self.cache_dir, digest[:2], '{}.npy'.format(digest))
+        try:
+            psfimg = np.load(cachefile)
+            self.hits += 1
+        except (TypeError, OSError, ValueError):
+            psfimg = func(*args)
+            self.misses += 1
+            if cachefile is not None:
+                os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+                tmpfile = '{}.{}.tmp'.format(cachefile, os.getpid())
+                with open(tmpfile, 'wb') as F:
+                    np.save(F, psfimg)
+                os.replace(tmpfile, cachefile)
+        self.memory[digest] = psfimg
+        return psfimg
+
+    def report(self, hits0=0, misses0=0):
+        """Print and record the hits and misses since the counts were hits0 and
+        misses0.
+
+        """
+        import legacyhalos.telemetry
+        hits, misses = self.hits - hits0, self.misses - misses0
+        print('PSF cache: {} hits, {} misses.'.format(hits, misses))
+        legacyhalos.telemetry.record(psfcache_hits=hits, psfcache_misses=misses)
+
+# Per-process (i.e., per-rank) cache, shared by all the galaxies built in this
+# process. Galaxies built in a forked worker (see
+# legacyhalos.mpi.run_with_watchdog) only share the stamps on disk.
+PSFCACHE = PSFCache()
+
 def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
                   nproc=1, pixscale=0.262, run='south', racolumn='RA', deccolumn='DEC',
                   nsigma=None, 
@@ -308,10 +713,23 @@ def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
                   #no_subsky=False,
                   subsky_radii=None, #ubercal_sky=False,
                   just_coadds=False, require_grz=True, no_gaia=False,
-                  no_tycho=False, write_wise_psf=False):
+                  no_tycho=False, write_wise_psf=False, inprocess=False, ccdindex=None,
+                  reuse=None, compression='runbrick', psf_cache_dir=None):
     """Build a custom set of large-galaxy coadds
 
     radius_mosaic in arcsec
+    ccdindex - optional legacyhalos.ccdindex.CCDIndex (see get_ccds)
+    reuse - optional directory of a legacyhalos.mosaics.MosaicRegistry; if a
+      mosaic built with the same settings contains this one then cut it out
+      instead of running runbrick (unless force=True), and register every
+      mosaic which is built
+    inprocess - run runbrick in this process with the given survey object (see
+      run_runbrick) rather than in a subprocess
+    compression - output compression profile of the image, model, and invvar
+      mosaics (see legacyhalos.compression)
+    psf_cache_dir - optional directory of the on-disk cache of the unWISE and
+      GALEX PSF stamps, which can be shared by all the ranks (see PSFCache);
+      the stamps are always cached in memory (see PSFCACHE)
 
     You must specify *one* of the following:
       * pipeline - standard call to runbrick
@@ -319,8 +737,8 @@ def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
         with custom sky-subtraction
 
     """
-    import subprocess
-    
+    from legacyhalos.compression import parse_profile, recompress_products
+
     if survey is None:
         from legacypipe.survey import LegacySurveyData
         survey = LegacySurveyData()
@@ -328,6 +746,8 @@ def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
     if galaxy is None:
         galaxy = 'galaxy'
 
+    parse_profile(compression) # fail early on an unknown profile
+
     if custom:
         stagesuffix = 'custom'
     else:
@@ -336,9 +756,26 @@ def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
     width = _mosaic_width(radius_mosaic, pixscale)
     brickname = 'custom-{}'.format(custom_brickname(onegal[racolumn], onegal[deccolumn]))
 
+    if just_coadds:
+        unwise = False
+
+    if reuse is not None:
+        from legacyhalos.mosaics import MosaicRegistry, mosaic_settings
+        registry = MosaicRegistry(reuse)
+        settings = mosaic_settings(stagesuffix, run, pixscale, unwise=unwise, galex=galex,
+                                   apodize=apodize, no_gaia=no_gaia, no_tycho=no_tycho,
+                                   nsigma=nsigma, subsky_radii=subsky_radii,
+                                   just_coadds=just_coadds, require_grz=require_grz,
+                                   write_wise_psf=write_wise_psf)
+        if not force and registry.reuse(galaxy, survey.output_dir, onegal[racolumn],
+                                        onegal[deccolumn], width, settings):
+            recompress_products(galaxy, survey.output_dir, stagesuffix, compression)
+            return 1, stagesuffix
+
     # Quickly read the input CCDs and check that we have all the colors we need.
     bands = ['g', 'r', 'z']
-    ccds = get_ccds(survey, onegal[racolumn], onegal[deccolumn], pixscale, width)
+    ccds = get_ccds(survey, onegal[racolumn], onegal[deccolumn], pixscale, width,
+                    ccdindex=ccdindex)
     if len(ccds) == 0:
         print('No CCDs touching this brick; nothing to do.')
         return 1, stagesuffix
@@ -368,7 +805,6 @@ def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
     cmd += '--checkpoint {galaxydir}/{galaxy}-{stagesuffix}-checkpoint.p '
     cmd += '--pickle {galaxydir}/{galaxy}-{stagesuffix}-%%(stage)s.p '
     if just_coadds:
-        unwise = False
         cmd += '--stage image_coadds --early-coadds '
     if not unwise:
         cmd += '--no-unwise-coadds --no-wise '
@@ -420,14 +856,12 @@ def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
                      stagesuffix=stagesuffix)
     print(cmd, flush=True, file=log)
 
-    err = subprocess.call(cmd.split(), stdout=log, stderr=log)
+    err = run_runbrick(cmd, survey=survey, log=log, inprocess=inprocess)
     #err = 0
 
     # optionally write out the GALEX and WISE PSFs
     if write_wise_psf:
         import fitsio
-        import unwise_psf.unwise_psf as unwise_psf
-        from legacypipe.galex import galex_psf
 
         cat = fitsio.read(os.path.join(survey.output_dir, 'tractor', 'cus', 'tractor-{}.fits'.format(brickname)),
                           columns=['ref_cat', 'ref_id', 'wise_coadd_id', 'brickname'])
@@ -448,46 +882,17 @@ def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
         hdr.add_record(dict(name='PIXSCAL', value=2.75, comment='pixel scale (arcsec)'))
         hdr.add_record(dict(name='COADD_ID', value=coadd_id, comment='WISE coadd ID'))
 
-        # https://github.com/legacysurvey/legacypipe/blob/main/py/legacypipe/unwise.py#L267-L310        
-        fluxrescales = {1: 1.04, 2: 1.005, 3: 1.0, 4: 1.0}
+        psfcache = PSFCACHE
+        if psf_cache_dir is not None:
+            psfcache.cache_dir = psf_cache_dir
+        hits0, misses0 = psfcache.hits, psfcache.misses
         for band in (1, 2, 3, 4):
             wband = 'W{}'.format(band)
             #hdr['BAND'] = wband
             hdr.delete('BAND')
             hdr.add_record(dict(name='BAND', value=wband, comment='Band of this coadd/PSF'))
 
-            #psfimg = unwise_psf.get_unwise_psf(band, coadd_id)
-            #psfimg /= psfimg.sum()
-
-            if (band == 1) or (band == 2):
-                # we only have updated PSFs for W1 and W2
-                psfimg = unwise_psf.get_unwise_psf(band, coadd_id,
-                                                   modelname='neo6_unwisecat')
-            else:
-                psfimg = unwise_psf.get_unwise_psf(band, coadd_id)
-
-            if band == 4:
-                # oversample (the unwise_psf models are at native W4 5.5"/pix,
-                # while the unWISE coadds are made at 2.75"/pix.
-                ph,pw = psfimg.shape
-                subpsf = np.zeros((ph*2-1, pw*2-1), np.float32)
-                from astrometry.util.util import lanczos3_interpolate
-                xx,yy = np.meshgrid(np.arange(0., pw-0.51, 0.5, dtype=np.float32),
-                                    np.arange(0., ph-0.51, 0.5, dtype=np.float32))
-                xx = xx.ravel()
-                yy = yy.ravel()
-                ix = xx.astype(np.int32)
-                iy = yy.astype(np.int32)
-                dx = (xx - ix).astype(np.float32)
-                dy = (yy - iy).astype(np.float32)
-                psfimg = psfimg.astype(np.float32)
-                rtn = lanczos3_interpolate(ix, iy, dx, dy, [subpsf.flat], [psfimg])
-
-                psfimg = subpsf
-                del xx, yy, ix, iy, dx, dy
-
-            psfimg /= psfimg.sum()
-            psfimg *= fluxrescales[band]
+            psfimg = psfcache.unwise(band, coadd_id)
             with survey.write_output('copsf', brick=brickname, band=wband) as out:
                 out.fits.write(psfimg, header=hdr)
 
@@ -500,10 +905,10 @@ def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
             #hdr['BAND'] = gband[band]
             hdr.delete('BAND')
             hdr.add_record(dict(name='BAND', value=gband[band], comment='Band of this coadd/PSF'))
-            psfimg = galex_psf(band, os.getenv('GALEX_DIR'))
-            psfimg /= psfimg.sum()
+            psfimg = psfcache.galex(band, os.getenv('GALEX_DIR'))
             with survey.write_output('copsf', brick=brickname, band=gband[band]) as out:
                 out.fits.write(psfimg, header=hdr)
+        psfcache.report(hits0, misses0)
 
     if err != 0:
         print('Something went wrong; please check the logfile.')
@@ -519,4 +924,9 @@ def custom_coadds(onegal, galaxy=None, survey=None, radius_mosaic=None,
                               write_wise_psf=write_wise_psf,
                               #clobber=force,
                               require_grz=require_grz, missing_ok=missing_ok)
+        if ok:
+            recompress_products(galaxy, survey.output_dir, stagesuffix, compression)
+        if ok and reuse is not None:
+            registry.register(galaxy, survey.output_dir, onegal[racolumn], onegal[deccolumn],
+                              width, settings, verbose=verbose)
         return ok, stagesuffix
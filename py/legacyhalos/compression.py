@@ -0,0 +1,250 @@
+"""
+legacyhalos.compression
+=======================
+
+Output compression profiles of the image, model, and inverse-variance mosaics
+written by legacyhalos.coadds.custom_coadds.
+
+runbrick writes these products as RICE-compressed (quantized) FITS, which the
+downstream stages have to decompress every time they are read. After the
+products have been staged (see coadds._rearrange_files) they can be rewritten
+with one of the following profiles:
+
+  runbrick - leave the files as runbrick wrote them (the default)
+  lossless - uncompressed images and models, and GZIP_2-compressed (lossless)
+    inverse variance maps, which compress well; fast to read and lossless
+    relative to the runbrick files
+  rice[:QLEVEL] - RICE compression of every product with the given quantization
+    level (default 4, the fpack and fitsio default); smallest files
+  float32 - everything uncompressed, for scratch space
+
+The file names are unchanged (so the .fits.fz files of the lossless and float32
+profiles hold uncompressed image HDUs, which fitsio and astropy read
+transparently), and the profile is recorded in the LHCOMPR header card of each
+rewritten HDU. Run python -m legacyhalos.compression [files] for a table of the
+read and write times and file sizes of each profile.
+
+"""
+import os, time
+from glob import glob
+import numpy as np
+
+COMPRESSION_PROFILES = ('runbrick', 'lossless', 'rice', 'float32')
+DEFAULT_QLEVEL = 4.0
+PROFILE_CARD = 'LHCOMPR'
+
+def parse_profile(profile):
+    """Split a profile string (e.g., 'rice:8') into its name and quantization
+    level (None unless the profile is 'rice').
+
+    """
+    if profile is None:
+        return 'runbrick', None
+    name, _, qlevel = str(profile).strip().lower().partition(':')
+    if name not in COMPRESSION_PROFILES:
+        raise ValueError('Unknown compression profile {}; choose from {}'.format(
+            profile, ', '.join(COMPRESSION_PROFILES)))
+    if name == 'rice':
+        qlevel = float(qlevel) if qlevel else DEFAULT_QLEVEL
+        if qlevel <= 0:
+            raise ValueError('The RICE quantization level must be positive.')
+        return name, qlevel
+    if qlevel:
+        raise ValueError('Only the rice profile takes a quantization level.')
+    return name, None
+
+def profile_string(profile):
+    """Canonical form of a profile string, as recorded in the header."""
+    name, qlevel = parse_profile(profile)
+    if name == 'rice':
+        return '{}:{:g}'.format(name, qlevel)
+    return name
+
+def compression_settings(profile, imtype, dtype='f4'):
+    """The fitsio (compress, qlevel) arguments for writing one product.
+
+    imtype - 'image', 'model', or 'invvar'
+
+    """
+    name, qlevel = parse_profile(profile)
+    if name in ('runbrick', 'float32'):
+        return None, None
+    if np.dtype(dtype).kind in 'iu':
+        # Integer images are always compressed losslessly.
+        return 'RICE', None
+    if name == 'lossless':
+        if imtype == 'invvar':
+            return 'GZIP_2', None
+        return None, None
+    return 'RICE', qlevel
+
+def _product_imtype(filename):
+    for imtype in ('invvar', 'model', 'image'):
+        if '-{}-'.format(imtype) in os.path.basename(filename):
+            return imtype
+    return 'image'
+
+def recompress_file(filename, profile, imtype=None, outfile=None):
+    """Rewrite every image HDU of a file with the given profile (atomically, so
+    hard links to the original file, e.g., from coadds._stage_file, are left
+    alone). Returns the sizes [bytes] of the input and output files.
+
+    The output always starts with an empty primary HDU (with the header of the
+    input one, if it is empty), so the images are in extension 1, as in the
+    runbrick files, whether or not they are compressed.
+
+    """
+    import fitsio
+    from legacyhalos.mosaics import _copy_header
+
+    if imtype is None:
+        imtype = _product_imtype(filename)
+    if outfile is None:
+        outfile = filename
+    insize = os.path.getsize(filename)
+    card = profile_string(profile)
+
+    tmpfile = outfile+'.tmp'
+    with fitsio.FITS(filename) as F, fitsio.FITS(tmpfile, 'rw', clobber=True) as out:
+        if F[0].has_data():
+            out.write(None)
+        else:
+            out.write(None, header=_copy_header(F[0].read_header()))
+        for hdu in F:
+            if not hdu.has_data():
+                continue
+            data = hdu.read()
+            hdr = _copy_header(hdu.read_header())
+            hdr.add_record(dict(name=PROFILE_CARD, value=card,
+                                comment='legacyhalos output compression profile'))
+            compress, qlevel = compression_settings(profile, imtype, dtype=data.dtype)
+            out.write(data, header=hdr, extname=hdu.get_extname() or None,
+                      compress=compress, qlevel=qlevel)
+    os.replace(tmpfile, outfile)
+    return insize, os.path.getsize(outfile)
+
+def read_profile(filename, ext=1):
+    """Compression profile recorded in a file (or 'runbrick' if none)."""
+    import fitsio
+    hdr = fitsio.read_header(filename, ext=ext)
+    if PROFILE_CARD in hdr:
+        return str(hdr[PROFILE_CARD]).strip()
+    return 'runbrick'
+
+def mosaic_files(galaxy, galaxydir, stagesuffix):
+    """The image, model, and inverse-variance mosaics of a galaxy (as written by
+    coadds._rearrange_files).
+
+    """
+    mosaics = []
+    for imtype in ('image', 'model', 'invvar'):
+        mosaics += sorted(glob(os.path.join(galaxydir, '{}-{}-{}-*.fits.fz'.format(
+            galaxy, stagesuffix, imtype))))
+    return mosaics
+
+def recompress_products(galaxy, galaxydir, stagesuffix, profile, verbose=False):
+    """Rewrite the mosaics of a galaxy with the given profile, skipping the ones
+    already written with it. Returns the number of files rewritten.
+
+    """
+    import legacyhalos.telemetry
+
+    if parse_profile(profile)[0] == 'runbrick':
+        return 0
+
+    card = profile_string(profile)
+    t0 = time.time()
+    nfile, insize, outsize = 0, 0, 0
+    for filename in mosaic_files(galaxy, galaxydir, stagesuffix):
+        if read_profile(filename) == card:
+            continue
+        nin, nout = recompress_file(filename, profile)
+        nfile += 1
+        insize += nin
+        outsize += nout
+        if verbose:
+            print('Rewrote {} ({:.2f} --> {:.2f} MB)'.format(filename, nin/1024**2, nout/1024**2))
+    if nfile > 0:
+        print('Rewrote {} mosaics with compression profile {} ({:.2f} --> {:.2f} MB) in {:.2f} sec.'.format(
+            nfile, card, insize/1024**2, outsize/1024**2, time.time() - t0))
+    legacyhalos.telemetry.record(compression_profile=card, compression_files=nfile,
+                                 compression_bytes_in=insize, compression_bytes_out=outsize)
+    return nfile
+
+def _synthetic_mosaic(size, imtype, rng):
+    """A mock mosaic: a smooth galaxy on a noisy background (for the
+    benchmark).
+
+    """
+    yy, xx = np.indices((size, size))
+    rr = np.hypot(xx - size / 2, (yy - size / 2) / 0.6)
+    galaxy = 50 * np.exp(-(rr / (0.05 * size))**0.5)
+    ivar = np.full((size, size), 400.0, 'f4') * rng.uniform(0.8, 1.2, (size, 1))
+    ivar[:, :size//20] = 0 # edge without coverage
+    if imtype == 'invvar':
+        return ivar.astype('f4')
+    if imtype == 'model':
+        return galaxy.astype('f4')
+    return (galaxy + rng.normal(size=(size, size)) / np.sqrt(400.0)).astype('f4')
+
+def benchmark(files=None, profiles=('runbrick', 'lossless', 'rice:4', 'rice:16', 'float32'),
+              sizes=(1000, 3000), repeat=3, seed=1, file=None):
+    """Time the reading and writing of mosaics with each compression profile and
+    print a table of the file sizes.
+
+    files - mosaics to test (default: synthetic image, model, and invvar mosaics
+      of each size, written as runbrick would, i.e., RICE with qlevel=4)
+
+    """
+    import tempfile, shutil
+    import fitsio
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if files is None:
+            rng = np.random.default_rng(seed)
+            files = []
+            for size in sizes:
+                for imtype in ('image', 'model', 'invvar'):
+                    infile = os.path.join(tmpdir, 'mock{}-custom-{}-r.fits.fz'.format(size, imtype))
+                    fitsio.write(infile, _synthetic_mosaic(size, imtype, rng), compress='RICE',
+                                 qlevel=DEFAULT_QLEVEL, clobber=True)
+                    files.append(infile)
+
+        for infile in files:
+            imtype = _product_imtype(infile)
+            for profile in profiles:
+                outfile = os.path.join(tmpdir, 'bench.fits.fz')
+                twrite = []
+                for _ in range(repeat):
+                    t0 = time.time()
+                    if parse_profile(profile)[0] == 'runbrick':
+                        shutil.copyfile(infile, outfile)
+                    else:
+                        recompress_file(infile, profile, imtype=imtype, outfile=outfile)
+                    twrite.append(time.time() - t0)
+                tread = []
+                for _ in range(repeat):
+                    t0 = time.time()
+                    fitsio.read(outfile, ext=1)
+                    tread.append(time.time() - t0)
+                results.append((os.path.basename(infile), profile_string(profile), min(twrite),
+                                min(tread), os.path.getsize(outfile)))
+
+    print('{:<36s} {:<10s} {:>10s} {:>10s} {:>10s}'.format(
+        'file', 'profile', 'write[ms]', 'read[ms]', 'size[MB]'), file=file)
+    for name, profile, twrite, tread, nbytes in results:
+        print('{:<36s} {:<10s} {:>10.1f} {:>10.1f} {:>10.2f}'.format(
+            name, profile, 1e3*twrite, 1e3*tread, nbytes/1024**2), file=file)
+    return results
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the output compression profiles.')
+    parser.add_argument('files', nargs='*', help='Mosaics to test (default: synthetic mosaics).')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timing repetitions.')
+    args = parser.parse_args()
+    benchmark(files=args.files if len(args.files) > 0 else None, repeat=args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+legacyhalos.coverage
+====================
+
+Lightweight grz coverage maps of the custom mosaics.
+
+A CoverageMap holds two bit-packed (one bit per pixel) planes for each band of
+a mosaic: whether the pixel has any data and whether it has a nonzero inverse
+variance. The maps are built once and cached in a small sidecar file
+({galaxy}-{filesuffix}-coverage.npz), so subsequent coverage checks (e.g.,
+when building the catalogs) never read the images. Positions and ellipses can
+be checked for a whole sample at once.
+
+The maps are built from the light-weight footprint products of the mosaic: a
+pixel has data if its nexp (number of exposures) is nonzero, and has a nonzero
+inverse variance unless the ALLMASK bit of its band is also set in the
+maskbits image (i.e., every exposure was masked). Older mosaics without the
+nexp images fall back to the (much larger) image and inverse-variance mosaics.
+
+"""
+import os
+import numpy as np
+
+COVERAGE_VERSION = 1
+
+def _allmask_bit(band):
+    """Value of the ALLMASK_{band} bit of the legacypipe maskbits."""
+    try:
+        from legacypipe.bits import MASKBITS
+    except ImportError:
+        MASKBITS = {'ALLMASK_G': 2**5, 'ALLMASK_R': 2**6, 'ALLMASK_Z': 2**7}
+    return MASKBITS['ALLMASK_{}'.format(band.upper())]
+
+def _coverage_meta(inputfiles, params):
+    """Modification time and size of each input file plus the (JSON-serializable)
+    parameters, used to decide whether a coverage map is stale.
+
+    """
+    import json
+    inputs = {}
+    for infile in inputfiles:
+        st = os.stat(infile)
+        inputs[infile] = [st.st_mtime, st.st_size]
+    return json.loads(json.dumps({'version': COVERAGE_VERSION, 'inputs': inputs,
+                                  'params': params}))
+
+def get_coverage_filename(galaxy, galaxydir, filesuffix='largegalaxy'):
+    return os.path.join(galaxydir, '{}-{}-coverage.npz'.format(galaxy, filesuffix))
+
+class CoverageMap(object):
+    """Bit-packed coverage planes of one mosaic.
+
+    wcs - TAN WCS parameters (CRVAL1, CRVAL2, CRPIX1, CRPIX2, CD1_1, CD1_2, CD2_1, CD2_2)
+    shape - (height, width) of the mosaic
+    packed - dictionary of np.packbits planes, with keys {kind}_{band}, where
+      kind is 'data' or 'ivar'
+
+    """
+    def __init__(self, wcs, shape, bands, packed):
+        self.wcs = [float(ww) for ww in wcs]
+        self.shape = tuple(int(nn) for nn in shape)
+        self.bands = list(bands)
+        self.packed = packed
+        self._planes = {}
+
+    @classmethod
+    def from_arrays(cls, wcs, images, ivars, bands):
+        """Build the map from image and inverse-variance arrays (dictionaries keyed
+        by band).
+
+        """
+        packed, shape = {}, images[bands[0]].shape
+        for band in bands:
+            img, ivar = images[band], ivars[band]
+            if img.shape != shape or ivar.shape != shape:
+                raise ValueError('Mosaics of different sizes.')
+            packed['data_{}'.format(band)] = np.packbits((img != 0) | (ivar != 0), axis=None)
+            packed['ivar_{}'.format(band)] = np.packbits(ivar != 0, axis=None)
+        return cls(wcs, shape, bands, packed)
+
+    @classmethod
+    def from_footprints(cls, wcs, nexps, maskbits, bands):
+        """Build the map from the nexp images (a dictionary keyed by band) and the
+        maskbits image.
+
+        """
+        packed, shape = {}, maskbits.shape
+        for band in bands:
+            nexp = nexps[band]
+            if nexp.shape != shape:
+                raise ValueError('Mosaics of different sizes.')
+            data = nexp > 0
+            packed['data_{}'.format(band)] = np.packbits(data, axis=None)
+            packed['ivar_{}'.format(band)] = np.packbits(data & (maskbits & _allmask_bit(band) == 0), axis=None)
+        return cls(wcs, shape, bands, packed)
+
+    @classmethod
+    def from_footprint_files(cls, nexpfiles, maskbitsfile, bands):
+        """Build the map from the nexp and maskbits mosaics (see from_footprints)."""
+        import fitsio
+        from legacyhalos.mosaics import _header_wcs
+
+        wcs = _header_wcs(fitsio.read_header(nexpfiles[bands[0]], ext=1))
+        nexps = {band: fitsio.read(nexpfiles[band]) for band in bands}
+        return cls.from_footprints(wcs, nexps, fitsio.read(maskbitsfile), bands)
+
+    @classmethod
+    def from_images(cls, imfiles, ivarfiles, bands):
+        """Build the map from the image and inverse-variance mosaics (dictionaries
+        of file names keyed by band).
+
+        """
+        import fitsio
+        from legacyhalos.mosaics import _header_wcs
+
+        wcs = _header_wcs(fitsio.read_header(imfiles[bands[0]], ext=1))
+        images = {band: fitsio.read(imfiles[band]) for band in bands}
+        ivars = {band: fitsio.read(ivarfiles[band]) for band in bands}
+        return cls.from_arrays(wcs, images, ivars, bands)
+
+    def write(self, filename, inputfiles):
+        """Write the map (atomically), along with the modification times of the
+        mosaics it was built from.
+
+        """
+        import json
+
+        meta = _coverage_meta(inputfiles, {'wcs': self.wcs, 'shape': self.shape,
+                                           'bands': self.bands})
+        tmpfile = filename+'.tmp'
+        with open(tmpfile, 'wb') as F:
+            np.savez_compressed(F, meta=np.array(json.dumps(meta)), **self.packed)
+        os.rename(tmpfile, filename)
+
+    @classmethod
+    def read(cls, filename, inputfiles):
+        """Read the output of write. Returns None if the file does not exist, cannot
+        be read, or any of the input files has changed.
+
+        """
+        import json, zipfile
+
+        if not os.path.isfile(filename):
+            return None
+        try:
+            with np.load(filename) as F:
+                meta = json.loads(str(F['meta']))
+                params = meta['params']
+                if meta != _coverage_meta(inputfiles, params):
+                    return None
+                packed = {key: F[key] for key in F.files if key != 'meta'}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            print('Problem reading coverage map {}'.format(filename))
+            return None
+        return cls(params['wcs'], params['shape'], params['bands'], packed)
+
+    def plane(self, band, kind='ivar'):
+        """Unpacked (boolean) coverage plane."""
+        key = '{}_{}'.format(kind, band)
+        if key not in self._planes:
+            npix = self.shape[0] * self.shape[1]
+            self._planes[key] = np.unpackbits(self.packed[key], count=npix).reshape(self.shape).astype(bool)
+        return self._planes[key]
+
+    def radec2pixelxy(self, ra, dec):
+        """One-indexed pixel coordinates."""
+        from legacyhalos.ccdindex import tan_radec2pixelxy
+        return tan_radec2pixelxy(*self.wcs, ra, dec)
+
+    def grz_missing(self, ra=None, dec=None, bands=None, just_ivar=False, box=2):
+        """Whether any band is missing in a small box around each position (or
+        around the center of the mosaic): missing means no data (or, if
+        just_ivar=True, no inverse variance) in any pixel of the box.
+
+        The box is the same slice [ycen-box:ycen+box, xcen-box:xcen+box] of the
+        plane as in the image-based check it replaces.
+
+        """
+        if bands is None:
+            bands = self.bands
+        H, W = self.shape
+        if ra is None:
+            ycen, xcen = np.array([H//2]), np.array([W//2])
+        else:
+            xx, yy = self.radec2pixelxy(np.atleast_1d(ra), np.atleast_1d(dec))
+            ycen, xcen = np.trunc(yy - 1).astype(int), np.trunc(xx - 1).astype(int)
+
+        def _slice(cen, nn):
+            # Start and stop of the python slice [cen-box:cen+box] of an axis
+            # of length nn (negative indices count from the end).
+            lo, hi = cen - box, cen + box
+            lo, hi = [np.clip(np.where(ii < 0, ii + nn, ii), 0, nn) for ii in (lo, hi)]
+            pix = lo[:, None] + np.arange(2 * box)[None, :]
+            return np.minimum(pix, nn - 1), pix < hi[:, None]
+
+        ypix, yok = _slice(ycen, H)
+        xpix, xok = _slice(xcen, W)
+        inbox = yok[:, :, None] & xok[:, None, :]
+
+        kind = 'ivar' if just_ivar else 'data'
+        missing = np.zeros(len(ycen), bool)
+        for band in bands:
+            plane = self.plane(band, kind)[ypix[:, :, None], xpix[:, None, :]]
+            missing |= ~np.any(plane & inbox, axis=(1, 2))
+        if ra is None or np.isscalar(ra):
+            return missing[0]
+        return missing
+
+    def ellipse_fraction(self, ra, dec, sma, ba, pa, bands=None, kind='ivar'):
+        """Fraction of the pixels inside each ellipse with coverage in every band.
+
+        ra, dec - centers [degrees]
+        sma - semi-major axes [arcsec]
+        ba - minor-to-major axis ratios
+        pa - position angles [degrees East of North]
+
+        Pixels which fall outside the mosaic count as not covered.
+
+        """
+        if bands is None:
+            bands = self.bands
+        ra, dec, sma, ba, pa = np.broadcast_arrays(*[np.atleast_1d(np.asarray(par, 'f8'))
+                                                     for par in (ra, dec, sma, ba, pa)])
+        nell = len(ra)
+
+        covered = np.ones(self.shape, bool)
+        for band in bands:
+            covered &= self.plane(band, kind)
+
+        H, W = self.shape
+        cd = np.array(self.wcs[4:]).reshape(2, 2) * 3600 # [arcsec/pixel]
+        pixscale = np.sqrt(np.abs(np.linalg.det(cd)))
+        xcen, ycen = self.radec2pixelxy(ra, dec)
+
+        # All the pixels of the bounding box of every ellipse, in one array.
+        rad = np.ceil(sma / pixscale).astype(int) + 1
+        nside = 2 * rad + 1
+        npix = nside**2
+        owner = np.repeat(np.arange(nell), npix)
+        local = np.arange(npix.sum()) - np.repeat(np.cumsum(npix) - npix, npix)
+        x0, y0 = np.round(xcen - 1).astype(int), np.round(ycen - 1).astype(int)
+        yy = y0[owner] - rad[owner] + local // nside[owner]
+        xx = x0[owner] - rad[owner] + local % nside[owner]
+
+        dx, dy = xx - (xcen[owner] - 1), yy - (ycen[owner] - 1)
+        # Offsets East and North [arcsec] and along the major and minor axes.
+        east, north = cd[0, 0] * dx + cd[0, 1] * dy, cd[1, 0] * dx + cd[1, 1] * dy
+        sinpa, cospa = np.sin(np.radians(pa))[owner], np.cos(np.radians(pa))[owner]
+        major, minor = east * sinpa + north * cospa, east * cospa - north * sinpa
+        inside = (major / sma[owner])**2 + (minor / (sma * ba)[owner])**2 <= 1
+
+        good = inside & (xx >= 0) & (xx < W) & (yy >= 0) & (yy < H)
+        good[good] = covered[yy[good], xx[good]]
+
+        ninside = np.bincount(owner[inside], minlength=nell)
+        ngood = np.bincount(owner[good], minlength=nell)
+        frac = np.zeros(nell, 'f4')
+        ok = ninside > 0
+        frac[ok] = ngood[ok] / ninside[ok]
+        return frac
+
+def get_coverage_map(galaxy, galaxydir, filesuffix='largegalaxy', bands=('g', 'r', 'z'),
+                     write=True, verbose=False):
+    """Read the coverage map of a mosaic, building it from the nexp and maskbits
+    mosaics (or, if they are missing, from the image and inverse-variance
+    mosaics) and caching it if necessary.
+
+    """
+    nexpfiles, imfiles, ivarfiles = {}, {}, {}
+    for band in bands:
+        nexpfiles[band] = os.path.join(galaxydir, '{}-{}-nexp-{}.fits.fz'.format(galaxy, filesuffix, band))
+        imfiles[band] = os.path.join(galaxydir, '{}-{}-image-{}.fits.fz'.format(galaxy, filesuffix, band))
+        ivarfiles[band] = os.path.join(galaxydir, '{}-{}-invvar-{}.fits.fz'.format(galaxy, filesuffix, band))
+    maskbitsfile = os.path.join(galaxydir, '{}-{}-maskbits.fits.fz'.format(galaxy, filesuffix))
+
+    footprint = os.path.isfile(maskbitsfile) and all([os.path.isfile(nexpfiles[band]) for band in bands])
+    if footprint:
+        inputfiles = [nexpfiles[band] for band in bands] + [maskbitsfile]
+    else:
+        inputfiles = [imfiles[band] for band in bands] + [ivarfiles[band] for band in bands]
+
+    covfile = get_coverage_filename(galaxy, galaxydir, filesuffix)
+    cmap = CoverageMap.read(covfile, inputfiles)
+    if cmap is not None:
+        if verbose:
+            print('Read {}'.format(covfile))
+        return cmap
+
+    if footprint:
+        cmap = CoverageMap.from_footprint_files(nexpfiles, maskbitsfile, bands)
+    else:
+        cmap = CoverageMap.from_images(imfiles, ivarfiles, bands)
+    if write:
+        try:
+            cmap.write(covfile, inputfiles)
+            if verbose:
+                print('Wrote {}'.format(covfile))
+        except OSError:
+            print('Unable to write coverage map {}'.format(covfile))
+    return cmap
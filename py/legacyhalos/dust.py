@@ -62,30 +62,11 @@ def _bilinear_interpolate(data, y, x):
 
     Notes
     -----
-    Taken in full from https://github.com/kbarbary/sfdmap/
+    Taken in full from https://github.com/kbarbary/sfdmap/ (the numpy and
+    compiled versions are in :mod:`legacyhalos.kernels`).
     """
-    yfloor = np.floor(y)
-    xfloor = np.floor(x)
-    yw = y - yfloor
-    xw = x - xfloor
-
-    # pixel locations
-    y0 = yfloor.astype(np.int)
-    y1 = y0 + 1
-    x0 = xfloor.astype(np.int)
-    x1 = x0 + 1
-
-    # clip locations out of range
-    ny, nx = data.shape
-    y0 = np.maximum(y0, 0)
-    y1 = np.minimum(y1, ny-1)
-    x0 = np.maximum(x0, 0)
-    x1 = np.minimum(x1, nx-1)
-
-    return ((1.0-xw) * (1.0-yw) * data[y0, x0] +
-            xw       * (1.0-yw) * data[y0, x1] +
-            (1.0-xw) * yw       * data[y1, x0] +
-            xw       * yw       * data[y1, x1])
+    from legacyhalos.kernels import bilinear_interpolate
+    return bilinear_interpolate(data, y, x)
 
 
 class _Hemisphere(object):
@@ -112,7 +93,8 @@ class _Hemisphere(object):
 
     Notes
     -----
-    Taken in full from https://github.com/kbarbary/sfdmap/
+    Taken in full from https://github.com/kbarbary/sfdmap/ (the numpy and
+    compiled versions are in :mod:`legacyhalos.kernels`).
     """
     def __init__(self, fname, scaling):
         self.data, header = getdata(fname, header=True)
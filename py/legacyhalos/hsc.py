@@ -77,107 +77,26 @@ def get_galaxy_galaxydir(cat, datadir=None, htmldir=None, html=False):
     else:
         return galaxy, galaxydir
 
-def missing_files(args, sample, size=1, clobber_overwrite=None):
-    from astrometry.util.multiproc import multiproc
-    from legacyhalos.io import _missing_files_one
-
-    dependson = None
-    galaxy, galaxydir = get_galaxy_galaxydir(sample)        
-
-    if args.coadds:
-        suffix = 'coadds'
-        filesuffix = '-custom-coadds.isdone'
-    elif args.pipeline_coadds:
-        suffix = 'pipeline-coadds'
-        if args.just_coadds:
-            filesuffix = '-pipeline-image-grz.jpg'
-        else:
-            filesuffix = '-pipeline-coadds.isdone'
-    elif args.ellipse:
-        suffix = 'ellipse'
-        filesuffix = '-custom-ellipse.isdone'
-        dependson = '-custom-coadds.isdone'
-    elif args.build_catalog:
-        suffix = 'build-catalog'
-        filesuffix = '-custom-ellipse.isdone'        
-        #dependson = '-custom-ellipse.isdone'
-    elif args.htmlplots:
-        suffix = 'html'
-        if args.just_coadds:
-            filesuffix = '-custom-montage-grz.png'
-        else:
-            filesuffix = '-ccdpos.png'
-            #filesuffix = '-custom-maskbits.png'
-        galaxy, _, galaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
-    elif args.htmlindex:
-        suffix = 'htmlindex'
-        filesuffix = '-custom-montage-grz.png'
-        galaxy, _, galaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
-    else:
-        print('Nothing to do.')
-        return
-
-    # Make clobber=False for build_SGA and htmlindex because we're not making
-    # the files here, we're just looking for them. The argument args.clobber
-    # gets used downstream.
-    if args.htmlindex or args.build_catalog:
-        clobber = False
-    else:
-        clobber = args.clobber
-
-    if clobber_overwrite is not None:
-        clobber = clobber_overwrite
-
-    if type(sample) is astropy.table.row.Row:
-        ngal = 1
-    else:
-        ngal = len(sample)
-    indices = np.arange(ngal)
-
-    mp = multiproc(nthreads=args.nproc)
-    missargs = []
-    for gal, gdir in zip(np.atleast_1d(galaxy), np.atleast_1d(galaxydir)):
-        #missargs.append([gal, gdir, filesuffix, dependson, clobber])
-        checkfile = os.path.join(gdir, '{}{}'.format(gal, filesuffix))
-        if dependson:
-            missargs.append([checkfile, os.path.join(gdir, '{}{}'.format(gal, dependson)), clobber])
-        else:
-            missargs.append([checkfile, None, clobber])
-        
-    todo = np.array(mp.map(_missing_files_one, missargs))
-
-    itodo = np.where(todo == 'todo')[0]
-    idone = np.where(todo == 'done')[0]
-    ifail = np.where(todo == 'fail')[0]
+# Filename templates of the files which mark each stage as complete (and of the
+# files each stage depends on); see legacyhalos.mpi.missing_files_plan.
+STAGE_TEMPLATES = [
+    ('coadds', {'suffix': 'coadds', 'filesuffix': '{galaxy}-custom-coadds.isdone'}),
+    ('pipeline_coadds', {'suffix': 'pipeline-coadds', 'filesuffix': '{galaxy}-pipeline-coadds.isdone',
+                         'just_coadds': {'filesuffix': '{galaxy}-pipeline-image-grz.jpg'}}),
+    ('ellipse', {'suffix': 'ellipse', 'filesuffix': '{galaxy}-custom-ellipse.isdone',
+                 'dependson': '{galaxy}-custom-coadds.isdone'}),
+    ('build_catalog', {'suffix': 'build-catalog', 'filesuffix': '{galaxy}-custom-ellipse.isdone',
+                       'clobber': False}),
+    ('htmlplots', {'suffix': 'html', 'filesuffix': '{galaxy}-ccdpos.png', 'html': True,
+                   'just_coadds': {'filesuffix': '{galaxy}-custom-montage-grz.png'}}),
+    ('htmlindex', {'suffix': 'htmlindex', 'filesuffix': '{galaxy}-custom-montage-grz.png', 'html': True,
+                   'clobber': False}),
+    ]
 
-    if len(ifail) > 0:
-        fail_indices = [indices[ifail]]
-    else:
-        fail_indices = [np.array([])]
-
-    if len(idone) > 0:
-        done_indices = [indices[idone]]
-    else:
-        done_indices = [np.array([])]
-
-    if len(itodo) > 0:
-        _todo_indices = indices[itodo]
-        todo_indices = np.array_split(_todo_indices, size) # unweighted
-
-        ## Assign the sample to ranks to make the D25 distribution per rank ~flat.
-        #
-        ## https://stackoverflow.com/questions/33555496/split-array-into-equally-weighted-chunks-based-on-order
-        #weight = np.atleast_1d(sample[DIAMCOLUMN])[_todo_indices]
-        #cumuweight = weight.cumsum() / weight.sum()
-        #idx = np.searchsorted(cumuweight, np.linspace(0, 1, size, endpoint=False)[1:])
-        #if len(idx) < size: # can happen in corner cases
-        #    todo_indices = np.array_split(_todo_indices, size) # unweighted
-        #else:
-        #    todo_indices = np.array_split(_todo_indices, idx) # weighted
-    else:
-        todo_indices = [np.array([])]
-
-    return suffix, todo_indices, done_indices, fail_indices
+def missing_files(args, sample, size=1, clobber_overwrite=None):
+    from legacyhalos.mpi import missing_files_plan
+    return missing_files_plan(args, sample, STAGE_TEMPLATES, get_galaxy_galaxydir, size=size,
+                              clobber_overwrite=clobber_overwrite, strict=False)
     
 def mpi_args():
     import argparse
@@ -438,8 +357,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         mge, centralmask = tractor2mge(central, factor=neighborfactor)
         #plt.clf() ; plt.imshow(centralmask, origin='lower') ; plt.savefig('junk-mask.png') ; pdb.set_trace()
         
-        iclose = np.where([centralmask[np.int(by), np.int(bx)]
-                           for by, bx in zip(tractor.by, tractor.bx)])[0]
+        iclose = np.where(centralmask[tractor.by.astype(int), tractor.bx.astype(int)])[0]
         
         srcs = tractor.copy()
         srcs.cut(np.delete(np.arange(len(tractor)), iclose))
@@ -450,7 +368,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         img = data[refband].data - model
         img[centralmask] = data[refband].data[centralmask]
 
-        mask = np.logical_or(ma.getmask(data[refband]), data['residual_mask'])
+        mask = legacyhalos.io.band_mask(data, refband, residual=True)
         #mask = np.logical_or(data[refband].mask, data['residual_mask'])
         mask[centralmask] = False
 
@@ -533,7 +451,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         # subtract out the PSF sources. Then update the mask (but ignore the
         # residual mask). Finally convert to surface brightness.
         for filt in bands:
-            mask = np.logical_or(ma.getmask(data[filt]), satmask)
+            mask = np.logical_or(legacyhalos.io.band_mask(data, filt), satmask)
             mask[centralmask] = False
             #plt.imshow(mask, origin='lower') ; plt.savefig('/mnt/legacyhalos-data/debug.png')
 
@@ -471,6 +471,69 @@ def write_sbprofile(sbprofile, smascale, sbfile):
 
     print('Wrote {}'.format(sbfile))
 
+MASKCACHE_VERSION = 3
+
+def get_maskcache_filename(galaxy, galaxydir, filesuffix=''):
+    if filesuffix.strip() == '':
+        fsuff = ''
+    else:
+        fsuff = '-{}'.format(filesuffix)
+    return os.path.join(galaxydir, '{}{}-maskcache.npz'.format(galaxy, fsuff))
+
+def _maskcache_meta(inputfiles, params):
+    """Modification time and size of each input file plus the (JSON-serializable)
+    parameters, used to decide whether a mask cache is stale.
+
+    """
+    import json
+    inputs = {}
+    for infile in inputfiles:
+        st = os.stat(infile)
+        inputs[infile] = [st.st_mtime, st.st_size]
+    return json.loads(json.dumps({'version': MASKCACHE_VERSION, 'inputs': inputs,
+                                  'params': params}))
+
+def write_maskcache(cachefile, maskcache, inputfiles, params, verbose=False):
+    """Write the per-central masks and geometry built by a project's
+    _build_multiband_mask (a dictionary of arrays) to a compressed sidecar file,
+    along with the modification times of the files they were built from.
+
+    """
+    import json
+
+    meta = _maskcache_meta(inputfiles, params)
+    tmpfile = cachefile+'.tmp'
+    with open(tmpfile, 'wb') as F:
+        np.savez_compressed(F, meta=np.array(json.dumps(meta)), **maskcache)
+    os.rename(tmpfile, cachefile)
+    if verbose:
+        print('Wrote {} ({:.1f} MB)'.format(cachefile, os.path.getsize(cachefile)/1024**2))
+
+def read_maskcache(cachefile, inputfiles, params, verbose=False):
+    """Read the output of write_maskcache. Returns None if the file does not exist,
+    cannot be read, or is stale (i.e., any of the input files or parameters have
+    changed since it was written).
+
+    """
+    import json, zipfile
+
+    if not os.path.isfile(cachefile):
+        return None
+    try:
+        with np.load(cachefile) as F:
+            meta = json.loads(str(F['meta']))
+            if meta != _maskcache_meta(inputfiles, params):
+                if verbose:
+                    print('Ignoring stale mask cache {}'.format(cachefile))
+                return None
+            maskcache = {key: F[key] for key in F.files if key != 'meta'}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        print('Problem reading mask cache {}'.format(cachefile))
+        return None
+    if verbose:
+        print('Read {}'.format(cachefile))
+    return maskcache
+
 def _get_psfsize_and_depth(tractor, bands, pixscale, incenter=False):
     """Support function for read_multiband. Compute the average PSF size (in arcsec)
     and depth (in 5-sigma AB mags) in each bandpass based on the Tractor
@@ -520,18 +583,39 @@ def _get_psfsize_and_depth(tractor, bands, pixscale, incenter=False):
     return out
 
 def _read_image_data(data, filt2imfile, starmask=None, fill_value=0.0,
-                     filt2pixscale=None, verbose=False):
+                     filt2pixscale=None, dtype=None, verbose=False):
     """Helper function for the project-specific read_multiband method.
 
     Read the multi-band images and inverse variance images and pack them into a
     dictionary. Also create an initial pixel-level mask and handle images with
     different pixel scales (e.g., GALEX and WISE images).
 
+    The mask layers (star, edge, residual, and the inverse variance mask of
+    each band) on each pixel grid are only kept as bits of
+    data['maskplanes'][shape] (see legacyhalos.misc.MaskPlanes), so the image
+    of each band, data[filt], is a masked array without a mask; use band_mask to
+    materialize the mask of a band. The images, models, and inverse variance
+    maps are cast to dtype, if given (e.g., 'f4'; the default keeps the type on
+    disk).
+
     """
-    from astropy.stats import sigma_clipped_stats
-    from scipy.ndimage.morphology import binary_dilation
+    import legacyhalos.telemetry
+    from legacyhalos.misc import data_nbytes
+
+    with legacyhalos.telemetry.timer('read'):
+        data = _read_image_data_bands(data, filt2imfile, starmask=starmask,
+                                      fill_value=fill_value, dtype=dtype,
+                                      verbose=verbose)
+    legacyhalos.telemetry.record(width=data['refband_width'], height=data['refband_height'],
+                                 nband=len(data['bands']), data_nbytes=data_nbytes(data))
+    return data
+
+def _read_image_data_bands(data, filt2imfile, starmask=None, fill_value=0.0,
+                           dtype=None, verbose=False):
+    """Read the images for each band (see _read_image_data)."""
     from scipy.ndimage.filters import gaussian_filter
-    from skimage.transform import resize
+    from legacyhalos.misc import MaskReprojectionCache
+    from legacyhalos.kernels import sigma_clipped_stats, threshold_mask
 
     from tractor.psf import PixelizedPSF
     from tractor.tractortime import TAITime
@@ -545,6 +629,10 @@ def _read_image_data(data, filt2imfile, starmask=None, fill_value=0.0,
 
     vega2ab = {'W1': 2.699, 'W2': 3.339, 'W3': 5.174, 'W4': 6.620}
 
+    # The star mask is only reprojected (and dilated) once onto each pixel grid.
+    starmasks = MaskReprojectionCache(starmask)
+    data['maskplanes'] = {}
+
     # Loop on each filter and return the masked data.
     residual_mask = None
     for filt in bands:
@@ -556,12 +644,16 @@ def _read_image_data(data, filt2imfile, starmask=None, fill_value=0.0,
         image = fitsio.read(filt2imfile[filt]['image'])
         hdr = fitsio.read_header(filt2imfile[filt]['image'], ext=1)
         model = fitsio.read(filt2imfile[filt]['model'])
+        if dtype is not None:
+            image, model = image.astype(dtype, copy=False), model.astype(dtype, copy=False)
 
         # Initialize the mask based on the inverse variance
         if 'invvar' in filt2imfile[filt].keys():
             if verbose:
                 print('Reading {}'.format(filt2imfile[filt]['invvar']))
             invvar = fitsio.read(filt2imfile[filt]['invvar'])
+            if dtype is not None:
+                invvar = invvar.astype(dtype, copy=False)
             mask = invvar <= 0 # True-->bad, False-->good
         else:
             invvar = None
@@ -603,13 +695,6 @@ def _read_image_data(data, filt2imfile, starmask=None, fill_value=0.0,
             wcs = ConstantFitsWcs(wcs)
         data['{}_wcs'.format(filt.lower())] = wcs
 
-        # Add in the star mask, resizing if necessary for this image/pixel scale.
-        if doresize:
-            _starmask = resize(starmask*1.0, mask.shape, mode='reflect') > 0
-            mask = np.logical_or(mask, _starmask)
-        else:
-            mask = np.logical_or(mask, starmask)
-
         # Flag significant residual pixels after subtracting *all* the models
         # (we will restore the pixels of the galaxies of interest later). Only
         # consider the optical (grz) bands here.
@@ -617,26 +702,23 @@ def _read_image_data(data, filt2imfile, starmask=None, fill_value=0.0,
         _, _, sig = sigma_clipped_stats(resid, sigma=3.0)
         data['{}_sigma'.format(filt.lower())] = sig
         if residual_mask is None:
-            residual_mask = np.abs(resid) > 5*sig
+            residual_mask = threshold_mask(resid, 5*sig)
         else:
-            _residual_mask = np.abs(resid) > 5*sig
             # In grz, use a cumulative residual mask. In UV/IR use an
             # individual-band mask.
             if doresize:
                 pass
                 #residual_mask = resize(_residual_mask, residual_mask.shape, mode='reflect')
             else:
-                residual_mask = np.logical_or(residual_mask, _residual_mask)
+                threshold_mask(resid, 5*sig, out=residual_mask)
 
-        # Dilate the mask, mask out a 10% border, and pack into a dictionary.
-        mask = binary_dilation(mask, iterations=2)
-        edge = np.int(0.02*sz[0])
-        mask[:edge, :] = True
-        mask[:, :edge] = True
-        mask[:, sz[0]-edge:] = True
-        mask[sz[0]-edge:, :] = True
+        # Add in the star mask (resized if necessary for this image/pixel
+        # scale), dilate the mask, mask out a 10% border, and pack into the
+        # mask planes of this pixel grid.
+        _add_band_masks(data, filt, mask, starmasks)
+        del mask
 
-        data[filt] = ma.masked_array(image, mask) # [nanomaggies]
+        data[filt] = ma.masked_array(image) # [nanomaggies]; see band_mask
         ma.set_fill_value(data[filt], fill_value)
 
         if invvar is not None:
@@ -649,6 +731,46 @@ def _read_image_data(data, filt2imfile, starmask=None, fill_value=0.0,
                 print('Warning! Negative pixels in the {}-band inverse variance map!'.format(filt))
                 #pdb.set_trace()
 
-    data['residual_mask'] = residual_mask
+    data['maskplanes'][residual_mask.shape].add('residual', residual_mask)
 
     return data
+
+def _add_band_masks(data, filt, mask, starmasks):
+    """Add the (dilated) inverse variance mask of one band to the mask planes of
+    its pixel grid, creating the planes (with the star mask, reprojected from
+    the MaskReprojectionCache starmasks, and a 2% edge mask) for the first band
+    on each grid. The dilation of the union is the union of the dilations, so
+    the star mask is only reprojected and dilated once per pixel scale.
+
+    """
+    from legacyhalos.misc import MaskPlanes, dilate_mask
+
+    sz = mask.shape
+    if 'maskplanes' not in data:
+        data['maskplanes'] = {}
+    if sz not in data['maskplanes']:
+        planes = MaskPlanes(sz)
+        planes.add('star', starmasks.reproject(sz, iterations=2))
+        edgemask = np.zeros(sz, bool)
+        edge = int(0.02*sz[0])
+        edgemask[:edge, :] = True
+        edgemask[:, :edge] = True
+        edgemask[:, sz[0]-edge:] = True
+        edgemask[sz[0]-edge:, :] = True
+        planes.add('edge', edgemask)
+        data['maskplanes'][sz] = planes
+    data['maskplanes'][sz].add('{}_invvar'.format(filt.lower()), dilate_mask(mask, iterations=2))
+
+def band_mask(data, filt, residual=False):
+    """Materialize the boolean mask (True=masked) of one band from the mask planes
+    written by _read_image_data: the star, edge, and inverse variance masks, and
+    (with residual=True) the cumulative residual mask.
+
+    A new array is returned on every call, so it can be modified freely.
+
+    """
+    planes = data['maskplanes'][data[filt].shape]
+    names = ['star', 'edge', '{}_invvar'.format(filt.lower())]
+    if residual:
+        names.append('residual')
+    return planes.any(names)
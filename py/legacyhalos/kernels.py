@@ -0,0 +1,543 @@
+"""
+legacyhalos.kernels
+===================
+
+Compiled versions of the hot pixel loops (painting elliptical masks, sigma
+clipping, residual thresholding, binned and annulus statistics, and bilinear
+interpolation), with pure-numpy fallbacks.
+
+The compiled kernels are used if numba is installed; otherwise (or if the
+$LEGACYHALOS_KERNELS environment variable is set to 'numpy') the numpy versions
+are used. Both backends give the same answers: the elliptical masks, thresholds
+and interpolation are bit-identical, and the statistics agree to floating-point
+rounding. Run python -m legacyhalos.kernels for a table of the speedups.
+
+The pipeline forks its workers (legacyhalos.mpi.run_with_watchdog and run_local,
+the ellipse-fitting pool and the sky batch), often after a parallel kernel has
+already run in the parent. Neither the TBB nor the OpenMP threading layer
+survives a fork (the parent hangs or the children are killed), so the numba
+threading layer is pinned to the fork-safe 'workqueue' layer unless
+$NUMBA_THREADING_LAYER is set explicitly.
+
+"""
+import os, time
+import numpy as np
+
+try:
+    import numba
+    from numba import njit, prange
+    if 'NUMBA_THREADING_LAYER' not in os.environ:
+        numba.config.THREADING_LAYER = 'workqueue'
+except ImportError:
+    numba = None
+    prange = range
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit (the kernels then run as plain Python)."""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+HAVE_NUMBA = numba is not None
+
+_BACKEND = None
+
+def set_backend(name=None):
+    """Select the 'numba' or 'numpy' backend (or the default, if None)."""
+    global _BACKEND
+    if name not in (None, 'numba', 'numpy'):
+        raise ValueError('Unrecognized backend {}'.format(name))
+    if name == 'numba' and not HAVE_NUMBA:
+        raise ImportError('numba is not installed')
+    _BACKEND = name
+
+def backend():
+    """Return the name of the active backend."""
+    if _BACKEND is not None:
+        return _BACKEND
+    if HAVE_NUMBA and os.getenv('LEGACYHALOS_KERNELS', 'numba') != 'numpy':
+        return 'numba'
+    return 'numpy'
+
+def use_numba():
+    return backend() == 'numba'
+
+# Elliptical masks.
+
+@njit(parallel=True, cache=True)
+def _paint_ellipses_numba(mask, x0, x1, y0, y1, xcen, ycen, semia, semib, cosphi, sinphi):
+    for kk in range(len(x0)):
+        for ii in prange(x0[kk], x1[kk]):
+            dx = ii - xcen[kk]
+            for jj in range(y0[kk], y1[kk]):
+                dy = jj - ycen[kk]
+                xp = dx * cosphi[kk] + dy * sinphi[kk]
+                yp = -dx * sinphi[kk] + dy * cosphi[kk]
+                if (xp / semia[kk])**2 + (yp / semib[kk])**2 <= 1:
+                    mask[ii, jj] = True
+
+def _paint_ellipses_numpy(mask, x0, x1, y0, y1, xcen, ycen, semia, semib,
+                          cosphi, sinphi, maxpix=2**24):
+    nx, ny = np.clip(x1 - x0, 0, None), np.clip(y1 - y0, 0, None)
+    npix = nx * ny
+
+    ellipses = np.where(npix > 0)[0]
+    if len(ellipses) == 1:
+        kk = ellipses[0]
+        x, y = np.ogrid[x0[kk]:x1[kk], y0[kk]:y1[kk]]
+        xp = (x-xcen[kk]) * cosphi[kk] + (y-ycen[kk]) * sinphi[kk]
+        yp = -(x-xcen[kk]) * sinphi[kk] + (y-ycen[kk]) * cosphi[kk]
+        mask[x0[kk]:x1[kk], y0[kk]:y1[kk]] |= (xp / semia[kk])**2 + (yp/semib[kk])**2 <= 1
+        return
+
+    chunks = np.split(ellipses, np.where(np.diff(np.cumsum(npix[ellipses]) // maxpix) > 0)[0] + 1)
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        counts = npix[chunk]
+        owner = np.repeat(chunk, counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        x = x0[owner] + offset // ny[owner]
+        y = y0[owner] + offset % ny[owner]
+
+        xp = (x-xcen[owner]) * cosphi[owner] + (y-ycen[owner]) * sinphi[owner]
+        yp = -(x-xcen[owner]) * sinphi[owner] + (y-ycen[owner]) * cosphi[owner]
+        inside = (xp / semia[owner])**2 + (yp/semib[owner])**2 <= 1
+        mask[x[inside], y[inside]] = True
+
+def paint_ellipses(mask, x0, x1, y0, y1, xcen, ycen, semia, semib, cosphi, sinphi,
+                   maxpix=2**24):
+    """OR one or more ellipses into a boolean mask (in place), evaluating only
+    the pixels in the [x0:x1, y0:y1] bounding box of each ellipse (see
+    legacyhalos.misc.ellipse_masks). The geometry is float64 and the cosine and
+    sine of the position angle are precomputed.
+
+    """
+    x0, x1, y0, y1 = [np.atleast_1d(val).astype(np.int64) for val in (x0, x1, y0, y1)]
+    xcen, ycen, semia, semib, cosphi, sinphi = [np.atleast_1d(val).astype('f8') for val in
+                                                (xcen, ycen, semia, semib, cosphi, sinphi)]
+    if use_numba():
+        _paint_ellipses_numba(mask, x0, x1, y0, y1, xcen, ycen, semia, semib, cosphi, sinphi)
+    else:
+        _paint_ellipses_numpy(mask, x0, x1, y0, y1, xcen, ycen, semia, semib,
+                              cosphi, sinphi, maxpix=maxpix)
+    return mask
+
+# Sigma-clipped statistics.
+
+@njit(cache=True)
+def _clipped_moments(x, lo, hi):
+    """Number, mean, standard deviation, minimum, and maximum of the pixels in
+    [lo, hi].
+
+    """
+    nn, mean, vmin, vmax = 0, 0.0, np.inf, -np.inf
+    for val in x:
+        if val >= lo and val <= hi:
+            nn += 1
+            mean += val
+            vmin = min(vmin, val)
+            vmax = max(vmax, val)
+    if nn == 0:
+        return 0, np.nan, np.nan, np.nan, np.nan
+    mean /= nn
+    var = 0.0
+    for val in x:
+        if val >= lo and val <= hi:
+            var += (val - mean)**2
+    return nn, mean, np.sqrt(var / nn), vmin, vmax
+
+@njit(cache=True)
+def _clipped_median(x, lo, hi, nn, vmin, vmax, nbins=65536):
+    """Median of the nn pixels in [lo, hi], which range from vmin to vmax. The
+    pixels are counted in a histogram to find the bin(s) which contain the
+    middle pixel(s), and only the pixels in those bins are partitioned.
+
+    """
+    if vmin == vmax:
+        return float(vmin)
+
+    scale = nbins / (vmax - vmin)
+    counts = np.zeros(nbins, np.int64)
+    for val in x:
+        if val >= lo and val <= hi:
+            counts[min(int((val - vmin) * scale), nbins-1)] += 1
+
+    k1, k2 = (nn - 1) // 2, nn // 2
+    ibin, nbelow = 0, 0
+    while nbelow + counts[ibin] <= k1:
+        nbelow += counts[ibin]
+        ibin += 1
+    jbin, nbelow2 = ibin, nbelow
+    while nbelow2 + counts[jbin] <= k2:
+        nbelow2 += counts[jbin]
+        jbin += 1
+
+    inbin = np.empty(nbelow2 + counts[jbin] - nbelow, x.dtype)
+    nin = 0
+    for val in x:
+        if val >= lo and val <= hi:
+            kbin = min(int((val - vmin) * scale), nbins-1)
+            if kbin >= ibin and kbin <= jbin:
+                inbin[nin] = val
+                nin += 1
+    inbin.sort()
+    return (float(inbin[k1 - nbelow]) + float(inbin[k2 - nbelow])) / 2
+
+@njit(cache=True)
+def _sigma_clipped_stats_numba(data, sigma, maxiters):
+    # Each iteration keeps a subset of the pixels kept by the previous one, so
+    # the clipped pixels are tracked as a range of values rather than copied.
+    # The initial range excludes the NaN and infinite pixels.
+    lo, hi = -np.finfo(np.float64).max, np.finfo(np.float64).max
+    nn, mean, std, vmin, vmax = _clipped_moments(data, lo, hi)
+    for _ in range(maxiters):
+        if nn == 0:
+            break
+        med = _clipped_median(data, lo, hi, nn, vmin, vmax)
+        lo1, hi1 = max(lo, med - std * sigma), min(hi, med + std * sigma)
+        nn1, mean1, std1, vmin1, vmax1 = _clipped_moments(data, lo1, hi1)
+        if nn1 == nn:
+            break
+        lo, hi, nn, mean, std, vmin, vmax = lo1, hi1, nn1, mean1, std1, vmin1, vmax1
+
+    if nn == 0:
+        return np.nan, np.nan, np.nan
+    return mean, _clipped_median(data, lo, hi, nn, vmin, vmax), std
+
+def _sigma_clipped_stats_numpy(data, sigma, maxiters):
+    x = data[np.isfinite(data)]
+    for _ in range(maxiters):
+        if x.size == 0:
+            break
+        med, std = np.median(x), np.std(x)
+        keep = (x >= med - std * sigma) & (x <= med + std * sigma)
+        if np.all(keep):
+            break
+        x = x[keep]
+
+    if x.size == 0:
+        return np.nan, np.nan, np.nan
+    return np.mean(x), np.median(x), np.std(x)
+
+def sigma_clipped_stats(data, sigma=3.0, maxiters=5):
+    """Mean, median, and standard deviation of the finite pixels of an image,
+    iteratively clipped at sigma times the standard deviation around the median.
+
+    This is the same algorithm (and gives the same answer, to floating-point
+    rounding) as astropy.stats.sigma_clipped_stats with its default arguments.
+
+    """
+    data = np.ascontiguousarray(data).ravel()
+    if use_numba():
+        return _sigma_clipped_stats_numba(data, float(sigma), int(maxiters))
+    return _sigma_clipped_stats_numpy(data, sigma, maxiters)
+
+# Residual thresholding.
+
+@njit(parallel=True, cache=True)
+def _threshold_mask_numba(resid, thresh, out):
+    for ii in prange(resid.size):
+        if np.abs(resid[ii]) > thresh:
+            out[ii] = True
+
+def threshold_mask(resid, thresh, out=None):
+    """Flag the pixels with |resid| > thresh, OR'ing them into out (in place),
+    if given.
+
+    """
+    # Compare in the same precision as numpy would.
+    thresh = np.asarray(thresh, dtype=np.result_type(resid, thresh))
+    if not use_numba() or (out is not None and not out.flags.c_contiguous):
+        mask = np.abs(resid) > thresh
+        if out is None:
+            return mask
+        out |= mask
+        return out
+
+    if out is None:
+        out = np.zeros(resid.shape, bool)
+    _threshold_mask_numba(np.ascontiguousarray(resid).ravel(), float(thresh), out.reshape(-1))
+    return out
+
+# Binned statistics.
+
+@njit(parallel=True, cache=True)
+def _binned_stats_numba(xx, yy, srt, edges, stats, npts):
+    qq = np.array([25.0, 50.0, 75.0])
+    for kk in prange(len(edges)-1):
+        these = srt[edges[kk]:edges[kk+1]]
+        yb = yy[these]
+        npts[kk] = np.count_nonzero(yb)
+        if npts[kk] > 0:
+            xb = xx[these]
+            stats[kk, 0] = np.nanmedian(xb)
+            stats[kk, 1] = np.nanmean(xb)
+            stats[kk, 2] = np.nanstd(yb)
+            stats[kk, 3] = np.nanmean(yb)
+            stats[kk, 4:] = np.nanpercentile(yb, qq)
+
+def _binned_stats_numpy(xx, yy, srt, edges, stats, npts):
+    for kk in range(len(edges)-1):
+        these = srt[edges[kk]:edges[kk+1]]
+        npts[kk] = np.count_nonzero(yy[these])
+        if npts[kk] > 0:
+            stats[kk, 0] = np.nanmedian(xx[these])
+            stats[kk, 1] = np.nanmean(xx[these])
+            stats[kk, 2] = np.nanstd(yy[these])
+            stats[kk, 3] = np.nanmean(yy[these])
+            stats[kk, 4:] = np.nanpercentile(yy[these], [25, 50, 75])
+
+def binned_stats(xx, yy, idx, nbin):
+    """Statistics of xx and yy in each of the bins kk=0,...,nbin-1, where idx is
+    the bin number of each point (see legacyhalos.misc.statsinbins).
+
+    Returns the number of nonzero yy values in each bin and an [nbin, 7] array of
+    the median and mean of xx and the standard deviation, mean, and 25th, 50th,
+    and 75th percentiles of yy, which are zero in the empty bins.
+
+    """
+    # Sort the points into bins once; the stable sort keeps the points of each
+    # bin in their original order.
+    srt = np.argsort(idx, kind='stable')
+    edges = np.searchsorted(idx[srt], np.arange(nbin+1))
+
+    stats = np.zeros((nbin, 7))
+    npts = np.zeros(nbin, np.int64)
+    if use_numba():
+        _binned_stats_numba(np.asarray(xx), np.asarray(yy), srt, edges, stats, npts)
+    else:
+        _binned_stats_numpy(xx, yy, srt, edges, stats, npts)
+    return npts, stats
+
+# Sigma-clipped statistics of groups of pixels (e.g., elliptical annuli).
+
+@njit(cache=True)
+def _range_moments(x, lo, hi):
+    """Number, mean, and standard deviation of the pixels in [lo, hi)."""
+    nn, mean = 0, 0.0
+    for val in x:
+        if val >= lo and val < hi:
+            nn += 1
+            mean += val
+    if nn == 0:
+        return 0, np.nan, np.nan
+    mean /= nn
+    var = 0.0
+    for val in x:
+        if val >= lo and val < hi:
+            var += (val - mean)**2
+    return nn, mean, np.sqrt(var / nn)
+
+@njit(parallel=True, cache=True)
+def _grouped_clipped_stats_numba(values, edges, sclip, nclip, stats, npix):
+    for kk in prange(len(edges)-1):
+        x = values[edges[kk]:edges[kk+1]]
+        # As in _sigma_clipped_stats_numba, the clipped pixels are tracked as a
+        # range of values; the initial range excludes the NaN and infinite pixels.
+        lo, hi = -np.finfo(np.float64).max, np.inf
+        nn, mean, std = _range_moments(x, lo, hi)
+        for _ in range(nclip):
+            if nn == 0:
+                break
+            lo, hi = max(lo, mean - sclip * std), min(hi, mean + sclip * std)
+            nn, mean, std = _range_moments(x, lo, hi)
+        npix[kk] = nn
+        if nn == 0:
+            continue
+        kept = np.empty(nn, np.float64)
+        nin = 0
+        for val in x:
+            if val >= lo and val < hi:
+                kept[nin] = val
+                nin += 1
+        kept.sort()
+        stats[kk, 0] = mean
+        stats[kk, 1] = (kept[(nn - 1) // 2] + kept[nn // 2]) / 2
+        stats[kk, 2] = std
+
+def _grouped_clipped_stats_numpy(values, edges, sclip, nclip, stats, npix):
+    # All the groups are clipped at once, using the group number of each pixel.
+    ngroup = len(edges) - 1
+    group = np.repeat(np.arange(ngroup), np.diff(edges))
+    keep = np.isfinite(values)
+    vals = np.where(keep, values, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for iclip in range(nclip+1):
+            nn = np.bincount(group, weights=keep, minlength=ngroup)
+            mean = np.bincount(group, weights=vals * keep, minlength=ngroup) / nn
+            dev = (vals - mean[group]) * keep
+            std = np.sqrt(np.bincount(group, weights=dev**2, minlength=ngroup) / nn)
+            if iclip == nclip:
+                break
+            lo, hi = mean - sclip * std, mean + sclip * std
+            keep &= (vals >= lo[group]) & (vals < hi[group])
+
+    # Sort the kept pixels to the front of each group to get the medians.
+    nn = nn.astype(np.int64)
+    srt = np.lexsort((np.where(keep, vals, np.inf), group))
+    svals = vals[srt]
+    good = nn > 0
+    i1 = edges[:-1][good] + (nn[good] - 1) // 2
+    i2 = edges[:-1][good] + nn[good] // 2
+    npix[:] = nn
+    stats[good, 0] = mean[good]
+    stats[good, 1] = (svals[i1] + svals[i2]) / 2
+    stats[good, 2] = std[good]
+
+def grouped_clipped_stats(values, edges, sclip=3.0, nclip=0):
+    """Sigma-clipped mean, median, and standard deviation of each group of
+    pixels values[edges[kk]:edges[kk+1]], kk=0,...,len(edges)-2.
+
+    The clipping follows photutils.isophote.EllipseSample: each of the nclip
+    iterations keeps the pixels in [mean - sclip*std, mean + sclip*std). NaN and
+    infinite pixels are ignored.
+
+    Returns the number of pixels kept in each group and an [ngroup, 3] array of
+    the mean, median, and standard deviation, which are NaN in the empty groups.
+
+    """
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.int64)
+    stats = np.zeros((len(edges)-1, 3)) + np.nan
+    npix = np.zeros(len(edges)-1, np.int64)
+    if use_numba():
+        _grouped_clipped_stats_numba(values, edges, float(sclip), int(nclip), stats, npix)
+    else:
+        _grouped_clipped_stats_numpy(values, edges, sclip, int(nclip), stats, npix)
+    return npix, stats
+
+# Bilinear interpolation.
+
+@njit(parallel=True, cache=True)
+def _bilinear_interpolate_numba(data, y, x, out):
+    ny, nx = data.shape
+    for ii in prange(y.size):
+        yfloor = np.floor(y[ii])
+        xfloor = np.floor(x[ii])
+        yw = y[ii] - yfloor
+        xw = x[ii] - xfloor
+
+        y0 = max(int(yfloor), 0)
+        y1 = min(int(yfloor) + 1, ny-1)
+        x0 = max(int(xfloor), 0)
+        x1 = min(int(xfloor) + 1, nx-1)
+
+        out[ii] = ((1.0-xw) * (1.0-yw) * data[y0, x0] +
+                   xw       * (1.0-yw) * data[y0, x1] +
+                   (1.0-xw) * yw       * data[y1, x0] +
+                   xw       * yw       * data[y1, x1])
+
+def _bilinear_interpolate_numpy(data, y, x):
+    yfloor = np.floor(y)
+    xfloor = np.floor(x)
+    yw = y - yfloor
+    xw = x - xfloor
+
+    # pixel locations
+    y0 = yfloor.astype(int)
+    y1 = y0 + 1
+    x0 = xfloor.astype(int)
+    x1 = x0 + 1
+
+    # clip locations out of range
+    ny, nx = data.shape
+    y0 = np.maximum(y0, 0)
+    y1 = np.minimum(y1, ny-1)
+    x0 = np.maximum(x0, 0)
+    x1 = np.minimum(x1, nx-1)
+
+    return ((1.0-xw) * (1.0-yw) * data[y0, x0] +
+            xw       * (1.0-yw) * data[y0, x1] +
+            (1.0-xw) * yw       * data[y1, x0] +
+            xw       * yw       * data[y1, x1])
+
+def bilinear_interpolate(data, y, x):
+    """Bilinearly interpolate a two-dimensional image at the float pixel
+    coordinates (y, x) (see legacyhalos.dust._bilinear_interpolate).
+
+    """
+    y, x = np.asarray(y), np.asarray(x)
+    if (not use_numba() or y.dtype != np.float64 or x.dtype != np.float64 or
+        data.dtype.kind != 'f'):
+        return _bilinear_interpolate_numpy(data, y, x)
+
+    shape = np.broadcast(y, x).shape
+    y, x = [np.ascontiguousarray(np.broadcast_to(val, shape)).ravel() for val in (y, x)]
+    out = np.empty(y.size, np.result_type(data, np.float64))
+    _bilinear_interpolate_numba(data, y, x, out)
+    return out.reshape(shape)[()]
+
+def benchmark(repeat=3, seed=1, file=None):
+    """Time the numpy and numba versions of each kernel and print a table of
+    the speedups.
+
+    """
+    from legacyhalos.misc import ellipse_masks
+
+    if not HAVE_NUMBA:
+        print('numba is not installed; nothing to compare.')
+        return None
+
+    rng = np.random.default_rng(seed)
+    shape = (3000, 3000)
+    nell = 200
+    ellargs = (rng.uniform(0, shape[0], nell), rng.uniform(0, shape[1], nell),
+               rng.uniform(5, 100, nell), rng.uniform(2, 50, nell), rng.uniform(0, np.pi, nell))
+    bigargs = (shape[0]/2, shape[1]/2, 1200.0, 700.0, 0.3)
+    resid = rng.normal(size=shape).astype('f4')
+    xx, yy = rng.uniform(0, 10, 10**6), rng.normal(size=10**6)
+    idx = np.digitize(xx, np.linspace(0, 10, 100))
+    sfd = rng.uniform(size=(4096, 4096)).astype('f4')
+    yint, xint = rng.uniform(0, 4096, 10**6), rng.uniform(0, 4096, 10**6)
+    annuli = rng.normal(size=10**6)
+    annedges = np.round(np.linspace(0, 1, 101)**2 * len(annuli)).astype(int)
+
+    tests = [
+        ('ellipse_masks', '{} ellipses, {}x{}'.format(nell, *shape),
+         lambda: ellipse_masks(*ellargs, shape)),
+        ('ellipse_masks', '1 ellipse, {}x{}'.format(*shape),
+         lambda: ellipse_masks(*bigargs, shape)),
+        ('sigma_clipped_stats', '{}x{}'.format(*shape),
+         lambda: sigma_clipped_stats(resid, sigma=3.0)),
+        ('threshold_mask', '{}x{}'.format(*shape),
+         lambda: threshold_mask(resid, 2.5)),
+        ('binned_stats', '{} points, 100 bins'.format(len(xx)),
+         lambda: binned_stats(xx, yy, idx, 100)),
+        ('grouped_clipped_stats', '{} pixels, {} annuli'.format(len(annuli), len(annedges)-1),
+         lambda: grouped_clipped_stats(annuli, annedges, sclip=3.0, nclip=2)),
+        ('bilinear_interpolate', '{} points'.format(len(yint)),
+         lambda: bilinear_interpolate(sfd, yint, xint)),
+        ]
+
+    previous = _BACKEND
+    results = []
+    try:
+        for name, size, func in tests:
+            times = []
+            for name_backend in ('numpy', 'numba'):
+                set_backend(name_backend)
+                func() # compile (numba) and warm up
+                tt = []
+                for _ in range(repeat):
+                    t0 = time.time()
+                    func()
+                    tt.append(time.time() - t0)
+                times.append(min(tt))
+            results.append((name, size, times[0], times[1]))
+    finally:
+        set_backend(previous)
+
+    print('{:<22s} {:<28s} {:>10s} {:>10s} {:>8s}'.format(
+        'kernel', 'size', 'numpy[ms]', 'numba[ms]', 'speedup'), file=file)
+    for name, size, tnumpy, tnumba in results:
+        print('{:<22s} {:<28s} {:>10.1f} {:>10.1f} {:>8.1f}'.format(
+            name, size, 1e3*tnumpy, 1e3*tnumba, tnumpy/tnumba), file=file)
+    print('numba {} with {} thread(s)'.format(numba.__version__, numba.get_num_threads()),
+          file=file)
+    return results
+
+def main():
+    benchmark()
+
+if __name__ == '__main__':
+    main()
@@ -686,8 +686,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         largeshift = False
         mge, centralmask = tractor2mge(central, factor=5.0)
 
-        iclose = np.where([centralmask[np.int(by), np.int(bx)]
-                           for by, bx in zip(tractor.by, tractor.bx)])[0]
+        iclose = np.where(centralmask[tractor.by.astype(int), tractor.bx.astype(int)])[0]
         
         srcs = tractor.copy()
         srcs.cut(np.delete(np.arange(len(tractor)), iclose))
@@ -698,7 +697,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         img = data[refband].data - model
         img[centralmask] = data[refband].data[centralmask]
 
-        mask = np.logical_or(ma.getmask(data[refband]), data['residual_mask'])
+        mask = legacyhalos.io.band_mask(data, refband, residual=True)
         #mask = np.logical_or(data[refband].mask, data['residual_mask'])
         mask[centralmask] = False
 
@@ -782,7 +781,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         # subtract out the PSF sources. Then update the mask (but ignore the
         # residual mask). Finally convert to surface brightness.
         for filt in bands:
-            mask = np.logical_or(ma.getmask(data[filt]), satmask)
+            mask = np.logical_or(legacyhalos.io.band_mask(data, filt), satmask)
             mask[centralmask] = False
             #plt.imshow(mask, origin='lower') ; plt.savefig('/mnt/legacyhalos-data/debug.png')
 
@@ -38,7 +38,8 @@ EXPLANATION:
 CALLING SEQUENCE:
 
       f = find_galaxy(img, binning=5, fraction=0.1, level=None,
-                      nblob=1, plot=False, quiet=False)
+                      nblob=1, plot=False, quiet=False, roi=None,
+                      median='medfilt', downsample=1)
 
 INPUTS:
       Img = The galaxy images as a 2D array.
@@ -76,6 +77,21 @@ OPTIONAL INPUT KEYWORDS:
       plot - display an image in the current graphic window showing
           the pixels used in the computation of the moments.
       quiet - do not print numerical values on the screen.
+      roi - optional (xcen, ycen, radius) region of interest, in pixels, where
+          xcen is the first index (row) and ycen the second index (column) of
+          the catalogued galaxy position. Only the square window of half-width
+          RADIUS around it is filtered, thresholded and labeled; all the
+          outputs are still in full-frame coordinates. The median filter is
+          evaluated on the window plus a BINNING//2 margin, so the filtered
+          pixels are identical to those of the full-frame filter. Note that
+          with LEVEL=None the percentile level is computed on the window.
+      median - median filter to apply: 'medfilt' (default, the original 2D
+          scipy.signal.medfilt) or 'separable', a much cheaper (approximate)
+          median of 1D medians along the rows and then the columns.
+      downsample - if >1, find the connected regions on a DOWNSAMPLE x
+          DOWNSAMPLE block-averaged version of the filtered image and then use
+          the full-resolution connected region which overlaps the selected one
+          most (the moments are always computed at full resolution).
 
 EXAMPLE:
       The command below locates the position and orientation of a galaxy
@@ -152,7 +168,8 @@ from scipy import signal, ndimage
 class find_galaxy(object):
 
     def __init__(self, img, fraction=0.1, plot=False, quiet=False,
-                 nblob=1, level=None, binning=5):
+                 nblob=1, level=None, binning=5, roi=None, median='medfilt',
+                 downsample=1):
         """
         With nblob=1 find the ellipse of inertia of the largest
         connected region in the image, with nblob=2 find the second
@@ -161,7 +178,26 @@ class find_galaxy(object):
         """
         assert img.ndim == 2, "IMG must be a two-dimensional array"
 
-        a = signal.medfilt(img, binning)
+        # Crop to the region of interest, keeping a margin of binning//2 pixels
+        # so the median filter inside the window is not affected by the edges.
+        fullimg = img
+        if roi is None:
+            x0, y0 = 0, 0
+            trim = (slice(None), slice(None))
+        else:
+            xcen, ycen, radius = roi
+            nx, ny = img.shape
+            x0 = int(np.clip(np.floor(xcen - radius), 0, nx - 1))
+            x1 = int(np.clip(np.ceil(xcen + radius) + 1, x0 + 1, nx))
+            y0 = int(np.clip(np.floor(ycen - radius), 0, ny - 1))
+            y1 = int(np.clip(np.ceil(ycen + radius) + 1, y0 + 1, ny))
+            pad = binning // 2
+            px0, py0 = max(x0 - pad, 0), max(y0 - pad, 0)
+            img = fullimg[px0:min(x1 + pad, nx), py0:min(y1 + pad, ny)]
+            trim = (slice(x0 - px0, x1 - px0), slice(y0 - py0, y1 - py0))
+
+        a = self.median_filter(img, binning, median=median)[trim]
+        img = img[trim]
 
         if level is None:
             level = np.percentile(a, (1 - fraction)*100)
@@ -171,15 +207,28 @@ class find_galaxy(object):
             a[badmask] = 0
 
         mask = a > level
-        labels, nb = ndimage.label(mask)   # Get blob indices
-        sizes = ndimage.sum(mask, labels, np.arange(nb + 1))
-        j = np.argsort(sizes)[-nblob]      # find the nblob-th largest blob
-        ind = np.flatnonzero(labels == j)
-        revind = np.flatnonzero(labels != j)
+        if downsample > 1:
+            ind = np.flatnonzero(self.coarse_blob(a, mask, level, nblob, downsample))
+        else:
+            labels, nb = ndimage.label(mask)   # Get blob indices
+            sizes = ndimage.sum(mask, labels, np.arange(nb + 1))
+            j = np.argsort(sizes)[-nblob]      # find the nblob-th largest blob
+            ind = np.flatnonzero(labels == j)
+            revind = np.flatnonzero(labels != j)
 
         self.second_moments(img, ind)
         self.pa = np.mod(270 - self.theta, 180)  # astronomical PA
 
+        # Back to full-frame coordinates.
+        if roi is not None:
+            self.xmed += x0
+            self.ymed += y0
+            self.xpeak += x0
+            self.ypeak += y0
+            _mask = np.zeros(fullimg.shape, bool)
+            _mask[x0:x0+mask.shape[0], y0:y0+mask.shape[1]] = mask
+            img, mask = fullimg, _mask
+
         if not quiet:
             print(' Pixels used:', ind.size)
             print(' Peak Img[j, k]:', self.xpeak, self.ypeak)
@@ -214,6 +263,74 @@ class find_galaxy(object):
             ax.set_xlabel("pixels")
             ax.set_ylabel("pixels")
 
+#-------------------------------------------------------------------------
+
+    @staticmethod
+    def median_filter(img, binning, median='medfilt'):
+        #
+        # Median-filter the image with a BINNING x BINNING kernel and zero
+        # padding at the edges (like signal.medfilt).
+
+        if median == 'medfilt':
+            return signal.medfilt(img, binning)
+        elif median == 'separable':
+            a = np.asarray(ma.getdata(img))
+            a = ndimage.median_filter(a, size=(binning, 1), mode='constant', cval=0.0)
+            return ndimage.median_filter(a, size=(1, binning), mode='constant', cval=0.0)
+        else:
+            raise ValueError('Unrecognized median option {}'.format(median))
+
+#-------------------------------------------------------------------------
+
+    @staticmethod
+    def coarse_blob(a, mask, level, nblob, downsample):
+        #
+        # Pick the nblob-th largest connected region of a DOWNSAMPLE x
+        # DOWNSAMPLE block-averaged version of the filtered image and return
+        # the full-resolution connected region of MASK which overlaps it most.
+        # The full-resolution labeling is restricted to a box around the
+        # coarse region, which is grown until it contains the whole region, so
+        # the result is always a single connected region of MASK (neighbouring
+        # blobs which only touch at the coarse resolution are not merged).
+
+        s = a.shape
+        f = int(downsample)
+        nx, ny = -(-s[0] // f), -(-s[1] // f)
+        b = np.zeros((nx*f, ny*f), dtype=a.dtype)
+        b[:s[0], :s[1]] = a
+        b = b.reshape(nx, f, ny, f).mean(axis=(1, 3))
+
+        cmask = b > level
+        labels, nb = ndimage.label(cmask)
+        blob = np.zeros(s, bool)
+        if nb == 0:
+            return blob
+        sizes = ndimage.sum(cmask, labels, np.arange(nb + 1))
+        j = np.argsort(sizes)[-nblob]
+        seed = np.repeat(np.repeat(labels == j, f, axis=0), f, axis=1)[:s[0], :s[1]]
+
+        xx, yy = np.where(seed)
+        margin = f
+        while True:
+            x0, x1 = max(xx.min() - margin, 0), min(xx.max() + margin + 1, s[0])
+            y0, y1 = max(yy.min() - margin, 0), min(yy.max() + margin + 1, s[1])
+            box = (slice(x0, x1), slice(y0, y1))
+            flabels, fnb = ndimage.label(mask[box])
+            overlap = np.bincount(flabels[seed[box]], minlength=fnb + 1)
+            overlap[0] = 0
+            if overlap.max() == 0: # no full-resolution pixel above the level
+                return blob
+            comp = flabels == np.argmax(overlap)
+            cx, cy = np.where(comp)
+            touches = ((cx.min() == 0 and x0 > 0) or (cx.max() == comp.shape[0] - 1 and x1 < s[0]) or
+                       (cy.min() == 0 and y0 > 0) or (cy.max() == comp.shape[1] - 1 and y1 < s[1]))
+            if not touches:
+                break
+            margin *= 2
+
+        blob[box] = comp
+        return blob
+
 #-------------------------------------------------------------------------
 
     def second_moments(self, img, ind):
@@ -83,12 +83,571 @@ def srcs2image(cat, wcs, band='r', allbands='grz', pixelized_psf=None, psf_sigma
 
     return mod
 
+class SourceModelCache(object):
+    """Render-once cache of Tractor model images.
+
+    Each source in the catalog is rendered exactly once per band; its model
+    patch (cutout) is kept and the patches are summed into the full model image.
+    The model of every source *except* a given one (e.g., the current central in
+    a group) is then the full model minus that source's patch, so building the
+    masks for N centrals costs O(N) rather than O(N**2) source renderings.
+
+    The images match srcs2image(cat, wcs, band, ...) with the source removed from
+    cat, to within floating-point roundoff.
+
+    """
+    def __init__(self, cat, wcs, pixelized_psf=None, psf_sigma=1.0):
+        self.cat = cat
+        self.wcs = wcs
+        self.pixelized_psf = pixelized_psf
+        self.psf_sigma = psf_sigma
+        self.models = {}
+        self.patches = {}
+
+    def _render(self, band):
+        import tractor, legacypipe
+        from legacypipe.catalog import read_fits_catalog
+
+        if type(self.wcs) is tractor.wcs.ConstantFitsWcs or type(self.wcs) is legacypipe.survey.LegacySurveyWcs:
+            shape = self.wcs.wcs.shape
+        else:
+            shape = self.wcs.shape
+
+        if self.pixelized_psf is None:
+            vv = self.psf_sigma**2
+            psf = tractor.GaussianMixturePSF(1.0, 0., 0., vv, vv, 0.0)
+        else:
+            psf = self.pixelized_psf
+
+        tim = tractor.Image(np.zeros(shape), invvar=np.ones(shape), wcs=self.wcs, psf=psf,
+                            photocal=tractor.basics.LinearPhotoCal(1.0, band=band.lower()),
+                            sky=tractor.sky.ConstantSky(0.0),
+                            name='model-{}'.format(band))
+
+        srcs = read_fits_catalog(self.cat, bands=[band.lower()])
+        tr = tractor.Tractor([tim], srcs)
+
+        # Same as tr.getModelImage(0) but hang on to each source's patch.
+        model = np.zeros(shape, tr.modtype)
+        patches = []
+        for src in srcs:
+            patch = None
+            if src is not None:
+                patch = tr.getModelPatch(tim, src)
+                if patch is not None:
+                    patch.addTo(model)
+            patches.append(patch)
+
+        self.models[band] = model
+        self.patches[band] = patches
+
+    def model(self, band):
+        """Model image of every source in the catalog."""
+        if band not in self.models:
+            self._render(band)
+        return self.models[band]
+
+    def patch(self, band, indx):
+        """Model of the source with row index indx, clipped to the image, as a
+        (y0, x0, cutout) tuple (the cutout is empty if the source was not
+        rendered).
+
+        """
+        model = self.model(band)
+        patch = self.patches[band][indx]
+        if patch is not None and patch.patch is not None:
+            ph, pw = patch.patch.shape
+            y0, x0 = max(patch.y0, 0), max(patch.x0, 0)
+            y1, x1 = min(patch.y0 + ph, model.shape[0]), min(patch.x0 + pw, model.shape[1])
+            if y1 > y0 and x1 > x0:
+                cutout = patch.patch[y0-patch.y0:y1-patch.y0, x0-patch.x0:x1-patch.x0]
+                return y0, x0, cutout.astype(model.dtype)
+        return 0, 0, np.zeros((0, 0), model.dtype)
+
+    def model_without(self, band, indx):
+        """Model image of every source except the one(s) with row index indx."""
+        model = self.model(band).copy()
+        for ii in np.atleast_1d(indx):
+            y0, x0, cutout = self.patch(band, ii)
+            model[y0:y0+cutout.shape[0], x0:x0+cutout.shape[1]] -= cutout
+        return model
+
+def _reproject_windows(nin, nout, footprint='resize', shrink=True):
+    """Range of input pixels [lo, hi] which contribute to each output pixel along
+    one axis (see reproject_mask).
+
+    """
+    zoom = nin / nout
+    if footprint == 'overlap':
+        # Input pixels which overlap the footprint of each output pixel.
+        lo = np.floor(np.arange(nout) * zoom).astype(int)
+        hi = np.ceil((np.arange(nout) + 1) * zoom).astype(int) - 1
+        return np.clip(lo, 0, nin-1), np.clip(np.maximum(hi, lo), 0, nin-1)
+    elif footprint != 'resize':
+        raise ValueError('Unrecognized footprint {}'.format(footprint))
+
+    # Support of skimage.transform.resize(mode='reflect'), i.e., a Gaussian
+    # anti-aliasing filter (only when shrinking) followed by linear
+    # interpolation with scipy.ndimage.zoom(grid_mode=True, mode='mirror').
+    sigma = max(0.0, (zoom - 1) / 2) if shrink else 0.0
+    radius = int(4 * sigma + 0.5) if sigma > 0 else 0
+
+    cc = (np.arange(nout) + 0.5) * zoom - 0.5
+    lo = np.floor(cc).astype(int)
+    hi = lo + (cc > lo) # zero interpolation weight at integer coordinates
+    lo, hi = lo - radius, hi + radius
+
+    # Mirror the pixels which fall off either edge back into the image.
+    _lo = np.where(hi > nin-1, np.minimum(lo, 2*(nin-1) - hi), lo)
+    _hi = np.where(lo < 0, np.maximum(hi, -lo), hi)
+    return np.clip(_lo, 0, nin-1), np.clip(_hi, 0, nin-1)
+
+def reproject_mask(mask, shape, footprint='resize'):
+    """Reproject a boolean mask onto a different pixel grid (covering the same
+    area of sky), e.g., the optical starmask onto the GALEX or unWISE images.
+
+    footprint - 'resize' (default) flags every output pixel with a non-zero
+      value in resize(mask*1.0, shape, mode='reflect'), i.e., the result is
+      identical to
+
+        skimage.transform.resize(mask*1.0, shape, mode='reflect') > 0
+
+      but it is computed exactly (and much faster) with integer cumulative sums.
+      'overlap' flags every output pixel which overlaps a masked input pixel,
+      which reduces to a block-any for integer pixel-scale ratios.
+
+    """
+    mask = np.asarray(mask, bool)
+    shape = tuple(shape)
+    if mask.shape == shape:
+        return mask.copy()
+
+    if footprint == 'overlap' and all(nin % nout == 0 for nin, nout in zip(mask.shape, shape)):
+        (nx, ny), (fx, fy) = shape, (mask.shape[0] // shape[0], mask.shape[1] // shape[1])
+        return mask.reshape(nx, fx, ny, fy).any(axis=(1, 3))
+
+    # skimage only anti-aliases if either axis is shrinking.
+    shrink = any(nout < nin for nin, nout in zip(mask.shape, shape))
+    out = mask
+    for axis in (0, 1):
+        lo, hi = _reproject_windows(mask.shape[axis], shape[axis], footprint=footprint, shrink=shrink)
+        csum = np.insert(np.cumsum(out, axis=axis, dtype=np.int32), 0, 0, axis=axis)
+        out = (np.take(csum, hi+1, axis=axis) - np.take(csum, lo, axis=axis)) > 0
+    return out
+
+class MaskPlanes(object):
+    """Compact container of all the boolean mask layers (e.g., star, residual,
+    and per-band inverse variance masks) on one pixel grid.
+
+    Each layer is one bit of a single uint16 image (uint32 or uint64 for more
+    layers), so N layers cost 2 (or 4, 8) bytes per pixel rather than N. The
+    boolean mask of one layer, or of the union of several layers, is only
+    materialized when it is requested.
+
+    """
+    def __init__(self, shape, dtype=np.uint16):
+        self.bits = np.zeros(shape, dtype)
+        self.planes = {}
+
+    @property
+    def shape(self):
+        return self.bits.shape
+
+    @property
+    def names(self):
+        return list(self.planes.keys())
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def __contains__(self, name):
+        return name in self.planes
+
+    def __getitem__(self, name):
+        return self.any([name])
+
+    def _promote(self):
+        nbit = 8 * self.bits.dtype.itemsize
+        if len(self.planes) < nbit:
+            return
+        if nbit >= 64:
+            raise ValueError('Too many mask layers ({}).'.format(len(self.planes)))
+        self.bits = self.bits.astype('u{}'.format(2 * nbit // 8))
+
+    def add(self, name, mask):
+        """Add (or replace) a layer."""
+        if mask.shape != self.shape:
+            raise ValueError('Mask layer {} has the wrong dimensions {} (expected {}).'.format(
+                name, mask.shape, self.shape))
+        if name in self.planes:
+            bit = self.planes[name]
+            self.bits &= ~self.bits.dtype.type(1 << bit)
+        else:
+            self._promote()
+            bit = len(self.planes)
+            if bit in self.planes.values(): # a layer was removed
+                bit = min(set(range(8 * self.bits.dtype.itemsize)) - set(self.planes.values()))
+            self.planes[name] = bit
+        self.bits[mask] |= self.bits.dtype.type(1 << bit)
+
+    def remove(self, name):
+        bit = self.planes.pop(name)
+        self.bits &= ~self.bits.dtype.type(1 << bit)
+
+    def bitmask(self, names=None):
+        """Integer bit-mask corresponding to one or more layers (default all)."""
+        if names is None:
+            names = self.names
+        bitmask = 0
+        for name in np.atleast_1d(names):
+            bitmask |= 1 << self.planes[name]
+        return self.bits.dtype.type(bitmask)
+
+    def any(self, names=None):
+        """Boolean mask of the union of one or more layers (default all)."""
+        return (self.bits & self.bitmask(names)) != 0
+
+def data_nbytes(data):
+    """Total memory [bytes] of the numpy (and masked) arrays in a data
+    dictionary (see read_multiband), counting shared arrays only once.
+
+    """
+    import numpy.ma as ma
+
+    seen, nbytes = set(), 0
+    def _count(arr):
+        nonlocal nbytes
+        key = (arr.__array_interface__['data'][0], arr.nbytes) # views of the same buffer
+        if key not in seen:
+            seen.add(key)
+            nbytes += arr.nbytes
+
+    def _visit(val):
+        if isinstance(val, ma.MaskedArray):
+            _count(ma.getdata(val))
+            if ma.getmask(val) is not ma.nomask:
+                _count(ma.getmask(val))
+        elif isinstance(val, np.ndarray):
+            _count(val)
+        elif isinstance(val, MaskPlanes):
+            _count(val.bits)
+        elif isinstance(val, (list, tuple)):
+            for _val in val:
+                _visit(_val)
+        elif isinstance(val, dict):
+            for _val in val.values():
+                _visit(_val)
+
+    _visit(data)
+    return nbytes
+
+def _maskplanes_layout(layout, shape, filt2pixscale, refpixscale, seed, out):
+    """Build the per-band images and masks of legacyhalos.io._read_image_data
+    with either layout and put the peak RSS [bytes] above the starting RSS
+    and the data_nbytes of the result on the queue out (for
+    benchmark_maskplanes).
+
+    """
+    import resource
+    import numpy.ma as ma
+
+    def _rss():
+        with open('/proc/self/statm') as F:
+            return int(F.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    rss0 = _rss()
+    rng = np.random.default_rng(seed)
+    data, grids = {}, {}
+    for filt, pixscale in filt2pixscale.items():
+        sz = tuple(int(nn * refpixscale / pixscale) for nn in shape)
+        image = rng.standard_normal(sz, dtype=np.float32)
+        invvarmask = image > 3.5
+        if layout == 'boolean':
+            if sz not in grids:
+                grids[sz] = {'star': image < -3.0, 'residual': image > 3.0}
+            mask = invvarmask | grids[sz]['star']
+            data[filt] = ma.masked_array(image, mask)
+        else:
+            if sz not in grids:
+                planes = MaskPlanes(sz)
+                planes.add('star', image < -3.0)
+                planes.add('residual', image > 3.0)
+                grids[sz] = planes
+            grids[sz].add('{}_invvar'.format(filt), invvarmask)
+            data[filt] = ma.masked_array(image)
+        del invvarmask
+    data['grids'] = grids
+    if layout != 'boolean':
+        # Consumers (e.g., _build_multiband_mask) materialize one mask at a time.
+        for filt in filt2pixscale.keys():
+            planes = grids[data[filt].shape]
+            mask = planes.any(['star', 'residual', '{}_invvar'.format(filt)])
+            del mask
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # [KB on Linux]
+    out.put((peak - rss0, data_nbytes(data)))
+
+def benchmark_maskplanes(shape=(4096, 4096), filt2pixscale=None, refpixscale=0.262,
+                         seed=1, file=None):
+    """Measure the peak RSS and the size of the data dictionary of the per-band
+    images and masks read by legacyhalos.io._read_image_data, keeping one
+    boolean mask per band (the previous layout) or only the bits of one
+    MaskPlanes per pixel grid. Each layout is built in a freshly forked process
+    (Linux only).
+
+    filt2pixscale - pixel scale [arcsec] of each band (default grz, unWISE W1-W4,
+      and GALEX FUV/NUV)
+
+    """
+    import multiprocessing
+
+    if filt2pixscale is None:
+        filt2pixscale = {'g': 0.262, 'r': 0.262, 'z': 0.262, 'W1': 2.75, 'W2': 2.75,
+                         'W3': 2.75, 'W4': 2.75, 'FUV': 1.5, 'NUV': 1.5}
+
+    ctx = multiprocessing.get_context('fork')
+    results = []
+    for layout in ('boolean', 'maskplanes'):
+        out = ctx.Queue()
+        proc = ctx.Process(target=_maskplanes_layout, args=(
+            layout, shape, filt2pixscale, refpixscale, seed, out))
+        proc.start()
+        peak, nbytes = out.get()
+        proc.join()
+        results.append((layout, peak, nbytes))
+
+    print('{}x{} pixels, {} bands'.format(shape[0], shape[1], len(filt2pixscale)), file=file)
+    print('{:<12s} {:>14s} {:>14s}'.format('layout', 'peak RSS[MB]', 'data[MB]'), file=file)
+    for layout, peak, nbytes in results:
+        print('{:<12s} {:>14.1f} {:>14.1f}'.format(layout, peak/1024**2, nbytes/1024**2), file=file)
+    return results
+
+def dilate_mask(masks, iterations=1):
+    """Take the union of one or more boolean masks (with the same dimensions) and
+    dilate it once.
+
+    The result is identical to scipy.ndimage.binary_dilation(mask,
+    iterations=iterations), i.e., with the default cross-shaped structuring
+    element and unmasked borders, which grows the mask to all the pixels within
+    a taxicab distance of iterations. Since the dilation of a union is the union
+    of the dilations, masks which are combined anyway only need to be dilated
+    once.
+
+    For a few iterations the dilation is done with shifted logical_or's on the
+    full frame, otherwise with a (single) chamfer distance transform.
+
+    """
+    from scipy.ndimage import distance_transform_cdt
+
+    if isinstance(masks, np.ndarray):
+        mask = masks.astype(bool) # copy
+    else:
+        mask = np.logical_or.reduce([np.asarray(_mask, bool) for _mask in masks])
+
+    if iterations < 1 or not np.any(mask):
+        return mask
+
+    if iterations > 16:
+        return distance_transform_cdt(~mask, metric='taxicab') <= iterations
+
+    for _ in range(iterations):
+        prev = mask.copy()
+        mask[1:, :] |= prev[:-1, :]
+        mask[:-1, :] |= prev[1:, :]
+        mask[:, 1:] |= prev[:, :-1]
+        mask[:, :-1] |= prev[:, 1:]
+    return mask
+
+class MaskReprojectionCache(object):
+    """Reproject (and optionally dilate) a mask onto each pixel grid only once.
+
+    All the bands with the same image dimensions (e.g., FUV and NUV, or W1-W4)
+    share the same reprojected mask. See reproject_mask and dilate_mask.
+
+    """
+    def __init__(self, mask, footprint='resize'):
+        self.mask = np.asarray(mask, bool)
+        self.footprint = footprint
+        self.cache = {}
+
+    def reproject(self, shape, iterations=0):
+        shape = tuple(shape)
+        if shape == self.mask.shape and iterations == 0:
+            return self.mask
+        if (shape, iterations) not in self.cache:
+            if iterations == 0:
+                self.cache[(shape, 0)] = reproject_mask(self.mask, shape, footprint=self.footprint)
+            else:
+                self.cache[(shape, iterations)] = dilate_mask(self.reproject(shape), iterations=iterations)
+        return self.cache[(shape, iterations)]
+
 def ellipse_mask(xcen, ycen, semia, semib, phi, x, y):
     """Simple elliptical mask."""
     xp = (x-xcen) * np.cos(phi) + (y-ycen) * np.sin(phi)
     yp = -(x-xcen) * np.sin(phi) + (y-ycen) * np.cos(phi)
     return (xp / semia)**2 + (yp/semib)**2 <= 1
 
+def ellipse_max_shrink(xcen, ycen, semia, eps, phi, x, y, shrink=None):
+    """Find the largest factor in the (descending) shrink grid for which an
+    ellipse with semi-major axis shrink*semia and ellipticity eps contains none
+    of the pixels (x, y).
+
+    This is the pixel criterion of rasterizing ellipse_mask at each factor and
+    testing the pixels one by one, but the ellipse equation is evaluated only at
+    the test pixels, for all the factors at once, in the same floating-point
+    operations (so the answer is identical). Returns the chosen factor (the last
+    one if the pixels are covered at every factor) and the (larger) factors
+    which were rejected.
+
+    """
+    if shrink is None:
+        shrink = np.arange(0.1, 1.05, 0.05)[::-1]
+    maxis = shrink * semia
+    covered = ellipse_mask(xcen, ycen, maxis[:, np.newaxis], (maxis * (1-eps))[:, np.newaxis],
+                           phi, np.atleast_1d(x)[np.newaxis, :], np.atleast_1d(y)[np.newaxis, :])
+    covered = np.any(covered, axis=1)
+    ok = np.where(~covered)[0]
+    if len(ok) > 0:
+        return shrink[ok[0]], shrink[:ok[0]]
+    return shrink[-1], shrink
+
+def ellipse_bbox(xcen, ycen, semia, semib, phi, shape, pad=1):
+    """Tight (padded) bounding box of one or more ellipses, with the same
+    conventions as ellipse_mask (x is the row, or first, index).
+
+    The half-extents of an ellipse rotated by phi are
+    sqrt(a**2*cos(phi)**2 + b**2*sin(phi)**2) along x and
+    sqrt(a**2*sin(phi)**2 + b**2*cos(phi)**2) along y. Returns the (clipped)
+    x0, x1, y0, y1 integer limits, suitable for slicing.
+
+    """
+    xcen, ycen, semia, semib, phi = [np.asarray(val, 'f8') for val in (xcen, ycen, semia, semib, phi)]
+    cosphi, sinphi = np.cos(phi), np.sin(phi)
+    xext = np.sqrt((semia * cosphi)**2 + (semib * sinphi)**2)
+    yext = np.sqrt((semia * sinphi)**2 + (semib * cosphi)**2)
+
+    # NaN geometry never selects any pixels (same as ellipse_mask).
+    with np.errstate(invalid='ignore'):
+        x0 = np.nan_to_num(np.clip(np.floor(xcen - xext) - pad, 0, shape[0]), nan=0)
+        x1 = np.nan_to_num(np.clip(np.ceil(xcen + xext) + pad + 1, 0, shape[0]), nan=0)
+        y0 = np.nan_to_num(np.clip(np.floor(ycen - yext) - pad, 0, shape[1]), nan=0)
+        y1 = np.nan_to_num(np.clip(np.ceil(ycen + yext) + pad + 1, 0, shape[1]), nan=0)
+    return x0.astype(int), x1.astype(int), y0.astype(int), y1.astype(int)
+
+def ellipse_mask_bbox(xcen, ycen, semia, semib, phi, shape, mask=None):
+    """Same as ellipse_mask(xcen, ycen, semia, semib, phi, *np.ogrid[0:shape[0],
+    0:shape[1]]), but only the pixels in the ellipse's bounding box are evaluated.
+
+    If mask is given, the ellipse is OR'd into it (in place) and it is returned.
+
+    """
+    from legacyhalos.kernels import paint_ellipses
+
+    if mask is None:
+        mask = np.zeros(shape, bool)
+    x0, x1, y0, y1 = ellipse_bbox(xcen, ycen, semia, semib, phi, shape)
+    if x1 > x0 and y1 > y0:
+        paint_ellipses(mask, x0, x1, y0, y1, xcen, ycen, semia, semib, np.cos(phi), np.sin(phi))
+    return mask
+
+def ellipse_masks(xcen, ycen, semia, semib, phi, shape, mask=None, maxpix=2**24):
+    """Paint many ellipses into one boolean mask with a single vectorized pass
+    over the pixels of their bounding boxes (in chunks of at most ~maxpix
+    pixels), with the same conventions and (bit-identical) result as OR'ing
+    ellipse_mask for each ellipse.
+
+    """
+    from legacyhalos.kernels import paint_ellipses
+
+    xcen, ycen, semia, semib, phi = [np.atleast_1d(val) for val in (xcen, ycen, semia, semib, phi)]
+    xcen, ycen, semia, semib, phi = np.broadcast_arrays(xcen, ycen, semia, semib, phi)
+    if mask is None:
+        mask = np.zeros(shape, bool)
+    if len(xcen) == 0:
+        return mask
+
+    # Evaluate the trig functions per ellipse (in the precision of phi, which
+    # may be float32) so the result is identical to ellipse_mask.
+    cosphi = np.array([np.cos(pp) for pp in phi], 'f8')
+    sinphi = np.array([np.sin(pp) for pp in phi], 'f8')
+    xcen, ycen, semia, semib = [val.astype('f8') for val in (xcen, ycen, semia, semib)]
+
+    x0, x1, y0, y1 = ellipse_bbox(xcen, ycen, semia, semib, phi, shape)
+    paint_ellipses(mask, x0, x1, y0, y1, xcen, ycen, semia, semib, cosphi, sinphi, maxpix=maxpix)
+
+    return mask
+
+class EllipticalAnnuli(object):
+    """Elliptical annuli of fixed geometry around the semi-major axes sma, for
+    measuring surface brightness profiles in one pass over the pixels.
+
+    The geometry follows photutils.isophote.EllipseGeometry: x0, y0 are the
+    (zero-indexed) column and row of the center, eps is the ellipticity, and pa
+    is the position angle [radians] counter-clockwise from the x (column) axis.
+    The elliptical radius of every pixel is computed once, and each pixel is
+    assigned to the annulus whose semi-major axis is nearest, i.e., the annuli
+    are bounded by the midpoints between successive sma values (and extend half
+    a step beyond the first and last ones). Pixels which are masked (mask=True)
+    or outside every annulus are ignored.
+
+    """
+    def __init__(self, shape, x0, y0, eps, pa, sma, mask=None):
+        sma = np.atleast_1d(np.asarray(sma, 'f8'))
+        if np.any(np.diff(sma) <= 0):
+            raise ValueError('sma must be increasing.')
+        self.shape = tuple(shape)
+        self.sma = sma
+
+        if len(sma) > 1:
+            mid = (sma[1:] + sma[:-1]) / 2
+            self.radii = np.hstack((max(0.0, sma[0] - (mid[0] - sma[0])), mid,
+                                    sma[-1] + (sma[-1] - mid[-1])))
+        else:
+            self.radii = np.array([0.0, 2 * sma[0]])
+
+        yy, xx = np.indices(self.shape)
+        dx, dy = xx - x0, yy - y0
+        xp = dx * np.cos(pa) + dy * np.sin(pa)
+        yp = -dx * np.sin(pa) + dy * np.cos(pa)
+        radius = np.hypot(xp, yp / (1 - eps)).ravel()
+
+        idx = np.searchsorted(self.radii, radius, side='right') - 1
+        # Include the outer edge of the last annulus.
+        idx[radius == self.radii[-1]] = len(sma) - 1
+        good = (idx >= 0) & (idx < len(sma))
+        if mask is not None:
+            good &= ~np.asarray(mask, bool).ravel()
+
+        # Sort the pixels into annuli once; the stable sort keeps the pixels of
+        # each annulus in their original order.
+        pix = np.flatnonzero(good)
+        srt = np.argsort(idx[pix], kind='stable')
+        self.pixels = pix[srt]
+        self.edges = np.searchsorted(idx[self.pixels], np.arange(len(sma)+1))
+
+    def npix(self):
+        """Number of (unmasked) pixels in each annulus."""
+        return np.diff(self.edges)
+
+    def profile(self, image, sclip=3.0, nclip=0):
+        """Sigma-clipped statistics of the image in each annulus (see
+        legacyhalos.kernels.grouped_clipped_stats).
+
+        Returns a dictionary with the semi-major axis, the number of pixels kept,
+        and the mean, median, and standard deviation in each annulus.
+
+        """
+        from legacyhalos.kernels import grouped_clipped_stats
+
+        image = np.asarray(image)
+        if image.shape != self.shape:
+            raise ValueError('Image and annuli have different shapes.')
+        npix, stats = grouped_clipped_stats(image.ravel()[self.pixels], self.edges,
+                                            sclip=sclip, nclip=nclip)
+        return {'sma': self.sma, 'npix': npix, 'mean': stats[:, 0],
+                'median': stats[:, 1], 'sigma': stats[:, 2]}
+
 def simple_wcs(onegal, radius=None, factor=1.0, pixscale=0.262, zcolumn='Z'):
     '''Build a simple WCS object for a single galaxy.
 
@@ -244,27 +803,16 @@ def statsinbins(xx, yy, binsize=0.1, minpts=10, xmin=None, xmax=None):
         xmean = xmean[keep]
         stats = stats[keep]
     else:
+        from legacyhalos.kernels import binned_stats
+
         _xbin = np.linspace(xmin, xmax, nbin)
         idx  = np.digitize(xx, _xbin)
 
-        for kk in range(nbin):
-            these = idx == kk
-            npts = np.count_nonzero( yy[these] )
-
-            stats['xbin'][kk] = _xbin[kk]
-            stats['npts'][kk] = npts
-
-            if npts > 0:
-                stats['xmedian'][kk] = np.nanmedian( xx[these] )
-                stats['xmean'][kk] = np.nanmean( xx[these] )
-
-                stats['ystd'][kk] = np.nanstd( yy[these] )
-                stats['ymean'][kk] = np.nanmean( yy[these] )
-
-                qq = np.nanpercentile( yy[these], [25, 50, 75] )
-                stats['y25'][kk] = qq[0]
-                stats['ymedian'][kk] = qq[1]
-                stats['y75'][kk] = qq[2]
+        npts, binstats = binned_stats(xx, yy, idx, nbin)
+        stats['xbin'] = _xbin
+        stats['npts'] = npts
+        for ii, col in enumerate(['xmedian', 'xmean', 'ystd', 'ymean', 'y25', 'ymedian', 'y75']):
+            stats[col] = binstats[:, ii]
 
         keep = stats['npts'] > minpts
         if np.count_nonzero(keep) == 0:
@@ -676,3 +1224,38 @@ def is_in_ellipse(ras, decs, RAcen, DECcen, r, e1, e2):
     dx, dy = np.dot(Ginv, [dra, ddec])
 
     return np.hypot(dx, dy) < 1
+
+class EllipseProximityIndex(object):
+    """KD-tree of source positions for repeated is_in_ellipse tests, e.g., when
+    finding the sources in the ellipse-of-influence of each galaxy in a group.
+
+    Only the sources within a box which bounds the ellipse are passed to
+    is_in_ellipse, so in_ellipse returns the same indices as
+
+      np.where(is_in_ellipse(ras, decs, RAcen, DECcen, r, e1, e2))[0]
+
+    at a fraction of the cost for large catalogs.
+
+    """
+    def __init__(self, ras, decs):
+        from scipy.spatial import cKDTree
+        self.ras = np.asarray(ras)
+        self.decs = np.asarray(decs)
+        self.tree = cKDTree(np.vstack((self.ras, self.decs)).T)
+
+    def in_ellipse(self, RAcen, DECcen, r, e1, e2):
+        # The ellipse is contained in a circle of radius r (in the tangent plane
+        # used by is_in_ellipse, i.e., with Delta-RA scaled by cos(Dec) of each
+        # source); pad the box by a small amount to absorb roundoff.
+        center = np.hstack((RAcen, DECcen)).astype(np.float64) # scalars or length-one arrays
+        r_deg = 1.001 * np.max(r) / 3600.0
+        maxdec = np.abs(center[1]) + r_deg
+        if maxdec >= 89.9:
+            return np.where(is_in_ellipse(self.ras, self.decs, RAcen, DECcen, r, e1, e2))[0]
+
+        radius = r_deg / np.cos(np.radians(maxdec))
+        cand = np.sort(np.array(self.tree.query_ball_point(center, radius, p=np.inf), dtype=int))
+        if len(cand) == 0:
+            return cand
+        inellipse = is_in_ellipse(self.ras[cand], self.decs[cand], RAcen, DECcen, r, e1, e2)
+        return cand[inellipse]
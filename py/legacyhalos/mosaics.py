@@ -0,0 +1,420 @@
+"""
+legacyhalos.mosaics
+===================
+
+Reuse of overlapping custom mosaics.
+
+Close pairs and the members of groups often have mosaics which overlap
+heavily. Every mosaic which is built by coadds.custom_coadds can be recorded in
+a MosaicRegistry (a directory of small JSON files, one per mosaic, which can be
+shared by all the MPI ranks of a job). A subsequent request for a mosaic which
+is fully contained in a registered one, and which was built with the same
+runbrick settings, is then cut out of the existing products (images, inverse
+variance, model and maskbits images, the outlier masks, the Tractor catalog,
+the CCDs table, and the color JPGs) rather than rebuilt from the CCDs. The
+cutouts keep the tangent point of the parent mosaic (only CRPIX changes), and
+every cut-out file records its provenance in its header (REUSEGAL, REUSEX0,
+REUSEY0). Only the CCDs (and their outlier masks) which touch the cutout are
+kept, and, as for a new mosaic, nothing else is written if they do not cover
+all of grz (with require_grz).
+
+Reuse is most effective when the mosaics are built in order of decreasing size.
+
+"""
+import os, re, json
+import numpy as np
+
+REGISTRY_VERSION = 1
+
+# Margin [arcsec] between the edge of a reused mosaic and the cutout, so that
+# the unWISE and GALEX cutouts (which have much coarser pixels) also fit.
+REUSE_MARGIN = 5.5
+
+# Header cards which describe the layout of the (compressed) HDU rather than
+# the image itself.
+_STRUCTURAL_CARDS = re.compile(r'^(SIMPLE|XTENSION|BITPIX|EXTEND|PCOUNT|GCOUNT|TFIELDS|CHECKSUM|DATASUM|'
+                               r'NAXIS\d*|TTYPE\d+|TFORM\d+|TUNIT\d+|TDIM\d+|TNULL\d+|TSCAL\d+|TZERO\d+|'
+                               r'ZIMAGE|ZSIMPLE|ZTENSION|ZBITPIX|ZEXTEND|ZPCOUNT|ZGCOUNT|ZCMPTYPE|ZQUANTIZ|'
+                               r'ZDITHER0|ZBLANK|ZHECKSUM|ZDATASUM|ZNAXIS\d*|ZTILE\d+|ZNAME\d+|ZVAL\d+)$')
+
+def mosaic_settings(stagesuffix, run, pixscale, **kwargs):
+    """The (JSON-serializable) runbrick settings a mosaic was built with; only
+    mosaics with identical settings can be reused.
+
+    """
+    settings = {'stagesuffix': stagesuffix, 'run': run, 'pixscale': float(pixscale)}
+    for key, val in kwargs.items():
+        if val is not None and not np.isscalar(val):
+            val = [float(vv) for vv in val]
+        settings[key] = val
+    return json.loads(json.dumps(settings))
+
+def mosaic_products(galaxy, galaxydir, stagesuffix, run):
+    """Basenames of the products of a custom mosaic (as written by
+    coadds._rearrange_files).
+
+    """
+    pattern = re.compile(r'^{}-({}-(((image|invvar|model|psf)-[A-Za-z0-9]+|maskbits|outlier-mask)\.fits\.fz|'
+                         r'tractor\.fits|(image|model|resid)-(grz|W1W2|FUVNUV)\.jpg)|ccds-{}\.fits)$'.format(
+                             re.escape(galaxy), re.escape(stagesuffix), re.escape(run)))
+    return sorted([ff for ff in os.listdir(galaxydir) if pattern.match(ff)])
+
+def _header_wcs(hdr):
+    """TAN WCS parameters of a FITS header (or None)."""
+    keys = ('CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2')
+    if 'TAN' not in str(hdr.get('CTYPE1', '')) or any(key not in hdr for key in keys):
+        return None
+    return [float(hdr[key]) for key in keys]
+
+def _cutout_box(wcs, shape, ra, dec, size):
+    """Pixel box (x0, y0, nx, ny) of a size x size [arcsec] cutout centered on ra,
+    dec, in an image with the given TAN WCS and shape. Raises ValueError if the
+    cutout does not fit.
+
+    """
+    from legacyhalos.ccdindex import tan_radec2pixelxy
+
+    xc, yc = tan_radec2pixelxy(*wcs, ra, dec)
+    scale = np.sqrt(np.abs(wcs[4] * wcs[7] - wcs[5] * wcs[6])) * 3600 # [arcsec/pixel]
+    npix = int(np.ceil(size / scale - 1e-6)) // 2 * 2 + 1 # odd
+    x0, y0 = int(np.round(xc - 1)) - npix // 2, int(np.round(yc - 1)) - npix // 2
+    if x0 < 0 or y0 < 0 or x0 + npix > shape[1] or y0 + npix > shape[0]:
+        raise ValueError('Cutout does not fit in the parent mosaic.')
+    return x0, y0, npix, npix
+
+def _copy_header(hdr):
+    """Copy a header without the cards which describe the layout of the HDU."""
+    import fitsio
+
+    out = fitsio.FITSHDR()
+    for rec in hdr.records():
+        if _STRUCTURAL_CARDS.match(rec['name'].strip().upper()):
+            continue
+        out.add_record(rec)
+    return out
+
+def _clean_header(hdr, srcgalaxy, x0, y0, nx, ny):
+    """Copy a header, shift the WCS reference pixel, and add the provenance
+    cards.
+
+    """
+    out = _copy_header(hdr)
+    if 'CRPIX1' in out:
+        out['CRPIX1'] = float(hdr['CRPIX1']) - x0
+        out['CRPIX2'] = float(hdr['CRPIX2']) - y0
+    if 'IMAGEW' in out:
+        out['IMAGEW'] = nx
+        out['IMAGEH'] = ny
+    out.add_record(dict(name='REUSEGAL', value=srcgalaxy, comment='cut out of the mosaic of this galaxy'))
+    out.add_record(dict(name='REUSEX0', value=x0, comment='x offset of this cutout in the parent mosaic'))
+    out.add_record(dict(name='REUSEY0', value=y0, comment='y offset of this cutout in the parent mosaic'))
+    return out
+
+def _compress_args(hdu, data):
+    """Integer images are compressed losslessly with RICE, as in the parent
+    mosaic; floating-point images were already quantized, so compress them
+    losslessly rather than quantizing them a second time.
+
+    """
+    if not hdu.is_compressed():
+        return None, None
+    elif data.dtype.kind in 'iu':
+        return 'RICE', None
+    else:
+        return 'GZIP_2', None
+
+def _cutout_image(infile, outfile, srcgalaxy, ra, dec, size):
+    """Cut out every image HDU with a TAN WCS (e.g., the WISE masks in the maskbits
+    file) and copy the others. The HDU layout is preserved (in particular, the
+    empty primary HDU of a compressed file, so the images stay in extension 1).
+    Returns the box of the first HDU.
+
+    """
+    import fitsio
+
+    box = None
+    tmpfile = outfile+'.tmp'
+    with fitsio.FITS(infile) as F, fitsio.FITS(tmpfile, 'rw', clobber=True) as out:
+        for ihdu, hdu in enumerate(F):
+            hdr = hdu.read_header()
+            if not hdu.has_data():
+                if ihdu == 0:
+                    out.write(None, header=_copy_header(hdr))
+                continue
+            data = hdu.read()
+            wcs = _header_wcs(hdr)
+            if wcs is not None:
+                x0, y0, nx, ny = _cutout_box(wcs, data.shape, ra, dec, size)
+                data = data[y0:y0+ny, x0:x0+nx]
+                if box is None:
+                    box = (x0, y0, nx, ny)
+            else:
+                x0, y0, ny, nx = 0, 0, data.shape[0], data.shape[1]
+            hdr = _clean_header(hdr, srcgalaxy, x0, y0, nx, ny)
+            compress, qlevel = _compress_args(hdu, data)
+            out.write(data, header=hdr, extname=hdu.get_extname() or None,
+                      compress=compress, qlevel=qlevel)
+    os.replace(tmpfile, outfile)
+    return box
+
+def _cutout_corners(ra, dec, width, pixscale):
+    """RA, Dec of the outer corners of a width x width pixel custom brick centered
+    on ra, dec.
+
+    """
+    from legacyhalos.ccdindex import tan_pixelxy2xyz
+
+    cd, crpix = pixscale / 3600, (width + 1) / 2
+    x = np.array([[0.5, width+0.5, width+0.5, 0.5]])
+    y = np.array([[0.5, 0.5, width+0.5, width+0.5]])
+    xyz = tan_pixelxy2xyz(ra, dec, crpix, crpix, -cd, 0., 0., cd, x, y)[0]
+    return np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360, np.degrees(np.arcsin(xyz[:, 2]))
+
+def _cutout_ccds(infile, outfile, srcgalaxy, box, ra, dec, width, pixscale):
+    """Keep the CCDs which touch the cutout (see legacyhalos.ccdindex.CCDIndex).
+    Returns the (camera, expnum, ccdname) key and the filter of each CCD kept.
+
+    """
+    import fitsio
+    from types import SimpleNamespace
+    from legacyhalos.ccdindex import CCDIndex, GEOMETRY_COLUMNS
+
+    ccds, hdr = fitsio.read(infile, header=True, lower=True)
+    index = CCDIndex.from_table(SimpleNamespace(**{col: ccds[col] for col in GEOMETRY_COLUMNS}))
+    ccds = ccds[index.query(ra, dec, width, pixscale=pixscale)[0]]
+    hdr = _clean_header(hdr, srcgalaxy, *box)
+    tmpfile = outfile+'.tmp'
+    fitsio.write(tmpfile, ccds, header=hdr, clobber=True)
+    os.replace(tmpfile, outfile)
+
+    keys = set()
+    for ccd in ccds:
+        keys.add((str(ccd['camera']).strip(), int(ccd['expnum']), str(ccd['ccdname']).strip()))
+    return keys, [str(filt).strip() for filt in ccds['filter']]
+
+def _cutout_outlier_mask(infile, outfile, srcgalaxy, ra, dec, width, pixscale, ccdkeys=None):
+    """Cut the outlier mask of each CCD (an HDU with the TAN WCS and the X0, Y0
+    offset of the CCD subimage) down to the part which overlaps the cutout, and
+    drop the CCDs which do not touch it (or are not in ccdkeys).
+
+    """
+    import fitsio
+    from legacyhalos.ccdindex import tan_radec2pixelxy
+
+    cornerra, cornerdec = _cutout_corners(ra, dec, width, pixscale)
+    tmpfile = outfile+'.tmp'
+    with fitsio.FITS(infile) as F, fitsio.FITS(tmpfile, 'rw', clobber=True) as out:
+        for ihdu, hdu in enumerate(F):
+            hdr = hdu.read_header()
+            if not hdu.has_data():
+                if ihdu == 0:
+                    out.write(None, header=_copy_header(hdr))
+                continue
+            if ccdkeys is not None and 'EXPNUM' in hdr and 'CCDNAME' in hdr:
+                key = (str(hdr.get('CAMERA', '')).strip(), int(hdr['EXPNUM']), str(hdr['CCDNAME']).strip())
+                if key not in ccdkeys:
+                    continue
+            data = hdu.read()
+            wcs = _header_wcs(hdr)
+            if wcs is None:
+                x0, y0, ny, nx = 0, 0, data.shape[0], data.shape[1]
+            else:
+                # The cutout is a box in the tangent plane, so its footprint on
+                # the CCD is the quadrilateral of its projected corners.
+                xx, yy = tan_radec2pixelxy(*wcs, cornerra, cornerdec)
+                x0 = max(int(np.floor(np.min(xx) - 0.5)), 0)
+                y0 = max(int(np.floor(np.min(yy) - 0.5)), 0)
+                x1 = min(int(np.floor(np.max(xx) - 0.5)) + 1, data.shape[1])
+                y1 = min(int(np.floor(np.max(yy) - 0.5)) + 1, data.shape[0])
+                if x1 <= x0 or y1 <= y0:
+                    continue
+                data, nx, ny = data[y0:y1, x0:x1], x1 - x0, y1 - y0
+            outhdr = _clean_header(hdr, srcgalaxy, x0, y0, nx, ny)
+            if 'X0' in outhdr and 'Y0' in outhdr:
+                outhdr['X0'] = int(hdr['X0']) + x0
+                outhdr['Y0'] = int(hdr['Y0']) + y0
+            compress, qlevel = _compress_args(hdu, data)
+            out.write(data, header=outhdr, extname=hdu.get_extname() or None,
+                      compress=compress, qlevel=qlevel)
+    os.replace(tmpfile, outfile)
+
+def _cutout_tractor(infile, outfile, srcgalaxy, box):
+    """Keep the Tractor sources inside the cutout and shift their brick
+    coordinates.
+
+    """
+    import fitsio
+
+    x0, y0, nx, ny = box
+    cat, hdr = fitsio.read(infile, header=True)
+    keep = ((cat['bx'] >= x0 - 0.5) * (cat['bx'] < x0 + nx - 0.5) *
+            (cat['by'] >= y0 - 0.5) * (cat['by'] < y0 + ny - 0.5))
+    cat = cat[keep]
+    cat['bx'] -= x0
+    cat['by'] -= y0
+    hdr = _clean_header(hdr, srcgalaxy, x0, y0, nx, ny)
+    tmpfile = outfile+'.tmp'
+    fitsio.write(tmpfile, cat, header=hdr, clobber=True)
+    os.replace(tmpfile, outfile)
+
+def _cutout_jpeg(infile, outfile, box):
+    """Crop a color JPG (written with origin='lower') to the given box."""
+    from PIL import Image
+
+    x0, y0, nx, ny = box
+    with Image.open(infile) as im:
+        H = im.size[1]
+        crop = im.crop((x0, H - (y0 + ny), x0 + nx, H - y0))
+        tmpfile = outfile+'.tmp'
+        crop.save(tmpfile, 'JPEG', quality=95)
+    os.replace(tmpfile, outfile)
+
+class MosaicRegistry(object):
+    """Registry of the custom mosaics built so far, stored as one JSON file per
+    mosaic in registry_dir.
+
+    """
+    def __init__(self, registry_dir):
+        self.registry_dir = registry_dir
+        self._entries = {}
+
+    def entries(self):
+        """All registered mosaics (re-reading only the new files)."""
+        if not os.path.isdir(self.registry_dir):
+            return []
+        for ff in os.listdir(self.registry_dir):
+            if not ff.endswith('.json') or ff in self._entries:
+                continue
+            try:
+                with open(os.path.join(self.registry_dir, ff)) as F:
+                    entry = json.load(F)
+            except (OSError, ValueError):
+                continue
+            if entry.get('version') == REGISTRY_VERSION:
+                self._entries[ff] = entry
+        return list(self._entries.values())
+
+    def register(self, galaxy, galaxydir, ra, dec, width, settings, verbose=False):
+        """Record a newly built mosaic. Returns False if there are no image products
+        to reuse.
+
+        """
+        products = mosaic_products(galaxy, galaxydir, settings['stagesuffix'], settings['run'])
+        if not any(['-image-' in ff and ff.endswith('.fits.fz') for ff in products]):
+            return False
+        entry = {'version': REGISTRY_VERSION, 'galaxy': galaxy,
+                 'galaxydir': os.path.abspath(galaxydir), 'ra': float(ra), 'dec': float(dec),
+                 'width': int(width), 'settings': settings, 'products': products}
+        os.makedirs(self.registry_dir, exist_ok=True)
+        regfile = os.path.join(self.registry_dir, '{}-{}.json'.format(galaxy, settings['stagesuffix']))
+        tmpfile = regfile+'.tmp'
+        with open(tmpfile, 'w') as F:
+            json.dump(entry, F)
+        os.replace(tmpfile, regfile)
+        if verbose:
+            print('Registered mosaic {} in {}'.format(galaxy, regfile))
+        return True
+
+    def find(self, galaxy, galaxydir, ra, dec, width, settings):
+        """Find the smallest registered mosaic with the same settings which fully
+        contains the requested one. Returns the entry and the (grz) pixel box
+        of the cutout, or None.
+
+        """
+        from legacyhalos.ccdindex import radec2xyz, tan_radec2pixelxy
+
+        pixscale = settings['pixscale']
+        margin = int(np.ceil(REUSE_MARGIN / pixscale))
+        best = None
+        for entry in self.entries():
+            if entry['settings'] != settings or entry['width'] <= width:
+                continue
+            if entry['galaxy'] == galaxy and entry['galaxydir'] == os.path.abspath(galaxydir):
+                continue
+            # Quick angular-distance cut before the exact containment test.
+            if np.dot(radec2xyz(ra, dec)[0], radec2xyz(entry['ra'], entry['dec'])[0]) < np.cos(
+                    np.radians(entry['width'] * pixscale / 3600)):
+                continue
+            W, cd = entry['width'], pixscale / 3600
+            xc, yc = tan_radec2pixelxy(entry['ra'], entry['dec'], W/2+0.5, W/2+0.5, -cd, 0., 0., cd, ra, dec)
+            x0, y0 = int(np.round(xc - 1)) - width // 2, int(np.round(yc - 1)) - width // 2
+            if x0 < margin or y0 < margin or x0 + width > W - margin or y0 + width > W - margin:
+                continue
+            if not os.path.isfile(os.path.join(entry['galaxydir'], entry['products'][0])):
+                continue
+            if best is None or entry['width'] < best[0]['width']:
+                best = (entry, (x0, y0, width, width))
+        return best
+
+    def cutout(self, entry, box, galaxy, galaxydir, ra, dec, width):
+        """Cut the products of the requested mosaic out of a registered one, given the
+        pixel box of the cutout (see find). Returns False if the CCDs touching
+        the cutout do not cover all of grz (and require_grz is set), in which
+        case only the CCDs file is written (as in coadds._rearrange_files).
+
+        """
+        from legacyhalos.coadds import _stage_file
+
+        settings = entry['settings']
+        pixscale = settings['pixscale']
+        size = width * pixscale # [arcsec]
+        srcgalaxy, srcdir = entry['galaxy'], entry['galaxydir']
+
+        def _outfile(ff):
+            return os.path.join(galaxydir, galaxy+ff[len(srcgalaxy):])
+
+        # The CCDs go first, since they decide whether there is anything else to
+        # do, and the color JPGs go last, since the unWISE and GALEX cutouts are
+        # defined by the W1 and FUV images.
+        ccdkeys = None
+        for ff in entry['products']:
+            if re.search(r'-ccds-[^-]+\.fits$', ff):
+                ccdkeys, filters = _cutout_ccds(os.path.join(srcdir, ff), _outfile(ff), srcgalaxy,
+                                                box, ra, dec, width, pixscale)
+                if settings.get('require_grz', True) and not set('grz').issubset(filters):
+                    print('Lost grz coverage and require_grz=True.')
+                    return False
+
+        boxes = {'grz': box}
+        jpgs = []
+        for ff in entry['products']:
+            infile, outfile = os.path.join(srcdir, ff), _outfile(ff)
+            if ff.endswith('.jpg'):
+                jpgs.append((ff, infile, outfile))
+            elif ff.endswith('-tractor.fits'):
+                _cutout_tractor(infile, outfile, srcgalaxy, box)
+            elif re.search(r'-((image|invvar|model)-[A-Za-z0-9]+|maskbits)\.fits\.fz$', ff):
+                imbox = _cutout_image(infile, outfile, srcgalaxy, ra, dec, size)
+                boxes.setdefault(ff[:-len('.fits.fz')].split('-')[-1], imbox)
+            elif ff.endswith('-outlier-mask.fits.fz'):
+                _cutout_outlier_mask(infile, outfile, srcgalaxy, ra, dec, width, pixscale,
+                                     ccdkeys=ccdkeys)
+            elif re.search(r'-ccds-[^-]+\.fits$', ff):
+                continue
+            else: # PSFs
+                _stage_file(infile, outfile)
+
+        for ff, infile, outfile in jpgs:
+            band = {'grz': 'grz', 'W1W2': 'W1', 'FUVNUV': 'FUV'}[ff[:-len('.jpg')].split('-')[-1]]
+            if band in boxes:
+                _cutout_jpeg(infile, outfile, boxes[band])
+
+        print('Cut out the {}x{} pixel mosaic of {} from the mosaic of {}.'.format(
+            width, width, galaxy, srcgalaxy), flush=True)
+        return True
+
+    def reuse(self, galaxy, galaxydir, ra, dec, width, settings):
+        """Cut the requested mosaic out of a registered one if possible. Returns True
+        if the mosaic was reused (also if its CCDs lost grz coverage, in which
+        case, as for a new mosaic, only the CCDs file is written).
+
+        """
+        match = self.find(galaxy, galaxydir, ra, dec, width, settings)
+        if match is None:
+            return False
+        try:
+            self.cutout(match[0], match[1], galaxy, galaxydir, ra, dec, width)
+        except (OSError, ValueError, KeyError) as err:
+            print('Unable to reuse the mosaic of {}: {}'.format(match[0]['galaxy'], err))
+            return False
+        return True
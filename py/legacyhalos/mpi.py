@@ -5,12 +5,13 @@ legacyhalos.mpi
 Code to deal with the MPI portion of the pipeline.
 
 """
-import os, time, subprocess, pdb
+import os, sys, time, signal, subprocess, pdb
 import numpy as np
 from contextlib import redirect_stdout, redirect_stderr
 
 import legacyhalos.io
 import legacyhalos.html
+import legacyhalos.telemetry
 
 def _start(galaxy, log=None, seed=None):
     if seed:
@@ -18,7 +19,14 @@ def _start(galaxy, log=None, seed=None):
     print('Started working on galaxy {} at {}'.format(
         galaxy, time.asctime()), flush=True, file=log)
 
-def _done(galaxy, galaxydir, err, t0, stage, filesuffix=None, log=None):
+def _done(galaxy, galaxydir, err, t0, stage, filesuffix=None, log=None,
+          outcome=None):
+    """Write the done (or fail) file for this stage.
+
+    outcome - optional string (e.g., from call_with_budget) which is written into
+      the done/fail file so the fate of each galaxy can be audited later.
+
+    """
     if filesuffix is None:
         suffix = ''
     else:
@@ -28,21 +36,576 @@ def _done(galaxy, galaxydir, err, t0, stage, filesuffix=None, log=None):
         donefile = os.path.join(galaxydir, '{}{}-{}.isfail'.format(galaxy, suffix, stage))
     else:
         donefile = os.path.join(galaxydir, '{}{}-{}.isdone'.format(galaxy, suffix, stage))
-        
-    cmd = 'touch {}'.format(donefile)
-    subprocess.call(cmd.split())
+
+    if outcome is None:
+        cmd = 'touch {}'.format(donefile)
+        subprocess.call(cmd.split())
+    else:
+        with open(donefile, 'a') as F:
+            F.write('{} {}\n'.format(time.strftime('%Y-%m-%dT%H:%M:%S'), outcome))
         
     print('Finished galaxy {} in {:.3f} minutes.'.format(
           galaxy, (time.time() - t0)/60), flush=True, file=log)
+
+def _watchdog_one(queue, func, kwargs):
+    """Worker-process target for run_with_watchdog."""
+    # Put the worker (and anything it spawns, e.g., runbrick or a
+    # multiprocessing pool) into its own process group so the watchdog can kill
+    # the whole tree at once.
+    os.setpgrp()
+    # Only send back what is measured here (the timers and counters inherited
+    # from the parent are already on its books, and the I/O counters of a
+    # forked process start again from zero).
+    legacyhalos.telemetry.current().reset()
+    try:
+        result = ('ok', func(**kwargs))
+    except Exception as err:
+        import traceback
+        traceback.print_exc()
+        result = ('error', repr(err))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    queue.put(result + (legacyhalos.telemetry.current().state(),))
+
+def _kill_process_group(proc, grace=10):
+    """Terminate a watchdog worker and all of its children."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            break
+        proc.join(grace)
+        if not proc.is_alive():
+            break
+
+def run_with_watchdog(func, kwargs, timeout=None, poll=1.0):
+    """Run func(**kwargs) in a forked worker process which is killed (together
+    with all its children) if it runs longer than timeout seconds.
+
+    Returns a (status, result) tuple, where status is one of 'ok', 'error', or
+    'timeout' and result is the return value of func (None unless status='ok').
+    A worker which dies without returning (e.g., killed by the OOM killer) is
+    reported as an 'error' as soon as it is noticed (within poll seconds).
+
+    """
+    import multiprocessing
+    import queue
+
+    if timeout is None:
+        return 'ok', func(**kwargs)
+
+    # Flush so the (inherited) log file is not written twice.
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    ctx = multiprocessing.get_context('fork')
+    resultq = ctx.Queue()
+    proc = ctx.Process(target=_watchdog_one, args=(resultq, func, kwargs))
+    proc.start()
+
+    tstop = time.time() + timeout
+    output = None
+    while output is None:
+        try:
+            output = resultq.get(timeout=max(0.0, min(poll, tstop - time.time())))
+        except queue.Empty:
+            if proc.exitcode is not None:
+                # The worker may have exited right after putting its result.
+                try:
+                    output = resultq.get(timeout=1)
+                except queue.Empty:
+                    print('Worker died with exit code {}.'.format(proc.exitcode), flush=True)
+                    output = ('error', 'exitcode={}'.format(proc.exitcode), None)
+            elif time.time() >= tstop:
+                break
+
+    if output is None:
+        status, result = 'timeout', None
+        _kill_process_group(proc)
+    else:
+        status, result, state = output
+        if state is not None:
+            legacyhalos.telemetry.current().merge(state)
+        if status != 'ok':
+            result = None
+    proc.join(10)
+    if proc.is_alive():
+        _kill_process_group(proc)
+
+    return status, result
+
+def _degrade_kwargs(stage, kwargs, attempt):
+    """Return a cheaper version of the stage keywords for retry number attempt
+    (starting at 1) together with a short description of what changed.
+
+    Every retry halves the number of cores again (which helps when the worker
+    was thrashing or starved of memory). The ellipse-fitting stage is additionally
+    run on a coarser semi-major axis grid and, on the second retry, only in the
+    optical bands.
+
+    """
+    kwargs = kwargs.copy()
+    changes = []
+
+    nproc = kwargs.get('nproc', 1)
+    if nproc > 1:
+        kwargs['nproc'] = max(1, nproc // 2**attempt)
+        changes.append('nproc={}'.format(kwargs['nproc']))
+
+    if stage == 'ellipse':
+        factor = 2**attempt
+        if kwargs.get('logsma', True):
+            kwargs['delta_logsma'] = factor * kwargs['delta_logsma']
+            changes.append('delta_logsma={:g}'.format(kwargs['delta_logsma']))
+        else:
+            kwargs['delta_sma'] = factor * kwargs['delta_sma']
+            changes.append('delta_sma={:g}'.format(kwargs['delta_sma']))
+
+        if attempt > 1:
+            data = kwargs['data']
+            optical = [filt for filt in data['bands'] if filt in ('g', 'r', 'z')]
+            if len(optical) < len(data['bands']):
+                data = data.copy()
+                data['bands'] = optical
+                kwargs['data'] = data
+                kwargs['bands'] = optical
+                changes.append('bands={}'.format(''.join(optical)))
+
+    return kwargs, ','.join(changes)
+
+def call_with_budget(func, kwargs, stage, timeout=None, retries=1, log=None):
+    """Call func(**kwargs) subject to a per-galaxy wall-clock budget.
+
+    If the stage does not finish within timeout seconds the worker is killed and
+    the stage is retried (up to retries times) in a progressively degraded mode
+    (see _degrade_kwargs). Exceptions are not retried, since those generally
+    point to a problem with the data rather than with the resources.
+
+    Returns the output of func (or None on failure) and a string describing the
+    outcome, suitable for _done.
+
+    """
+    if timeout is None:
+        retries = 0
+
+    tall = time.time()
+    thiskwargs, changes = kwargs, ''
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            thiskwargs, changes = _degrade_kwargs(stage, kwargs, attempt)
+            print('Retry {}/{} of stage {} in degraded mode ({}).'.format(
+                attempt, retries, stage, changes), flush=True, file=log)
+
+        status, result = run_with_watchdog(func, thiskwargs, timeout=timeout)
+        if status == 'timeout':
+            print('Stage {} exceeded its budget of {:.1f} sec.'.format(
+                stage, timeout), flush=True, file=log)
+            continue
+        break
+
+    if status == 'ok' and attempt > 0:
+        outcome = 'degraded attempt={} {}'.format(attempt, changes)
+    elif status == 'ok':
+        outcome = 'ok'
+    else:
+        outcome = '{} attempt={}'.format(status, attempt)
+    outcome = '{} stage={} wall={:.1f}s'.format(outcome, stage, time.time() - tall)
+        
+    return result, outcome
     
+def estimate_footprint(width, height=None, nband=3, ncentral=1, nproc=1, pyramid=False):
+    """Estimate the peak memory [bytes] needed to read, mask, and ellipse-fit one
+    mosaic of width x height pixels.
+
+    The budget per band is the image, model, and inverse variance (float32),
+    the variance and Tractor model images (float64), the initial mask, and a
+    masked float32 image and float64 variance image for each central. On top of
+    that, every multiprocessing task receives a pickled copy of the masked image
+    it works on. Bands with coarser pixels (GALEX, unWISE) are counted at the
+    optical pixel scale, so this is an upper limit.
+
+    In pyramid mode (see legacyhalos.pyramid) each band also holds its coarse
+    levels (1/4 + 1/16 + 1/64 of the pixels), but each task only receives a
+    cutout of the coarsest level which resolves it, which is at most 1/64 of
+    the mosaic.
+
+    """
+    if height is None:
+        height = width
+    npix = float(width) * float(height)
+
+    perband = npix * (4 + 4 + 4 + 8 + 8 + 1 + ncentral * (4 + 1 + 8))
+    shared = npix * (1 + 1 + 4 + 8 + 8) # star, residual masks, maskbits, coordinates
+    pool = nproc * npix * (4 + 1) * 2   # pickled (masked) image per task and its unpickled copy
+    overhead = 500 * 1024**2            # interpreter, tractor, legacypipe, etc.
+    if pyramid:
+        perband += npix * (1/4 + 1/16 + 1/64) * (4 + 1 + 8)
+        pool /= 64
+
+    return int(overhead + nband * perband + shared + pool)
+
+def budget_nproc(nproc, budget, **kwargs):
+    """Shrink the number of cores for galaxies whose estimated footprint (see
+    estimate_footprint) would not fit in budget [bytes] with nproc workers.
+
+    """
+    while nproc > 1 and estimate_footprint(nproc=nproc, **kwargs) > budget:
+        nproc = max(1, nproc // 2)
+    return nproc
+
+def node_memory():
+    """Total physical memory [bytes] on this node."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+class MemoryBudget(object):
+    """Node-wide memory admission control shared by all ranks on a node.
+
+    Every process registers the projected footprint of the galaxy it is about to
+    work on in a small ledger file in node-local memory (/dev/shm by default)
+    and waits until the sum over all running galaxies fits under the budget. A
+    galaxy is always admitted when nothing else is running, so outliers larger
+    than the whole budget cannot deadlock the job. Use admit() (rather than
+    acquire and release) so the budget is handed back even if the stage fails.
+
+    The ledger is private to one user and one job (the batch job id, or the
+    login session outside of a batch system), so two jobs sharing a node do
+    not throttle each other.
+
+    """
+    def __init__(self, budget, ledgerdir=None, poll=10.0, jobid=None):
+        self.budget = int(budget)
+        self.poll = poll
+        if ledgerdir is None:
+            ledgerdir = '/dev/shm' if os.path.isdir('/dev/shm') else '/tmp'
+        if jobid is None:
+            jobid = os.getenv('SLURM_JOB_ID', os.getenv('PBS_JOBID', 'sid{}'.format(os.getsid(0))))
+        user = os.getenv('USER', 'legacyhalos')
+        self.ledgerfile = os.path.join(ledgerdir, 'legacyhalos-membudget-{}-{}.json'.format(user, jobid))
+
+    def _update(self, func):
+        import json, fcntl
+        with open(self.ledgerfile, 'a+') as F:
+            fcntl.flock(F, fcntl.LOCK_EX)
+            try:
+                F.seek(0)
+                try:
+                    ledger = json.loads(F.read())
+                except ValueError:
+                    ledger = {}
+                # Forget about processes which died without releasing.
+                for pid in list(ledger.keys()):
+                    try:
+                        os.kill(int(pid), 0)
+                    except ProcessLookupError:
+                        del ledger[pid]
+                    except PermissionError:
+                        pass
+                result = func(ledger)
+                F.seek(0)
+                F.truncate()
+                F.write(json.dumps(ledger))
+            finally:
+                fcntl.flock(F, fcntl.LOCK_UN)
+        return result
+
+    def inuse(self):
+        return self._update(lambda ledger: sum(ledger.values()))
+
+    def acquire(self, nbytes, log=None):
+        pid = str(os.getpid())
+        def _admit(ledger):
+            inuse = sum([val for key, val in ledger.items() if key != pid])
+            if inuse == 0 or inuse + nbytes <= self.budget:
+                ledger[pid] = int(nbytes)
+                return True
+            return False
+
+        t0, waited = time.time(), False
+        while not self._update(_admit):
+            if not waited:
+                print('Waiting for {:.2f} GB of memory (budget {:.2f} GB).'.format(
+                    nbytes / 1024**3, self.budget / 1024**3), flush=True, file=log)
+                waited = True
+            time.sleep(self.poll)
+        if waited:
+            print('Admitted after waiting {:.1f} sec.'.format(time.time() - t0), flush=True, file=log)
+
+    def release(self):
+        pid = str(os.getpid())
+        self._update(lambda ledger: ledger.pop(pid, None))
+
+    def admit(self, nbytes, log=None):
+        """Context manager which holds nbytes of the budget while it runs."""
+        from contextlib import contextmanager
+        @contextmanager
+        def _admit():
+            self.acquire(nbytes, log=log)
+            try:
+                yield
+            finally:
+                self.release()
+        return _admit()
+
+def run_local(func, groups, nworkers, *args):
+    """Run func(rank, group, *args) for each rank's group of galaxies on a pool of
+    local processes, as a single-node stand-in for mpirun.
+
+    The groups should be split exactly as for MPI (i.e., missing_files with
+    size=nworkers), so the scheduling and the per-rank logging are unchanged.
+    The workers are forked (not daemonic), so each one can still use its own
+    multiprocessing pool of nproc cores. A failure on one rank is reported but
+    does not take down the others. Returns the list of ranks which failed.
+
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    nworkers = max(1, min(nworkers, len(groups)))
+    ctx = multiprocessing.get_context('fork')
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx) as pool:
+        futures = {}
+        for rank, group in enumerate(groups):
+            if len(group) == 0:
+                continue
+            futures[pool.submit(func, rank, group, *args)] = rank
+        for future in as_completed(futures):
+            rank = futures[future]
+            try:
+                future.result()
+            except Exception as err:
+                print('Rank {:03d} failed: {}'.format(rank, err), flush=True)
+                failed.append(rank)
+    return sorted(failed)
+
+def _format_paths(template, galaxy, sample):
+    """Vectorized str.format of a filename template over the whole sample, where
+    {galaxy} is the galaxy name and any other field is a column of the sample,
+    e.g., '{galaxy}-largegalaxy-{SGA_ID}-ellipse.fits'.
+
+    """
+    from string import Formatter
+
+    ngal = len(galaxy)
+    paths = np.repeat('', ngal).astype('U1')
+    for literal, field, _, _ in Formatter().parse(template):
+        if literal:
+            paths = np.char.add(paths, literal)
+        if field is not None:
+            if field == 'galaxy':
+                values = galaxy
+            else:
+                values = np.atleast_1d(sample[field])
+            paths = np.char.add(paths, np.asarray(values).astype(str))
+    return paths
+
+def _scandir_one(dirname):
+    try:
+        with os.scandir(str(dirname)) as it: # numpy strings would return bytes
+            return set([entry.name for entry in it])
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+def _exists(dirs, files, listing):
+    return np.array([ff in listing[dd] for dd, ff in zip(dirs, files)], bool)
+
+def split_ranks(indices, size=1, weight=None):
+    """Divide the indices of the galaxies left to do across size ranks.
+
+    With a weight (e.g., the group diameter), the sample is split so that the
+    cumulative weight per rank is ~flat (or dealt out round-robin by weight when
+    that is not possible) and each rank works from the smallest to the largest
+    object; otherwise the split is unweighted.
+
+    """
+    # https://stackoverflow.com/questions/33555496/split-array-into-equally-weighted-chunks-based-on-order
+    if len(indices) == 0:
+        return [np.array([])]
+    if weight is None:
+        return np.array_split(indices, size) # unweighted
+
+    weight = np.atleast_1d(weight)
+    cumuweight = weight.cumsum() / weight.sum()
+    idx = np.searchsorted(cumuweight, np.linspace(0, 1, size, endpoint=False)[1:])
+    # If the weighted split would leave a rank idle (e.g., a handful of
+    # objects, or a single dominant weight), deal the objects out round-robin
+    # from the largest to the smallest instead, so the largest objects are
+    # spread across the ranks.
+    if size == 1 or len(np.unique(idx)) < size - 1 or idx[0] == 0 or idx[-1] >= len(indices):
+        order = indices[np.argsort(weight, kind='stable')[::-1]]
+        groups = [order[rank::size] for rank in range(size)] # round-robin by weight
+    else:
+        groups = np.array_split(indices, idx) # weighted
+    lookup = dict(zip(indices, weight))
+    for ii in range(len(groups)): # sort by weight
+        srt = np.argsort([lookup[jj] for jj in groups[ii]])
+        groups[ii] = groups[ii][srt]
+    return groups
+
+def plan_stage(sample, galaxy, galaxydir, filesuffix, dependson=None, dependsondir=None,
+               clobber=False, size=1, weight=None, nproc=1):
+    """Vectorized job planning for one stage of the pipeline.
+
+    Builds the output (and dependency) file names for every galaxy with a filename
+    template (see _format_paths), lists each unique output directory only once,
+    and classifies every galaxy as todo, done, or fail with the same rules as
+    legacyhalos.io.missing_files_one. Returns the todo (divided across size ranks,
+    see split_ranks), done, and fail indices.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    galaxy = np.atleast_1d(galaxy).astype(str)
+    galaxydir = np.atleast_1d(galaxydir).astype(str)
+    ngal = len(galaxy)
+    indices = np.arange(ngal)
+    if dependsondir is None:
+        dependsondir = galaxydir
+    dependsondir = np.atleast_1d(dependsondir).astype(str)
+
+    checkfiles = _format_paths(filesuffix, galaxy, sample)
+    isdonefile = filesuffix[-6:] == 'isdone'
+    if isdonefile:
+        failfiles = np.char.add(np.char.replace(checkfiles, '.isdone', ''), '.isfail')
+    if dependson:
+        dependsfiles = _format_paths(dependson, galaxy, sample)
+
+    # One directory listing per unique directory instead of one (or more) stat
+    # per galaxy.
+    alldirs = np.unique(np.hstack((galaxydir, dependsondir)) if dependson else galaxydir)
+    if nproc > 1 and len(alldirs) > 1:
+        with ThreadPoolExecutor(nproc) as pool:
+            listing = dict(zip(alldirs, pool.map(_scandir_one, alldirs)))
+    else:
+        listing = dict(zip(alldirs, [_scandir_one(dd) for dd in alldirs]))
+
+    check = _exists(galaxydir, checkfiles, listing)
+    if dependson:
+        depends = _exists(dependsondir, dependsfiles, listing)
+    else:
+        depends = np.ones(ngal, bool)
+
+    done = np.zeros(ngal, bool)
+    fail = np.zeros(ngal, bool)
+    if not clobber:
+        done = check & depends
+        rest = ~check
+    else:
+        rest = np.ones(ngal, bool)
+
+    if isdonefile:
+        failed = rest & _exists(galaxydir, failfiles, listing)
+        if clobber:
+            for ii in np.where(failed)[0]:
+                os.remove(os.path.join(galaxydir[ii], failfiles[ii]))
+        else:
+            fail = failed
+    elif dependson:
+        fail = rest & ~depends
+        for ii in np.where(fail)[0]:
+            print('Missing depends file {}'.format(os.path.join(dependsondir[ii], dependsfiles[ii])))
+    todo = ~done & ~fail
+
+    itodo = indices[todo]
+    if len(itodo) > 0 and weight is not None:
+        weight = np.atleast_1d(weight)[itodo]
+
+    if np.sum(fail) > 0:
+        fail_indices = [indices[fail]]
+    else:
+        fail_indices = [np.array([])]
+
+    if np.sum(done) > 0:
+        done_indices = [indices[done]]
+    else:
+        done_indices = [np.array([])]
+
+    todo_indices = split_ranks(itodo, size=size, weight=weight)
+
+    return todo_indices, done_indices, fail_indices
+
+def missing_files_plan(args, sample, templates, get_galaxy_galaxydir, size=1,
+                       clobber_overwrite=None, weightcolumn=None, strict=True):
+    """Shared implementation of the missing_files function of each project.
+
+    templates is an ordered list of (argument, spec) pairs, one per stage, where
+    the first stage whose command-line argument is set is planned. Each spec is a
+    dictionary with the keys:
+
+      suffix - stage name (used for the log file and messages)
+      filesuffix - template of the file which marks the stage as complete
+      dependson - (optional) template of the file the stage depends on
+      html - (optional) the stage writes to the HTML directory
+      clobber - (optional) always use this clobber value (e.g., False for
+        stages which only look for existing files)
+      just_coadds - (optional) dictionary of spec overrides for --just-coadds
+
+    and the templates are formatted as in _format_paths.
+
+    If none of the stage arguments is set, a ValueError is raised (or, with
+    strict=False, 'Nothing to do.' is printed and None is returned).
+
+    """
+    import astropy.table
+
+    for argname, spec in templates:
+        if getattr(args, argname, False):
+            break
+    else:
+        if not strict:
+            print('Nothing to do.')
+            return
+        raise ValueError('Need at least one keyword argument.')
+
+    spec = dict(spec)
+    if getattr(args, 'just_coadds', False) and 'just_coadds' in spec:
+        spec.update(spec['just_coadds'])
+
+    if type(sample) is astropy.table.row.Row:
+        sample = astropy.table.Table(sample)
+
+    if spec.get('html', False):
+        galaxy, dependsondir, galaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
+    else:
+        galaxy, galaxydir = get_galaxy_galaxydir(sample)
+        dependsondir = galaxydir
+
+    clobber = spec.get('clobber', args.clobber)
+    if clobber_overwrite is not None:
+        clobber = clobber_overwrite
+
+    if weightcolumn is not None:
+        weight = sample[weightcolumn]
+    else:
+        weight = None
+
+    if args.verbose:
+        t0 = time.time()
+        print('Finding missing files...', end='')
+    todo_indices, done_indices, fail_indices = plan_stage(
+        sample, galaxy, galaxydir, spec['filesuffix'], dependson=spec.get('dependson'),
+        dependsondir=dependsondir, clobber=clobber, size=size, weight=weight,
+        nproc=args.nproc)
+    if args.verbose:
+        print('...took {:.3f} sec'.format(time.time() - t0))
+
+    return spec['suffix'], todo_indices, done_indices, fail_indices
+
 def call_ellipse(galaxy, galaxydir, data, galaxyinfo=None,
                  pixscale=0.262, nproc=1, bands=['g', 'r', 'z'], refband='r',
-                 delta_logsma=5, maxsma=None, logsma=True,
+                 delta_logsma=5, delta_sma=1.0, maxsma=None, logsma=True,
                  verbose=False, debug=False, write_donefile=True,
                  logfile=None, input_ellipse=None, sbthresh=None,
-                 apertures=None, clobber=False):
+                 apertures=None, clobber=False, timeout=None, retries=1,
+                 pyramid=False):
     """Wrapper script to do ellipse-fitting.
 
+    timeout - optional wall-clock budget [seconds] for each galaxy; see
+      call_with_budget.
+    pyramid - multi-resolution mode for the largest mosaics (see
+      legacyhalos.ellipse.ellipsefit_multiband).
+
     """
     import legacyhalos.ellipse
 
@@ -50,31 +613,37 @@ def call_ellipse(galaxy, galaxydir, data, galaxyinfo=None,
     #if zcolumn is None:
     #    zcolumn = 'Z_LAMBDA'
 
+    kwargs = dict(galaxy=galaxy, galaxydir=galaxydir, data=data, galaxyinfo=galaxyinfo,
+                  bands=bands, refband=refband,
+                  pixscale=pixscale, nproc=nproc,
+                  sbthresh=sbthresh, apertures=apertures, input_ellipse=input_ellipse,
+                  delta_logsma=delta_logsma, delta_sma=delta_sma, maxsma=maxsma, logsma=logsma,
+                  pyramid=pyramid, verbose=verbose, debug=debug, clobber=clobber)
+
     t0 = time.time()
-    if debug:
-        _start(galaxy)
-        err = legacyhalos.ellipse.legacyhalos_ellipse(
-            galaxy, galaxydir, data, galaxyinfo=galaxyinfo,
-            bands=bands, refband=refband,
-            pixscale=pixscale, nproc=nproc,
-            sbthresh=sbthresh, apertures=apertures, input_ellipse=input_ellipse,
-            delta_logsma=delta_logsma, maxsma=maxsma, logsma=logsma,
-            verbose=verbose, debug=debug, clobber=clobber)
-        if write_donefile:
-            _done(galaxy, galaxydir, err, t0, 'ellipse', data['filesuffix'])
-    else:
-        with open(logfile, 'a') as log:
-            with redirect_stdout(log), redirect_stderr(log):
-                _start(galaxy, log=log)
-                err = legacyhalos.ellipse.legacyhalos_ellipse(
-                    galaxy, galaxydir, data, galaxyinfo=galaxyinfo,
-                    bands=bands, refband=refband,
-                    pixscale=pixscale, nproc=nproc,
-                    sbthresh=sbthresh, apertures=apertures, input_ellipse=input_ellipse,
-                    delta_logsma=delta_logsma, maxsma=maxsma, logsma=logsma,
-                    verbose=verbose, clobber=clobber)
-                if write_donefile:
-                    _done(galaxy, galaxydir, err, t0, 'ellipse', data['filesuffix'], log=log)
+    with legacyhalos.telemetry.stage(galaxy, 'ellipse', nproc=nproc) as tel:
+        if debug:
+            _start(galaxy)
+            err, outcome = call_with_budget(legacyhalos.ellipse.legacyhalos_ellipse, kwargs,
+                                            'ellipse', timeout=timeout, retries=retries)
+            if err is None:
+                err = 0
+            if write_donefile:
+                _done(galaxy, galaxydir, err, t0, 'ellipse', data['filesuffix'],
+                      outcome=outcome if timeout else None)
+        else:
+            with open(logfile, 'a') as log:
+                with redirect_stdout(log), redirect_stderr(log):
+                    _start(galaxy, log=log)
+                    err, outcome = call_with_budget(legacyhalos.ellipse.legacyhalos_ellipse, kwargs,
+                                                    'ellipse', timeout=timeout, retries=retries,
+                                                    log=log)
+                    if err is None:
+                        err = 0
+                    if write_donefile:
+                        _done(galaxy, galaxydir, err, t0, 'ellipse', data['filesuffix'], log=log,
+                              outcome=outcome if timeout else None)
+        tel.status = outcome
 
     return err
 
@@ -99,8 +668,11 @@ def call_sersic(onegal, galaxy, galaxydir, seed, verbose, debug, logfile):
                 _done(galaxy, err, t0, log=log)
 
 def call_sky(onegal, galaxy, galaxydir, survey, seed, nproc, pixscale,
-              verbose, debug, logfile):
-    """Wrapper script to do Sersic-fitting.
+              verbose, debug, logfile, force=False, batch=False, threads=2,
+              inprocess=False, ccdindex=None, sampler='isophote'):
+    """Wrapper script to measure the sky variance.
+
+    batch, threads, inprocess, ccdindex, sampler - see legacyhalos.sky.legacyhalos_sky
 
     """
     import legacyhalos.sky
@@ -110,16 +682,21 @@ def call_sky(onegal, galaxy, galaxydir, survey, seed, nproc, pixscale,
         _start(galaxy, seed=seed)
         err = legacyhalos.sky.legacyhalos_sky(onegal, survey=survey, galaxy=galaxy, galaxydir=galaxydir,
                                               nproc=nproc, pixscale=pixscale, seed=seed,
-                                              debug=debug, verbose=verbose, force=force)
-        _done(galaxy, err, t0)
+                                              debug=debug, verbose=verbose, force=force,
+                                              batch=batch, threads=threads, inprocess=inprocess,
+                                              ccdindex=ccdindex, sampler=sampler)
+        _done(galaxy, galaxydir, err, t0, 'sky')
     else:
         with open(logfile, 'a') as log:
             with redirect_stdout(log), redirect_stderr(log):
                 _start(galaxy, log=log, seed=seed)
                 err = legacyhalos.sky.legacyhalos_sky(onegal, survey=survey, galaxy=galaxy, galaxydir=galaxydir,
                                                       nproc=nproc, pixscale=pixscale, seed=seed,
-                                                      debug=debug, verbose=verbose, force=force)
-                _done(galaxy, err, t0, log=log)
+                                                      debug=debug, verbose=verbose, force=force,
+                                                      log=log, batch=batch, threads=threads,
+                                                      inprocess=inprocess, ccdindex=ccdindex,
+                                                      sampler=sampler)
+                _done(galaxy, galaxydir, err, t0, 'sky', log=log)
                 
 def call_htmlplots(onegal, galaxy, survey, pixscale=0.262, nproc=1, 
                    verbose=False, debug=False, clobber=False, ccdqa=False,
@@ -131,6 +708,24 @@ def call_htmlplots(onegal, galaxy, survey, pixscale=0.262, nproc=1,
     """Wrapper script to build the pipeline coadds."""
     t0 = time.time()
 
+    with legacyhalos.telemetry.stage(galaxy, 'html', nproc=nproc):
+        _call_htmlplots(onegal, galaxy, survey, t0, pixscale=pixscale, nproc=nproc,
+                        verbose=verbose, debug=debug, clobber=clobber, ccdqa=ccdqa,
+                        logfile=logfile, zcolumn=zcolumn, galaxy_id=galaxy_id,
+                        datadir=datadir, htmldir=htmldir, cosmo=cosmo,
+                        galex=galex, unwise=unwise, just_coadds=just_coadds,
+                        write_donefile=write_donefile, barlen=barlen, barlabel=barlabel,
+                        radius_mosaic_arcsec=radius_mosaic_arcsec,
+                        get_galaxy_galaxydir=get_galaxy_galaxydir,
+                        read_multiband=read_multiband)
+
+def _call_htmlplots(onegal, galaxy, survey, t0, pixscale=0.262, nproc=1, 
+                    verbose=False, debug=False, clobber=False, ccdqa=False,
+                    logfile=None, zcolumn='Z', galaxy_id=None,
+                    datadir=None, htmldir=None, cosmo=None,
+                    galex=False, unwise=False, just_coadds=False, write_donefile=True,
+                    barlen=None, barlabel=None, radius_mosaic_arcsec=None,
+                    get_galaxy_galaxydir=None, read_multiband=None):
     if debug:
         _start(galaxy)
         err = legacyhalos.html.make_plots(
@@ -172,46 +767,76 @@ def call_custom_coadds(onegal, galaxy, survey, run, radius_mosaic, nproc=1,
                        #ubercal_sky=False,
                        write_wise_psf=False,
                        just_coadds=False, require_grz=True, 
-                       no_gaia=False, no_tycho=False,
-                       debug=False, logfile=None):
+                       no_gaia=False, no_tycho=False, inprocess=False, reuse=None,
+                       compression='runbrick', psf_cache_dir=None, debug=False,
+                       logfile=None, timeout=None, retries=1):
     """Wrapper script to build custom coadds.
 
     radius_mosaic in arcsec
 
+    timeout - optional wall-clock budget [seconds] for each galaxy; see
+      call_with_budget.
+    inprocess - run runbrick in this process with a survey object which is
+      reused by all the galaxies on this rank (see
+      legacyhalos.coadds.run_runbrick).
+    reuse - optional directory of the registry of built mosaics (see
+      legacyhalos.coadds.custom_coadds).
+    compression - output compression profile of the mosaics (see
+      legacyhalos.compression).
+    psf_cache_dir - optional directory of the on-disk cache of the unWISE and
+      GALEX PSF stamps (see legacyhalos.coadds.PSFCache).
+
     """
     import legacyhalos.coadds
+
+    if inprocess:
+        survey = legacyhalos.coadds.SURVEYS.get(run, survey.output_dir, survey_dir=survey.survey_dir)
+
+    kwargs = dict(onegal=onegal, galaxy=galaxy, survey=survey, 
+                  radius_mosaic=radius_mosaic, nproc=nproc, 
+                  pixscale=pixscale, racolumn=racolumn, deccolumn=deccolumn,
+                  nsigma=nsigma, custom=custom,
+                  run=run, apodize=apodize, unwise=unwise, galex=galex, force=force, plots=plots,
+                  verbose=verbose, cleanup=cleanup, write_all_pickles=write_all_pickles,
+                  write_wise_psf=write_wise_psf,
+                  #no_subsky=no_subsky,
+                  subsky_radii=subsky_radii, #ubercal_sky=ubercal_sky,
+                  just_coadds=just_coadds,
+                  require_grz=require_grz, no_gaia=no_gaia, no_tycho=no_tycho,
+                  inprocess=inprocess, reuse=reuse, compression=compression,
+                  psf_cache_dir=psf_cache_dir)
+    stagesuffix = 'custom' if custom else 'pipeline'
     
     t0 = time.time()
-    if debug:
-        _start(galaxy)
-        err, filesuffix = legacyhalos.coadds.custom_coadds(
-            onegal, galaxy=galaxy, survey=survey, 
-            radius_mosaic=radius_mosaic, nproc=nproc, 
-            pixscale=pixscale, racolumn=racolumn, deccolumn=deccolumn,
-            nsigma=nsigma, custom=custom,
-            run=run, apodize=apodize, unwise=unwise, galex=galex, force=force, plots=plots,
-            verbose=verbose, cleanup=cleanup, write_all_pickles=write_all_pickles,
-            write_wise_psf=write_wise_psf,
-            #no_subsky=no_subsky,
-            subsky_radii=subsky_radii, #ubercal_sky=ubercal_sky,
-            just_coadds=just_coadds,
-            require_grz=require_grz, no_gaia=no_gaia, no_tycho=no_tycho)
-        _done(galaxy, survey.output_dir, err, t0, 'coadds', filesuffix)
-    else:
-        with open(logfile, 'a') as log:
-            with redirect_stdout(log), redirect_stderr(log):
-                _start(galaxy, log=log)
-                err, filesuffix = legacyhalos.coadds.custom_coadds(
-                    onegal, galaxy=galaxy, survey=survey, 
-                    radius_mosaic=radius_mosaic, nproc=nproc, 
-                    pixscale=pixscale, racolumn=racolumn, deccolumn=deccolumn,
-                    nsigma=nsigma, custom=custom,
-                    run=run, apodize=apodize, unwise=unwise, galex=galex, force=force, plots=plots,
-                    verbose=verbose, cleanup=cleanup, write_all_pickles=write_all_pickles,
-                    write_wise_psf=write_wise_psf,
-                    #no_subsky=no_subsky,
-                    subsky_radii=subsky_radii, #ubercal_sky=ubercal_sky,
-                    just_coadds=just_coadds,
-                    require_grz=require_grz, no_gaia=no_gaia, no_tycho=no_tycho,
-                    log=log)
-                _done(galaxy, survey.output_dir, err, t0, 'coadds', filesuffix, log=log)
+    with legacyhalos.telemetry.stage(galaxy, '{}-coadds'.format(stagesuffix), nproc=nproc,
+                                     width=int(legacyhalos.coadds._mosaic_width(radius_mosaic, pixscale)),
+                                     height=int(legacyhalos.coadds._mosaic_width(radius_mosaic, pixscale))) as tel:
+        if inprocess:
+            surveys = legacyhalos.coadds.SURVEYS
+            legacyhalos.telemetry.record(runbrick_startup=surveys.startup)
+            if surveys.subprocess_startup is None:
+                print('In-process runbrick startup {:.2f} sec.'.format(surveys.startup), flush=True)
+            else:
+                legacyhalos.telemetry.record(runbrick_subprocess_startup=surveys.subprocess_startup,
+                                             runbrick_startup_saved=surveys.saved())
+                print('In-process runbrick startup {:.2f} sec (runbrick.py startup {:.2f} sec; saved {:.2f} sec).'.format(
+                    surveys.startup, surveys.subprocess_startup, surveys.saved()), flush=True)
+        if debug:
+            _start(galaxy)
+            result, outcome = call_with_budget(legacyhalos.coadds.custom_coadds, kwargs,
+                                               'coadds', timeout=timeout, retries=retries)
+            err, filesuffix = result if result is not None else (0, stagesuffix)
+            _done(galaxy, survey.output_dir, err, t0, 'coadds', filesuffix,
+                  outcome=outcome if timeout else None)
+        else:
+            with open(logfile, 'a') as log:
+                with redirect_stdout(log), redirect_stderr(log):
+                    _start(galaxy, log=log)
+                    kwargs['log'] = log
+                    result, outcome = call_with_budget(legacyhalos.coadds.custom_coadds, kwargs,
+                                                       'coadds', timeout=timeout, retries=retries,
+                                                       log=log)
+                    err, filesuffix = result if result is not None else (0, stagesuffix)
+                    _done(galaxy, survey.output_dir, err, t0, 'coadds', filesuffix, log=log,
+                          outcome=outcome if timeout else None)
+        tel.status = outcome
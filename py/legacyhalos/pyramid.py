@@ -0,0 +1,161 @@
+"""
+legacyhalos.pyramid
+===================
+
+Multi-resolution (pyramid) images for ellipse-fitting the largest galaxies.
+
+The masked image and variance of each band are block-averaged once into levels
+with 2x2, 4x4, and 8x8 pixels. Each isophote and curve-of-growth aperture is
+then measured on the coarsest level which still resolves it (at least minpix
+coarse pixels along its semi-minor axis), and on a cutout of that level just
+large enough to hold it, so each multiprocessing task works on (and receives a
+pickled copy of) a small image rather than the full mosaic.
+
+The levels are in the same units as the input: the image level is the mean
+surface brightness of the unmasked pixels in each block and the variance level
+is the variance of that mean, which is what the isophotes sample. Blocks with
+fewer than minfrac of their pixels unmasked are masked. Each level also keeps
+the fraction of unmasked pixels in each block, and the curve-of-growth
+apertures are measured on the image weighted by that fraction (and the
+variance by its square; see ImagePyramid.cutout), i.e., with masked pixels
+counting as zero as in the full-resolution aperture photometry, so the flux
+(and variance) of every block is that of its unmasked pixels whether or not
+the block is masked. The only difference from full resolution is then in the
+partial blocks on the edge of each aperture, which are weighted by their
+overlap with the aperture rather than pixel by pixel.
+
+Only the ellipse fitting and curve of growth use the levels; the masks
+themselves (legacyhalos.SGA._build_multiband_mask) are still built at full
+resolution.
+
+Pixel coordinates follow photutils (x is the column and y the row, with pixel
+centers at integer values), so a position x at full resolution is at
+(x + 0.5) / factor - 0.5 on the level with the given factor.
+
+"""
+import numpy as np
+
+PYRAMID_FACTORS = (1, 2, 4, 8)
+PYRAMID_MINPIX = 20 # minimum semi-minor axis [coarse pixels]
+PYRAMID_MINFRAC = 0.5
+
+def block_reduce(img, mask=None, var=None, factor=2, minfrac=PYRAMID_MINFRAC):
+    """Block-average an image (and variance) over its unmasked pixels.
+
+    img - 2D image
+    mask - boolean mask (True=masked) of the same shape, optional
+    var - variance image of the same shape, optional
+    factor - block size [pixels]; the image is padded (with masked pixels) to a
+      multiple of factor
+
+    Returns the block-averaged image, mask, variance (or None), and fraction
+    of unmasked pixels in each block. Blocks without any unmasked pixels are
+    zero.
+
+    """
+    img = np.asarray(img)
+    if mask is None:
+        mask = np.zeros(img.shape, bool)
+    H, W = img.shape
+    ny, nx = -(-H // factor), -(-W // factor)
+
+    def _blocksum(arr):
+        out = np.zeros((ny * factor, nx * factor), 'f8')
+        out[:H, :W] = arr
+        return out.reshape(ny, factor, nx, factor).sum(axis=(1, 3))
+
+    good = ~np.asarray(mask, bool)
+    ngood = _blocksum(good)
+    outmask = ngood < max(minfrac * factor**2, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        outimg = _blocksum(np.where(good, img, 0)) / ngood
+        outvar = None
+        if var is not None:
+            outvar = _blocksum(np.where(good, var, 0)) / ngood**2
+    empty = ngood == 0
+    outimg[empty] = 0
+    outimg = outimg.astype(img.dtype)
+    if outvar is not None:
+        outvar[empty] = 0
+        outvar = outvar.astype(np.asarray(var).dtype)
+    frac = (ngood / factor**2).astype('f4')
+    return outimg, outmask, outvar, frac
+
+class ImagePyramid(object):
+    """Block-averaged levels of a masked image (and its variance).
+
+    img - masked array (see numpy.ma)
+    var - variance image, optional
+    factors - block sizes of the levels (including 1, the input image)
+
+    """
+    def __init__(self, img, var=None, factors=PYRAMID_FACTORS, minfrac=PYRAMID_MINFRAC):
+        import numpy.ma as ma
+
+        data, mask = ma.getdata(img), ma.getmaskarray(img)
+        self.factors = sorted(set([1] + list(factors)))
+        self.shape = data.shape
+        self.levels = {1: (data, mask, var, None)}
+        for factor in self.factors[1:]:
+            self.levels[factor] = block_reduce(data, mask, var, factor=factor, minfrac=minfrac)
+
+    def nbytes(self):
+        """Memory used by the coarse levels [bytes]."""
+        nbytes = 0
+        for factor in self.factors[1:]:
+            nbytes += sum([arr.nbytes for arr in self.levels[factor] if arr is not None])
+        return nbytes
+
+    def factor(self, sma, eps=0.0, minpix=PYRAMID_MINPIX):
+        """Coarsest level which resolves an ellipse with semi-major axis sma [pixels
+        at full resolution] and ellipticity eps.
+
+        """
+        smb = sma * (1 - eps)
+        for factor in self.factors[::-1]:
+            if smb / factor >= minpix:
+                return factor
+        return 1
+
+    @staticmethod
+    def to_level(factor, x, y):
+        """Full-resolution to level coordinates."""
+        return (x + 0.5) / factor - 0.5, (y + 0.5) / factor - 0.5
+
+    @staticmethod
+    def from_level(factor, x, y):
+        """Level to full-resolution coordinates."""
+        return (x + 0.5) * factor - 0.5, (y + 0.5) * factor - 0.5
+
+    def cutout(self, factor, x0, y0, radius, pad=3, photometry=False):
+        """Cutout of one level around the full-resolution position (x0, y0), large
+        enough to hold a circle of the given radius [full-resolution pixels] plus
+        pad coarse pixels.
+
+        photometry - weight the image by the fraction of unmasked pixels in each
+          block (and the variance by its square) and only mask the blocks
+          without any unmasked pixels, for aperture photometry
+
+        Returns the masked image, variance (or None), the position (x0, y0) in
+        the coordinates of the cutout, and the offsets (xoff, yoff) of the cutout
+        in the level.
+
+        """
+        import numpy.ma as ma
+
+        data, mask, var, frac = self.levels[factor]
+        xc, yc = self.to_level(factor, x0, y0)
+        rad = radius / factor + pad
+        ny, nx = data.shape
+        x1, x2 = max(0, int(np.floor(xc - rad))), min(nx, int(np.ceil(xc + rad)) + 1)
+        y1, y2 = max(0, int(np.floor(yc - rad))), min(ny, int(np.ceil(yc + rad)) + 1)
+        data, mask = data[y1:y2, x1:x2], mask[y1:y2, x1:x2]
+        if var is not None:
+            var = var[y1:y2, x1:x2]
+        if photometry and frac is not None:
+            frac = frac[y1:y2, x1:x2]
+            data, mask = (data * frac).astype(data.dtype), frac == 0
+            if var is not None:
+                var = (var * frac**2).astype(var.dtype)
+        img = ma.masked_array(data, mask=mask)
+        return img, var, xc - x1, yc - y1, x1, y1
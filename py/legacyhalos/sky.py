@@ -17,16 +17,61 @@ import matplotlib.pyplot as plt
 
 import legacyhalos.io
 
+class SkyProfile(object):
+    """Surface brightness profile of a sky coadd measured in elliptical annuli
+    (see legacyhalos.misc.EllipticalAnnuli), with the same attributes as the
+    photutils IsophoteList it replaces (sma, intens, int_err, pix_stddev, and
+    npix), plus the mean, median, and (clipped) standard deviation of each
+    annulus.
+
+    The statistics are those of every (unmasked) pixel in each annulus rather
+    than of the samples along each isophote, so they are not identical to the
+    photutils ones: intens is the clipped mean of the annulus (equivalent to
+    integrmode='mean' on a flat sky, but not to the default 'median');
+    pix_stddev is the clipped standard deviation of the pixels, which photutils
+    instead estimates from the scatter of the sector values (~25% larger with
+    integrmode='median'); and int_err=pix_stddev/sqrt(npix) is the error of the
+    mean of npix *independent* pixels rather than the scatter of the samples
+    divided by the square root of their number, so it underestimates the error
+    if the pixels are correlated (as they are in resampled coadds).
+    legacyhalos_sky only keeps intens, and the sky variance is the scatter of
+    the profiles of many sky positions, which is only comparable to the errors
+    of the galaxy profile if both are measured the same way (hence the default
+    sampler='isophote' in sky_coadd).
+
+    """
+    def __init__(self, sma, npix, mean, median, sigma):
+        self.sma = sma
+        self.npix = npix
+        self.mean = mean
+        self.median = median
+        self.sigma = sigma
+        self.intens = mean
+        self.pix_stddev = sigma
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.int_err = sigma / np.sqrt(npix)
+
 def sky_coadd(ra, dec, outdir='.', size=100, prefix='', survey=None, ncpu=1, ellipsefit=None,
-              band=('g', 'r', 'z'), pixscale=0.262, log=None, force=False):
+              band=('g', 'r', 'z'), pixscale=0.262, log=None, force=False, inprocess=False,
+              sampler='isophote'):
     """Run legacypipe to generate a coadd in a "blank" part of sky near / around a
     given central.
 
+    inprocess - see legacyhalos.coadds.run_runbrick
+    sampler - 'isophote' (default) to sample each isophote with photutils, with
+      the same integration mode and clipping as the ellipse fit of the galaxy
+      (returning IsophoteList instances); or 'annulus' to measure the profile
+      of each band in one pass over the pixels, in elliptical annuli around
+      the isophotes of the (fixed-geometry) ellipse fit, with the same
+      sigma-clipping (returning SkyProfile instances). The annuli are much
+      faster, but their statistics differ from those of the galaxy profile
+      (see SkyProfile).
+
     """
-    import subprocess
     import fitsio
     from photutils.isophote import EllipseSample, Isophote, IsophoteList
-    from legacyhalos.misc import custom_brickname
+    from legacyhalos.misc import custom_brickname, EllipticalAnnuli
+    from legacyhalos.coadds import run_runbrick, SURVEYS
 
     # Check whether the coadd has already been generated.
     brickname = custom_brickname(ra, dec, prefix='custom-')
@@ -60,7 +105,9 @@ def sky_coadd(ra, dec, outdir='.', size=100, prefix='', survey=None, ncpu=1, ell
                          threads=ncpu, outdir=outdir)
 
         print(cmd, flush=True, file=log)
-        err = subprocess.call(cmd.split(), stdout=log, stderr=log)
+        if inprocess and survey is None:
+            survey = SURVEYS.get(None, outdir)
+        err = run_runbrick(cmd, survey=survey, log=log, inprocess=inprocess)
         if err != 0:
             print('Something we wrong; please check the logfile.')
             return dict()
@@ -88,6 +135,23 @@ def sky_coadd(ra, dec, outdir='.', size=100, prefix='', survey=None, ncpu=1, ell
 
     print('Reading {}'.format(blobfile))
     blobs = fitsio.read(blobfile)
+
+    if sampler == 'annulus':
+        geoms = [iso.sample.geometry for iso in isophot]
+        if len(set([(g.eps, g.pa) for g in geoms])) != 1:
+            print('Isophotes do not have a fixed geometry; sampling each one.')
+            sampler = 'isophote'
+    if sampler == 'annulus':
+        # The pixel radii and annuli are computed once, for all the bands.
+        annuli = EllipticalAnnuli(blobs.shape, size / 2, size / 2, geoms[0].eps, geoms[0].pa,
+                                  [g.sma for g in geoms], mask=(blobs != -1))
+        for filt, imfile in zip( band, imfiles ):
+            print('Reading {}'.format(imfile))
+            prof = annuli.profile(fitsio.read(imfile), sclip=sclip, nclip=nclip)
+            skyellipsefit[filt] = SkyProfile(prof['sma'], prof['npix'], prof['mean'],
+                                             prof['median'], prof['sigma'])
+        return skyellipsefit
+
     for filt, imfile in zip( band, imfiles ):
         print('Reading {}'.format(imfile))
         image = fitsio.read(imfile)
@@ -132,7 +196,7 @@ def sky_positions(ra_cluster, dec_cluster, redshift, r_lambda, nsky, rand):
     uniformly distributed in an annulus around the central.
 
     """
-    from legacyhalos.misc import cutout_radius_cluster
+    from legacyhalos.legacyhalos import cutout_radius_cluster
 
     rcluster = cutout_radius_cluster(redshift, r_lambda, pixscale=1, # [degrees]
                                      factor=1.0) / 3600
@@ -151,44 +215,256 @@ def sky_positions(ra_cluster, dec_cluster, redshift, r_lambda, nsky, rand):
 
     return ra, dec
 
-def legacyhalos_sky(sample, survey=None, objid=None, objdir=None, ncpu=1, nsky=30,
+def sky_footprint(survey, ra, dec, size, pixscale=0.262, band=('g', 'r', 'z'),
+                  ccdindex=None):
+    """Select the CCDs of all the sky positions (of one or many galaxies) in a
+    single query of the CCD index and return a boolean array indicating which
+    positions have imaging in every band (after legacyhalos.coadds.select_ccds,
+    the same cuts runbrick and get_ccds apply).
+
+    size - width of each sky coadd [pixels]; scalar or one per position
+
+    """
+    from legacyhalos.ccdindex import CCDIndex
+    from legacyhalos.coadds import select_ccds
+
+    if ccdindex is None:
+        ccdindex = CCDIndex.from_survey(survey)
+
+    ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+    size = np.broadcast_to(size, ra.shape)
+    allccds = ccdindex.ccds_touching(survey, ra, dec, size, pixscale=pixscale)
+
+    infootprint = np.zeros(len(ra), bool)
+    for ii, ccds in enumerate(allccds):
+        ccds = select_ccds(ccds, band=band)
+        if len(ccds) == 0:
+            continue
+        usebands = set(ccds.filter)
+        infootprint[ii] = np.all([filt in usebands for filt in band])
+    return infootprint
+
+def _sky_init(onegal, ellipsefit, nsky=30, seed=1, band=('g', 'r', 'z')):
+    """Choose the (random) sky positions around one galaxy and initialize its
+    output dictionary of sky profiles.
+
+    """
+    rand = np.random.RandomState(seed)
+
+    # Set the size of the sky cutout to 3 times the length of the semi-major
+    # axis of the central galaxy.
+    size = np.ceil(3 * ellipsefit['geometry'].sma).astype('int')
+
+    # get the (random) sky coordinates
+    ra, dec = sky_positions(onegal['ra'], onegal['dec'], onegal['z'],
+                            onegal['r_lambda'], nsky, rand)
+
+    sky = dict()
+    sky['seed'] = seed
+    sky['size'] = size
+    sky['ra'] = ra
+    sky['dec'] = dec
+    sky['sma'] = ellipsefit[ellipsefit['refband']].sma
+    nsma = len(sky['sma'])
+    for filt in band:
+        sky[filt] = np.zeros( (nsma, nsky) ).astype('f4')
+
+    return sky
+
+# Shared (read-only) state of the current sky batch, inherited by the forked
+# workers of legacyhalos_sky_batch rather than pickled with every task.
+_SKYBATCH = {}
+
+def _sky_batch_one(itask):
+    """Build one sky coadd of the current batch and measure its surface
+    brightness profile. Returns the per-band intensities (or None on failure).
+
+    """
+    task = _SKYBATCH['tasks'][itask]
+    ellipsefit = _SKYBATCH['ellipsefit'][task['igal']]
+    band = _SKYBATCH['band']
+
+    logfile = os.path.join(task['outdir'], '{}.log'.format(task['prefix']))
+    with open(logfile, 'a') as log:
+        skyellipsefit = sky_coadd(task['ra'], task['dec'], ellipsefit=ellipsefit,
+                                  size=task['size'], outdir=task['outdir'], prefix=task['prefix'],
+                                  survey=_SKYBATCH['survey'], ncpu=_SKYBATCH['threads'],
+                                  pixscale=_SKYBATCH['pixscale'], log=log,
+                                  force=_SKYBATCH['force'], band=band,
+                                  inprocess=_SKYBATCH['inprocess'], sampler=_SKYBATCH['sampler'])
+    if not bool(skyellipsefit):
+        return None
+    return {filt: np.asarray(skyellipsefit[filt].intens, 'f4') for filt in band}
+
+def legacyhalos_sky_batch(sample, galaxy, galaxydir, survey=None, nproc=1, threads=1,
+                          nsky=30, pixscale=0.262, seed=1, band=('g', 'r', 'z'),
+                          ccdindex=None, outfile=None, force=False, inprocess=False,
+                          sampler='isophote', verbose=False):
+    """Measure the sky variance around one or more galaxies, scheduling all their
+    sky positions on one pool of processes.
+
+    sample - table of galaxies (with columns ra, dec, z, and r_lambda)
+    galaxy, galaxydir - name and output directory of each galaxy
+    nproc - total number of cores to use; nproc // threads sky coadds are built
+      at a time, each with threads cores (the sky coadds are small, so a few
+      threads each is enough)
+    ccdindex - optional legacyhalos.ccdindex.CCDIndex; the CCDs of all the sky
+      positions are selected in one query, and positions without imaging in
+      every band are skipped rather than handed to runbrick
+    outfile - optional output file for the table of sky profiles
+    inprocess - run runbrick in the workers with the (forked) survey object
+    sampler - see sky_coadd
+
+    The sky profiles of each galaxy are written as in legacyhalos_sky and are
+    also collected into one table, with one row per sky position, which is
+    returned.
+
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from astropy.table import Table
+    import legacyhalos.telemetry
+
+    if np.ndim(galaxy) == 0: # one galaxy
+        sample = [sample]
+    galaxy, galaxydir = np.atleast_1d(galaxy), np.atleast_1d(galaxydir)
+    if survey is None:
+        from legacypipe.survey import LegacySurveyData
+        survey = LegacySurveyData()
+
+    # Choose the sky positions of every galaxy, in the same order as
+    # legacyhalos_sky (so the same seed gives the same positions).
+    tasks, skies, ellipsefits = [], [], []
+    for igal, (onegal, gal, galdir) in enumerate(zip(sample, galaxy, galaxydir)):
+        ellipsefit = legacyhalos.io.read_ellipsefit(gal, galdir)
+        ellipsefits.append(ellipsefit)
+        if not bool(ellipsefit) or not ellipsefit['success']:
+            skies.append(None)
+            continue
+
+        sky = _sky_init(onegal, ellipsefit, nsky=nsky, seed=seed, band=band)
+        skies.append(sky)
+
+        outdir = os.path.join(galdir.replace('analysis', 'analysis-archive'))
+        for ii in range(nsky):
+            tasks.append({'igal': igal, 'isky': ii, 'ra': sky['ra'][ii], 'dec': sky['dec'][ii],
+                          'size': sky['size'],
+                          'outdir': outdir, 'prefix': 'sky-{:03d}'.format(ii)})
+
+    if len(tasks) == 0:
+        print('No galaxies with successful ellipse fits; nothing to do.')
+        return None
+
+    # One CCD query for all the positions.
+    infootprint = sky_footprint(survey, [tt['ra'] for tt in tasks], [tt['dec'] for tt in tasks],
+                                [tt['size'] for tt in tasks], pixscale=pixscale, band=band,
+                                ccdindex=ccdindex)
+    todo = np.where(infootprint)[0]
+    print('Building {}/{} sky coadds ({} outside the {} footprint) of {} galaxies.'.format(
+        len(todo), len(tasks), len(tasks) - len(todo), ''.join(band), len(galaxy)), flush=True)
+
+    threads = max(1, min(threads, nproc))
+    nworkers = max(1, min(nproc // threads, len(todo)))
+
+    _SKYBATCH.update({'tasks': tasks, 'ellipsefit': ellipsefits, 'survey': survey,
+                      'band': band, 'pixscale': pixscale, 'threads': threads,
+                      'force': force, 'inprocess': inprocess, 'sampler': sampler})
+    t0 = time.time()
+    try:
+        if nworkers == 1:
+            results = [_sky_batch_one(itask) for itask in todo]
+        else:
+            ctx = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx) as pool:
+                results = list(pool.map(_sky_batch_one, todo))
+    finally:
+        _SKYBATCH.clear()
+    print('Built {} sky coadds with {} workers x {} threads in {:.2f} min.'.format(
+        len(todo), nworkers, threads, (time.time() - t0) / 60), flush=True)
+
+    # Collect the profiles.
+    done = np.zeros(len(tasks), bool)
+    for itask, result in zip(todo, results):
+        if result is None:
+            continue
+        task = tasks[itask]
+        for filt in band:
+            skies[task['igal']][filt][:, task['isky']] = result[filt]
+        done[itask] = True
+    nfail = len(todo) - np.sum(done[todo])
+    legacyhalos.telemetry.record(sky_positions=len(tasks), sky_skipped=len(tasks) - len(todo),
+                                 sky_failed=int(nfail), sky_workers=nworkers)
+
+    maxsma = max([len(sky['sma']) for sky in skies if sky is not None])
+    out = Table()
+    out['GALAXY'] = [str(galaxy[tt['igal']]) for tt in tasks]
+    out['SKYID'] = np.array([tt['isky'] for tt in tasks], 'i2')
+    out['RA'] = np.array([tt['ra'] for tt in tasks], 'f8')
+    out['DEC'] = np.array([tt['dec'] for tt in tasks], 'f8')
+    out['SIZE'] = np.array([tt['size'] for tt in tasks], 'i4')
+    out['IN_FOOTPRINT'] = infootprint
+    out['SUCCESS'] = done
+    out['NSMA'] = np.array([len(skies[tt['igal']]['sma']) for tt in tasks], 'i2')
+    out['SMA'] = np.zeros((len(tasks), maxsma), 'f4') + np.nan
+    for filt in band:
+        out['{}_INTENS'.format(filt.upper())] = np.zeros((len(tasks), maxsma), 'f4') + np.nan
+    for itask, tt in enumerate(tasks):
+        sky = skies[tt['igal']]
+        nsma = len(sky['sma'])
+        out['SMA'][itask, :nsma] = sky['sma']
+        if done[itask]:
+            for filt in band:
+                out['{}_INTENS'.format(filt.upper())][itask, :nsma] = sky[filt][:, tt['isky']]
+
+    # Write out each galaxy for which every sky coadd in the footprint worked.
+    for igal, sky in enumerate(skies):
+        if sky is None:
+            continue
+        these = np.array([tt['igal'] == igal for tt in tasks])
+        if np.all(done[these & infootprint]):
+            legacyhalos.io.write_ellipsefit(galaxy[igal], galaxydir[igal], sky, verbose=True,
+                                            filesuffix='sky')
+        else:
+            print('Some sky coadds of {} failed; please check the logfiles.'.format(galaxy[igal]))
+
+    if outfile is not None:
+        print('Writing {} sky profiles to {}'.format(len(out), outfile))
+        out.write(outfile, overwrite=True)
+
+    return out
+
+def legacyhalos_sky(sample, survey=None, galaxy=None, galaxydir=None, nproc=1, nsky=30,
                     pixscale=0.262, log=None, seed=1, verbose=False, band=('g', 'r', 'z'),
-                    debug=False, force=False):
+                    debug=False, force=False, inprocess=False, batch=False, threads=2,
+                    ccdindex=None, sampler='isophote'):
     """Top-level wrapper script to measure the sky variance around a given galaxy.
 
+    inprocess - run runbrick in this process, reusing one survey object for all
+      the sky coadds (see legacyhalos.coadds.run_runbrick)
+    batch - build the sky coadds in parallel on a pool of nproc cores (see
+      legacyhalos_sky_batch), with threads cores each
+    sampler - see sky_coadd
+
     """
-    if objid is None and objdir is None:
-        objid, objdir = legacyhalos.io.get_objid(sample)
+    if galaxy is None or galaxydir is None:
+        raise ValueError('Both galaxy and galaxydir must be specified.')
+
+    if batch:
+        out = legacyhalos_sky_batch(sample, galaxy, galaxydir, survey=survey, nproc=nproc,
+                                    threads=threads, nsky=nsky, pixscale=pixscale, seed=seed,
+                                    band=band, ccdindex=ccdindex, force=force, inprocess=inprocess,
+                                    sampler=sampler,
+                                    outfile=os.path.join(galaxydir, '{}-sky-profiles.fits'.format(galaxy)),
+                                    verbose=verbose)
+        return int(out is not None and np.all(out['SUCCESS'][out['IN_FOOTPRINT']]))
         
-    rand = np.random.RandomState(seed)
-
     # Read the ellipse-fitting results and 
-    ellipsefit = legacyhalos.io.read_ellipsefit(objid, objdir)
+    ellipsefit = legacyhalos.io.read_ellipsefit(galaxy, galaxydir)
     if bool(ellipsefit):
         if ellipsefit['success']:
 
-            refband = ellipsefit['refband']
-
-            # Set the size of the sky cutout to 2.2 times the length of the
-            # semi-major axis of the central galaxy.
-            size = np.ceil(3 * ellipsefit['geometry'].sma).astype('int')
-
-            # get the (random) sky coordinates
-            ra, dec = sky_positions(sample['ra'], sample['dec'], sample['z'],
-                                    sample['r_lambda'], nsky, rand)
-
             # initialize the output dictionary
-            sky = dict()
-            sky['seed'] = seed
-            sky['size'] = size
-            sky['ra'] = ra
-            sky['dec'] = dec
-            sky['sma'] = ellipsefit[refband].sma
-            nsma = len(sky['sma'])
-            for filt in band:
-                #sma = 
-                #sky['{}_sma'.format(filt)] = np.zeros( (nsma, nsky) ).astype('f4')
-                sky[filt] = np.zeros( (nsma, nsky) ).astype('f4')
+            sky = _sky_init(sample, ellipsefit, nsky=nsky, seed=seed, band=band)
 
             # Build each sky coadd and measure the null surface brightness
             # profile.
@@ -196,13 +472,14 @@ def legacyhalos_sky(sample, survey=None, objid=None, objdir=None, ncpu=1, nsky=3
             for ii in range(nsky):
                 prefix = 'sky-{:03d}'.format(ii)
                 print('Working on {}'.format(prefix))
-                outdir = os.path.join(objdir.replace('analysis', 'analysis-archive'))
+                outdir = os.path.join(galaxydir.replace('analysis', 'analysis-archive'))
 
                 # Do it!
-                skyellipsefit = sky_coadd(ra[ii], dec[ii], ellipsefit=ellipsefit,
-                                          size=size, outdir=outdir, prefix=prefix,
-                                          survey=survey, ncpu=ncpu, pixscale=pixscale,
-                                          log=log, force=force)
+                skyellipsefit = sky_coadd(sky['ra'][ii], sky['dec'][ii], ellipsefit=ellipsefit,
+                                          size=sky['size'], outdir=outdir, prefix=prefix,
+                                          survey=survey, ncpu=nproc, pixscale=pixscale,
+                                          log=log, force=force, inprocess=inprocess,
+                                          sampler=sampler)
                 if bool(skyellipsefit):
                     for filt in band:
                         sky[filt][:, ii] = skyellipsefit[filt].intens
@@ -212,8 +489,7 @@ def legacyhalos_sky(sample, survey=None, objid=None, objdir=None, ncpu=1, nsky=3
 
             if bool(skyellipsefit):
                 # write out!
-                legacyhalos.io.write_ellipsefit(objid, objdir, sky, verbose=True, filesuffix='sky')
+                legacyhalos.io.write_ellipsefit(galaxy, galaxydir, sky, verbose=True, filesuffix='sky')
                 return 1
             else:
                 return 0
-            
@@ -0,0 +1,369 @@
+"""
+legacyhalos.telemetry
+=====================
+
+Lightweight, structured performance telemetry for the pipeline. Each stage of
+each galaxy emits one JSON line with its wall-clock and CPU time, peak memory,
+I/O volume, and any sub-timers (read, mask, fit, cog, write) and counters
+recorded along the way.
+
+The telemetry file is set with the $LEGACYHALOS_TELEMETRY environment variable
+(or the outfile argument to stage); if it is not set, all of the calls below are
+cheap no-ops. Use legacyhalos-telemetry (or summarize) to turn the JSON lines
+from a job into hotspot tables.
+
+"""
+import os, sys, json, time, socket
+from contextlib import contextmanager
+
+_CURRENT = None
+
+def _io_counters():
+    """Bytes read and written by this process (Linux only; zeros otherwise)."""
+    counters = {'read_bytes': 0, 'write_bytes': 0}
+    try:
+        with open('/proc/self/io') as F:
+            for line in F:
+                key, val = line.split(':')
+                if key in ('rchar', 'wchar'):
+                    counters['read_bytes' if key == 'rchar' else 'write_bytes'] = int(val)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of this process to its current value
+    (Linux only). Returns False if the peak cannot be reset.
+
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as F:
+            F.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    """Peak resident set size [bytes] of this process (since the last
+    _reset_peak_rss) and the largest of its reaped children.
+
+    """
+    import resource
+    scale = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss is in KB on Linux
+    rself = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    try:
+        with open('/proc/self/status') as F:
+            for line in F:
+                if line.startswith('VmHWM:'):
+                    rself = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError):
+        pass
+    rchild = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return rself, rchild
+
+def _cpu_time():
+    tt = os.times()
+    return tt.user + tt.system + tt.children_user + tt.children_system
+
+class StageTelemetry(object):
+    """Accumulate the performance measurements for one stage of one galaxy.
+
+    The peak memory (peak_rss) is measured over this stage only: the high-water
+    mark of the process is reset when the stage starts, and reaped children only
+    count if one of them set a new maximum during the stage. Where the
+    high-water mark cannot be reset (i.e., not on Linux), peak_rss is the
+    maximum over the lifetime of the process and peak_rss_scope is 'process'
+    instead of 'stage'.
+
+    """
+    def __init__(self, galaxy, stage, outfile=None, **meta):
+        self.outfile = outfile
+        self.record = {'galaxy': str(galaxy), 'stage': stage,
+                       'host': socket.gethostname(), 'pid': os.getpid()}
+        self.record.update(meta)
+        self.timers = {}
+        self.counters = {}
+
+        self._t0 = time.time()
+        self._cpu0 = _cpu_time()
+        self._io0 = _io_counters()
+        self._start_peak()
+
+    def _start_peak(self):
+        self._rss_reset = _reset_peak_rss()
+        self._rss_child0 = _peak_rss()[1]
+        self._rss_peak = 0
+
+    def _update_peak(self):
+        """Peak memory [bytes] of this stage so far (see the class docstring)."""
+        rself, rchild = _peak_rss()
+        self._rss_peak = max(self._rss_peak, rself)
+        if rchild > self._rss_child0 or not self._rss_reset:
+            self._rss_peak = max(self._rss_peak, rchild)
+        return self._rss_peak
+
+    def reset(self):
+        """Start again from zero in a forked worker, so that state() only returns
+        what the worker measured and merge() does not count the timers and
+        counters inherited from the parent twice.
+
+        """
+        self.timers = {}
+        self.counters = {}
+        self._io0 = _io_counters()
+        self._start_peak()
+
+    @contextmanager
+    def timer(self, name):
+        """Accumulate the wall-clock time spent in a block of code."""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.timers[name] = self.timers.get(name, 0.0) + time.time() - t0
+
+    def set(self, **kwargs):
+        """Record scalar metadata, e.g., image dimensions."""
+        for key, val in kwargs.items():
+            if hasattr(val, 'item'): # numpy scalar
+                val = val.item()
+            self.record[key] = val
+
+    def add(self, key, value=1):
+        """Increment a counter, e.g., the number of pool tasks."""
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def state(self):
+        """Measurements which need to be passed back from a forked worker."""
+        return {'timers': self.timers, 'counters': self.counters,
+                'record': self.record, 'io': _io_counters(), 'io0': self._io0,
+                'peak_rss': self._update_peak()}
+
+    def merge(self, state):
+        """Fold in the measurements made by a forked worker (see
+        legacyhalos.mpi.run_with_watchdog).
+
+        """
+        for key, val in state['timers'].items():
+            self.timers[key] = self.timers.get(key, 0.0) + val
+        for key, val in state['counters'].items():
+            self.counters[key] = self.counters.get(key, 0) + val
+        for key, val in state['record'].items():
+            self.record.setdefault(key, val)
+        # Linux adds the I/O of a reaped child to the counters of its parent,
+        # so the worker's I/O is already part of the totals of this stage;
+        # record it separately.
+        for key in state['io']:
+            self.record['worker_'+key] = state['io'][key] - state['io0'][key]
+        self._rss_peak = max(self._rss_peak, state['peak_rss'])
+
+    def finish(self, status=None):
+        """Finalize the record and append it to the telemetry file."""
+        io1 = _io_counters()
+
+        out = dict(self.record)
+        out['status'] = status
+        out['time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._t0))
+        out['wall'] = time.time() - self._t0
+        out['cpu'] = _cpu_time() - self._cpu0
+        out['peak_rss'] = self._update_peak()
+        out['peak_rss_scope'] = 'stage' if self._rss_reset else 'process'
+        for key in io1.keys():
+            out[key] = io1[key] - self._io0[key]
+        out['timers'] = self.timers
+        out['counters'] = self.counters
+
+        if self.outfile is not None:
+            outdir = os.path.dirname(self.outfile)
+            if outdir != '' and not os.path.isdir(outdir):
+                os.makedirs(outdir, exist_ok=True)
+            # A single write of a short line in append mode is effectively
+            # atomic, so many ranks can share one file.
+            with open(self.outfile, 'a') as F:
+                F.write(json.dumps(out) + '\n')
+        return out
+
+class _NullTelemetry(object):
+    """No-op stand-in used when telemetry is not enabled."""
+    @contextmanager
+    def timer(self, name):
+        yield
+
+    def set(self, **kwargs):
+        pass
+
+    def add(self, key, value=1):
+        pass
+
+    def reset(self):
+        pass
+
+    def state(self):
+        return None
+
+    def merge(self, state):
+        pass
+
+_NULL = _NullTelemetry()
+
+def telemetry_file():
+    """Return the telemetry output file (or None if telemetry is disabled)."""
+    return os.getenv('LEGACYHALOS_TELEMETRY')
+
+def current():
+    """Return the telemetry object of the running stage (or a no-op object)."""
+    if _CURRENT is None:
+        return _NULL
+    return _CURRENT
+
+def timer(name):
+    """Sub-timer on the current stage, e.g., with telemetry.timer('fit'):"""
+    return current().timer(name)
+
+def record(**kwargs):
+    current().set(**kwargs)
+
+def add(key, value=1):
+    current().add(key, value)
+
+@contextmanager
+def stage(galaxy, stage, outfile=None, **meta):
+    """Measure one stage of one galaxy and emit a JSON line when it finishes.
+
+    The yielded object has a status attribute which the caller can set to record
+    the outcome of the stage.
+
+    Nested calls for the same galaxy and stage join the enclosing stage, so a
+    project wrapper can open the stage around its own preparatory work (e.g.,
+    read_multiband) before calling the generic legacyhalos.mpi wrapper.
+
+    """
+    global _CURRENT
+
+    if outfile is None:
+        outfile = telemetry_file()
+    if outfile is None:
+        yield _NULL
+        return
+
+    if (_CURRENT is not None and _CURRENT.record['galaxy'] == str(galaxy) and
+        _CURRENT.record['stage'] == stage):
+        _CURRENT.record.update(meta)
+        yield _CURRENT
+        return
+
+    previous = _CURRENT
+    if previous is not None:
+        previous._update_peak() # before the high-water mark is reset
+    _CURRENT = StageTelemetry(galaxy, stage, outfile=outfile, **meta)
+    _CURRENT.status = None
+    try:
+        yield _CURRENT
+    finally:
+        _CURRENT.finish(status=_CURRENT.status)
+        _CURRENT = previous
+
+def read_telemetry(telemetryfiles):
+    """Read one or more telemetry files and return a list of records."""
+    if isinstance(telemetryfiles, str):
+        telemetryfiles = [telemetryfiles]
+    records = []
+    for telemetryfile in telemetryfiles:
+        with open(telemetryfile) as F:
+            for line in F:
+                line = line.strip()
+                if line == '':
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print('Skipping corrupted line in {}'.format(telemetryfile))
+    return records
+
+def summarize(records, top=10, file=None):
+    """Print per-stage and per-sub-timer hotspot tables and the slowest galaxies.
+
+    Returns a dictionary of per-stage summary statistics.
+
+    """
+    import numpy as np
+
+    if file is None:
+        file = sys.stdout
+
+    summary = {}
+    stages = sorted(set([rec['stage'] for rec in records]))
+
+    print('{:<16s} {:>6s} {:>10s} {:>9s} {:>9s} {:>9s} {:>8s} {:>10s} {:>10s}'.format(
+        'stage', 'N', 'wall[hr]', 'med[s]', 'p90[s]', 'max[s]', 'cpu/wall',
+        'RSS[GB]', 'IO[GB]'), file=file)
+    for stage in stages:
+        recs = [rec for rec in records if rec['stage'] == stage]
+        wall = np.array([rec['wall'] for rec in recs])
+        cpu = np.array([rec['cpu'] for rec in recs])
+        rss = np.array([rec['peak_rss'] for rec in recs])
+        iobytes = np.array([rec.get('read_bytes', 0) + rec.get('write_bytes', 0) for rec in recs])
+
+        timers = {}
+        for rec in recs:
+            for key, val in rec.get('timers', {}).items():
+                timers[key] = timers.get(key, 0.0) + val
+
+        summary[stage] = {'n': len(recs), 'wall': wall.sum(), 'wall_median': np.median(wall),
+                          'wall_p90': np.percentile(wall, 90), 'wall_max': wall.max(),
+                          'cpu': cpu.sum(), 'peak_rss_max': rss.max(),
+                          'io_bytes': iobytes.sum(), 'timers': timers}
+        print('{:<16s} {:>6d} {:>10.2f} {:>9.1f} {:>9.1f} {:>9.1f} {:>8.2f} {:>10.2f} {:>10.2f}'.format(
+            stage, len(recs), wall.sum() / 3600, np.median(wall), np.percentile(wall, 90),
+            wall.max(), cpu.sum() / max(wall.sum(), 1e-6), rss.max() / 1024**3,
+            iobytes.sum() / 1024**3), file=file)
+
+    # Sub-timers, sorted by total time.
+    print('', file=file)
+    print('{:<16s} {:<12s} {:>10s} {:>8s}'.format('stage', 'timer', 'total[hr]', 'frac'), file=file)
+    for stage in stages:
+        timers = summary[stage]['timers']
+        for key in sorted(timers, key=timers.get, reverse=True):
+            print('{:<16s} {:<12s} {:>10.3f} {:>8.3f}'.format(
+                stage, key, timers[key] / 3600, timers[key] / max(summary[stage]['wall'], 1e-6)),
+                file=file)
+
+    # Slowest galaxies.
+    print('', file=file)
+    print('{:<16s} {:<30s} {:>9s} {:>9s} {:>10s} {:<s}'.format(
+        'stage', 'galaxy', 'wall[s]', 'RSS[GB]', 'npix', 'status'), file=file)
+    for stage in stages:
+        recs = [rec for rec in records if rec['stage'] == stage]
+        srt = np.argsort([rec['wall'] for rec in recs])[::-1][:top]
+        for ii in srt:
+            rec = recs[ii]
+            npix = rec.get('width', 0) * rec.get('height', 0)
+            print('{:<16s} {:<30s} {:>9.1f} {:>9.2f} {:>10d} {}'.format(
+                stage, rec['galaxy'][:30], rec['wall'], rec['peak_rss'] / 1024**3,
+                int(npix), rec.get('status')), file=file)
+
+    return summary
+
+def main():
+    """Command-line entry point of legacyhalos-telemetry."""
+    import argparse
+    from glob import glob
+
+    parser = argparse.ArgumentParser(description='Summarize legacyhalos telemetry files.')
+    parser.add_argument('telemetryfiles', nargs='+', help='Telemetry file(s) or glob pattern(s).')
+    parser.add_argument('--stage', type=str, default=None, help='Only summarize this stage.')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest galaxies to list per stage.')
+    args = parser.parse_args()
+
+    telemetryfiles = []
+    for pattern in args.telemetryfiles:
+        telemetryfiles += sorted(glob(pattern))
+    records = read_telemetry(telemetryfiles)
+    if args.stage is not None:
+        records = [rec for rec in records if rec['stage'] == args.stage]
+    if len(records) == 0:
+        print('No telemetry records found.')
+        return
+    print('Read {} telemetry records from {} file(s).'.format(len(records), len(telemetryfiles)))
+    summarize(records, top=args.top)
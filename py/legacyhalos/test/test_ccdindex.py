@@ -0,0 +1,127 @@
+import os, tempfile, unittest
+from types import SimpleNamespace
+import numpy as np
+
+from astropy.wcs import WCS
+
+from legacyhalos.ccdindex import CCDIndex
+
+def _tan_wcs(crval1, crval2, crpix1, crpix2, cd1_1, cd1_2, cd2_1, cd2_2):
+    """Independent (astropy/wcslib) TAN projection."""
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [crval1, crval2]
+    wcs.wcs.crpix = [crpix1, crpix2]
+    wcs.wcs.cd = [[cd1_1, cd1_2], [cd2_1, cd2_2]]
+    return wcs
+
+def _point_in_poly(x, y, poly):
+    inside = False
+    for (x1, y1), (x2, y2) in zip(poly, np.roll(poly, -1, axis=0)):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+def _segments_intersect(p1, p2, p3, p4):
+    def ccw(a, b, c):
+        return (c[1]-a[1]) * (b[0]-a[0]) > (b[1]-a[1]) * (c[0]-a[0])
+    return ccw(p1, p3, p4) != ccw(p2, p3, p4) and ccw(p1, p2, p3) != ccw(p1, p2, p4)
+
+def _polygons_intersect(poly1, poly2):
+    """Brute-force version of astrometry.util.miscutils.polygons_intersect."""
+    if any(_point_in_poly(x, y, poly2) for x, y in poly1):
+        return True
+    if any(_point_in_poly(x, y, poly1) for x, y in poly2):
+        return True
+    for p1, p2 in zip(poly1, np.roll(poly1, -1, axis=0)):
+        for p3, p4 in zip(poly2, np.roll(poly2, -1, axis=0)):
+            if _segments_intersect(p1, p2, p3, p4):
+                return True
+    return False
+
+class TestCCDIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2021)
+        nccd = 400
+        scale = 0.262 / 3600
+        theta = rng.uniform(-0.1, 0.1, nccd)
+        W, H = np.repeat(2046, nccd), np.repeat(4094, nccd)
+        self.ccds = SimpleNamespace(
+            crval1=rng.uniform(148, 152, nccd), crval2=rng.uniform(-2, 2, nccd),
+            crpix1=W / 2 + rng.uniform(-20, 20, nccd), crpix2=H / 2 + rng.uniform(-20, 20, nccd),
+            cd1_1=-scale * np.cos(theta), cd1_2=scale * np.sin(theta),
+            cd2_1=scale * np.sin(theta), cd2_2=scale * np.cos(theta),
+            width=W, height=H)
+        self.ccds.ra, self.ccds.dec = self.ccds.crval1, self.ccds.crval2
+
+        ngal = 150
+        self.ra = rng.uniform(147.5, 152.5, ngal)
+        self.dec = rng.uniform(-2.5, 2.5, ngal)
+        self.width = rng.integers(100, 5000, ngal)
+
+    def ccd_wcs(self, ii):
+        c = self.ccds
+        return _tan_wcs(c.crval1[ii], c.crval2[ii], c.crpix1[ii], c.crpix2[ii],
+                        c.cd1_1[ii], c.cd1_2[ii], c.cd2_1[ii], c.cd2_2[ii])
+
+    def ccd_corners(self, ii):
+        """RA, Dec of the outer corners of CCD ii."""
+        W, H = self.ccds.width[ii], self.ccds.height[ii]
+        xy = np.array([[0.5, 0.5], [W+0.5, 0.5], [W+0.5, H+0.5], [0.5, H+0.5]])
+        return self.ccd_wcs(ii).all_pix2world(xy, 1)
+
+    def brute_force(self, ra, dec, width, pixscale=0.262):
+        """Loop over every CCD and test whether its outline, projected into the
+        pixel coordinates of the brick WCS, overlaps the brick (the algorithm in
+        legacypipe.survey.ccds_touching_wcs, but without its distance cut).
+
+        """
+        scale = pixscale / 3600
+        brickwcs = _tan_wcs(ra, dec, (width+1) / 2, (width+1) / 2, -scale, 0.0, 0.0, scale)
+        brickpoly = np.array([[0.5, 0.5], [width+0.5, 0.5], [width+0.5, width+0.5], [0.5, width+0.5]])
+        if not hasattr(self, 'corners'):
+            self.corners = np.array([self.ccd_corners(ii) for ii in range(len(self.ccds.crval1))])
+        ccdpolys = brickwcs.all_world2pix(self.corners.reshape(-1, 2), 1).reshape(self.corners.shape)
+        # Polygons with disjoint bounding boxes cannot intersect.
+        overlap = np.all((ccdpolys.min(axis=1) <= width+0.5) & (ccdpolys.max(axis=1) >= 0.5), axis=1)
+        out = [ii for ii in np.where(overlap)[0] if _polygons_intersect(brickpoly, ccdpolys[ii])]
+        return np.array(out, int)
+
+    def test_query(self):
+        index = CCDIndex.from_table(self.ccds)
+        result = index.query(self.ra, self.dec, self.width, chunksize=40)
+        self.assertEqual(len(result), len(self.ra))
+        nmatch = 0
+        for ra, dec, width, indx in zip(self.ra, self.dec, self.width, result):
+            ref = self.brute_force(ra, dec, width)
+            self.assertTrue(np.array_equal(indx, ref))
+            nmatch += len(ref)
+        self.assertGreater(nmatch, 0)
+
+    def test_corners(self):
+        index = CCDIndex.from_table(self.ccds)
+        for ii in range(5):
+            xyz = index.corners[ii]
+            ra = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360
+            dec = np.degrees(np.arcsin(xyz[:, 2]))
+            ref = self.ccd_corners(ii)
+            self.assertTrue(np.allclose(ra, ref[:, 0], rtol=0, atol=1e-10))
+            self.assertTrue(np.allclose(dec, ref[:, 1], rtol=0, atol=1e-10))
+
+    def test_write(self):
+        index = CCDIndex.from_table(self.ccds)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            indexfile = os.path.join(tmpdir, 'ccdindex.npz')
+            index.write(indexfile)
+            index2 = CCDIndex.read(indexfile)
+        self.assertEqual(index2.radius, index.radius)
+        for indx, indx2 in zip(index.query(self.ra, self.dec, self.width),
+                               index2.query(self.ra, self.dec, self.width)):
+            self.assertTrue(np.array_equal(indx, indx2))
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
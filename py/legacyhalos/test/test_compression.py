@@ -0,0 +1,64 @@
+import os, tempfile, unittest
+import numpy as np
+
+from legacyhalos.compression import (parse_profile, profile_string, compression_settings,
+                                     recompress_file, read_profile)
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+class TestCompression(unittest.TestCase):
+
+    def test_profiles(self):
+        self.assertEqual(parse_profile(None), ('runbrick', None))
+        self.assertEqual(parse_profile('rice'), ('rice', 4.0))
+        self.assertEqual(parse_profile('RICE:16'), ('rice', 16.0))
+        self.assertEqual(profile_string('rice:16.0'), 'rice:16')
+        self.assertEqual(profile_string('lossless'), 'lossless')
+        for bad in ('gzip', 'rice:0', 'lossless:4'):
+            self.assertRaises(ValueError, parse_profile, bad)
+
+    def test_settings(self):
+        self.assertEqual(compression_settings('lossless', 'image'), (None, None))
+        self.assertEqual(compression_settings('lossless', 'invvar'), ('GZIP_2', None))
+        self.assertEqual(compression_settings('rice:8', 'model'), ('RICE', 8.0))
+        self.assertEqual(compression_settings('rice:8', 'image', dtype='i2'), ('RICE', None))
+        self.assertEqual(compression_settings('float32', 'invvar'), (None, None))
+
+    @unittest.skipIf(fitsio is None, 'fitsio is not installed')
+    def test_recompress(self):
+        rng = np.random.default_rng(1)
+        ivar = rng.uniform(100, 200, (64, 48)).astype('f4')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ivarfile = os.path.join(tmpdir, 'NGC1234-custom-invvar-r.fits.fz')
+            hdr = fitsio.FITSHDR([dict(name='BANDNAME', value='r')])
+            fitsio.write(ivarfile, ivar, header=hdr, compress='GZIP_2', qlevel=None)
+            for profile in ('lossless', 'float32', 'lossless'):
+                recompress_file(ivarfile, profile)
+                self.assertEqual(read_profile(ivarfile), profile)
+                # Uncompressed or not, the image stays in extension 1.
+                with fitsio.FITS(ivarfile) as F:
+                    self.assertEqual(len(F), 2)
+                    self.assertFalse(F[0].has_data())
+                data, hdr = fitsio.read(ivarfile, ext=1, header=True)
+                self.assertTrue(np.array_equal(data, ivar))
+                self.assertEqual(hdr['BANDNAME'].strip(), 'r')
+            recompress_file(ivarfile, 'rice:16')
+            self.assertEqual(read_profile(ivarfile), 'rice:16')
+            # The quantization step is (about) the noise divided by the qlevel.
+            self.assertLess(np.max(np.abs(fitsio.read(ivarfile, ext=1) - ivar)), np.std(ivar) / 16)
+
+            # An image in the primary HDU is moved to extension 1.
+            imfile = os.path.join(tmpdir, 'NGC1234-custom-image-r.fits.fz')
+            fitsio.write(imfile, ivar, header=hdr)
+            recompress_file(imfile, 'float32')
+            self.assertTrue(np.array_equal(fitsio.read(imfile, ext=1), ivar))
+            self.assertEqual(read_profile(imfile), 'float32')
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
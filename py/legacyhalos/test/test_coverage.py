@@ -0,0 +1,173 @@
+import os, tempfile, unittest
+import numpy as np
+
+from legacyhalos.coverage import CoverageMap, get_coverage_map
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+def _ellipse_fraction(cmap, ra, dec, sma, ba, pa, kind='ivar'):
+    """Reference (one ellipse at a time) version of CoverageMap.ellipse_fraction."""
+    covered = np.ones(cmap.shape, bool)
+    for band in cmap.bands:
+        covered &= cmap.plane(band, kind)
+    H, W = cmap.shape
+    cd = np.array(cmap.wcs[4:]).reshape(2, 2) * 3600
+    pixscale = np.sqrt(np.abs(np.linalg.det(cd)))
+    xcen, ycen = cmap.radec2pixelxy(ra, dec)
+    frac = np.zeros(len(ra), 'f4')
+    for ii in range(len(ra)):
+        rad = int(np.ceil(sma[ii] / pixscale)) + 1
+        x0, y0 = int(np.round(xcen[ii] - 1)), int(np.round(ycen[ii] - 1))
+        yy, xx = np.mgrid[y0-rad:y0+rad+1, x0-rad:x0+rad+1]
+        dx, dy = xx - (xcen[ii] - 1), yy - (ycen[ii] - 1)
+        east, north = cd[0, 0] * dx + cd[0, 1] * dy, cd[1, 0] * dx + cd[1, 1] * dy
+        sinpa, cospa = np.sin(np.radians(pa[ii])), np.cos(np.radians(pa[ii]))
+        major, minor = east * sinpa + north * cospa, east * cospa - north * sinpa
+        inside = (major / sma[ii])**2 + (minor / (sma[ii] * ba[ii]))**2 <= 1
+        if np.sum(inside) == 0:
+            continue
+        good = inside & (xx >= 0) & (xx < W) & (yy >= 0) & (yy < H)
+        frac[ii] = np.sum(covered[yy[good], xx[good]]) / np.sum(inside)
+    return frac
+
+class TestCoverage(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2021)
+        self.bands = ['g', 'r', 'z']
+        self.shape = (101, 121)
+        cd = 0.262 / 3600
+        self.wcs = [150.0, 2.0, 61.0, 51.0, -cd, 0.0, 0.0, cd]
+        self.images, self.ivars = {}, {}
+        for band in self.bands:
+            img = rng.normal(size=self.shape).astype('f4')
+            ivar = np.ones(self.shape, 'f4')
+            ivar[:, :40] = 0 # no inverse variance on the west side...
+            img[:, :20] = 0  # ...and no data at all on the far west side
+            self.images[band], self.ivars[band] = img, ivar
+        self.ivars['z'][60:, :] = 0
+        self.cmap = CoverageMap.from_arrays(self.wcs, self.images, self.ivars, self.bands)
+
+    def test_grz_missing(self):
+        rng = np.random.default_rng(1)
+        x, y = rng.uniform(-2, 125, 200), rng.uniform(-2, 105, 200)
+        cd = self.wcs[4:]
+        ra = self.wcs[0] + (x - self.wcs[2]) * cd[0] / np.cos(np.radians(self.wcs[1]))
+        dec = self.wcs[1] + (y - self.wcs[3]) * cd[3]
+        for just_ivar in (False, True):
+            missing = self.cmap.grz_missing(ra, dec, just_ivar=just_ivar)
+            xx, yy = self.cmap.radec2pixelxy(ra, dec)
+            for ii in range(len(ra)):
+                # the original, image-based check
+                ycen, xcen, box, ref = int(yy[ii]-1), int(xx[ii]-1), 2, False
+                for band in self.bands:
+                    img = self.images[band][ycen-box:ycen+box, xcen-box:xcen+box]
+                    ivar = self.ivars[band][ycen-box:ycen+box, xcen-box:xcen+box]
+                    if np.all(ivar == 0) and (just_ivar or np.all(img == 0)):
+                        ref = True
+                        break
+                self.assertEqual(missing[ii], ref)
+                self.assertEqual(self.cmap.grz_missing(ra[ii], dec[ii], just_ivar=just_ivar), ref)
+        self.assertFalse(self.cmap.grz_missing())
+
+    def test_ellipse_fraction(self):
+        ra, dec = self.wcs[0], self.wcs[1]
+        frac = self.cmap.ellipse_fraction([ra, ra], [dec, dec], [2.0, 20.0], [0.5, 1.0], [30.0, 0.0])
+        self.assertEqual(frac[0], 1.0)
+        # Circle of radius 20 arcsec (76 pixels) centered on pixel (60, 50): the
+        # covered pixels are x >= 40, y < 60 (in the z-band).
+        x, y = np.meshgrid(np.arange(-100, 200), np.arange(-100, 200))
+        inside = np.hypot(x - 60, y - 50) * 0.262 <= 20.0
+        ref = np.sum(inside & (x >= 40) & (x < 121) & (y >= 0) & (y < 60)) / np.sum(inside)
+        self.assertAlmostEqual(frac[1], ref, places=3)
+        self.assertEqual(self.cmap.ellipse_fraction(ra, dec, 10.0, 0.5, 30.0, kind='data')[0], 1.0)
+
+        # A thin ellipse along the z-band edge (y=60): fully covered if it lies
+        # East-West, and about half covered if it lies North-South.
+        ra = self.wcs[0] + 15 * self.wcs[4] / np.cos(np.radians(self.wcs[1]))
+        dec = self.wcs[1] + 6 * self.wcs[7]
+        frac = self.cmap.ellipse_fraction(ra, dec, 8.0, 0.1, [0.0, 90.0, 180.0])
+        self.assertLess(abs(frac[0] - 0.5), 0.1)
+        self.assertEqual(frac[0], frac[2])
+        self.assertEqual(frac[1], 1.0)
+
+    def test_ellipse_fraction_batch(self):
+        rng = np.random.default_rng(3)
+        nell = 300
+        x, y = rng.uniform(-20, 140, nell), rng.uniform(-20, 120, nell)
+        ra = self.wcs[0] + (x - self.wcs[2]) * self.wcs[4] / np.cos(np.radians(self.wcs[1]))
+        dec = self.wcs[1] + (y - self.wcs[3]) * self.wcs[7]
+        sma, ba, pa = rng.uniform(0.1, 15, nell), rng.uniform(0.05, 1, nell), rng.uniform(0, 180, nell)
+        for kind in ('ivar', 'data'):
+            frac = self.cmap.ellipse_fraction(ra, dec, sma, ba, pa, kind=kind)
+            ref = _ellipse_fraction(self.cmap, ra, dec, sma, ba, pa, kind=kind)
+            self.assertTrue(np.array_equal(frac, ref))
+        self.assertTrue(np.any(frac == 0) and np.any(frac == 1) and np.any((frac > 0) & (frac < 1)))
+
+    def test_footprints(self):
+        # The same coverage from the exposure counts and the ALLMASK bits.
+        nexps = {band: (self.images[band] != 0).astype(np.int16) * 3 for band in self.bands}
+        maskbits = np.zeros(self.shape, np.int16)
+        for bit, band in enumerate(self.bands):
+            maskbits[(self.ivars[band] == 0) & (nexps[band] > 0)] |= 2**(5 + bit)
+        maskbits[::7, :] |= 2**1 # other bits do not matter
+        cmap = CoverageMap.from_footprints(self.wcs, nexps, maskbits, self.bands)
+        for band in self.bands:
+            for kind in ('data', 'ivar'):
+                self.assertTrue(np.array_equal(cmap.plane(band, kind), self.cmap.plane(band, kind)))
+
+    @unittest.skipIf(fitsio is None, 'fitsio is not installed')
+    def test_get_coverage_map(self):
+        hdr = [{'name': 'CTYPE1', 'value': 'RA---TAN'}, {'name': 'CTYPE2', 'value': 'DEC--TAN'}]
+        for key, val in zip(('CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2'), self.wcs):
+            hdr.append({'name': key, 'value': val})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def _write(suffix, data):
+                fitsio.write(os.path.join(tmpdir, 'NGC1-largegalaxy-{}.fits.fz'.format(suffix)),
+                             data, header=hdr, compress='gzip', qlevel=None, clobber=True)
+
+            # Only the image mosaics.
+            for band in self.bands:
+                _write('image-{}'.format(band), self.images[band])
+                _write('invvar-{}'.format(band), self.ivars[band])
+            cmap = get_coverage_map('NGC1', tmpdir, write=False)
+            self.assertTrue(np.allclose(cmap.wcs, self.wcs, rtol=1e-12))
+            self.assertTrue(np.array_equal(cmap.plane('z'), self.ivars['z'] != 0))
+
+            # With the footprint products, the images are not read at all.
+            maskbits = np.zeros(self.shape, np.int16)
+            for bit, band in enumerate(self.bands):
+                _write('nexp-{}'.format(band), (self.images[band] != 0).astype(np.int16))
+                maskbits[(self.ivars[band] == 0) & (self.images[band] != 0)] |= 2**(5 + bit)
+            _write('maskbits', maskbits)
+            for band in self.bands:
+                os.remove(os.path.join(tmpdir, 'NGC1-largegalaxy-image-{}.fits.fz'.format(band)))
+            cmap = get_coverage_map('NGC1', tmpdir)
+            for band in self.bands:
+                self.assertTrue(np.array_equal(cmap.plane(band, 'ivar'), self.cmap.plane(band, 'ivar')))
+                self.assertTrue(np.array_equal(cmap.plane(band, 'data'), self.cmap.plane(band, 'data')))
+            self.assertTrue(os.path.isfile(os.path.join(tmpdir, 'NGC1-largegalaxy-coverage.npz')))
+            self.assertEqual(get_coverage_map('NGC1', tmpdir).packed.keys(), cmap.packed.keys())
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile = os.path.join(tmpdir, 'image.fits')
+            open(infile, 'w').close()
+            covfile = os.path.join(tmpdir, 'coverage.npz')
+            self.cmap.write(covfile, [infile])
+            cmap = CoverageMap.read(covfile, [infile])
+            for band in self.bands:
+                self.assertTrue(np.array_equal(cmap.plane(band, 'data'), self.cmap.plane(band, 'data')))
+                self.assertTrue(np.array_equal(cmap.plane(band, 'ivar'), self.ivars[band] != 0))
+            with open(infile, 'w') as F: # stale
+                F.write('x')
+            self.assertIsNone(CoverageMap.read(covfile, [infile]))
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
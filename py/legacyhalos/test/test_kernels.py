@@ -0,0 +1,236 @@
+import os, subprocess, sys, tempfile, textwrap, unittest
+from unittest import mock
+import numpy as np
+
+from legacyhalos import kernels
+
+try:
+    from astropy.stats import sigma_clipped_stats as astropy_sigma_clipped_stats
+except ImportError:
+    astropy_sigma_clipped_stats = None
+
+try:
+    import photutils
+except ImportError:
+    photutils = None
+
+class TestKernels(unittest.TestCase):
+    """Check that the numpy and compiled kernels agree. If numba is not installed,
+    the compiled kernels are run as plain Python (on small inputs).
+
+    """
+    def setUp(self):
+        self.rng = np.random.default_rng(2021)
+
+    def both(self, func, *args, **kwargs):
+        with mock.patch.object(kernels, 'use_numba', return_value=False):
+            ref = func(*args, **kwargs)
+        with mock.patch.object(kernels, 'use_numba', return_value=True):
+            out = func(*args, **kwargs)
+        return ref, out
+
+    def test_ellipse_masks(self):
+        from legacyhalos.misc import ellipse_mask, ellipse_masks, ellipse_mask_bbox
+        shape = (60, 45)
+        nell = 12
+        xcen, ycen = self.rng.uniform(-5, 65, nell), self.rng.uniform(-5, 50, nell)
+        semia = self.rng.uniform(0.5, 20, nell)
+        semib = semia * self.rng.uniform(0.1, 1, nell)
+        phi = self.rng.uniform(0, np.pi, nell).astype('f4')
+
+        x, y = np.ogrid[0:shape[0], 0:shape[1]]
+        truth = np.zeros(shape, bool)
+        for args in zip(xcen, ycen, semia, semib, phi):
+            truth |= ellipse_mask(*args, x, y)
+            ref, out = self.both(ellipse_mask_bbox, *args, shape)
+            self.assertTrue(np.array_equal(ref, ellipse_mask(*args, x, y)))
+            self.assertTrue(np.array_equal(out, ref))
+
+        ref, out = self.both(ellipse_masks, xcen, ycen, semia, semib, phi, shape)
+        self.assertTrue(np.array_equal(ref, truth))
+        self.assertTrue(np.array_equal(out, truth))
+
+    def test_sigma_clipped_stats(self):
+        data = self.rng.normal(size=(50, 40)).astype('f4')
+        data[self.rng.random(data.shape) < 0.05] = 50.0
+        data[0, :3] = np.nan
+        ref, out = self.both(kernels.sigma_clipped_stats, data, sigma=3.0)
+        self.assertTrue(np.allclose(ref, out, rtol=1e-5, atol=1e-6))
+        if astropy_sigma_clipped_stats is not None:
+            self.assertTrue(np.allclose(ref, astropy_sigma_clipped_stats(data, sigma=3.0),
+                                        rtol=1e-5, atol=1e-6))
+
+    def test_threshold_mask(self):
+        resid = self.rng.normal(size=(30, 20)).astype('f4')
+        ref, out = self.both(kernels.threshold_mask, resid, 1.3)
+        self.assertTrue(np.array_equal(ref, np.abs(resid) > 1.3))
+        self.assertTrue(np.array_equal(out, ref))
+
+        prior = self.rng.random(resid.shape) < 0.1
+        ref, out = self.both(lambda: kernels.threshold_mask(resid, 1.3, out=prior.copy()))
+        self.assertTrue(np.array_equal(ref, prior | (np.abs(resid) > 1.3)))
+        self.assertTrue(np.array_equal(out, ref))
+
+    def test_binned_stats(self):
+        nbin = 8
+        xx = self.rng.uniform(0, 1, 500)
+        yy = self.rng.normal(size=500)
+        yy[::50] = np.nan
+        idx = np.digitize(xx, np.linspace(0, 1, nbin))
+        (npts, ref), (npts2, out) = self.both(kernels.binned_stats, xx, yy, idx, nbin)
+        self.assertTrue(np.array_equal(npts, npts2))
+        self.assertTrue(np.allclose(ref, out, rtol=1e-10, atol=1e-12))
+
+        kk = 3
+        these = idx == kk
+        self.assertEqual(npts[kk], np.count_nonzero(yy[these]))
+        self.assertEqual(ref[kk, 0], np.nanmedian(xx[these]))
+        self.assertEqual(ref[kk, 2], np.nanstd(yy[these]))
+        self.assertTrue(np.array_equal(ref[kk, 4:], np.nanpercentile(yy[these], [25, 50, 75])))
+        self.assertTrue(np.all(ref[0, :] == 0))
+
+    def test_grouped_clipped_stats(self):
+        edges = np.array([0, 0, 40, 45, 200, 203])
+        values = self.rng.normal(size=edges[-1])
+        values[self.rng.random(len(values)) < 0.05] = 30.0
+        values[50] = np.nan
+        (npix, ref), (npix2, out) = self.both(kernels.grouped_clipped_stats, values, edges,
+                                              sclip=2.5, nclip=3)
+        self.assertTrue(np.array_equal(npix, npix2))
+        self.assertTrue(np.allclose(ref, out, rtol=1e-10, atol=1e-12, equal_nan=True))
+        self.assertEqual(npix[0], 0)
+        self.assertTrue(np.all(np.isnan(ref[0, :])))
+
+        # Same clipping as photutils.isophote.EllipseSample.
+        x = values[edges[3]:edges[4]]
+        x = x[np.isfinite(x)]
+        for _ in range(3):
+            mean, std = np.mean(x), np.std(x)
+            x = x[(x >= mean - 2.5 * std) & (x < mean + 2.5 * std)]
+        self.assertEqual(npix[3], len(x))
+        self.assertTrue(np.allclose(ref[3, :], [np.mean(x), np.median(x), np.std(x)]))
+
+    def test_elliptical_annuli(self):
+        from legacyhalos.misc import EllipticalAnnuli
+        shape, x0, y0, eps, pa = (61, 71), 35.2, 30.7, 0.4, 0.6
+        sma = np.array([0.0, 2.0, 4.0, 7.0, 11.0, 16.0])
+        image = self.rng.normal(size=shape)
+        mask = self.rng.random(shape) < 0.1
+        annuli = EllipticalAnnuli(shape, x0, y0, eps, pa, sma, mask=mask)
+        prof = annuli.profile(image)
+
+        yy, xx = np.indices(shape)
+        xp = (xx - x0) * np.cos(pa) + (yy - y0) * np.sin(pa)
+        yp = -(xx - x0) * np.sin(pa) + (yy - y0) * np.cos(pa)
+        radius = np.hypot(xp, yp / (1 - eps))
+        for ii, (r0, r1) in enumerate(zip(annuli.radii[:-1], annuli.radii[1:])):
+            these = (radius >= r0) & (radius < r1) & ~mask
+            self.assertEqual(prof['npix'][ii], np.sum(these))
+            self.assertTrue(np.isclose(prof['mean'][ii], np.mean(image[these])))
+            self.assertTrue(np.isclose(prof['median'][ii], np.median(image[these])))
+        self.assertTrue(np.allclose(annuli.radii, [0.0, 1.0, 3.0, 5.5, 9.0, 13.5, 18.5]))
+
+    @unittest.skipIf(photutils is None, 'photutils is not installed')
+    def test_elliptical_annuli_photutils(self):
+        """Compare the annuli with photutils.isophote.EllipseSample (see
+        legacyhalos.sky.SkyProfile).
+
+        """
+        import warnings
+        from photutils.isophote import EllipseGeometry, EllipseSample, Isophote
+        from legacyhalos.misc import EllipticalAnnuli
+
+        shape, x0, y0, eps, pa = (201, 201), 100.0, 100.0, 0.3, 0.7
+        sma = np.arange(30.0, 90.0, 5.0)
+        yy, xx = np.indices(shape)
+        xp = (xx - x0) * np.cos(pa) + (yy - y0) * np.sin(pa)
+        yp = -(xx - x0) * np.sin(pa) + (yy - y0) * np.cos(pa)
+        radius = np.hypot(xp, yp / (1 - eps))
+        annuli = EllipticalAnnuli(shape, x0, y0, eps, pa, sma)
+
+        def isophotes(image, integrmode):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                isos = []
+                for aa in sma:
+                    sample = EllipseSample(image, aa, geometry=EllipseGeometry(x0, y0, aa, eps, pa),
+                                           integrmode=integrmode, sclip=3, nclip=2)
+                    sample.update()
+                    isos.append(Isophote(sample, 0, True, 0))
+            return isos
+
+        # A smooth profile: each annulus averages to the value at its sma.
+        image = 100 * np.exp(-radius / 25) + 5
+        prof = annuli.profile(image, sclip=3, nclip=2)
+        ref = np.array([iso.intens for iso in isophotes(image, 'bilinear')])
+        self.assertTrue(np.allclose(prof['mean'], ref, rtol=5e-3))
+
+        # A flat, noisy sky: same intensity and pixel scatter as integrmode='mean'
+        # (within the errors), and int_err is the error of the annulus mean.
+        pulls = []
+        for ii in range(20):
+            image = self.rng.normal(5.0, 1.0, shape)
+            prof = annuli.profile(image, sclip=3, nclip=2)
+            int_err = prof['sigma'] / np.sqrt(prof['npix'])
+            pulls.append((prof['mean'] - 5.0) / int_err)
+            if ii == 0:
+                isos = isophotes(image, 'mean')
+                ref = np.array([iso.intens for iso in isos])
+                ref_err = np.array([iso.int_err for iso in isos])
+                self.assertTrue(np.all(np.abs(prof['mean'] - ref) < 4 * ref_err))
+                self.assertTrue(np.allclose(prof['sigma'], [iso.pix_stddev for iso in isos], rtol=0.25))
+        self.assertLess(abs(np.std(pulls) - 1), 0.15)
+
+    def test_bilinear_interpolate(self):
+        data = self.rng.random((40, 30)).astype('f4')
+        y, x = self.rng.uniform(-0.5, 39.5, 200), self.rng.uniform(-0.5, 29.5, 200)
+        ref, out = self.both(kernels.bilinear_interpolate, data, y, x)
+        self.assertTrue(np.array_equal(ref, out))
+        ref, out = self.both(kernels.bilinear_interpolate, data, 10.3, 5.7)
+        self.assertEqual(ref, out)
+
+class TestKernelsFork(unittest.TestCase):
+    """The pipeline forks its workers after the parallel kernels have run in the
+    parent, which hangs (TBB) or kills the children (OpenMP) unless numba uses a
+    fork-safe threading layer.
+
+    """
+    script = textwrap.dedent("""
+        import multiprocessing
+        import numpy as np
+        from legacyhalos import kernels
+
+        def work(seed):
+            resid = np.random.default_rng(seed).normal(size=(500, 400))
+            return int(kernels.threshold_mask(resid, 2.0).sum())
+
+        if __name__ == '__main__':
+            ref = work(0)
+            with multiprocessing.get_context('fork').Pool(2) as pool:
+                out = pool.map(work, [0, 0, 1])
+            assert out[:2] == [ref, ref], out
+            print(kernels.backend(), kernels.numba.config.THREADING_LAYER if kernels.HAVE_NUMBA else '')
+        """)
+
+    def test_fork_after_parallel_kernel(self):
+        env = dict(os.environ)
+        env.pop('NUMBA_THREADING_LAYER', None)
+        env.pop('LEGACYHALOS_KERNELS', None)
+        pypath = os.path.dirname(os.path.dirname(os.path.abspath(kernels.__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([pypath, env.get('PYTHONPATH', '')])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            scriptfile = os.path.join(tmpdir, 'fork.py')
+            with open(scriptfile, 'w') as F:
+                F.write(self.script)
+            proc = subprocess.run([sys.executable, scriptfile], env=env, timeout=120,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        if kernels.HAVE_NUMBA:
+            self.assertEqual(proc.stdout.split(), ['numba', 'workqueue'])
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import os, copy, tempfile, unittest
+from unittest import mock
+import numpy as np
+import numpy.ma as ma
+
+try:
+    import legacyhalos.SGA
+    from legacyhalos.io import write_maskcache, read_maskcache
+except ImportError: # legacyhalos.io needs astrometry.net
+    write_maskcache = None
+
+def _galaxy(shape, x0, y0, sigma, eps, amp):
+    xx, yy = np.indices(shape)
+    return amp * np.exp(-0.5 * (((xx-x0)/sigma)**2 + ((yy-y0)/(sigma*(1-eps)))**2))
+
+class _Tractor(object):
+    def __init__(self, **kwargs):
+        for key, val in kwargs.items():
+            setattr(self, key, np.asarray(val))
+    def __len__(self):
+        return len(self.bx)
+
+class _WCS(object):
+    class _Pos(object):
+        def __init__(self, x, y):
+            self.vals = (180.0 + 1e-4 * x, 1e-4 * y)
+    def pixelToPosition(self, x, y):
+        return self._Pos(x, y)
+
+class _SourceModelCache(object):
+    """Stand-in for the Tractor rendering: a Gaussian per source."""
+    nrender = 0
+    def __init__(self, cat, wcs, pixelized_psf=None):
+        self.cat, self.shape = cat, wcs.shape
+        self.models = {}
+    def model(self, band):
+        if band not in self.models:
+            _SourceModelCache.nrender += 1
+            scale = {'g': 0.5, 'r': 1.0}[band]
+            self.models[band] = [_galaxy(self.shape, self.cat.by[ii], self.cat.bx[ii], 2.0, 0.0, scale * 30)
+                                 for ii in range(len(self.cat))]
+        return np.sum(self.models[band], axis=0)
+    def patch(self, band, indx):
+        self.model(band)
+        return 20, 30, self.models[band][indx][20:-10, 30:-5]
+    def model_without(self, band, indx):
+        model = self.model(band)
+        y0, x0, cutout = self.patch(band, indx)
+        model[y0:y0+cutout.shape[0], x0:x0+cutout.shape[1]] -= cutout
+        return model
+
+@unittest.skipIf(write_maskcache is None, 'legacyhalos.io cannot be imported')
+class TestMaskCache(unittest.TestCase):
+
+    def setUp(self):
+        from legacyhalos.misc import MaskPlanes
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(4)
+        shape = (160, 160)
+        self.shape = shape
+
+        # Two centrals and one point source.
+        self.tractor = _Tractor(bx=[60.0, 110.0, 30.0], by=[70.0, 100.0, 130.0],
+                                shape_r=[4.0, 2.5, 0.5], shape_e1=[0.1, 0.0, 0.0],
+                                shape_e2=[0.05, 0.0, 0.0], d25_leda=[0.3, 0.2, 0.0],
+                                ra=[180.0, 180.01, 180.02], dec=[0.0, 0.01, 0.02],
+                                mw_transmission_g=[0.9]*3, mw_transmission_r=[0.95]*3,
+                                mw_transmission_z=[0.98]*3)
+        wcs = _WCS()
+        wcs.shape = shape
+
+        data = {'bands': ['g', 'r'], 'refband': 'r', 'refband_height': shape[0],
+                'refband_width': shape[1], 'r_wcs': wcs, 'r_psf': None, 'failed': False,
+                'galaxy_indx': np.array([0, 1])}
+        planes = MaskPlanes(shape)
+        planes.add('star', _galaxy(shape, 20, 20, 3, 0, 1) > 0.5)
+        edge = np.zeros(shape, bool)
+        edge[:3, :], edge[-3:, :], edge[:, :3], edge[:, -3:] = True, True, True, True
+        planes.add('edge', edge)
+        planes.add('residual', rng.random(shape) < 0.01)
+        for filt, scale in zip(data['bands'], (0.5, 1.0)):
+            image = scale * (_galaxy(shape, 70, 60, 12, 0.3, 50) + _galaxy(shape, 100, 110, 6, 0.1, 30) +
+                             _galaxy(shape, 130, 30, 2, 0.0, 30)) + rng.normal(0, 0.1, shape)
+            data[filt] = ma.masked_array(image.astype('f4'))
+            data['{}_var_'.format(filt)] = np.full(shape, 0.01, 'f4')
+            planes.add('{}_invvar'.format(filt), rng.random(shape) < 0.001)
+        data['maskplanes'] = {shape: planes}
+        self.data = data
+        self.filt2pixscale = {'g': 0.262, 'r': 0.262}
+
+        self.inputfile = os.path.join(self.tmpdir.name, 'input.fits')
+        with open(self.inputfile, 'w') as F:
+            F.write('x')
+        self.cachefile = os.path.join(self.tmpdir.name, 'galaxy-maskcache.npz')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @mock.patch('legacyhalos.misc.SourceModelCache', _SourceModelCache)
+    def test_roundtrip(self):
+        params = {'bands': ['g', 'r'], 'mge_roi': None}
+
+        cache = {}
+        built = legacyhalos.SGA._build_multiband_mask(copy.deepcopy(self.data), self.tractor,
+                                                      self.filt2pixscale, maskcache=cache)
+        self.assertFalse(built['failed'])
+
+        # The geometry, the packed masks, one model per band, and the model
+        # patch of each central are cached.
+        for key in cache:
+            self.assertTrue(key.split('_')[0] in ('mge', 'mask', 'model', 'patch', 'patchyx'), key)
+        masksize = int(np.ceil(self.shape[0] * self.shape[1] / 8))
+        self.assertEqual(cache['mask_0_r'].nbytes, masksize)
+        self.assertEqual(sorted([key for key in cache if key.startswith('model_')]), ['model_g', 'model_r'])
+        self.assertEqual(cache['patch_1_g'].shape, (self.shape[0]-30, self.shape[1]-35))
+
+        write_maskcache(self.cachefile, cache, [self.inputfile], params)
+        newcache = read_maskcache(self.cachefile, [self.inputfile], params)
+        self.assertEqual(sorted(newcache.keys()), sorted(cache.keys()))
+
+        # Nothing is rendered when the cache is applied.
+        nrender = _SourceModelCache.nrender
+        applied = legacyhalos.SGA._apply_maskcache(copy.deepcopy(self.data), newcache,
+                                                   self.filt2pixscale)
+        self.assertEqual(_SourceModelCache.nrender, nrender)
+        self.assertNotIn('maskplanes', applied)
+        self.assertEqual(len(applied['mge']), 2)
+        for mge1, mge2 in zip(built['mge'], applied['mge']):
+            self.assertEqual(sorted(mge1.keys()), sorted(mge2.keys()))
+            for key in mge1:
+                self.assertEqual(mge1[key], mge2[key], key)
+                self.assertEqual(type(mge1[key]), type(mge2[key]), key)
+        for filt in self.data['bands']:
+            for key in ('{}_masked'.format(filt), '{}_var'.format(filt)):
+                for img1, img2 in zip(built[key], applied[key]):
+                    self.assertEqual(img1.dtype, img2.dtype)
+                    self.assertEqual(ma.getdata(img1).tobytes(), ma.getdata(img2).tobytes())
+                    self.assertEqual(ma.getmaskarray(img1).tobytes(), ma.getmaskarray(img2).tobytes())
+
+        # The cache is stale if an input file or a parameter changes.
+        self.assertIsNone(read_maskcache(self.cachefile, [self.inputfile], {'bands': ['g']}))
+        with open(self.inputfile, 'a') as F:
+            F.write('y')
+        self.assertIsNone(read_maskcache(self.cachefile, [self.inputfile], params))
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
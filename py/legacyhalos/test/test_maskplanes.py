@@ -0,0 +1,64 @@
+import unittest
+import numpy as np
+import numpy.ma as ma
+
+from legacyhalos.misc import MaskPlanes, data_nbytes
+
+class TestMaskPlanes(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.shape = (50, 40)
+        self.layers = {name: rng.random(self.shape) < 0.2
+                       for name in ('star', 'edge', 'g_invvar', 'r_invvar', 'residual')}
+
+    def test_layers(self):
+        planes = MaskPlanes(self.shape)
+        for name, mask in self.layers.items():
+            planes.add(name, mask)
+        self.assertEqual(planes.bits.dtype, np.uint16)
+        for name, mask in self.layers.items():
+            self.assertTrue(np.array_equal(planes[name], mask))
+
+        # Band mask = union of the star, edge, and inverse variance layers.
+        union = self.layers['star'] | self.layers['edge'] | self.layers['r_invvar']
+        self.assertTrue(np.array_equal(planes.any(['star', 'edge', 'r_invvar']), union))
+        self.assertTrue(np.array_equal(planes.any(['star', 'edge', 'r_invvar', 'residual']),
+                                       union | self.layers['residual']))
+
+        # The returned mask is a copy.
+        mask = planes['star']
+        mask[:] = False
+        self.assertTrue(np.array_equal(planes['star'], self.layers['star']))
+
+        # Replacing and removing a layer leaves the others untouched.
+        planes.add('residual', np.zeros(self.shape, bool))
+        self.assertFalse(planes['residual'].any())
+        planes.remove('g_invvar')
+        planes.add('z_invvar', self.layers['g_invvar'])
+        for name in ('star', 'edge', 'r_invvar'):
+            self.assertTrue(np.array_equal(planes[name], self.layers[name]))
+        self.assertTrue(np.array_equal(planes['z_invvar'], self.layers['g_invvar']))
+
+    def test_promote(self):
+        planes = MaskPlanes(self.shape)
+        for ii in range(20):
+            planes.add('layer{}'.format(ii), self.layers['star'] if ii % 2 else self.layers['edge'])
+        self.assertEqual(planes.bits.dtype, np.uint32)
+        self.assertTrue(np.array_equal(planes['layer19'], self.layers['star']))
+        self.assertTrue(np.array_equal(planes['layer0'], self.layers['edge']))
+
+    def test_nbytes(self):
+        planes = MaskPlanes(self.shape)
+        for name, mask in self.layers.items():
+            planes.add(name, mask)
+        image = np.zeros(self.shape, 'f4')
+        data = {'r': ma.masked_array(image), 'r_masked': [ma.masked_array(image, planes['star'])],
+                'maskplanes': {self.shape: planes}}
+        self.assertEqual(data_nbytes(data), image.nbytes + planes.nbytes + planes['star'].nbytes)
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os, subprocess, sys, tempfile, threading, time, unittest
+from unittest import mock
+
+try:
+    from legacyhalos.mpi import MemoryBudget
+except ImportError: # legacyhalos.io needs astrometry.net
+    MemoryBudget = None
+
+@unittest.skipIf(MemoryBudget is None, 'legacyhalos.mpi cannot be imported')
+class TestMemoryBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.budget = MemoryBudget(100, ledgerdir=self.tmpdir.name, poll=0.01, jobid='test')
+        # Another (live) process on the node.
+        self.other = str(os.getppid())
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _hold(self, pid, nbytes):
+        def _set(ledger):
+            if nbytes is None:
+                ledger.pop(pid, None)
+            else:
+                ledger[pid] = nbytes
+        self.budget._update(_set)
+
+    def test_admission(self):
+        self._hold(self.other, 60)
+        self.budget.acquire(30)
+        self.assertEqual(self.budget.inuse(), 90)
+        self.budget.release()
+        self.assertEqual(self.budget.inuse(), 60)
+
+        # Wait until the other galaxy is done.
+        self._hold(self.other, 80)
+        admitted = threading.Event()
+        def _acquire():
+            self.budget.acquire(30)
+            admitted.set()
+        thread = threading.Thread(target=_acquire)
+        thread.start()
+        time.sleep(0.2)
+        self.assertFalse(admitted.is_set())
+        self._hold(self.other, None)
+        thread.join(5)
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(self.budget.inuse(), 30)
+        self.budget.release()
+
+    def test_outlier(self):
+        # A galaxy larger than the whole budget runs when nothing else does.
+        with self.budget.admit(1000):
+            self.assertEqual(self.budget.inuse(), 1000)
+        self.assertEqual(self.budget.inuse(), 0)
+
+    def test_dead_process(self):
+        proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proc.wait()
+        self._hold(str(proc.pid), 90)
+        with self.budget.admit(50):
+            self.assertEqual(self.budget.inuse(), 50)
+
+    def test_release_on_exception(self):
+        with self.assertRaises(RuntimeError):
+            with self.budget.admit(40):
+                self.assertEqual(self.budget.inuse(), 40)
+                raise RuntimeError('stage failed')
+        self.assertEqual(self.budget.inuse(), 0)
+
+        # ...so the next galaxy on another rank is not held up.
+        self._hold(self.other, 70)
+        with self.budget.admit(30):
+            self.assertEqual(self.budget.inuse(), 100)
+
+    def test_ledger_per_job(self):
+        with mock.patch.dict(os.environ, {'SLURM_JOB_ID': '1234', 'USER': 'sga'}):
+            budget1 = MemoryBudget(100, ledgerdir=self.tmpdir.name)
+        with mock.patch.dict(os.environ, {'SLURM_JOB_ID': '5678', 'USER': 'sga'}):
+            budget2 = MemoryBudget(100, ledgerdir=self.tmpdir.name)
+        self.assertEqual(os.path.basename(budget1.ledgerfile), 'legacyhalos-membudget-sga-1234.json')
+        with budget1.admit(90):
+            with budget2.admit(90):
+                self.assertEqual(budget1.inuse(), 90)
+                self.assertEqual(budget2.inuse(), 90)
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import numpy as np
+import numpy.ma as ma
+
+try:
+    from legacyhalos.mge import find_galaxy
+except ImportError: # matplotlib
+    find_galaxy = None
+
+def _galaxy(shape, x0, y0, sigma, eps, theta, amp=100.0):
+    xx, yy = np.indices(shape)
+    dx, dy = xx - x0, yy - y0
+    ct, st = np.cos(np.radians(theta)), np.sin(np.radians(theta))
+    xr, yr = dx*ct + dy*st, -dx*st + dy*ct
+    return amp * np.exp(-0.5 * ((xr/sigma)**2 + (yr/(sigma*(1-eps)))**2))
+
+@unittest.skipIf(find_galaxy is None, 'matplotlib is not installed')
+class TestFindGalaxy(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        shape = (300, 260)
+        self.img = (_galaxy(shape, 140.3, 120.7, 25, 0.4, 30) +
+                    _galaxy(shape, 40, 220, 6, 0.1, 0, amp=500) + # bright neighbor
+                    rng.normal(0, 0.5, shape))
+        self.mask = np.zeros(shape, bool)
+        self.mask[60:64, 100:140] = True
+        self.level = 3.0
+
+    def _compare(self, mge1, mge2, places=6):
+        for attr in ('xmed', 'ymed', 'xpeak', 'ypeak', 'eps', 'theta', 'majoraxis'):
+            self.assertAlmostEqual(float(getattr(mge1, attr)), float(getattr(mge2, attr)),
+                                   places=places, msg=attr)
+
+    def test_roi(self):
+        img = ma.masked_array(self.img, self.mask)
+        full = find_galaxy(img, nblob=1, binning=3, level=self.level, quiet=True)
+        roi = find_galaxy(img, nblob=1, binning=3, level=self.level, quiet=True,
+                          roi=(140, 121, 110))
+        self._compare(full, roi)
+
+        # The window is clipped at the edges of the image.
+        edge = find_galaxy(img, nblob=1, binning=3, level=self.level, quiet=True,
+                           roi=(140, 121, 1000))
+        self._compare(full, edge)
+
+    def test_separable(self):
+        full = find_galaxy(self.img, nblob=1, binning=3, level=self.level, quiet=True)
+        sep = find_galaxy(self.img, nblob=1, binning=3, level=self.level, quiet=True,
+                          median='separable')
+        self.assertLess(abs(full.xmed - sep.xmed), 0.5)
+        self.assertLess(abs(full.ymed - sep.ymed), 0.5)
+        self.assertLess(abs(full.eps - sep.eps), 0.02)
+        self.assertLess(abs(full.theta - sep.theta), 1.0)
+        self.assertLess(abs(full.majoraxis - sep.majoraxis) / full.majoraxis, 0.02)
+
+    def test_downsample(self):
+        full = find_galaxy(self.img, nblob=1, binning=3, level=self.level, quiet=True)
+        coarse = find_galaxy(self.img, nblob=1, binning=3, level=self.level, quiet=True,
+                             downsample=4)
+        self._compare(full, coarse)
+
+    def test_downsample_neighbors(self):
+        # Two blobs separated by a one-pixel gap are merged at the coarse
+        # resolution, but only the larger one may be used.
+        mask = np.zeros((64, 64), bool)
+        mask[10:40, 10:30] = True
+        mask[10:40, 31:35] = True
+        img = np.where(mask, 10.0, 0.0)
+        full = find_galaxy(img, nblob=1, binning=1, level=1.0, quiet=True)
+        coarse = find_galaxy(img, nblob=1, binning=1, level=1.0, quiet=True, downsample=4)
+        self.assertEqual(coarse.coarse_blob(img, mask, 1.0, 1, 4).sum(), 30 * 20)
+        self._compare(full, coarse)
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+import os, tempfile, unittest
+import numpy as np
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+from legacyhalos.mosaics import MosaicRegistry, mosaic_settings, mosaic_products, _cutout_box
+
+class TestMosaics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.galaxydir = os.path.join(self.tmpdir.name, 'NGC1234_GROUP')
+        os.makedirs(self.galaxydir)
+        for ff in ['NGC1234_GROUP-custom-image-r.fits.fz', 'NGC1234_GROUP-custom-tractor.fits',
+                   'NGC1234_GROUP-custom-image-grz.jpg', 'NGC1234_GROUP-ccds-south.fits',
+                   'NGC1234_GROUP-custom-psf-W1.fits.fz', 'NGC1234_GROUP-custom-checkpoint.p',
+                   'NGC1234_GROUP-custom-ellipse.fits']:
+            open(os.path.join(self.galaxydir, ff), 'w').close()
+        self.settings = mosaic_settings('custom', 'south', 0.262, unwise=True, subsky_radii=np.arange(3))
+        self.registry = MosaicRegistry(os.path.join(self.tmpdir.name, 'registry'))
+        self.ra, self.dec, self.width = 150.0, 30.0, 2001
+        self.assertTrue(self.registry.register('NGC1234_GROUP', self.galaxydir, self.ra, self.dec,
+                                               self.width, self.settings))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_products(self):
+        products = mosaic_products('NGC1234_GROUP', self.galaxydir, 'custom', 'south')
+        self.assertEqual(products, ['NGC1234_GROUP-ccds-south.fits', 'NGC1234_GROUP-custom-image-grz.jpg',
+                                    'NGC1234_GROUP-custom-image-r.fits.fz', 'NGC1234_GROUP-custom-psf-W1.fits.fz',
+                                    'NGC1234_GROUP-custom-tractor.fits'])
+
+    def test_find(self):
+        galaxydir = os.path.join(self.tmpdir.name, 'NGC1235')
+        dra = 40 * 0.262 / 3600 / np.cos(np.radians(self.dec))
+        match = MosaicRegistry(self.registry.registry_dir).find(
+            'NGC1235', galaxydir, self.ra + dra, self.dec, 501, self.settings)
+        self.assertIsNotNone(match)
+        entry, (x0, y0, nx, ny) = match
+        self.assertEqual(entry['galaxy'], 'NGC1234_GROUP')
+        # East is to the left.
+        self.assertEqual((x0, y0, nx, ny), (1000 - 40 - 250, 1000 - 250, 501, 501))
+
+        self.assertIsNone(self.registry.find('NGC1235', galaxydir, self.ra + 30 * dra, self.dec, 501, self.settings))
+        self.assertIsNone(self.registry.find('NGC1235', galaxydir, self.ra, self.dec, 2001, self.settings))
+        settings = mosaic_settings('custom', 'south', 0.262, unwise=False, subsky_radii=np.arange(3))
+        self.assertIsNone(self.registry.find('NGC1235', galaxydir, self.ra, self.dec, 501, settings))
+        self.assertIsNone(self.registry.find('NGC1234_GROUP', self.galaxydir, self.ra, self.dec, 501, self.settings))
+
+    def test_cutout_box(self):
+        cd = 2.75 / 3600
+        wcs = [self.ra, self.dec, 100.0, 100.0, -cd, 0.0, 0.0, cd]
+        self.assertEqual(_cutout_box(wcs, (200, 200), self.ra, self.dec, 501 * 0.262), (75, 75, 49, 49))
+        self.assertRaises(ValueError, _cutout_box, wcs, (200, 200), self.ra, self.dec, 600.0)
+
+def _tan_header(ra, dec, crpix1, crpix2, cd):
+    import fitsio
+    hdr = fitsio.FITSHDR()
+    for key, val in zip(('CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2',
+                         'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2'),
+                        ('RA---TAN', 'DEC--TAN', ra, dec, crpix1, crpix2, -cd, 0.0, 0.0, cd)):
+        hdr[key] = val
+    return hdr
+
+@unittest.skipIf(fitsio is None, 'fitsio is not installed')
+class TestMosaicCutout(unittest.TestCase):
+    """Cut a mosaic out of a synthetic parent mosaic."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pixscale, self.ra, self.dec, self.W = 0.262, 150.0, 30.0, 201
+        self.settings = mosaic_settings('custom', 'south', self.pixscale, require_grz=True)
+        self.registry = MosaicRegistry(os.path.join(self.tmpdir.name, 'registry'))
+        self.cd = self.pixscale / 3600
+        # 20 pixels to the west of the center of the parent.
+        self.dra = 20 * self.cd / np.cos(np.radians(self.dec))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _parent(self, filters='grz'):
+        galaxy, W, cd = 'PARENT', self.W, self.cd
+        galaxydir = os.path.join(self.tmpdir.name, galaxy)
+        os.makedirs(galaxydir)
+        rng = np.random.default_rng(5)
+        self.image = rng.normal(size=(W, W)).astype('f4')
+        self.maskbits = rng.integers(0, 2**12, size=(W, W)).astype('i2')
+        hdr = _tan_header(self.ra, self.dec, (W+1)/2, (W+1)/2, cd)
+        primary = fitsio.FITSHDR([dict(name='LEGPIPEV', value='test')])
+        for ff, data, compress in ((galaxy+'-custom-image-r.fits.fz', self.image, 'GZIP_2'),
+                                   (galaxy+'-custom-maskbits.fits.fz', self.maskbits, 'RICE')):
+            with fitsio.FITS(os.path.join(galaxydir, ff), 'rw', clobber=True) as F:
+                F.write(None, header=primary)
+                F.write(data, header=hdr, compress=compress, qlevel=None)
+
+        cat = np.zeros(3, dtype=[('bx', 'f4'), ('by', 'f4')])
+        cat['bx'], cat['by'] = [100.0, 125.0, 10.0], [100.0, 105.0, 10.0]
+        fitsio.write(os.path.join(galaxydir, galaxy+'-custom-tractor.fits'), cat)
+
+        # Three 40x40 pixel CCDs on the cutout and one far from it.
+        ccdra = [self.ra - self.dra, self.ra - self.dra, self.ra - 1.5 * self.dra, self.ra + 4 * self.dra]
+        ccddec = [self.dec + 10 * cd, self.dec - 10 * cd, self.dec, self.dec]
+        ccds = np.zeros(len(ccdra), dtype=[('camera', 'U7'), ('expnum', 'i8'), ('ccdname', 'U4'), ('filter', 'U1'),
+                                           ('ra', 'f8'), ('dec', 'f8'), ('crval1', 'f8'), ('crval2', 'f8'),
+                                           ('crpix1', 'f4'), ('crpix2', 'f4'), ('cd1_1', 'f4'), ('cd1_2', 'f4'),
+                                           ('cd2_1', 'f4'), ('cd2_2', 'f4'), ('width', 'i2'), ('height', 'i2')])
+        ccds['camera'], ccds['expnum'], ccds['ccdname'] = 'decam', np.arange(len(ccds)) + 1000, 'N4'
+        ccds['filter'] = list(filters) + ['z'] * (len(ccds) - len(filters))
+        ccds['ra'], ccds['dec'], ccds['crval1'], ccds['crval2'] = ccdra, ccddec, ccdra, ccddec
+        ccds['crpix1'], ccds['crpix2'], ccds['cd1_1'], ccds['cd2_2'] = 20.5, 20.5, -cd, cd
+        ccds['width'], ccds['height'] = 40, 40
+        fitsio.write(os.path.join(galaxydir, galaxy+'-ccds-south.fits'), ccds)
+
+        self.outlier = {}
+        with fitsio.FITS(os.path.join(galaxydir, galaxy+'-custom-outlier-mask.fits.fz'), 'rw', clobber=True) as F:
+            F.write(None, header=primary)
+            for ccd in ccds:
+                hdr = _tan_header(ccd['crval1'], ccd['crval2'], ccd['crpix1'], ccd['crpix2'], cd)
+                for key, val in (('CAMERA', 'decam'), ('EXPNUM', int(ccd['expnum'])),
+                                 ('CCDNAME', 'N4'), ('X0', 7), ('Y0', 3)):
+                    hdr[key] = val
+                mask = rng.integers(0, 2, size=(40, 40)).astype('u1')
+                extname = 'decam-{}-N4'.format(ccd['expnum'])
+                self.outlier[extname] = mask
+                F.write(mask, header=hdr, extname=extname, compress='RICE')
+
+        self.assertTrue(self.registry.register(galaxy, galaxydir, self.ra, self.dec, W, self.settings))
+
+        self.galaxydir = os.path.join(self.tmpdir.name, 'CHILD')
+        os.makedirs(self.galaxydir)
+        match = self.registry.find('CHILD', self.galaxydir, self.ra - self.dra, self.dec, 51, self.settings)
+        self.assertIsNotNone(match)
+        return match
+
+    def test_cutout(self):
+        entry, box = self._parent()
+        x0, y0, nx, ny = box
+        self.assertEqual(box, (100 + 20 - 25, 100 - 25, 51, 51))
+        self.assertTrue(self.registry.cutout(entry, box, 'CHILD', self.galaxydir, self.ra - self.dra, self.dec, 51))
+
+        # The images stay in extension 1, behind an empty primary HDU.
+        for ff, parent in (('CHILD-custom-image-r.fits.fz', self.image),
+                           ('CHILD-custom-maskbits.fits.fz', self.maskbits)):
+            with fitsio.FITS(os.path.join(self.galaxydir, ff)) as F:
+                self.assertEqual(len(F), 2)
+                self.assertFalse(F[0].has_data())
+                self.assertEqual(F[0].read_header()['LEGPIPEV'], 'test')
+                self.assertTrue(F[1].is_compressed())
+            data, hdr = fitsio.read(os.path.join(self.galaxydir, ff), ext=1, header=True)
+            self.assertEqual(data.dtype, parent.dtype)
+            self.assertTrue(np.array_equal(data, parent[y0:y0+ny, x0:x0+nx]))
+            self.assertEqual(hdr['CRPIX1'], (self.W+1)/2 - x0)
+            self.assertEqual(hdr['REUSEGAL'], 'PARENT')
+
+        cat = fitsio.read(os.path.join(self.galaxydir, 'CHILD-custom-tractor.fits'))
+        self.assertEqual(len(cat), 2)
+        self.assertTrue(np.array_equal(cat['bx'], [100.0 - x0, 125.0 - x0]))
+
+        # Only the CCDs (and outlier masks) which touch the cutout are kept.
+        ccds = fitsio.read(os.path.join(self.galaxydir, 'CHILD-ccds-south.fits'))
+        self.assertEqual(list(ccds['expnum']), [1000, 1001, 1002])
+        with fitsio.FITS(os.path.join(self.galaxydir, 'CHILD-custom-outlier-mask.fits.fz')) as F:
+            self.assertFalse(F[0].has_data())
+            extnames = [hdu.get_extname() for hdu in F[1:]]
+            self.assertEqual(extnames, ['decam-1000-N4', 'decam-1001-N4', 'decam-1002-N4'])
+            for hdu in F[1:]:
+                mask, hdr = hdu.read(), hdu.read_header()
+                mx0, my0 = hdr['X0'] - 7, hdr['Y0'] - 3
+                self.assertTrue(np.array_equal(mask, self.outlier[hdu.get_extname()][
+                    my0:my0+mask.shape[0], mx0:mx0+mask.shape[1]]))
+                self.assertEqual(hdr['CRPIX1'], 20.5 - mx0)
+            # The cutout (+-25.5 pixels) covers only 36 columns of the third
+            # CCD, whose center is 10 pixels further to the west.
+            self.assertEqual(F['decam-1002-N4'].read().shape, (40, 36))
+
+    def test_require_grz(self):
+        entry, box = self._parent(filters='ggz')
+        self.assertFalse(self.registry.cutout(entry, box, 'CHILD', self.galaxydir, self.ra - self.dra, self.dec, 51))
+        self.assertEqual(os.listdir(self.galaxydir), ['CHILD-ccds-south.fits'])
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os, tempfile, unittest
+import numpy as np
+
+try:
+    from legacyhalos.mpi import plan_stage, split_ranks
+except ImportError: # legacyhalos.io needs astrometry.net
+    plan_stage = None
+
+@unittest.skipIf(plan_stage is None, 'legacyhalos.mpi cannot be imported')
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.galaxy = np.array(['NGC{:04d}'.format(ii) for ii in range(6)])
+        self.galaxydir = np.array([os.path.join(self.tmpdir.name, gal) for gal in self.galaxy])
+        self.sample = {'SGA_ID': np.arange(6) + 100}
+        for gdir in self.galaxydir:
+            os.makedirs(gdir)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _touch(self, igal, suffix):
+        open(os.path.join(self.galaxydir[igal], self.galaxy[igal]+suffix), 'w').close()
+
+    def test_plan_stage(self):
+        for igal in range(6):
+            if igal != 5:
+                self._touch(igal, '-coadds.isdone')
+        self._touch(0, '-ellipse.isdone')
+        self._touch(1, '-ellipse.isfail')
+
+        todo, done, fail = plan_stage(self.sample, self.galaxy, self.galaxydir, '{galaxy}-ellipse.isdone',
+                                      dependson='{galaxy}-coadds.isdone')
+        self.assertEqual(list(done[0]), [0])
+        self.assertEqual(list(fail[0]), [1])
+        self.assertEqual(list(np.hstack(todo)), [2, 3, 4, 5])
+
+        # With clobber, the done galaxy is redone and the fail file is removed.
+        todo, done, fail = plan_stage(self.sample, self.galaxy, self.galaxydir, '{galaxy}-ellipse.isdone',
+                                      dependson='{galaxy}-coadds.isdone', clobber=True)
+        self.assertEqual(list(np.hstack(todo)), [0, 1, 2, 3, 4, 5])
+        self.assertFalse(os.path.isfile(os.path.join(self.galaxydir[1], self.galaxy[1]+'-ellipse.isfail')))
+
+        # Sample columns in the template.
+        self._touch(2, '-102-ellipse.fits')
+        todo, done, _ = plan_stage(self.sample, self.galaxy, self.galaxydir, '{galaxy}-{SGA_ID}-ellipse.fits')
+        self.assertEqual(list(done[0]), [2])
+
+    def test_split_ranks(self):
+        indices = np.arange(10)
+        groups = split_ranks(indices, size=3)
+        self.assertEqual([len(group) for group in groups], [4, 3, 3])
+
+        # Weighted split: ~flat cumulative weight, smallest to largest per rank.
+        weight = np.linspace(1, 2, 12)
+        groups = split_ranks(np.arange(12), size=3, weight=weight)
+        for group in groups:
+            self.assertLess(abs(np.sum(weight[group]) - np.sum(weight) / 3), np.max(weight))
+
+        # A few dominant objects are dealt out round-robin by size, so they do
+        # not all end up on one rank.
+        weight = np.array([1, 1, 1, 1, 1, 1, 50, 60, 70.])
+        groups = split_ranks(np.arange(9), size=3, weight=weight)
+        self.assertEqual(sorted([group[-1] for group in groups]), [6, 7, 8])
+        for group in groups:
+            self.assertTrue(np.all(np.diff(weight[group]) >= 0))
+        self.assertEqual(sorted(np.hstack(groups)), list(range(9)))
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import os, tempfile, unittest
+import numpy as np
+
+from legacyhalos.coadds import PSFCache, PSFCACHE
+
+class TestPSFCache(unittest.TestCase):
+
+    def setUp(self):
+        self.ncall = 0
+
+    def stamp(self, band):
+        self.ncall += 1
+        return np.full((5, 5), band / 25.0, 'f4')
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = PSFCache(cache_dir)
+            psf1 = cache.get(dict(kind='test', band=1), self.stamp, 1)
+            psf2 = cache.get(dict(kind='test', band=2), self.stamp, 2)
+            self.assertIs(cache.get(dict(kind='test', band=1), self.stamp, 1), psf1)
+            self.assertEqual((self.ncall, cache.hits, cache.misses), (2, 1, 2))
+
+            # A second process (rank) reads the stamps from disk.
+            cache2 = PSFCache(cache_dir)
+            self.assertTrue(np.array_equal(cache2.get(dict(band=2, kind='test'), self.stamp, 2), psf2))
+            self.assertEqual((self.ncall, cache2.hits, cache2.misses), (2, 1, 0))
+            self.assertFalse(any(ff.endswith('.tmp') for _, _, files in os.walk(cache_dir) for ff in files))
+
+    def test_memory(self):
+        cache = PSFCache() # in-memory only
+        cache.get(dict(kind='test', band=3), self.stamp, 3)
+        cache.get(dict(kind='test', band=3), self.stamp, 3)
+        self.assertEqual((self.ncall, cache.hits, cache.misses), (1, 1, 1))
+
+    def test_module_cache(self):
+        # The per-process cache keeps the stamps of the previous galaxies.
+        self.assertIsInstance(PSFCACHE, PSFCache)
+        self.assertIsNone(PSFCACHE.cache_dir)
+        hits0, misses0 = PSFCACHE.hits, PSFCACHE.misses
+        for _ in range(3): # three galaxies
+            PSFCACHE.get(dict(kind='test-module', band=4), self.stamp, 4)
+        self.assertEqual(self.ncall, 1)
+        self.assertEqual((PSFCACHE.hits - hits0, PSFCACHE.misses - misses0), (2, 1))
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
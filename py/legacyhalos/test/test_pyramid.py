@@ -0,0 +1,204 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import numpy.ma as ma
+
+from legacyhalos.pyramid import block_reduce, ImagePyramid
+
+try:
+    import legacyhalos.ellipse
+    from photutils import EllipticalAperture as _ # see legacyhalos.ellipse.apphot_one
+except ImportError: # legacyhalos.io needs astrometry.net
+    legacyhalos = None
+
+try:
+    from photutils.aperture import EllipticalAperture, aperture_photometry
+except ImportError:
+    aperture_photometry = None
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.data = rng.normal(10, 1, (101, 90)).astype('f4')
+        self.var = rng.uniform(0.5, 1.5, self.data.shape)
+        self.mask = rng.random(self.data.shape) < 0.1
+        self.mask[:8, :8] = True
+        self.mask[4:8, 8:12] = False
+        self.mask[12:16, 12:16] = False
+        self.mask[12, 12:15] = True
+
+    def test_block_reduce(self):
+        img, mask, var, frac = block_reduce(self.data, self.mask, self.var, factor=4)
+        self.assertEqual(img.shape, (26, 23))
+        self.assertTrue(mask[0, 0] and mask[1, 1])
+        self.assertEqual((img[0, 0], var[0, 0], frac[0, 0]), (0, 0, 0))
+        self.assertEqual(frac[1, 2], 1)
+
+        # Flux and variance are conserved in fully unmasked blocks.
+        self.assertTrue(np.isclose(img[1, 2] * 16, np.sum(self.data[4:8, 8:12]), rtol=1e-5))
+        self.assertTrue(np.isclose(var[1, 2] * 16**2, np.sum(self.var[4:8, 8:12])))
+
+        # Partially masked blocks average their unmasked pixels; the partial
+        # blocks at the edge are padded with masked pixels.
+        good = ~self.mask[12:16, 12:16]
+        self.assertFalse(mask[3, 3])
+        self.assertTrue(np.isclose(img[3, 3], np.mean(self.data[12:16, 12:16][good]), rtol=1e-5))
+        self.assertTrue(np.isclose(var[3, 3], np.sum(self.var[12:16, 12:16][good]) / 13**2))
+        self.assertTrue(np.isclose(frac[3, 3], 13 / 16))
+        self.assertTrue(mask[25, 22])
+        self.assertTrue(np.isclose(frac[25, 22], np.sum(~self.mask[100, 88:90]) / 16))
+
+        # Blocks with fewer than half of their pixels unmasked are masked but
+        # keep their flux.
+        good = ~self.mask[4:8, 4:8]
+        self.assertTrue(mask[1, 1])
+        self.assertTrue(np.isclose(img[1, 1] * frac[1, 1] * 16, np.sum(self.data[4:8, 4:8][good]), rtol=1e-5))
+
+    def test_factor_and_cutout(self):
+        pyr = ImagePyramid(ma.masked_array(self.data, mask=self.mask), var=self.var, factors=(2, 4, 8))
+        self.assertEqual(pyr.factor(10.0), 1)
+        self.assertEqual(pyr.factor(45.0), 2)
+        self.assertEqual(pyr.factor(45.0, eps=0.6), 1)
+        self.assertEqual(pyr.factor(1000.0), 8)
+
+        x0, y0 = 50.3, 60.7
+        xx, yy = pyr.from_level(4, *pyr.to_level(4, x0, y0))
+        self.assertTrue(np.allclose((xx, yy), (x0, y0)))
+
+        img, var, xc, yc, xoff, yoff = pyr.cutout(4, x0, y0, 20.0)
+        full = pyr.levels[4]
+        self.assertTrue(np.allclose(pyr.from_level(4, xc + xoff, yc + yoff), (x0, y0)))
+        self.assertTrue(np.array_equal(ma.getdata(img), full[0][yoff:yoff+img.shape[0], xoff:xoff+img.shape[1]]))
+        self.assertTrue(np.array_equal(var, full[2][yoff:yoff+img.shape[0], xoff:xoff+img.shape[1]]))
+        self.assertTrue(xc >= 20 / 4 and img.shape[1] - xc >= 20 / 4)
+
+        # The cutouts are clipped at the edges of the image.
+        img, _, xc, yc, xoff, yoff = pyr.cutout(1, 2.0, 3.0, 10.0)
+        self.assertEqual((xoff, yoff, xc, yc), (0, 0, 2.0, 3.0))
+        self.assertTrue(np.array_equal(ma.getmaskarray(img), self.mask[:img.shape[0], :img.shape[1]]))
+
+    @unittest.skipIf(aperture_photometry is None, 'photutils is not installed')
+    def test_cog_masked(self):
+        """The coarse curve of growth matches the full-resolution one, in which
+        masked pixels count as zero (see legacyhalos.ellipse.apphot_one).
+
+        """
+        rng = np.random.default_rng(7)
+        shape, x0, y0, eps, theta = (400, 400), 201.3, 197.8, 0.4, 0.6
+        yy, xx = np.indices(shape)
+        xp = (xx - x0) * np.cos(theta) + (yy - y0) * np.sin(theta)
+        yp = -(xx - x0) * np.sin(theta) + (yy - y0) * np.cos(theta)
+        radius = np.hypot(xp, yp / (1 - eps))
+        img = (100 * np.exp(-radius / 30) + rng.normal(0, 0.5, shape)).astype('f4')
+        var = rng.uniform(0.2, 0.3, shape).astype('f4')
+        mask = rng.random(shape) < 0.15
+        for xc, yc, rad in rng.uniform(0, 400, (15, 3)):
+            mask |= np.hypot(xx - xc, yy - yc) < rad / 15 + 3
+
+        def apphot(data, mask, xc, yc, aa):
+            aperture = EllipticalAperture((xc, yc), aa, aa * (1 - eps), theta=theta)
+            return aperture_photometry(data, aperture, mask=mask, method='exact')['aperture_sum'][0]
+
+        pyr = ImagePyramid(ma.masked_array(img, mask=mask), var=var)
+        for aa in (40.0, 80.0, 160.0):
+            flux, fvar = apphot(img, mask, x0, y0, aa), apphot(var, mask, x0, y0, aa)
+            for factor in (1, 2, 4, 8):
+                cut, cutvar, xc, yc, _, _ = pyr.cutout(factor, x0, y0, aa, photometry=True)
+                cutmask = ma.getmaskarray(cut)
+                flux1 = apphot(ma.getdata(cut), cutmask, xc, yc, aa / factor) * factor**2
+                fvar1 = apphot(cutvar, cutmask, xc, yc, aa / factor) * factor**4
+                self.assertLess(abs(flux1 / flux - 1), 0.02 if aa < 80 else 0.005)
+                self.assertLess(abs(fvar1 / fvar - 1), 0.005)
+
+            # Without the weighting the masked pixels would be filled in.
+            cut, _, xc, yc, _, _ = pyr.cutout(4, x0, y0, aa)
+            self.assertGreater(apphot(ma.getdata(cut), ma.getmaskarray(cut), xc, yc, aa / 4) * 16, 1.1 * flux)
+
+def _fit_one(args):
+    """Stand-in for legacyhalos.ellipse._integrate_isophot_one: the mean of the
+    unmasked pixels within half a pixel of the (circular) isophote, with fixed
+    scatter and errors in the units of the image it was given.
+
+    """
+    img, sma, theta, eps, x0, y0, integrmode, sclip, nclip = args
+    yy, xx = np.indices(img.shape)
+    ring = (np.abs(np.hypot(xx - x0, yy - y0) - sma) < 0.5) & ~ma.getmaskarray(img)
+    intens = np.mean(ma.getdata(img)[ring]) if np.any(ring) else 0.0
+    return SimpleNamespace(sma=sma, intens=intens, int_err=1e-3, eps=eps, ellip_err=0.0,
+                           pa=theta, pa_err=0.0, x0=x0, y0=y0, x0_err=1.0, y0_err=1.0,
+                           a3=0.0, a3_err=0.0, a4=0.0, a4_err=0.0, rms=1.0, pix_stddev=1.0,
+                           stop_code=0, n_data=10, n_flag=1, n_iter=0)
+
+@unittest.skipIf(legacyhalos is None, 'legacyhalos.ellipse cannot be imported')
+class TestPyramidEllipse(unittest.TestCase):
+    """ellipsefit_multiband(pyramid=True), with the isophote fit stubbed."""
+
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        shape, x0, y0 = (600, 600), 300.0, 300.0
+        yy, xx = np.indices(shape)
+        radius = np.hypot(xx - x0, yy - y0)
+        img = (100 * np.exp(-radius / 40) + rng.normal(0, 0.01, shape)).astype('f4')
+        mask = rng.random(shape) < 0.1
+        for xc, yc in rng.uniform(0, 600, (20, 2)):
+            mask |= np.hypot(xx - xc, yy - yc) < 8
+        mask[290:311, 290:311] = False
+        mge = {'largeshift': False, 'ra_moment': 180.0, 'dec_moment': 0.0, 'majoraxis': 100.0,
+               'pa': 90.0, 'eps': 0.0, 'xmed': y0, 'ymed': x0}
+        self.data = {'bands': ['r'], 'refband': 'r', 'refpixscale': 0.262,
+                     'refband_width': shape[1], 'refband_height': shape[0],
+                     'r_masked': [ma.masked_array(img, mask=mask)],
+                     'r_var': [np.full(shape, 1e-4, 'f4')], 'mge': [mge]}
+
+    def fit(self, pyramid, integrmode='median'):
+        levels = []
+        def _pyramid_tasks(*args, **kwargs):
+            tasks, _levels = pyramid_tasks(*args, **kwargs)
+            levels.append(_levels)
+            return tasks, _levels
+        pyramid_tasks = legacyhalos.ellipse._pyramid_tasks
+
+        with mock.patch('legacyhalos.ellipse._integrate_isophot_one', _fit_one), \
+             mock.patch('legacyhalos.ellipse._pyramid_tasks', _pyramid_tasks):
+            ellipsefit = legacyhalos.ellipse.ellipsefit_multiband(
+                'galaxy', '.', self.data, nproc=1, integrmode=integrmode, logsma=False,
+                delta_sma=10.0, pyramid=pyramid, nowrite=True)
+        return ellipsefit, levels[0] if pyramid else None
+
+    def test_pyramid(self):
+        ref, _ = self.fit(False)
+        for integrmode in ('median', 'bilinear'):
+            ellipsefit, levels = self.fit(True, integrmode=integrmode)
+            factor = levels[:, 0]
+            self.assertEqual(set(factor), set([1, 2, 4, 8]))
+
+            # Isophotes are reported at full resolution.
+            self.assertTrue(np.array_equal(ellipsefit['sma_r'], ref['sma_r']))
+            self.assertTrue(np.allclose(ellipsefit['x0_r'], 300.0))
+            self.assertTrue(np.allclose(ellipsefit['y0_r'], 300.0))
+            self.assertTrue(np.allclose(ellipsefit['x0_err_r'], factor))
+            self.assertTrue(np.allclose(ellipsefit['pix_stddev_r'], factor))
+            if integrmode == 'bilinear':
+                self.assertTrue(np.allclose(ellipsefit['intens_err_r'], 1e-3 * np.sqrt(factor)))
+                self.assertTrue(np.allclose(ellipsefit['rms_r'], factor))
+                self.assertTrue(np.array_equal(ellipsefit['ndata_r'], 10 * factor))
+            else:
+                self.assertTrue(np.allclose(ellipsefit['intens_err_r'], 1e-3))
+                self.assertTrue(np.all(ellipsefit['rms_r'] == 1))
+                self.assertTrue(np.all(ellipsefit['ndata_r'] == 10))
+            self.assertTrue(np.allclose(ellipsefit['intens_r'], ref['intens_r'], rtol=0.05))
+
+            # ...and so is the (masked) curve of growth.
+            self.assertTrue(np.allclose(ellipsefit['cog_flux_r'], ref['cog_flux_r'], rtol=0.01))
+            self.assertTrue(np.allclose(ellipsefit['cog_flux_ivar_r'], ref['cog_flux_ivar_r'], rtol=0.01))
+            for key in ref.keys():
+                if key.startswith('flux_'):
+                    self.assertTrue(np.isclose(ellipsefit[key], ref[key], rtol=0.01), key)
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+
+try:
+    from skimage.transform import resize
+except ImportError:
+    resize = None
+
+class TestReprojectMask(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2021)
+        self.masks = []
+        for nn, mm, frac in [(100, 100, 0.01), (175, 140, 0.2), (61, 93, 0.001), (240, 240, 0.05)]:
+            self.masks.append(rng.random((nn, mm)) < frac)
+        # Shapes for (approximately) the GALEX and unWISE pixel scales, integer
+        # ratios, and upsampling.
+        self.shapes = [(17, 17), (10, 10), (20, 25), (50, 50), (33, 71), (300, 200)]
+
+    @unittest.skipIf(resize is None, 'skimage is not installed')
+    def test_resize(self):
+        from legacyhalos.misc import reproject_mask
+        for mask in self.masks:
+            for shape in self.shapes:
+                ref = resize(mask*1.0, shape, mode='reflect') > 0
+                self.assertTrue(np.array_equal(reproject_mask(mask, shape), ref))
+
+    def test_overlap(self):
+        from legacyhalos.misc import reproject_mask
+        for mask in self.masks:
+            for shape in self.shapes:
+                out = reproject_mask(mask, shape, footprint='overlap')
+                fx, fy = mask.shape[0] / shape[0], mask.shape[1] / shape[1]
+                for ii in range(shape[0]):
+                    x0 = int(np.floor(ii*fx))
+                    x1 = max(int(np.ceil((ii+1)*fx)), x0+1)
+                    for jj in range(shape[1]):
+                        y0 = int(np.floor(jj*fy))
+                        y1 = max(int(np.ceil((jj+1)*fy)), y0+1)
+                        self.assertEqual(out[ii, jj], mask[x0:x1, y0:y1].any())
+
+    def test_cache(self):
+        from legacyhalos.misc import reproject_mask, MaskReprojectionCache
+        mask = self.masks[0]
+        cache = MaskReprojectionCache(mask)
+        self.assertIs(cache.reproject((17, 17)), cache.reproject((17, 17)))
+        self.assertTrue(np.array_equal(cache.reproject((17, 17)), reproject_mask(mask, (17, 17))))
+        self.assertIs(cache.reproject(mask.shape), cache.mask)
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
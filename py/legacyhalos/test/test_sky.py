@@ -0,0 +1,149 @@
+import os, tempfile, unittest
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+
+try:
+    import legacyhalos.sky
+except ImportError: # legacyhalos.io needs astrometry.net
+    legacyhalos = None
+
+NSMA = 5
+
+class _CCDs(object):
+    """Stand-in for a fits_table of CCDs."""
+    def __init__(self, filt, ccd_cuts):
+        self.filter = np.array(filt)
+        self.ccd_cuts = np.array(ccd_cuts)
+    def __len__(self):
+        return len(self.filter)
+    def cut(self, keep):
+        self.filter, self.ccd_cuts = self.filter[keep], self.ccd_cuts[keep]
+
+class _CCDIndex(object):
+    """Every fifth position only has z-band CCDs which fail the ccd_cuts."""
+    def ccds_touching(self, survey, ra, dec, width, pixscale=0.262, height=None):
+        allccds = []
+        for ii in range(len(ra)):
+            if ii % 5 == 4:
+                allccds.append(_CCDs(['g', 'r', 'z', 'i'], [0, 0, 1, 0]))
+            else:
+                allccds.append(_CCDs(['g', 'r', 'z', 'z'], [0, 0, 1, 0]))
+        return allccds
+
+def _sky_coadd(ra, dec, outdir='.', size=100, prefix='', survey=None, ncpu=1, ellipsefit=None,
+               band=('g', 'r', 'z'), pixscale=0.262, log=None, force=False, inprocess=False,
+               sampler='isophote'):
+    """Stand-in for the coadd and profile of one sky position: the profile
+    records the position, the number of threads, and the worker process.
+
+    """
+    if os.path.basename(outdir) == 'gal2' and prefix == 'sky-002':
+        return {}
+    intens = np.array([ra, dec, ncpu, os.getpid(), 0.0])
+    return {filt: SimpleNamespace(intens=intens) for filt in band}
+
+def _read_ellipsefit(galaxy, galaxydir, **kwargs):
+    if galaxy == 'gal3':
+        return {}
+    return {'success': True, 'refband': 'r', 'geometry': SimpleNamespace(sma=10.0),
+            'r': SimpleNamespace(sma=np.arange(NSMA, dtype='f4'))}
+
+@unittest.skipIf(legacyhalos is None, 'legacyhalos.sky cannot be imported')
+class TestSkyBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.galaxy = np.array(['gal1', 'gal2', 'gal3'])
+        self.galaxydir = np.array([os.path.join(self.tmpdir.name, gal) for gal in self.galaxy])
+        for galdir in self.galaxydir:
+            os.makedirs(galdir)
+        self.sample = [{'ra': 150.0 + ii, 'dec': 2.0, 'z': 0.2, 'r_lambda': 30.0} for ii in range(3)]
+        self.written = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write_ellipsefit(self, galaxy, galaxydir, sky, **kwargs):
+        self.written.append((galaxy, sky))
+
+    def test_footprint(self):
+        ra, dec = np.arange(10.0), np.zeros(10)
+        infootprint = legacyhalos.sky.sky_footprint(None, ra, dec, 100, ccdindex=_CCDIndex())
+        self.assertEqual(infootprint.tolist(), [ii % 5 != 4 for ii in range(10)])
+        infootprint = legacyhalos.sky.sky_footprint(None, ra, dec, 100, band=('g', 'r'),
+                                                    ccdindex=_CCDIndex())
+        self.assertTrue(np.all(infootprint))
+
+    @mock.patch('legacyhalos.sky.sky_coadd', _sky_coadd)
+    @mock.patch('legacyhalos.io.read_ellipsefit', _read_ellipsefit)
+    def test_batch(self):
+        nsky = 10
+        with mock.patch('legacyhalos.io.write_ellipsefit', self._write_ellipsefit):
+            out = legacyhalos.sky.legacyhalos_sky_batch(self.sample, self.galaxy, self.galaxydir,
+                                                        survey=object(), nproc=8, threads=2,
+                                                        nsky=nsky, seed=3, ccdindex=_CCDIndex())
+
+        # Galaxies without an ellipse fit are skipped.
+        self.assertEqual(len(out), 2 * nsky)
+        self.assertEqual(out['GALAXY'].tolist(), ['gal1'] * nsky + ['gal2'] * nsky)
+        self.assertEqual(out['SKYID'].tolist(), list(range(nsky)) * 2)
+
+        # The positions match the serial code.
+        for igal in range(2):
+            sky = legacyhalos.sky._sky_init(self.sample[igal], _read_ellipsefit('', ''),
+                                            nsky=nsky, seed=3)
+            these = out['GALAXY'] == self.galaxy[igal]
+            self.assertTrue(np.array_equal(out['RA'][these], sky['ra']))
+            self.assertTrue(np.array_equal(out['DEC'][these], sky['dec']))
+            self.assertTrue(np.all(out['SIZE'][these] == sky['size']))
+
+        # Positions outside the footprint are never built; failures are flagged.
+        skyid = out['SKYID'].data
+        self.assertEqual(out['IN_FOOTPRINT'].tolist(), (skyid % 5 != 4).tolist())
+        failed = (out['GALAXY'] == 'gal2') & (skyid == 2)
+        self.assertEqual(out['SUCCESS'].tolist(), ((skyid % 5 != 4) & ~failed).tolist())
+        self.assertTrue(np.all(np.isnan(out['R_INTENS'][~out['SUCCESS']])))
+
+        # Each profile lands in its own row, built with threads cores by 8 // 2 workers.
+        done = out[out['SUCCESS']]
+        self.assertTrue(np.allclose(done['G_INTENS'][:, 0], done['RA'], rtol=1e-6))
+        self.assertTrue(np.allclose(done['G_INTENS'][:, 1], done['DEC'], rtol=1e-6))
+        self.assertTrue(np.all(done['Z_INTENS'][:, 2] == 2))
+        self.assertLessEqual(len(set(done['Z_INTENS'][:, 3])), 4)
+        self.assertTrue(np.all(out['NSMA'] == NSMA))
+
+        # Only the galaxy whose sky coadds all worked is written out.
+        self.assertEqual([gal for gal, _ in self.written], ['gal1'])
+        sky = self.written[0][1]
+        self.assertEqual(sky['g'].shape, (NSMA, nsky))
+        self.assertTrue(np.all(sky['g'][:, 4] == 0))
+        self.assertTrue(np.allclose(sky['g'][0, :4], sky['ra'][:4], rtol=1e-6))
+
+    @mock.patch('legacyhalos.sky.sky_coadd', _sky_coadd)
+    @mock.patch('legacyhalos.io.read_ellipsefit', _read_ellipsefit)
+    def test_wrapper(self):
+        with mock.patch('legacyhalos.io.write_ellipsefit', self._write_ellipsefit):
+            err = legacyhalos.sky.legacyhalos_sky(self.sample[0], survey=object(), galaxy='gal1',
+                                                  galaxydir=self.galaxydir[0], nproc=2, threads=1,
+                                                  nsky=6, batch=True, ccdindex=_CCDIndex())
+        self.assertEqual(err, 1)
+        self.assertTrue(os.path.isfile(os.path.join(self.galaxydir[0], 'gal1-sky-profiles.fits')))
+        self.assertRaises(ValueError, legacyhalos.sky.legacyhalos_sky, self.sample[0])
+
+    def test_call_sky(self):
+        from legacyhalos.mpi import call_sky
+        logfile = os.path.join(self.galaxydir[0], 'gal1-sky.log')
+        for err, suffix in ((1, 'isdone'), (0, 'isfail')):
+            with mock.patch('legacyhalos.sky.legacyhalos_sky', return_value=err) as sky:
+                call_sky(self.sample[0], 'gal1', self.galaxydir[0], None, 1, 2, 0.262,
+                         False, False, logfile, batch=True, threads=1)
+            self.assertEqual(sky.call_args[1]['galaxydir'], self.galaxydir[0])
+            self.assertTrue(sky.call_args[1]['batch'])
+            self.assertTrue(os.path.isfile(os.path.join(self.galaxydir[0], 'gal1-sky.{}'.format(suffix))))
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+import unittest
+import numpy as np
+
+from legacyhalos.misc import EllipseProximityIndex, is_in_ellipse
+
+try:
+    from legacyhalos.SGA import _classify_sga_sources
+except ImportError: # legacyhalos.io needs astrometry.net
+    _classify_sga_sources = None
+
+class _Tractor(object):
+    """Stand-in for a fits_table Tractor catalog."""
+    def __init__(self, **kwargs):
+        for key, val in kwargs.items():
+            setattr(self, key, np.asarray(val))
+    def get(self, key):
+        return getattr(self, key)
+
+def _classify_loop(sga_id, tractor, refband='r', minsize=2.0, minsize_rex=5.0):
+    """The original per-galaxy loop of read_multiband, except that it uses the
+    first Tractor match of a duplicated ref_id (the loop itself fails or keeps
+    every match).
+
+    """
+    msg = []
+    islslga = ['L' in refcat for refcat in tractor.ref_cat]
+    galaxy_indx, reject_galaxy, keep_galaxy = [], [], []
+    flags = {}
+    for ii, sid in enumerate(sga_id):
+        I = np.where((sid == tractor.ref_id) * islslga)[0][:1]
+        if len(I) == 0:
+            reject_galaxy.append(ii)
+            flags.update({str(sid): 'dropped'})
+            msg.append('Dropped by Tractor (spurious?)')
+        else:
+            r50 = tractor.shape_r[I][0]
+            refflux = tractor.get('flux_{}'.format(refband))[I][0]
+            ng = tractor.flux_g[I][0] * np.sqrt(tractor.flux_ivar_g[I][0]) == 0
+            nr = tractor.flux_r[I][0] * np.sqrt(tractor.flux_ivar_r[I][0]) == 0
+            nz = tractor.flux_z[I][0] * np.sqrt(tractor.flux_ivar_z[I][0]) == 0
+            if ng or nr or nz:
+                reject_galaxy.append(ii)
+                flags.update({str(sid): 'nogrz'})
+                msg.append('Missing 3-band coverage')
+            elif tractor.type[I] == 'PSF':
+                reject_galaxy.append(ii)
+                flags.update({str(sid): 'psf'})
+                msg.append('Tractor type=PSF')
+            elif refflux < 0:
+                reject_galaxy.append(ii)
+                flags.update({str(sid): 'negflux'})
+                msg.append('{}-band flux={:.3g} (<=0)'.format(refband, refflux))
+            elif r50 < minsize:
+                reject_galaxy.append(ii)
+                flags.update({str(sid): 'anytype_toosmall'})
+                msg.append('type={}, r50={:.3f} (<{:.1f}) arcsec'.format(tractor.type[I], r50, minsize))
+            elif tractor.type[I] == 'REX':
+                if r50 < minsize_rex:
+                    reject_galaxy.append(ii)
+                    flags.update({str(sid): 'rex_toosmall'})
+                    msg.append('Tractor type=REX & r50={:.3f} (<{:.1f}) arcsec'.format(r50, minsize_rex))
+                else:
+                    keep_galaxy.append(ii)
+                    galaxy_indx.append(I)
+            else:
+                keep_galaxy.append(ii)
+                galaxy_indx.append(I)
+    galaxy_indx = np.hstack(galaxy_indx) if len(galaxy_indx) > 0 else np.zeros(0, int)
+    return galaxy_indx, np.array(keep_galaxy, int), np.array(reject_galaxy, int), flags, msg
+
+def _random_catalog(rng, duplicates=False):
+    nsrc = rng.integers(0, 40)
+    ref_id = rng.choice(1000, nsrc, replace=duplicates)
+    cols = {'ref_id': ref_id, 'ref_cat': rng.choice(['L3', 'L6', 'G2', 'T2', ''], nsrc),
+            'type': rng.choice(['PSF', 'REX', 'EXP', 'DEV', 'SER'], nsrc),
+            'shape_r': rng.uniform(0, 10, nsrc)}
+    for filt in ('g', 'r', 'z'):
+        flux = rng.normal(5, 5, nsrc)
+        flux[rng.random(nsrc) < 0.05] = 0
+        ivar = rng.uniform(0.1, 2, nsrc)
+        ivar[rng.random(nsrc) < 0.05] = 0
+        cols['flux_{}'.format(filt)], cols['flux_ivar_{}'.format(filt)] = flux, ivar
+    tractor = _Tractor(**cols)
+
+    # Mostly galaxies in the catalog, plus a few which were dropped.
+    nsga = rng.integers(1, 10)
+    sga_id = np.hstack((rng.choice(np.hstack((ref_id, [-1])), nsga), rng.choice(1000, 2)))
+    return rng.permutation(sga_id), tractor
+
+@unittest.skipIf(_classify_sga_sources is None, 'legacyhalos.SGA cannot be imported')
+class TestClassifySGASources(unittest.TestCase):
+
+    def check(self, sga_id, tractor):
+        out = _classify_sga_sources(sga_id, tractor)
+        ref = _classify_loop(sga_id, tractor)
+        for new, old in zip(out[:3], ref[:3]):
+            self.assertEqual(np.asarray(new).tolist(), np.asarray(old).tolist())
+        self.assertEqual(out[3], ref[3])
+        self.assertEqual(out[4], ref[4])
+        return out
+
+    def test_random_catalogs(self):
+        rng = np.random.default_rng(37)
+        reasons = set()
+        for _ in range(500):
+            out = self.check(*_random_catalog(rng))
+            reasons |= set(out[3].values())
+        self.assertEqual(reasons, set(['dropped', 'nogrz', 'psf', 'negflux',
+                                       'anytype_toosmall', 'rex_toosmall']))
+
+    def test_duplicate_ref_ids(self):
+        rng = np.random.default_rng(38)
+        for _ in range(200):
+            self.check(*_random_catalog(rng, duplicates=True))
+
+        # The first LSLGA/SGA source with this ref_id sets the fate of the galaxy.
+        tractor = _Tractor(ref_id=[7, 7, 7, 8], ref_cat=['G2', 'L3', 'L3', 'L3'],
+                           type=['EXP', 'PSF', 'EXP', 'EXP'], shape_r=[10.0, 10.0, 10.0, 10.0],
+                           flux_g=[1.0]*4, flux_r=[1.0]*4, flux_z=[1.0]*4,
+                           flux_ivar_g=[1.0]*4, flux_ivar_r=[1.0]*4, flux_ivar_z=[1.0]*4)
+        galaxy_indx, keep, reject, flags, msg = self.check(np.array([8, 7]), tractor)
+        self.assertEqual(galaxy_indx.tolist(), [3])
+        self.assertEqual((keep.tolist(), reject.tolist()), ([0], [1]))
+        self.assertEqual((flags, msg), ({'7': 'psf'}, ['Tractor type=PSF']))
+
+    def test_no_sga_sources(self):
+        tractor = _Tractor(ref_id=[1, 2], ref_cat=['G2', ''], type=['PSF', 'EXP'],
+                           shape_r=[0.0, 3.0], flux_g=[1.0]*2, flux_r=[1.0]*2, flux_z=[1.0]*2,
+                           flux_ivar_g=[1.0]*2, flux_ivar_r=[1.0]*2, flux_ivar_z=[1.0]*2)
+        self.check(np.array([1, 2, 3]), tractor)
+
+class TestEllipseProximityIndex(unittest.TestCase):
+
+    def test_in_ellipse(self):
+        rng = np.random.default_rng(137)
+        for dec0 in (0.0, 45.0, -70.0, 89.97):
+            ra = 150.0 + rng.uniform(-0.1, 0.1, 5000) / np.cos(np.radians(min(abs(dec0), 85)))
+            dec = np.clip(dec0 + rng.uniform(-0.1, 0.1, 5000), -90, 90)
+            index = EllipseProximityIndex(ra, dec)
+            for _ in range(50):
+                ii = rng.integers(len(ra))
+                r = rng.uniform(1, 200) # [arcsec]
+                e1, e2 = rng.uniform(-0.6, 0.6, 2)
+                out = index.in_ellipse(ra[ii], dec[ii], r, e1, e2)
+                ref = np.where(is_in_ellipse(ra, dec, ra[ii], dec[ii], r, e1, e2))[0]
+                self.assertEqual(out.tolist(), ref.tolist())
+                self.assertIn(ii, out)
+            # Length-one array centers (as used in build_ellipse_SGA_one).
+            out = index.in_ellipse(ra[:1], dec[:1], np.array([60.0]), np.array([0.2]), np.array([0.1]))
+            ref = np.where(is_in_ellipse(ra, dec, ra[:1], dec[:1], np.array([60.0]), np.array([0.2]), np.array([0.1])))[0]
+            self.assertEqual(out.tolist(), ref.tolist())
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import os, tempfile, unittest
+
+from legacyhalos.coadds import _stage_file
+
+class TestStageFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.infile = os.path.join(self.tmpdir.name, 'in.fits')
+        self.outfile = os.path.join(self.tmpdir.name, 'out.fits')
+        with open(self.infile, 'wb') as F:
+            F.write(b'x' * 1000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_move(self):
+        self.assertEqual(_stage_file(self.infile, self.outfile, move=True), ('rename', 0))
+        self.assertFalse(os.path.exists(self.infile))
+        self.assertEqual(os.path.getsize(self.outfile), 1000)
+
+    def test_link(self):
+        with open(self.outfile, 'wb') as F: # clobber
+            F.write(b'y')
+        self.assertEqual(_stage_file(self.infile, self.outfile), ('link', 0))
+        self.assertTrue(os.path.samefile(self.infile, self.outfile))
+        self.assertFalse(os.path.exists(self.outfile+'.tmp'))
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
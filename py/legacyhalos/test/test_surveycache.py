@@ -0,0 +1,84 @@
+import sys, tempfile, unittest
+from unittest import mock
+from collections import OrderedDict
+
+from legacyhalos.coadds import SurveyCache
+
+class _Survey(object):
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.output_file_hashes = OrderedDict()
+        self.ccds = ['ccd1', 'ccd2']
+        self.cache_dir = None
+
+class _SurveyCache(SurveyCache):
+    """SurveyCache with a fake survey object and a fake runbrick.py start-up."""
+    nbuilt = 0
+
+    def _new_survey(self, run, output_dir, survey_dir=None):
+        _SurveyCache.nbuilt += 1
+        return _Survey(output_dir)
+
+    def _startup_command(self, run, output_dir, survey_dir=None):
+        return [sys.executable, '-c', 'import time; time.sleep(0.3)']
+
+class TestSurveyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reset(self):
+        cache = _SurveyCache()
+        nbuilt = _SurveyCache.nbuilt
+        survey = cache.get('south', self.tmpdir.name)
+        self.assertEqual(_SurveyCache.nbuilt, nbuilt + 1)
+
+        # Per-brick changes made by runbrick.
+        survey.output_file_hashes['file1'] = 'abc'
+        survey.ccds.append('ccd3')
+        survey.cache_dir = '/tmp/cache'
+        survey.brick = 'brick1'
+
+        survey2 = cache.get('south', '/tmp/galaxy2')
+        self.assertIs(survey2, survey)
+        self.assertEqual(_SurveyCache.nbuilt, nbuilt + 1)
+        self.assertEqual(survey.output_dir, '/tmp/galaxy2')
+        self.assertEqual(len(survey.output_file_hashes), 0)
+        self.assertEqual(survey.ccds, ['ccd1', 'ccd2'])
+        self.assertIsNone(survey.cache_dir)
+        self.assertFalse(hasattr(survey, 'brick'))
+
+    def test_no_benchmark(self):
+        # By default, no runbrick.py start-up is launched.
+        cache = _SurveyCache()
+        with mock.patch('subprocess.call') as call:
+            cache.get('south', self.tmpdir.name)
+            cache.get('south', self.tmpdir.name)
+        self.assertFalse(call.called)
+        self.assertIsNone(cache.subprocess_startup)
+        self.assertLess(cache.startup, 0.1)
+        self.assertEqual(cache.saved(), 0.0)
+
+    def test_saved(self):
+        cache = _SurveyCache(measure=True)
+        self.assertEqual(cache.saved(), 0.0)
+        cache.get('south', self.tmpdir.name)
+        self.assertGreaterEqual(cache.subprocess_startup, 0.3)
+        cache.get('south', self.tmpdir.name)
+        self.assertLess(cache.startup, 0.1)
+        self.assertAlmostEqual(cache.saved(), cache.subprocess_startup - cache.startup)
+        self.assertGreater(cache.saved(), 0.2)
+
+        # The subprocess start-up is only measured once per process.
+        startup = cache.subprocess_startup
+        cache.get('north', self.tmpdir.name)
+        self.assertEqual(cache.subprocess_startup, startup)
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os, tempfile, time, unittest
+import numpy as np
+
+import legacyhalos.telemetry as telemetry
+
+try:
+    from legacyhalos.mpi import run_with_watchdog
+except ImportError: # legacyhalos.io needs astrometry.net
+    run_with_watchdog = None
+
+def _fit(nisophote):
+    with telemetry.timer('fit'):
+        time.sleep(0.1)
+    telemetry.add('nisophote', nisophote)
+    return nisophote
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_nested_stage(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, 'telemetry.jsonl')
+            with telemetry.stage('NGC1234', 'ellipse', outfile=outfile):
+                with telemetry.timer('read'):
+                    telemetry.record(width=100, height=80)
+                with telemetry.stage('NGC1234', 'ellipse', outfile=outfile, nproc=4) as tel:
+                    with telemetry.timer('fit'):
+                        pass
+                    tel.status = 'ok'
+                # A different stage gets its own record.
+                with telemetry.stage('NGC1234', 'htmlplots', outfile=outfile):
+                    pass
+
+            records = telemetry.read_telemetry(outfile)
+            self.assertEqual([rec['stage'] for rec in records], ['htmlplots', 'ellipse'])
+            rec = records[1]
+            self.assertEqual(sorted(rec['timers']), ['fit', 'read'])
+            self.assertEqual((rec['width'], rec['height'], rec['nproc']), (100, 80, 4))
+            self.assertEqual(rec['status'], 'ok')
+
+    def test_peak_rss(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, 'telemetry.jsonl')
+            nbytes = 300 * 1024**2
+            with telemetry.stage('NGC1234', 'coadds', outfile=outfile):
+                big = np.ones(nbytes, np.uint8)
+                del big
+            with telemetry.stage('NGC1234', 'ellipse', outfile=outfile):
+                pass
+            coadds, ellipse = telemetry.read_telemetry(outfile)
+
+        self.assertGreater(coadds['peak_rss'], nbytes)
+        if coadds['peak_rss_scope'] == 'process':
+            self.skipTest('the peak memory cannot be reset on this platform')
+        # The next stage does not inherit the high-water mark.
+        self.assertLess(ellipse['peak_rss'], coadds['peak_rss'] - nbytes // 2)
+
+    @unittest.skipIf(run_with_watchdog is None, 'legacyhalos.mpi cannot be imported')
+    def test_watchdog(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, 'telemetry.jsonl')
+            with telemetry.stage('NGC1234', 'ellipse', outfile=outfile):
+                with telemetry.timer('read'):
+                    time.sleep(0.3)
+                telemetry.add('nisophote', 10)
+                status, result = run_with_watchdog(_fit, {'nisophote': 5}, timeout=60, poll=0.1)
+            rec = telemetry.read_telemetry(outfile)[0]
+
+        self.assertEqual((status, result), ('ok', 5))
+        # The forked worker does not send back what it inherited.
+        self.assertEqual(rec['counters'], {'nisophote': 15})
+        self.assertLess(rec['timers']['read'], 0.5)
+        self.assertGreaterEqual(rec['timers']['fit'], 0.1)
+        self.assertLess(rec['timers']['fit'], 0.3)
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
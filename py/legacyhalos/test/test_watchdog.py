@@ -0,0 +1,120 @@
+import os, sys, time, subprocess, tempfile, unittest
+
+try:
+    from legacyhalos.mpi import run_with_watchdog, call_with_budget, _degrade_kwargs, _done
+except ImportError: # legacyhalos.io needs astrometry.net
+    run_with_watchdog = None
+
+def _sleep(seconds, pidfile=None, nproc=1):
+    """Sleep (in a child process too, if pidfile is given) unless nproc is small
+    enough, and return nproc.
+
+    """
+    if pidfile is not None:
+        child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+        with open(pidfile, 'w') as F:
+            F.write(str(child.pid))
+    if nproc > 2:
+        time.sleep(seconds)
+    return nproc
+
+def _fail():
+    raise ValueError('bad data')
+
+def _crash():
+    os._exit(3)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # A zombie has been killed but not (yet) reaped by init.
+    try:
+        with open('/proc/{}/stat'.format(pid)) as F:
+            return F.read().split(')')[-1].split()[0] != 'Z'
+    except OSError:
+        return True
+
+@unittest.skipIf(run_with_watchdog is None, 'legacyhalos.mpi cannot be imported')
+class TestWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.devnull = open(os.devnull, 'w')
+
+    def tearDown(self):
+        self.devnull.close()
+        self.tmpdir.cleanup()
+
+    def test_status(self):
+        self.assertEqual(run_with_watchdog(_sleep, {'seconds': 0.1, 'nproc': 4}, timeout=30, poll=0.1), ('ok', 4))
+        self.assertEqual(run_with_watchdog(_sleep, {'seconds': 0.1}, timeout=None), ('ok', 1))
+        self.assertEqual(run_with_watchdog(_fail, {}, timeout=30, poll=0.1), ('error', None))
+        self.assertEqual(run_with_watchdog(_crash, {}, timeout=30, poll=0.1), ('error', None))
+
+    def test_timeout(self):
+        # The worker and everything it started are killed.
+        pidfile = os.path.join(self.tmpdir.name, 'child.pid')
+        t0 = time.time()
+        status, result = run_with_watchdog(_sleep, {'seconds': 60, 'pidfile': pidfile, 'nproc': 4},
+                                           timeout=1.0, poll=0.1)
+        self.assertEqual((status, result), ('timeout', None))
+        self.assertLess(time.time() - t0, 15)
+
+        with open(pidfile) as F:
+            child = int(F.read())
+        for _ in range(50):
+            if not _alive(child):
+                break
+            time.sleep(0.1)
+        self.assertFalse(_alive(child))
+
+    def test_degrade_kwargs(self):
+        data = {'bands': ['g', 'r', 'z', 'W1', 'W2']}
+        kwargs = {'nproc': 8, 'delta_logsma': 0.1, 'data': data, 'bands': data['bands']}
+        kw1, changes1 = _degrade_kwargs('ellipse', kwargs, 1)
+        kw2, changes2 = _degrade_kwargs('ellipse', kwargs, 2)
+        self.assertEqual(changes1, 'nproc=4,delta_logsma=0.2')
+        self.assertEqual(changes2, 'nproc=2,delta_logsma=0.4,bands=grz')
+        self.assertEqual(kw1['bands'], data['bands'])
+        self.assertEqual((kw2['bands'], kw2['data']['bands']), (['g', 'r', 'z'], ['g', 'r', 'z']))
+        # The input keywords are not changed.
+        self.assertEqual((kwargs['nproc'], data['bands']), (8, ['g', 'r', 'z', 'W1', 'W2']))
+
+        kw, changes = _degrade_kwargs('coadds', {'nproc': 1, 'delta_logsma': 0.1}, 1)
+        self.assertEqual((kw, changes), ({'nproc': 1, 'delta_logsma': 0.1}, ''))
+
+    def test_call_with_budget(self):
+        # Too slow with 8 or 4 cores, but fast enough on the second retry.
+        kwargs = {'seconds': 60, 'nproc': 8}
+        result, outcome = call_with_budget(_sleep, kwargs, 'coadds', timeout=1.0, retries=2,
+                                           log=self.devnull)
+        self.assertEqual(result, 2)
+        self.assertTrue(outcome.startswith('degraded attempt=2 nproc=2 stage=coadds wall='), outcome)
+
+        t0 = time.time()
+        _done('NGC1', self.tmpdir.name, 1, t0, 'coadds', outcome=outcome, log=self.devnull)
+        with open(os.path.join(self.tmpdir.name, 'NGC1-coadds.isdone')) as F:
+            self.assertTrue(F.read().strip().endswith(outcome))
+
+        # The budget is exhausted.
+        result, outcome = call_with_budget(_sleep, kwargs, 'coadds', timeout=1.0, retries=1,
+                                           log=self.devnull)
+        self.assertIsNone(result)
+        self.assertTrue(outcome.startswith('timeout attempt=1 stage=coadds'), outcome)
+        _done('NGC1', self.tmpdir.name, 0, t0, 'coadds', filesuffix='custom', outcome=outcome,
+              log=self.devnull)
+        with open(os.path.join(self.tmpdir.name, 'NGC1-custom-coadds.isfail')) as F:
+            self.assertIn(outcome, F.read())
+
+        # Errors are not retried.
+        result, outcome = call_with_budget(_fail, {}, 'coadds', timeout=30, retries=2, log=self.devnull)
+        self.assertIsNone(result)
+        self.assertTrue(outcome.startswith('error attempt=0'), outcome)
+
+def main():
+    unittest.main()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,6 +10,7 @@ import numpy as np
 import astropy
 
 import legacyhalos.io
+import legacyhalos.telemetry
 
 #ZCOLUMN = 'Z'
 #RACOLUMN = 'RA'
@@ -83,108 +84,26 @@ def get_galaxy_galaxydir(cat, datadir=None, htmldir=None, html=False):
     else:
         return galaxy, galaxydir
 
-def missing_files(args, sample, size=1, clobber_overwrite=None):
-    from astrometry.util.multiproc import multiproc
-    from legacyhalos.io import _missing_files_one
-
-    dependson = None
-    galaxy, galaxydir = get_galaxy_galaxydir(sample)        
-    if args.coadds:
-        suffix = 'coadds'
-        filesuffix = '-custom-coadds.isdone'
-    elif args.pipeline_coadds:
-        suffix = 'pipeline-coadds'
-        if args.just_coadds:
-            filesuffix = '-pipeline-image-grz.jpg'
-        else:
-            filesuffix = '-pipeline-coadds.isdone'
-    elif args.ellipse:
-        suffix = 'ellipse'
-        filesuffix = '-custom-ellipse.isdone'
-        dependson = '-custom-coadds.isdone'
-    elif args.build_catalog:
-        suffix = 'build-catalog'
-        filesuffix = '-custom-ellipse.isdone'
-    elif args.htmlplots:
-        suffix = 'html'
-        if args.just_coadds:
-            filesuffix = '-custom-montage-grz.png'
-        else:
-            filesuffix = '-ccdpos.png'
-            #filesuffix = '-custom-maskbits.png'
-        galaxy, _, galaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
-    elif args.htmlindex:
-        suffix = 'htmlindex'
-        filesuffix = '-custom-montage-grz.png'
-        galaxy, _, galaxydir = get_galaxy_galaxydir(sample, htmldir=args.htmldir, html=True)
-    else:
-        raise ValueError('Need at least one keyword argument.')
-
-    # Make clobber=False for build_catalog and htmlindex because we're not
-    # making the files here, we're just looking for them. The argument
-    # args.clobber gets used downstream.
-    if args.htmlindex or args.build_catalog:
-        clobber = False
-    else:
-        clobber = args.clobber
-
-    if clobber_overwrite is not None:
-        clobber = clobber_overwrite
-
-    if type(sample) is astropy.table.row.Row:
-        ngal = 1
-    else:
-        ngal = len(sample)
-    indices = np.arange(ngal)
-
-    mp = multiproc(nthreads=args.nproc)
-    missargs = []
-    for gal, gdir in zip(np.atleast_1d(galaxy), np.atleast_1d(galaxydir)):
-        #missargs.append([gal, gdir, filesuffix, dependson, clobber])
-        checkfile = os.path.join(gdir, '{}{}'.format(gal, filesuffix))
-        if dependson:
-            missargs.append([checkfile, os.path.join(gdir, '{}{}'.format(gal, dependson)), clobber])
-        else:
-            missargs.append([checkfile, None, clobber])
-        
-    todo = np.array(mp.map(_missing_files_one, missargs))
+# Filename templates of the files which mark each stage as complete (and of the
+# files each stage depends on); see legacyhalos.mpi.missing_files_plan.
+STAGE_TEMPLATES = [
+    ('coadds', {'suffix': 'coadds', 'filesuffix': '{galaxy}-custom-coadds.isdone'}),
+    ('pipeline_coadds', {'suffix': 'pipeline-coadds', 'filesuffix': '{galaxy}-pipeline-coadds.isdone',
+                         'just_coadds': {'filesuffix': '{galaxy}-pipeline-image-grz.jpg'}}),
+    ('ellipse', {'suffix': 'ellipse', 'filesuffix': '{galaxy}-custom-ellipse.isdone',
+                 'dependson': '{galaxy}-custom-coadds.isdone'}),
+    ('build_catalog', {'suffix': 'build-catalog', 'filesuffix': '{galaxy}-custom-ellipse.isdone',
+                       'clobber': False}),
+    ('htmlplots', {'suffix': 'html', 'filesuffix': '{galaxy}-ccdpos.png', 'html': True,
+                   'just_coadds': {'filesuffix': '{galaxy}-custom-montage-grz.png'}}),
+    ('htmlindex', {'suffix': 'htmlindex', 'filesuffix': '{galaxy}-custom-montage-grz.png', 'html': True,
+                   'clobber': False}),
+    ]
 
-    itodo = np.where(todo == 'todo')[0]
-    idone = np.where(todo == 'done')[0]
-    ifail = np.where(todo == 'fail')[0]
-
-    if len(ifail) > 0:
-        fail_indices = [indices[ifail]]
-    else:
-        fail_indices = [np.array([])]
-
-    if len(idone) > 0:
-        done_indices = [indices[idone]]
-    else:
-        done_indices = [np.array([])]
-
-    if len(itodo) > 0:
-        _todo_indices = indices[itodo]
-        #todo_indices = np.array_split(_todo_indices, size) # unweighted
-
-        # Assign the sample to ranks to make the D25 distribution per rank ~flat.
-        
-        # https://stackoverflow.com/questions/33555496/split-array-into-equally-weighted-chunks-based-on-order
-        weight = np.atleast_1d(sample[DIAMCOLUMN])[_todo_indices]
-        cumuweight = weight.cumsum() / weight.sum()
-        idx = np.searchsorted(cumuweight, np.linspace(0, 1, size, endpoint=False)[1:])
-        if len(idx) < size: # can happen in corner cases or with 1 rank
-            #todo_indices = np.array_split(_todo_indices, size) # unweighted
-            todo_indices = np.array_split(_todo_indices[np.argsort(weight)], size) # unweighted but sorted
-        else:
-            todo_indices = np.array_split(_todo_indices, idx) # weighted
-        for ii in range(size): # sort by weight
-            srt = np.argsort(sample[DIAMCOLUMN][todo_indices[ii]])
-            todo_indices[ii] = todo_indices[ii][srt]            
-    else:
-        todo_indices = [np.array([])]
-
-    return suffix, todo_indices, done_indices, fail_indices
+def missing_files(args, sample, size=1, clobber_overwrite=None):
+    from legacyhalos.mpi import missing_files_plan
+    return missing_files_plan(args, sample, STAGE_TEMPLATES, get_galaxy_galaxydir, size=size,
+                              clobber_overwrite=clobber_overwrite, weightcolumn=DIAMCOLUMN)
     
 def mpi_args():
     import argparse
@@ -220,6 +139,11 @@ def mpi_args():
     parser.add_argument('--no-galex', action='store_false', dest='galex', help='Do not build GALEX coadds or do forced GALEX photometry.')
     parser.add_argument('--no-cleanup', action='store_false', dest='cleanup', help='Do not clean up legacypipe files after coadds.')
 
+    parser.add_argument('--timeout', default=None, type=float, help='Wall-clock budget per galaxy (minutes) for --coadds and --ellipse.')
+    parser.add_argument('--retries', default=1, type=int, help='Number of degraded-mode retries after a galaxy exceeds --timeout.')
+    parser.add_argument('--reuse-coadds', default=None, type=str, metavar='REGISTRY_DIR', help='Directory of the registry of built mosaics; cut out mosaics which are contained in an existing one (with the same settings) instead of rerunning runbrick with --coadds and --pipeline-coadds.')
+    parser.add_argument('--compression', default='runbrick', type=str, metavar='PROFILE', help='Output compression profile of the image, model, and invvar mosaics built with --coadds and --pipeline-coadds: runbrick, lossless, rice[:QLEVEL], or float32 (see legacyhalos.compression).')
+
     parser.add_argument('--force', action='store_true', help='Use with --coadds; ignore previous pickle files.')
     parser.add_argument('--count', action='store_true', help='Count how many objects are left to analyze and then return.')
     parser.add_argument('--debug', action='store_true', help='Log to STDOUT and build debugging plots.')
@@ -327,9 +251,9 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
     """
     import numpy.ma as ma
     from copy import copy
-    from skimage.transform import resize
     from legacyhalos.mge import find_galaxy
-    from legacyhalos.misc import srcs2image, ellipse_mask
+    from legacyhalos.misc import srcs2image, ellipse_mask_bbox
+    from legacyhalos.misc import reproject_mask, MaskReprojectionCache
 
     import matplotlib.pyplot as plt
     from astropy.visualization import simple_norm
@@ -341,7 +265,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
     #box = np.arange(nbox)-nbox // 2
     #box = np.meshgrid(np.arange(nbox), np.arange(nbox))[0]-nbox//2
 
-    xobj, yobj = np.ogrid[0:data['refband_height'], 0:data['refband_width']]
+    shape = (data['refband_height'], data['refband_width'])
 
     # If the row-index of the central galaxy is not provided, use the source
     # nearest to the center of the field.
@@ -396,15 +320,15 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         mgegalaxy.theta = (270 - pa) % 180
         mgegalaxy.majoraxis = majoraxis
 
-        objmask = ellipse_mask(mgegalaxy.xmed, mgegalaxy.ymed, # object pixels are True
-                               mgegalaxy.majoraxis,
-                               mgegalaxy.majoraxis * (1-mgegalaxy.eps), 
-                               np.radians(mgegalaxy.theta-90), xobj, yobj)
+        objmask = ellipse_mask_bbox(mgegalaxy.xmed, mgegalaxy.ymed, # object pixels are True
+                                    mgegalaxy.majoraxis,
+                                    mgegalaxy.majoraxis * (1-mgegalaxy.eps), 
+                                    np.radians(mgegalaxy.theta-90), shape)
 
         return mgegalaxy, objmask
 
     # Now, loop through each 'galaxy_indx' from bright to faint.
-    data['mge'] = []
+    data['mge'], filt2var = [], {}
     for ii, central in enumerate(galaxy_indx):
         print('Determing the geometry for galaxy {}/{}.'.format(
                 ii+1, len(galaxy_indx)))
@@ -417,8 +341,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         mge, centralmask = tractor2mge(central, factor=neighborfactor)
         #plt.clf() ; plt.imshow(centralmask, origin='lower') ; plt.savefig('junk-mask.png') ; pdb.set_trace()
 
-        iclose = np.where([centralmask[np.int(by), np.int(bx)]
-                           for by, bx in zip(tractor.by, tractor.bx)])[0]
+        iclose = np.where(centralmask[tractor.by.astype(int), tractor.bx.astype(int)])[0]
         
         srcs = tractor.copy()
         srcs.cut(np.delete(np.arange(len(tractor)), iclose))
@@ -429,7 +352,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         img = data[refband].data - model
         img[centralmask] = data[refband].data[centralmask]
 
-        mask = np.logical_or(ma.getmask(data[refband]), data['residual_mask'])
+        mask = legacyhalos.io.band_mask(data, refband, residual=True)
         #mask = np.logical_or(data[refband].mask, data['residual_mask'])
         mask[centralmask] = False
 
@@ -513,7 +436,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
                 #    #plt.clf() ; plt.imshow(data[filt], origin='lower') ; plt.savefig('junk-{}.png'.format(filt.lower()))
                 #    pdb.set_trace()
                 if satmask.shape != satimg.shape:
-                    thissatmask = resize(thissatmask*1.0, satmask.shape, mode='reflect') > 0
+                    thissatmask = reproject_mask(thissatmask, satmask.shape)
 
                 satmask = np.logical_or(satmask, thissatmask)
                 #if True:
@@ -527,15 +450,18 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
 
         #plt.clf() ; plt.imshow(satmask, origin='lower') ; plt.savefig('junk-satmask.png')
         
+        # Reproject the satellite and central masks only once per pixel scale.
+        satmasks, centralmasks = MaskReprojectionCache(satmask), MaskReprojectionCache(centralmask)
+
         # [3] Build the final image (in each filter) for ellipse-fitting. First,
         # subtract out the PSF sources. Then update the mask (but ignore the
         # residual mask). Finally convert to surface brightness.
         #for filt in ['W1']:
         for filt in bands:
-            thismask = ma.getmask(data[filt])
+            thismask = legacyhalos.io.band_mask(data, filt)
             if satmask.shape != thismask.shape:
-                _satmask = (resize(satmask*1.0, thismask.shape, mode='reflect') > 0) == 1.0
-                _centralmask = (resize(centralmask*1.0, thismask.shape, mode='reflect') > 0) == 1.0
+                _satmask = satmasks.reproject(thismask.shape)
+                _centralmask = centralmasks.reproject(thismask.shape)
                 mask = np.logical_or(thismask, _satmask)
                 mask[_centralmask] = False
             else:
@@ -584,7 +510,10 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             data[psfimgkey].append(psfimg)
             
             img = ma.masked_array((img / thispixscale**2).astype('f4'), mask) # [nanomaggies/arcsec**2]
-            var = data['{}_var_'.format(filt.lower())] / thispixscale**4 # [nanomaggies**2/arcsec**4]
+            # The variance image is the same for every central, so share it.
+            if filt not in filt2var:
+                filt2var[filt] = data['{}_var_'.format(filt.lower())] / thispixscale**4 # [nanomaggies**2/arcsec**4]
+            var = filt2var[filt]
 
             # Fill with zeros, for fun--
             ma.set_fill_value(img, fill_value)
@@ -793,9 +722,11 @@ def read_multiband(galaxy, galaxydir, filesuffix='custom',
     data['galaxy_indx'] = galaxy_indx
 
     # Now build the multiband mask.
-    data = _build_multiband_mask(data, tractor, filt2pixscale,
-                                 fill_value=fill_value,
-                                 verbose=verbose)
+    with legacyhalos.telemetry.timer('mask'):
+        data = _build_multiband_mask(data, tractor, filt2pixscale,
+                                     fill_value=fill_value,
+                                     verbose=verbose)
+    legacyhalos.telemetry.record(ncentral=len(data['galaxy_indx']), nsource=len(tractor))
 
     #import matplotlib.pyplot as plt
     #plt.clf() ; plt.imshow(np.log10(data['g_masked'][0]), origin='lower') ; plt.savefig('junk1.png')
@@ -821,7 +752,7 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                  filesuffix='custom', bands=['g', 'r', 'z'], refband='r',
                  galex_pixscale=1.5, unwise_pixscale=2.75,
                  sky_tests=False, unwise=False, galex=False, verbose=False,
-                 clobber=False, debug=False, logfile=None):
+                 clobber=False, debug=False, logfile=None, timeout=None, retries=1):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the legacyhalos project.
 
@@ -871,7 +802,8 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                      bands=bands, refband=refband, sbthresh=SBTHRESH,
                      apertures=APERTURES,
                      logsma=True, delta_logsma=delta_logsma, maxsma=maxsma,
-                     verbose=verbose, clobber=clobber, debug=True)#debug, logfile=logfile)
+                     verbose=verbose, clobber=clobber, timeout=timeout, retries=retries,
+                     debug=True)#debug, logfile=logfile)
 
 def _datarelease_table(ellipse):
     """Convert the ellipse table into a data release catalog."""